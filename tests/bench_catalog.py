@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+"""
+Compares listing deployment templates by reading every meta.json (the old way)
+against the template catalog, for a directory of many templates.
+
+Run with ``python -m tests.bench_catalog`` from the root of the repo.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from unittest.mock import patch
+
+from vlab_deployment_api.lib import template_meta_data
+from vlab_deployment_api.lib.worker.catalog import TemplateCatalog
+from .test_catalog import make_template
+
+
+def list_by_reading(location):
+    """What ``list_images(verbose=True)`` did before the catalog"""
+    templates = [x for x in os.listdir(location) if not x.startswith('.')]
+    return [{x: template_meta_data.get_meta(x)} for x in templates]
+
+
+def timed(func, repeat):
+    """The average seconds a call of ``func`` takes"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--templates', type=int, default=10000, help='How many templates to make')
+    parser.add_argument('--repeat', type=int, default=5, help='How many listings to average over')
+    parser.add_argument('--location', default=None, help='Where to make templates (i.e. an NFS mount). Default is a temp dir')
+    args = parser.parse_args()
+
+    location = tempfile.mkdtemp(dir=args.location)
+    try:
+        for idx in range(args.templates):
+            make_template(location, 'template{}'.format(idx), owner='user{}'.format(idx % 100))
+        new_const = template_meta_data.const._replace(VLAB_DEPLOYMENT_TEMPLATE_DIR=location)
+        with patch.object(template_meta_data, 'const', new_const):
+            the_catalog = TemplateCatalog(ttl=30)
+            results = [('read every meta.json', timed(lambda: list_by_reading(location), args.repeat))]
+            io_stats = dict(template_meta_data.IO_STATS)
+            results += [
+                       ('catalog, cold', timed(lambda: the_catalog.templates(location), 1)),
+                       ('catalog, warm', timed(lambda: the_catalog.templates(location), args.repeat))]
+            make_template(location, 'oneMore')
+            results.append(('catalog, 1 new template', timed(lambda: the_catalog.templates(location), 1)))
+            the_catalog.ttl = 0
+            results.append(('catalog, TTL sweep', timed(lambda: the_catalog.templates(location), args.repeat)))
+    finally:
+        shutil.rmtree(location)
+
+    print('{} templates'.format(args.templates))
+    print('{:<28} {:>12}'.format('listing', 'ms/listing'))
+    for name, seconds in results:
+        print('{:<28} {:>12.2f}'.format(name, seconds * 1000))
+    print('get_meta while reading every meta.json: {stat} stat, {listdir} listdir, {hits} OVA lookups cached'.format(**io_stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures how fast OVAs are split into chunks, comparing hashing every sector in
+a Python loop (the CRC32 of each sector, like ``chunk_boundaries`` used to) with
+hashing every sector of a buffer at once, and how many chunks two versions of
+a disk share when some bytes were inserted part way through it.
+
+Run with ``python -m tests.bench_chunk_store`` from the root of the repo.
+"""
+import io
+import os
+import time
+import zlib
+import argparse
+
+from vlab_deployment_api.lib.worker import chunk_store
+
+# What the per sector loop used; a chunk ends where (crc32 & mask) == mask
+BOUNDARY_MASK = 0x7FF
+
+
+def per_sector(the_file):
+    """What ``chunk_boundaries`` did before; one CRC32 call per sector"""
+    pending = bytearray()
+    buf = the_file.read(chunk_store.READ_SIZE)
+    while buf:
+        view = memoryview(buf)
+        start = 0
+        for offset in range(0, len(buf), chunk_store.SECTOR_SIZE):
+            end = min(offset + chunk_store.SECTOR_SIZE, len(buf))
+            size = len(pending) + end - start
+            if size < chunk_store.MIN_CHUNK:
+                continue
+            if size >= chunk_store.MAX_CHUNK or zlib.crc32(view[offset:end]) & BOUNDARY_MASK == BOUNDARY_MASK:
+                pending += view[start:end]
+                yield bytes(pending)
+                pending = bytearray()
+                start = end
+        pending += view[start:]
+        buf = the_file.read(chunk_store.READ_SIZE)
+    if pending:
+        yield bytes(pending)
+
+
+def make_disk(size):
+    """Incompressible data, with a zero filled stretch like a sparse disk has"""
+    data = bytearray(os.urandom(size))
+    data[size // 4:size // 2] = bytes(size // 4)
+    return bytes(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=64, help='MB in the disk')
+    parser.add_argument('--insert', type=int, default=8, help='Sectors inserted part way through the second version')
+    args = parser.parse_args()
+
+    disk = make_disk(args.size * 1024 * 1024)
+    middle = len(disk) * 3 // 4
+    edited = disk[:middle] + bytes(args.insert * chunk_store.SECTOR_SIZE) + disk[middle:]
+    print('{}MB disk; the second version has {} sectors inserted at {}MB'.format(args.size, args.insert, middle >> 20))
+    print('{:<12} {:>8} {:>8} {:>14}'.format('approach', 'MB/s', 'chunks', 'shared chunks'))
+    for name, func in [('per sector', per_sector), ('per buffer', chunk_store.chunk_boundaries)]:
+        start = time.perf_counter()
+        first = list(func(io.BytesIO(disk)))
+        elapsed = time.perf_counter() - start
+        second = set(func(io.BytesIO(edited)))
+        shared = sum(1 for x in first if x in second)
+        print('{:<12} {:>8.1f} {:>8} {:>14}'.format(name, args.size / elapsed, len(first), shared))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: UTF-8 -*-
+"""
+Compares making port maps one request (and connection) at a time, like
+``create_port_maps`` used to, with the pooled, concurrent ``GatewayClient``.
+
+The stand-in gateway charges ``--handshake`` seconds for every new connection,
+like a TLS handshake to a user's gateway would, and ``--latency`` for every request.
+
+Run with ``python -m tests.bench_gateway`` from the root of the repo.
+"""
+import time
+import argparse
+
+import requests
+
+from .fake_gateway import FakeGateway, PORTMAP_PATH
+
+HEADERS = {'X-Auth': 'aaa.bbb.ccc', 'X-Forwarded-For': '1.2.3.4'}
+
+
+def payloads(machines, ports):
+    """The port maps of a template"""
+    return [{'target_addr': '10.0.0.{}'.format(x), 'target_port': y, 'target_name': 'vm{:02}-dply'.format(x),
+             'target_component': 'bench'} for x in range(machines) for y in range(ports)]
+
+
+def serial(gateway, rules):
+    """One ``requests.post`` after another, each on a new connection"""
+    url = gateway.url_format.format(username='bench') + PORTMAP_PATH
+    for payload in rules:
+        resp = requests.post(url, json=payload, headers=HEADERS, verify=False)
+        resp.raise_for_status()
+
+
+def pooled(gateway, rules, concurrency):
+    """Every rule at once, over pooled connections"""
+    client = gateway.client(concurrency=concurrency)
+    try:
+        with client.batch('bench', HEADERS) as batch:
+            for payload in rules:
+                batch.submit('post', PORTMAP_PATH, json=payload)
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--machines', type=int, default=6, help='How many VMs the template has')
+    parser.add_argument('--ports', type=int, default=4, help='How many control ports every VM has')
+    parser.add_argument('--handshake', type=float, default=0.05, help='Seconds every new connection costs')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds every request costs')
+    parser.add_argument('--concurrency', default='1,4,8,16', help='Comma separated batch sizes to try')
+    args = parser.parse_args()
+
+    rules = payloads(args.machines, args.ports)
+    print('{} port maps; {}s per handshake, {}s per request'.format(len(rules), args.handshake, args.latency))
+    print('{:<14} {:>10} {:>12} {:>10}'.format('approach', 'seconds', 'connections', 'in flight'))
+    trials = [('serial', lambda x: serial(x, rules))]
+    trials += [('pooled x{}'.format(y), lambda x, y=int(y): pooled(x, rules, y)) for y in args.concurrency.split(',')]
+    for name, func in trials:
+        with FakeGateway(latency=args.latency, handshake=args.handshake) as gateway:
+            start = time.perf_counter()
+            func(gateway)
+            elapsed = time.perf_counter() - start
+            stats = gateway.stats
+        print('{:<14} {:>10.3f} {:>12} {:>10}'.format(name, elapsed, stats['connections'], stats['max_in_flight']))
+
+
+if __name__ == '__main__':
+    main()
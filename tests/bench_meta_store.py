@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+"""
+Compares the meta.json and SQLite backends for template meta data, at several
+catalog sizes: writing every template, reading one by name, finding the
+templates of one owner, finding templates by kind of machine, and updating one.
+
+Run with ``python -m tests.bench_meta_store`` from the root of the repo.
+"""
+import os
+import time
+import shutil
+import random
+import argparse
+import tempfile
+
+from vlab_deployment_api.lib import meta_store
+
+KINDS = ['CentOS', 'OneFS', 'InsightIQ', 'Windows', 'Ubuntu']
+
+
+def make_meta(idx):
+    """The meta data of one template, owned by one of 100 users"""
+    return {'owner': 'user{}'.format(idx % 100), 'email': '', 'summary': 'template {}'.format(idx),
+            'machines': {'vm01': {'ip': '1.2.3.4', 'kind': KINDS[idx % len(KINDS)], 'ports': [22]}}}
+
+
+def timed(func, repeat):
+    """The average seconds a call of ``func`` takes"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def populate(store, location, size):
+    """Write ``size`` templates into a backend"""
+    with store.transaction():
+        for idx in range(size):
+            template = 'template{}'.format(idx)
+            os.makedirs(os.path.join(location, template), exist_ok=True)
+            store.write(template, make_meta(idx))
+
+
+def update(store, template):
+    """What ``update_meta`` does"""
+    with store.transaction():
+        meta = store.read(template)
+        meta['summary'] = 'updated'
+        store.write(template, meta)
+
+
+def bench(kind, size, repeat, parent):
+    """Time every operation against one backend
+
+    :Returns: Dictionary - operation -> seconds per call
+    """
+    location = tempfile.mkdtemp(dir=parent)
+    try:
+        if kind == 'json':
+            store = meta_store.JsonStore(location)
+        else:
+            store = meta_store.SqliteStore(os.path.join(location, '.meta.sqlite'))
+        results = {'write all': timed(lambda: populate(store, location, size), 1)}
+        names = ['template{}'.format(random.randrange(size)) for _ in range(repeat)]
+        start = time.perf_counter()
+        for name in names:
+            store.read(name)
+        results['read one'] = (time.perf_counter() - start) / repeat
+        results['find owner'] = timed(lambda: store.find(owner='user7'), max(1, repeat // 100))
+        results['find kind'] = timed(lambda: store.find(kind='OneFS'), max(1, repeat // 100))
+        results['update one'] = timed(lambda: update(store, names[0]), repeat)
+        if kind == 'sqlite':
+            store.close()
+    finally:
+        shutil.rmtree(location)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help='Comma separated number of templates to try')
+    parser.add_argument('--repeat', type=int, default=200, help='How many reads/updates to average over')
+    parser.add_argument('--location', default=None, help='Where to make templates (i.e. an NFS mount). Default is a temp dir')
+    args = parser.parse_args()
+
+    operations = ['write all', 'read one', 'find owner', 'find kind', 'update one']
+    print('{:<10} {:<8} '.format('templates', 'backend') + ' '.join('{:>14}'.format(x + ' (ms)') for x in operations))
+    for size in [int(x) for x in args.sizes.split(',')]:
+        for kind in ('json', 'sqlite'):
+            results = bench(kind, size, args.repeat, args.location)
+            print('{:<10} {:<8} '.format(size, kind) + ' '.join('{:>14.3f}'.format(results[x] * 1000) for x in operations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures throughput and tail latency of the worker operations, at several
+levels of concurrency, using the in-process fake vCenter.
+
+Every concurrent client is a different user, because a user can only have one
+deployment. Each round, every client makes a template from its VM, lists the
+templates, deploys its template, shows the deployment, and deletes it.
+
+Run with ``python -m tests.bench_operations`` from the root of the repo.
+"""
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from unittest.mock import MagicMock
+
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import catalog
+from vlab_deployment_api.lib.worker import templates
+from .fake_vcenter import FakeVSphere, patched, templates_in
+
+
+def percentile(samples, pct):
+    """The value that ``pct`` percent of samples are at, or below"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def client(username, rounds, barrier, latencies, errors):
+    """Run every operation ``rounds`` times, as one user"""
+    logger = MagicMock()
+    template = '{}Template'.format(username)
+    portmaps = [{'name': 'vm01', 'target_addr': '192.168.1.2', 'target_ports': [22]}]
+    operations = [('templates.create', lambda: templates.create(username, template, ['vm01'], portmaps, 'bench', logger)),
+                  ('list_images', lambda: catalog.list_images()),
+                  ('create_deployment', lambda: vmware.create_deployment(username, template, logger)),
+                  ('show_deployment', lambda: vmware.show_deployment(username)),
+                  ('delete_deployment', lambda: vmware.delete_deployment(username, template, logger)),
+                  ('templates.delete', lambda: templates.delete(username, template, logger))]
+    barrier.wait()
+    for _ in range(rounds):
+        for name, operation in operations:
+            start = time.perf_counter()
+            try:
+                operation()
+            except Exception:
+                errors[name] += 1
+            latencies[name].append(time.perf_counter() - start)
+
+
+def run(concurrency, rounds, server_args):
+    """Run the clients at the same time
+
+    :Returns: Tuple - (latencies per operation, errors per operation, wall clock seconds)
+    """
+    server = FakeVSphere(**server_args)
+    usernames = ['user{}'.format(x) for x in range(concurrency)]
+    for username in usernames:
+        server.add_user(username)
+        server.add_vm(username, 'vm01', meta={'component': 'CentOS'}, ips=['192.168.1.2'])
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    barrier = threading.Barrier(concurrency + 1)
+    template_dir = tempfile.mkdtemp()
+    try:
+        with patched(server, pool_size=concurrency * 2), templates_in(template_dir):
+            threads = [threading.Thread(target=client, args=(x, rounds, barrier, latencies, errors)) for x in usernames]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(template_dir)
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,4,16', help='Comma separated number of concurrent users to try')
+    parser.add_argument('--rounds', type=int, default=5, help='How many times each user runs every operation')
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds per round trip to vCenter')
+    parser.add_argument('--bandwidth', type=int, default=64 * 1024 * 1024, help='Bytes per second, per upload/download')
+    parser.add_argument('--disk-bytes', type=int, default=4 * 1024 * 1024, help='Size of every VMDK')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Chance (0.0 - 1.0) a task/upload/download fails')
+    parser.add_argument('--seed', type=int, default=0, help='Makes injected failures repeatable')
+    args = parser.parse_args()
+
+    server_args = {'latency': args.latency,
+                   'bandwidth': args.bandwidth,
+                   'disk_bytes': args.disk_bytes,
+                   'failure_rate': args.failure_rate,
+                   'seed': args.seed}
+    print('{:<6} {:<20} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('users', 'operation', 'ops/s',
+                                                                    'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+                                                                    'max (ms)', 'errors'))
+    for concurrency in [int(x) for x in args.concurrency.split(',')]:
+        latencies, errors, elapsed = run(concurrency, args.rounds, server_args)
+        for name, samples in latencies.items():
+            print('{:<6} {:<20} {:>8.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}'.format(
+                  concurrency, name, len(samples) / elapsed,
+                  percentile(samples, 50) * 1000, percentile(samples, 95) * 1000,
+                  percentile(samples, 99) * 1000, max(samples) * 1000, errors[name]))
+
+
+if __name__ == '__main__':
+    main()
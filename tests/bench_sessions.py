@@ -0,0 +1,42 @@
+# -*- coding: UTF-8 -*-
+"""
+Counts vCenter logins per operation, using the in-process fake vCenter.
+
+Run with ``python -m tests.bench_sessions`` from the root of the repo.
+"""
+import argparse
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib.worker import vmware
+from .fake_vcenter import FakeVSphere, patched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--machines', type=int, default=5, help='VMs in the deployment template')
+    parser.add_argument('--rounds', type=int, default=10, help='How many create/show/delete cycles to run')
+    args = parser.parse_args()
+
+    meta = {'machines': {'vm{}'.format(x): {'ova_path': '/foo.ova', 'kind': 'CentOS'} for x in range(args.machines)}}
+    server = FakeVSphere()
+    server.add_user('bench')
+    logger = MagicMock()
+    operations = [('create_deployment', lambda: vmware.create_deployment('bench', 'bench', logger)),
+                  ('show_deployment', lambda: vmware.show_deployment('bench')),
+                  ('delete_deployment', lambda: vmware.delete_deployment('bench', 'bench', logger))]
+    totals = {name: [0, 0] for name, _ in operations}
+    with patch.object(vmware, 'get_meta', return_value=meta), patched(server) as pool:
+        for _ in range(args.rounds):
+            for name, operation in operations:
+                logins, borrows = pool.stats['logins'], pool.stats['borrows']
+                operation()
+                totals[name][0] += pool.stats['logins'] - logins
+                totals[name][1] += pool.stats['borrows'] - borrows
+
+    print('{:<20} {:>16} {:>24}'.format('operation', 'logins/op', 'logins/op without pool'))
+    for name, (logins, borrows) in totals.items():
+        print('{:<20} {:>16.2f} {:>24.2f}'.format(name, logins / args.rounds, borrows / args.rounds))
+
+
+if __name__ == '__main__':
+    main()
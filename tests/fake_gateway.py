@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-process stand-in for the gateways of users' labs, used by the benchmarks
+and a few tests.
+
+It's a real (threaded, keep-alive) HTTP server on 127.0.0.1 that implements the
+port map API. The gateway of every user lives under ``/<username>``, so a single
+server plays every gateway. New connections can cost ``handshake`` seconds (like
+a TLS handshake does), and every request ``latency`` seconds.
+"""
+import time
+import itertools
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import ujson
+
+from vlab_deployment_api.lib.gateway import GatewayClient
+
+PORTMAP_PATH = '/api/1/ipam/portmap'
+
+
+class FakeGateway(object):
+    """The port map API of every user's gateway
+
+    :param latency: How long (in seconds) every request takes.
+    :type latency: Float
+
+    :param handshake: How long (in seconds) every new connection takes to set up.
+    :type handshake: Float
+    """
+    def __init__(self, latency=0, handshake=0):
+        self.latency = latency
+        self.handshake = handshake
+        self.portmaps = {}
+        self.stats = {'connections': 0, 'requests': 0, 'in_flight': 0, 'max_in_flight': 0}
+        self._failures = 0
+        self._ports = itertools.count(50000)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        """Start serving, in a background thread"""
+        gateway = self
+
+        class Handler(GatewayHandler):
+            pass
+        Handler.gateway = gateway
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop serving"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        self.stop()
+
+    @property
+    def url_format(self):
+        """What ``GatewayClient`` needs to find every user's gateway on this server"""
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1]) + '/{username}'
+
+    def client(self, concurrency=8, timeout=5):
+        """Make a ``GatewayClient`` that talks to this server"""
+        return GatewayClient(fqdn='', concurrency=concurrency, timeout=timeout, url_format=self.url_format)
+
+    def fail(self, times=1):
+        """Make the next request(s) fail with a 500"""
+        with self._lock:
+            self._failures += times
+
+    def should_fail(self):
+        with self._lock:
+            if self._failures:
+                self._failures -= 1
+                return True
+            return False
+
+    def add(self, username, rule):
+        """Make a port map, returning its connection port"""
+        with self._lock:
+            conn_port = next(self._ports)
+            self.portmaps.setdefault(username, {})[conn_port] = rule
+            return conn_port
+
+    def remove(self, username, conn_port):
+        """Delete a port map; False if it doesn't exist"""
+        with self._lock:
+            return self.portmaps.get(username, {}).pop(conn_port, None) is not None
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    """Handles the port map API, on behalf of a ``FakeGateway``"""
+    protocol_version = 'HTTP/1.1' # keep-alive
+    # Headers and body are separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+    gateway = None
+
+    def setup(self):
+        super(GatewayHandler, self).setup()
+        with self.gateway._lock:
+            self.gateway.stats['connections'] += 1
+        if self.gateway.handshake:
+            time.sleep(self.gateway.handshake)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(self._list)
+
+    def do_POST(self):
+        self._handle(self._create)
+
+    def do_DELETE(self):
+        self._handle(self._delete)
+
+    def _handle(self, action):
+        gateway = self.gateway
+        url = urlparse(self.path)
+        username, _, path = url.path.lstrip('/').partition('/')
+        length = int(self.headers.get('Content-Length', 0))
+        body = ujson.loads(self.rfile.read(length)) if length else {}
+        with gateway._lock:
+            gateway.stats['requests'] += 1
+            gateway.stats['in_flight'] += 1
+            gateway.stats['max_in_flight'] = max(gateway.stats['max_in_flight'], gateway.stats['in_flight'])
+        try:
+            if gateway.latency:
+                time.sleep(gateway.latency)
+            if '/{}'.format(path) != PORTMAP_PATH:
+                status, answer = 404, {'error': 'No such resource'}
+            elif not self.headers.get('X-Auth'):
+                status, answer = 401, {'error': 'No auth token'}
+            elif gateway.should_fail():
+                status, answer = 500, {'error': 'Injected failure'}
+            else:
+                status, answer = action(username, body, parse_qs(url.query))
+        finally:
+            with gateway._lock:
+                gateway.stats['in_flight'] -= 1
+        data = ujson.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _list(self, username, body, query):
+        component = query.get('component', [None])[0]
+        ports = {str(x): y for x, y in self.gateway.portmaps.get(username, {}).items()
+                 if component is None or y.get('target_component') == component}
+        return 200, {'content': {'ports': ports}, 'error': None}
+
+    def _create(self, username, body, query):
+        conn_port = self.gateway.add(username, body)
+        return 200, {'content': {'conn_port': conn_port}, 'error': None}
+
+    def _delete(self, username, body, query):
+        if self.gateway.remove(username, body.get('conn_port')):
+            return 200, {'content': {}, 'error': None}
+        return 404, {'content': {}, 'error': 'No port map {}'.format(body.get('conn_port'))}
@@ -0,0 +1,684 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-process stand-in for vCenter, used by the benchmarks and a few tests.
+
+Unlike a MagicMock, the fake keeps state (folders, VMs, networks, tasks) and
+plugs into pyVmomi as the SOAP "stub". The code under test works with real
+``vim.VirtualMachine`` (etc) objects, and every method call or lazy property
+read is counted as a round trip to vCenter.
+
+For benchmarks, every round trip can cost ``latency`` seconds, OVA uploads and
+VMDK downloads move at ``bandwidth`` bytes per second, and calls can be made to
+fail (see ``FakeVSphere.fail`` and ``failure_rate``).
+"""
+import time
+import shutil
+import random
+import tempfile
+import itertools
+import threading
+from contextlib import contextmanager, ExitStack
+from datetime import datetime
+from collections import Counter
+from unittest.mock import patch
+
+import ujson
+import requests
+from pyVmomi import vim, vmodl
+
+from vlab_deployment_api.lib import template_meta_data
+from vlab_deployment_api.lib.worker import export
+from vlab_deployment_api.lib.worker import catalog
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import templates
+from vlab_deployment_api.lib.worker import morefs
+from vlab_deployment_api.lib.worker import vcenter_pool
+from vlab_deployment_api.lib.worker.morefs import CachedvCenter, MorefCache
+from vlab_deployment_api.lib.worker.catalog import TemplateCatalog
+from vlab_deployment_api.lib.worker.deployment_index import DeploymentIndex
+
+
+class FakeVSphere(object):
+    """The "server side" state shared by every session
+
+    :param base_dir: The VM folder that user folders live in.
+    :type base_dir: String
+
+    :param task_seconds: How long every task takes to finish.
+    :type task_seconds: Float
+
+    :param latency: How long every round trip to vCenter takes, in seconds.
+    :type latency: Float
+
+    :param bandwidth: How fast (bytes per second) each upload/download goes. Zero means instantly.
+    :type bandwidth: Integer
+
+    :param failure_rate: How often (0.0 - 1.0) a task, upload or download fails.
+    :type failure_rate: Float
+
+    :param disk_bytes: How big the VMDK of every VM is.
+    :type disk_bytes: Integer
+
+    :param seed: Makes injected failures repeatable.
+    :type seed: Integer
+    """
+    def __init__(self, base_dir='/', task_seconds=0, latency=0, bandwidth=0, failure_rate=0,
+                 disk_bytes=64 * 1024, seed=0):
+        self.base_dir = base_dir
+        self.task_seconds = task_seconds
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.disk_bytes = disk_bytes
+        self.random = random.Random(seed)
+        self._failures = Counter()
+        self.calls = Counter()
+        self.objects = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self.root = self.add(vim.Folder, 'group-d', name='Datacenters', children=[])
+        datacenter = self.add(vim.Datacenter, 'datacenter', name='DC', parent=self.root)
+        self.vm_folder = self.add(vim.Folder, 'group-v', name='vm', children=[], parent=datacenter)
+        self.net_folder = self.add(vim.Folder, 'group-n', name='network', children=[], parent=datacenter)
+        self.objects[self.root]['children'].append(datacenter)
+        self.objects[datacenter]['vmFolder'] = self.vm_folder
+        self.objects[datacenter]['networkFolder'] = self.net_folder
+
+    def fail(self, method, times=1):
+        """Make the next call(s) to a method fail
+
+        :param method: The name of the API call (i.e. Destroy_Task, ImportVApp, ExportVm, download)
+        :type method: String
+
+        :param times: How many calls in a row should fail.
+        :type times: Integer
+        """
+        with self._lock:
+            self._failures[method] += times
+
+    def should_fail(self, method):
+        """Decide if a call fails, either because it was told to, or by chance"""
+        with self._lock:
+            if self._failures[method]:
+                self._failures[method] -= 1
+                return True
+            return self.failure_rate > 0 and self.random.random() < self.failure_rate
+
+    def round_trip(self):
+        """Spend the time a round trip to vCenter takes"""
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer(self, nbytes):
+        """Spend the time moving some bytes takes"""
+        if self.bandwidth:
+            time.sleep(nbytes / self.bandwidth)
+
+    @property
+    def round_trips(self):
+        """Total number of API calls made by every session"""
+        return sum(y for x, y in self.calls.items() if x not in ('login', 'logout'))
+
+    def add(self, vimtype, prefix, **props):
+        """Create a managed object, returning its moId"""
+        with self._lock:
+            moid = '{}-{}'.format(prefix, next(self._ids))
+            props['_type'] = vimtype
+            self.objects[moid] = props
+            return moid
+
+    def ref(self, moid, stub):
+        """Make a pyVmomi object for a moId that is bound to a session"""
+        return self.objects[moid]['_type'](moid, stub)
+
+    def add_folder(self, name):
+        """Create a VM folder, returning its moId"""
+        folder = self.add(vim.Folder, 'group-v', name=name, children=[], parent=self.vm_folder)
+        self.objects[self.vm_folder]['children'].append(folder)
+        return folder
+
+    def add_user(self, username):
+        """Create the folder and networks every vLab user has"""
+        folder = self.add_folder(username)
+        for net in ('frontend', 'backend'):
+            name = '{}_{}'.format(username, net)
+            network = self.add(vim.Network, 'network', name=name, vms=[], parent=self.net_folder)
+            self.objects[self.net_folder]['children'].append(network)
+        return folder
+
+    def folder(self, name):
+        """Find the moId of a VM folder by name"""
+        for moid, props in self.objects.items():
+            if props['_type'] is vim.Folder and props['name'] == name:
+                return moid
+        raise ValueError('No folder named {}'.format(name))
+
+    def network(self, name):
+        """Find the moId of a network by name"""
+        for moid, props in self.objects.items():
+            if props['_type'] is vim.Network and props['name'] == name:
+                return moid
+        raise ValueError('No network named {}'.format(name))
+
+    def add_vm(self, username, name, meta=None, state='poweredOn', ips=None, networks=None):
+        """Put a VM into a user's folder, returning its moId"""
+        folder = self.folder(username)
+        annotation = ujson.dumps(meta) if meta is not None else ''
+        if networks is None:
+            networks = [self.network('{}_frontend'.format(username))]
+        moid = self.add(vim.VirtualMachine, 'vm', name=name, annotation=annotation, powerState=state,
+                        ips=list(ips or []), networks=networks, parent=folder, disk_bytes=self.disk_bytes,
+                        writes=0)
+        self.objects[folder]['children'].append(moid)
+        for network in networks:
+            self.objects[network]['vms'].append(moid)
+        return moid
+
+    def write_disk(self, moid):
+        """Change the disk of a VM; the ``changeId`` moves if change tracking is active"""
+        with self._lock:
+            props = self.objects[moid]
+            props['writes'] += 1
+            if props.get('change_id'):
+                props['change_id'] = self._change_id(moid)
+
+    def activate_tracking(self, moid):
+        """Like vSphere, a disk only gets a ``changeId`` once change tracking is
+        on *and* the VM is stunned; i.e. by a snapshot or power on"""
+        with self._lock:
+            props = self.objects[moid]
+            if props.get('tracking') and not props.get('change_id'):
+                props['change_id'] = self._change_id(moid)
+
+    def reset_tracking(self, moid):
+        """Like turning change tracking off and on again; earlier ``changeId`` are no good after"""
+        with self._lock:
+            props = self.objects[moid]
+            props['change_id'] = None
+            props['epoch'] = props.get('epoch', 0) + 1
+
+    def change_prefix(self, moid):
+        """What every ``changeId`` of a VM starts with, until change tracking is reset"""
+        return '52 fa 1c 9e-{}.{}/'.format(moid, self.objects[moid].get('epoch', 0))
+
+    def _change_id(self, moid):
+        return '{}{}'.format(self.change_prefix(moid), self.objects[moid]['writes'])
+
+    def vms(self, username):
+        """The moIds of every VM in a user's folder"""
+        return list(self.objects[self.folder(username)]['children'])
+
+    def remove(self, moid):
+        """Delete a managed object"""
+        with self._lock:
+            props = self.objects.pop(moid)
+            parent = self.objects.get(props.get('parent'), {})
+            if moid in parent.get('children', []):
+                parent['children'].remove(moid)
+            for network in props.get('networks', []):
+                self.objects[network]['vms'].remove(moid)
+
+    def descendants(self, moid):
+        """Every object below a container"""
+        props = self.objects[moid]
+        found = []
+        for child in props.get('children', []) + [props[x] for x in ('vmFolder', 'networkFolder') if x in props]:
+            found.append(child)
+            found.extend(self.descendants(child))
+        return found
+
+    def task(self, error=None, result=None):
+        """Make a task that finishes after ``task_seconds``"""
+        state = 'error' if error else 'success'
+        return self.add(vim.Task, 'task', state=state, error=error, result=result,
+                        done_at=time.time() + self.task_seconds)
+
+    def task_info(self, moid):
+        """What vCenter would report about a task right now"""
+        props = self.objects[moid]
+        if time.time() < props['done_at']:
+            return vim.TaskInfo(key=moid, state='running')
+        return vim.TaskInfo(key=moid, state=props['state'], completeTime=datetime.now(),
+                            error=props['error'], result=props['result'])
+
+
+class FakeStub(object):
+    """Plays the part of ``pyVmomi.SoapStubAdapter`` for a single session"""
+    def __init__(self, server):
+        self.server = server
+        self.expired = False
+        self.key = server.add(vim.UserSession, 'session')
+        self.cookie = 'vmware_soap_session="{}"; Path=/; HttpOnly; Secure;'.format(self.key)
+
+    def InvokeAccessor(self, mo, info):
+        self.server.calls['{}.{}'.format(type(mo).__name__, info.name)] += 1
+        self.server.round_trip()
+        return self._get(mo._moId, info.name)
+
+    def InvokeMethod(self, mo, info, args):
+        self.server.calls[info.wsdlName] += 1
+        self.server.round_trip()
+        if self.expired:
+            raise vim.fault.NotAuthenticated()
+        if self.server.should_fail(info.wsdlName):
+            fault = vim.fault.GenericVmConfigFault(msg='Injected failure of {}'.format(info.wsdlName))
+            if info.wsdlName.endswith('_Task'):
+                return self._ref(self.server.task(error=fault))
+            raise fault
+        handler = getattr(self, '_{}'.format(info.wsdlName))
+        return handler(mo, *args)
+
+    def _ref(self, moid):
+        if isinstance(moid, list):
+            return [self._ref(x) for x in moid]
+        return self.server.ref(moid, self)
+
+    def _get(self, moid, prop):
+        """Build the value of a (possibly dotted) property, like vCenter would"""
+        first, _, rest = prop.partition('.')
+        value = self._top_level(moid, first)
+        for attr in [x for x in rest.split('.') if x]:
+            value = getattr(value, attr, None)
+        return value
+
+    def _top_level(self, moid, prop):
+        server = self.server
+        if moid not in server.objects:
+            raise vmodl.fault.ManagedObjectNotFound(obj=vim.ManagedEntity(moid))
+        props = server.objects[moid]
+        if prop == 'currentSession':
+            return None if self.expired else vim.UserSession(key=self.key)
+        elif prop == 'childEntity':
+            return self._ref(props['children'])
+        elif prop in ('vmFolder', 'networkFolder', 'parent'):
+            return self._ref(props[prop]) if props.get(prop) else None
+        elif prop == 'view':
+            return self._ref(props['view'])
+        elif prop == 'vm':
+            return self._ref(props['vms'])
+        elif prop == 'network':
+            return self._ref(props['networks'])
+        elif prop == 'runtime':
+            return vim.vm.RuntimeInfo(powerState=props['powerState'])
+        elif prop == 'config' and props['_type'] is vim.vm.Snapshot:
+            # The disks as they were when the snapshot was taken
+            return self._config(props['vm'], props['change_id'])
+        elif prop == 'config':
+            return self._config(moid, props.get('change_id'))
+        elif prop == 'snapshot':
+            if not props.get('snapshot'):
+                return None
+            return vim.vm.SnapshotInfo(currentSnapshot=self._ref(props['snapshot']))
+        elif prop == 'guest':
+            nics = [vim.vm.GuestInfo.NicInfo(ipAddress=props['ips'])]
+            return vim.vm.GuestInfo(net=nics, ipAddress=(props['ips'] or [None])[0])
+        elif prop == 'info' and props['_type'] is vim.HttpNfcLease:
+            devices = [vim.HttpNfcLease.DeviceUrl(key=x, targetId=y, disk=True, url='fake://{}/{}'.format(moid, y))
+                       for x, y in props['disks']]
+            return vim.HttpNfcLease.Info(deviceUrl=devices, totalDiskCapacityInKB=props['total'] // 1024)
+        elif prop == 'info':
+            return server.task_info(moid)
+        return props.get(prop)
+
+    def _config(self, moid, change_id):
+        server = self.server
+        props = server.objects[moid]
+        nics = []
+        for idx, network in enumerate(props['networks']):
+            backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName=server.objects[network]['name'],
+                                                                           network=self._ref(network))
+            nics.append(vim.vm.device.VirtualVmxnet3(key=4000 + idx, backing=backing))
+        backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName='[fake] {}.vmdk'.format(moid),
+                                                                diskMode='persistent',
+                                                                changeId=change_id)
+        disk = vim.vm.device.VirtualDisk(key=2000, capacityInBytes=props['disk_bytes'], backing=backing)
+        return vim.vm.ConfigInfo(annotation=props['annotation'], template=props.get('template', False),
+                                 changeTrackingEnabled=bool(props.get('tracking')),
+                                 hardware=vim.vm.VirtualHardware(device=[disk] + nics))
+
+    # vim.ServiceInstance
+    def _RetrieveServiceContent(self, mo):
+        return vim.ServiceInstanceContent(rootFolder=self._ref(self.server.root),
+                                          viewManager=vim.view.ViewManager('ViewManager', self),
+                                          propertyCollector=vim.PropertyCollector('propertyCollector', self),
+                                          sessionManager=vim.SessionManager('SessionManager', self),
+                                          ovfManager=vim.OvfManager('OvfManager', self),
+                                          about=vim.AboutInfo(instanceUuid='fake-vcenter'))
+
+    # vim.view.ViewManager / vim.view.ContainerView
+    def _CreateContainerView(self, mo, container, type, recursive):
+        if recursive:
+            found = self.server.descendants(container._moId)
+        else:
+            found = list(self.server.objects[container._moId].get('children', []))
+        wanted = tuple(type) if type else (vim.ManagedEntity,)
+        found = [x for x in found if issubclass(self.server.objects[x]['_type'], wanted)]
+        return self._ref(self.server.add(vim.view.ContainerView, 'session', view=found))
+
+    def _DestroyView(self, mo):
+        self.server.remove(mo._moId)
+
+    # vim.PropertyCollector
+    def _RetrieveProperties(self, mo, specSet):
+        answer = []
+        for spec in specSet:
+            for obj_spec in spec.objectSet:
+                if obj_spec.skip:
+                    moids = self.server.objects[obj_spec.obj._moId]['view']
+                else:
+                    moids = [obj_spec.obj._moId]
+                for moid in moids:
+                    vimtype = self.server.objects[moid]['_type']
+                    prop_set = []
+                    for prop_spec in spec.propSet:
+                        if not issubclass(vimtype, prop_spec.type):
+                            continue
+                        for path in prop_spec.pathSet:
+                            value = self._get(moid, path)
+                            if isinstance(value, list):
+                                # the real stub deserializes into typed arrays
+                                value = type(value[0]).Array(value) if value else None
+                            if value is not None:
+                                prop_set.append(vmodl.DynamicProperty(name=path, val=value))
+                    answer.append(vmodl.query.PropertyCollector.ObjectContent(obj=self._ref(moid), propSet=prop_set))
+        return answer
+
+    def _CreatePropertyCollector(self, mo):
+        return self._ref(self.server.add(vim.PropertyCollector, 'session', filters=[], version=0))
+
+    def _CreateFilter(self, mo, spec, partialUpdates):
+        moid = self.server.add(vmodl.query.PropertyCollector.Filter, 'session', spec=spec, reported={})
+        self.server.objects[mo._moId]['filters'].append(moid)
+        return self._ref(moid)
+
+    def _DestroyPropertyFilter(self, mo):
+        self.server.remove(mo._moId)
+
+    def _DestroyPropertyCollector(self, mo):
+        for moid in self.server.objects[mo._moId]['filters']:
+            self.server.objects.pop(moid, None)
+        self.server.remove(mo._moId)
+
+    def _WaitForUpdatesEx(self, mo, version, options):
+        collector = self.server.objects[mo._moId]
+        max_wait = options.maxWaitSeconds if options and options.maxWaitSeconds is not None else 600
+        deadline = time.time() + max_wait
+        while True:
+            filter_updates = [x for x in (self._filter_update(y) for y in collector['filters']) if x]
+            if filter_updates:
+                collector['version'] += 1
+                return vmodl.query.PropertyCollector.UpdateSet(version=str(collector['version']),
+                                                               filterSet=filter_updates)
+            elif time.time() >= deadline:
+                return None
+            time.sleep(0.005)
+
+    def _filter_update(self, filter_moid):
+        """Report every watched property that changed since the last WaitForUpdatesEx"""
+        the_filter = self.server.objects.get(filter_moid)
+        if the_filter is None:
+            return None
+        object_updates = []
+        for obj_spec in the_filter['spec'].objectSet:
+            moid = obj_spec.obj._moId
+            if moid not in self.server.objects:
+                continue
+            reported = the_filter['reported'].setdefault(moid, {})
+            changes = []
+            for prop_spec in the_filter['spec'].propSet:
+                for path in prop_spec.pathSet:
+                    value = self._get(moid, path)
+                    if path not in reported and value is None:
+                        continue
+                    if path not in reported or reported[path] != value:
+                        reported[path] = value
+                        if isinstance(value, list):
+                            # the real stub deserializes into typed arrays
+                            value = type(value[0]).Array(value) if value else None
+                        changes.append(vmodl.query.PropertyCollector.Change(name=path, op='assign', val=value))
+            if changes:
+                kind = 'modify' if reported.get('_entered') else 'enter'
+                reported['_entered'] = True
+                object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(kind=kind,
+                                                                                 obj=self._ref(moid),
+                                                                                 changeSet=changes))
+        if object_updates:
+            return vmodl.query.PropertyCollector.FilterUpdate(filter=self._ref(filter_moid),
+                                                              objectSet=object_updates)
+        return None
+
+    # vim.Folder
+    def _CreateFolder(self, mo, name):
+        server = self.server
+        with server._lock:
+            for child in server.objects[mo._moId]['children']:
+                if server.objects[child].get('name') == name:
+                    raise vim.fault.DuplicateName(name=name, object=self._ref(child))
+            moid = server.add(vim.Folder, 'group-v', name=name, children=[], parent=mo._moId)
+            server.objects[mo._moId]['children'].append(moid)
+        return self._ref(moid)
+
+    # vim.VirtualMachine
+    def _PowerOnVM_Task(self, mo, host=None):
+        self.server.objects[mo._moId]['powerState'] = 'poweredOn'
+        self.server.activate_tracking(mo._moId)
+        return self._ref(self.server.task())
+
+    def _PowerOffVM_Task(self, mo):
+        if self.server.objects[mo._moId]['powerState'] == 'poweredOff':
+            fault = vim.fault.InvalidPowerState(msg='The attempted operation cannot be performed in the current state (Powered off).')
+            return self._ref(self.server.task(error=fault))
+        self.server.objects[mo._moId]['powerState'] = 'poweredOff'
+        return self._ref(self.server.task())
+
+    def _Destroy_Task(self, mo):
+        fault = self.server.objects[mo._moId].get('destroy_fault')
+        if fault:
+            return self._ref(self.server.task(error=fault))
+        if self.server.objects[mo._moId]['powerState'] == 'poweredOn':
+            fault = vim.fault.InvalidPowerState(msg='The attempted operation cannot be performed in the current state (Powered on).')
+            return self._ref(self.server.task(error=fault))
+        self.server.remove(mo._moId)
+        return self._ref(self.server.task())
+
+    def _CreateSnapshot_Task(self, mo, name, description, memory, quiesce):
+        self.server.activate_tracking(mo._moId)
+        props = self.server.objects[mo._moId]
+        snapshot = self.server.add(vim.vm.Snapshot, 'snapshot', name=name, vm=mo._moId, parent=props.get('snapshot'),
+                                   change_id=props.get('change_id'), writes=props['writes'])
+        props['snapshot'] = snapshot
+        return self._ref(self.server.task(result=self._ref(snapshot)))
+
+    def _RemoveSnapshot_Task(self, mo, removeChildren, consolidate=None):
+        snapshot = self.server.objects[mo._moId]
+        props = self.server.objects[snapshot['vm']]
+        if props.get('snapshot') == mo._moId:
+            props['snapshot'] = snapshot['parent']
+        with self.server._lock:
+            self.server.objects.pop(mo._moId)
+        return self._ref(self.server.task())
+
+    def _QueryChangedDiskAreas(self, mo, snapshot, deviceKey, startOffset, changeId):
+        props = self.server.objects[mo._moId]
+        prefix = self.server.change_prefix(mo._moId)
+        if not props.get('change_id') or not (changeId or '').startswith(prefix):
+            # i.e. change tracking was reset since, or never active
+            raise vim.fault.FileFault(msg='Error caused by file [fake] {}.vmdk'.format(mo._moId))
+        writes = self.server.objects[snapshot._moId]['writes'] if snapshot else props['writes']
+        changed = []
+        if writes > int(changeId[len(prefix):]):
+            changed.append(vim.VirtualMachine.DiskChangeInfo.DiskChangeExtent(start=0, length=props['disk_bytes']))
+        return vim.VirtualMachine.DiskChangeInfo(startOffset=startOffset, length=props['disk_bytes'] - startOffset,
+                                                 changedArea=changed)
+
+    def _CloneVM_Task(self, mo, folder, name, spec):
+        source = self.server.objects[mo._moId]
+        linked = spec.location.diskMoveType == 'createNewChildDiskBacking'
+        if linked and (spec.snapshot is None or spec.snapshot._moId != source.get('snapshot')):
+            fault = vim.fault.InvalidArgument(msg='A linked clone needs a snapshot of the source VM')
+            return self._ref(self.server.task(error=fault))
+        networks = list(source['networks'])
+        for change in spec.location.deviceChange or []:
+            networks[change.device.key - 4000] = change.device.backing.network._moId
+        state = 'poweredOn' if spec.powerOn else 'poweredOff'
+        moid = self.server.add_vm(self.server.objects[folder._moId]['name'], name, state=state,
+                                  ips=['192.168.1.3'], networks=networks)
+        self.server.objects[moid]['annotation'] = source['annotation']
+        self.server.objects[moid]['cloned_from'] = mo._moId
+        self.server.objects[moid]['linked'] = linked
+        self.server.objects[moid]['tracking'] = source.get('tracking', False)
+        if spec.powerOn:
+            self.server.activate_tracking(moid)
+        return self._ref(self.server.task(result=self._ref(moid)))
+
+    def _ExportVm(self, mo):
+        props = self.server.objects[mo._moId]
+        disks = [('vm-{}-disk-0'.format(mo._moId), '{}-disk1.vmdk'.format(props['name']))]
+        return self._ref(self.server.add(vim.HttpNfcLease, 'session', state='ready', disks=disks,
+                                         vm=mo._moId, total=props['disk_bytes'] * len(disks)))
+
+    def _HttpNfcLeaseProgress(self, mo, percent):
+        self.server.objects[mo._moId]['percent'] = percent
+
+    def _HttpNfcLeaseComplete(self, mo):
+        self.server.objects[mo._moId]['state'] = 'done'
+
+    def _HttpNfcLeaseAbort(self, mo, fault=None):
+        self.server.objects[mo._moId]['state'] = 'error'
+
+    # vim.OvfManager
+    def _CreateDescriptor(self, mo, obj, cdp):
+        networks = ''.join('<Network ovf:name="{}">'.format(self.server.objects[x]['name'])
+                           for x in self.server.objects[obj._moId]['networks'])
+        xml = '<Envelope><NetworkSection>{}</NetworkSection><VirtualSystem ovf:id="{}"/></Envelope>'.format(networks, cdp.name)
+        return vim.OvfManager.CreateDescriptorResult(ovfDescriptor=xml)
+
+    def _ReconfigVM_Task(self, mo, spec):
+        if spec.annotation is not None:
+            self.server.objects[mo._moId]['annotation'] = spec.annotation
+        if spec.changeTrackingEnabled:
+            self.server.objects[mo._moId]['tracking'] = True
+        return self._ref(self.server.task())
+
+
+class FakeVCenter(CachedvCenter):
+    """A ``vlab_inf_common.vmware.vCenter`` that talks to a ``FakeVSphere`` instead of the network"""
+    def __init__(self, server, host=None, user=None, password=None, port=443, base_dir=None):
+        server.calls['login'] += 1
+        self.server = server
+        self._conn = vim.ServiceInstance('ServiceInstance', FakeStub(server))
+        self._base_dir = base_dir if base_dir else server.base_dir
+        self._net_cache = None
+
+    def close(self):
+        self.server.calls['logout'] += 1
+
+    def expire(self):
+        """Make vCenter forget about this session, like an idle timeout would"""
+        self._conn._stub.expired = True
+
+
+class FakeOva(object):
+    """Stands in for ``vlab_inf_common.vmware.Ova``"""
+    def __init__(self, ova_file, files=None):
+        self.ova_file = ova_file
+        self.files = files
+        self.networks = ['frontend']
+
+    def close(self):
+        pass
+
+
+class FakeResponse(object):
+    """Stands in for the ``requests.Response`` of downloading a VMDK from an export lease"""
+    def __init__(self, server, url):
+        self.server = server
+        lease_moid = url.split('/')[2]
+        self.size = server.objects[lease_moid]['total'] // len(server.objects[lease_moid]['disks'])
+        self.status_code = 200
+        if server.should_fail('download'):
+            self.status_code = 500
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('{} Server Error'.format(self.status_code))
+
+    def iter_content(self, chunk_size=1):
+        remaining = self.size
+        while remaining > 0:
+            amount = min(chunk_size, remaining)
+            self.server.transfer(amount)
+            remaining -= amount
+            yield b'\0' * amount
+
+    def close(self):
+        pass
+
+
+def fake_requests_get(server):
+    """Make a stand in for ``requests.get`` that downloads VMDKs from ``server``"""
+    def get(url, **kwargs):
+        server.calls['download'] += 1
+        return FakeResponse(server, url)
+    return get
+
+
+def fake_deploy_from_ova(vcenter, ova, network_map, username, machine_name, logger, power_on=True):
+    """Stands in for ``virtual_machine.deploy_from_ova``"""
+    server = vcenter.server
+    server.calls['ImportVApp'] += 1
+    server.round_trip()
+    if server.should_fail('ImportVApp'):
+        raise RuntimeError('Injected failure of ImportVApp')
+    server.transfer(server.disk_bytes)
+    networks = [x.network._moId for x in network_map]
+    state = 'poweredOn' if power_on else 'poweredOff'
+    moid = server.add_vm(username, machine_name, state=state, ips=['192.168.1.2'], networks=networks)
+    return server.ref(moid, vcenter._conn._stub)
+
+
+def fake_console_url(vcenter, the_vm):
+    """The real function opens a TLS connection to vCenter just to get its cert"""
+    return 'https://localhost/ui/webconsole.html?vmId={}'.format(the_vm._moId)
+
+
+@contextmanager
+def patched(server, pool_size=10):
+    """Point the pool and ``vmware.py`` at a fake vSphere for the duration of a ``with`` statement.
+
+    Each use gets a brand new session pool, moref cache and deployment index, so login counts
+    and cached answers are not polluted by earlier callers.
+
+    :Returns: vlab_deployment_api.lib.worker.vcenter_pool.SessionPool
+    """
+    pool = vcenter_pool.SessionPool(max_size=pool_size, keepalive=300)
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(vcenter_pool, 'CachedvCenter', lambda **kw: FakeVCenter(server, **kw)))
+        stack.enter_context(patch.object(morefs, 'MOREFS', MorefCache(ttl=300)))
+        stack.enter_context(patch.object(vcenter_pool, 'POOL', pool))
+        stack.enter_context(patch.object(vmware.virtual_machine, 'deploy_from_ova', fake_deploy_from_ova))
+        stack.enter_context(patch.object(vmware.virtual_machine, '_get_vm_console_url', fake_console_url))
+        stack.enter_context(patch.object(vmware, 'open_ova', FakeOva))
+        lock_dir = tempfile.mkdtemp()
+        stack.callback(shutil.rmtree, lock_dir)
+        stack.enter_context(patch.object(vmware, 'INDEX', DeploymentIndex(ttl=300, lock_dir=lock_dir)))
+        stack.enter_context(patch.object(export.requests, 'get', fake_requests_get(server)))
+        yield pool
+        pool.close()
+
+
+@contextmanager
+def templates_in(template_dir):
+    """Keep deployment templates in ``template_dir`` for the duration of a ``with`` statement.
+
+    Templates are made as if by the owner ``<username>@localhost``; LDAP isn't involved.
+    """
+    the_catalog = TemplateCatalog(ttl=300)
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(catalog, 'CATALOG', the_catalog))
+        stack.enter_context(patch.object(templates, 'CATALOG', the_catalog))
+        for module in (vmware, templates, catalog, template_meta_data):
+            new_const = module.const._replace(VLAB_DEPLOYMENT_TEMPLATE_DIR=template_dir)
+            stack.enter_context(patch.object(module, 'const', new_const))
+        stack.enter_context(patch.object(templates, 'lookup_email_addr', lambda username: '{}@localhost'.format(username)))
+        yield template_dir
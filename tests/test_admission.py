@@ -0,0 +1,430 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the admission.py module
+"""
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib.worker import admission
+
+
+class TestSlotScheduler(unittest.TestCase):
+    """A set of test cases for the SlotScheduler object"""
+
+    def setUp(self):
+        """Every test gets a scheduler with one import slot and two export slots"""
+        self.scheduler = admission.SlotScheduler({'import': 1, 'export': 2})
+
+    def _wait_for_queue(self, kind, length):
+        for _ in range(200):
+            if self.scheduler.waiting(kind) == length:
+                return
+            time.sleep(0.01)
+        raise AssertionError('Queue never reached {}'.format(length))
+
+    def test_limit(self):
+        """``SlotScheduler`` never has more slots in use than its limit"""
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            with self.scheduler.slot('export', MagicMock()):
+                with lock:
+                    running.append(1)
+                    peak.append(len(running))
+                time.sleep(0.02)
+                with lock:
+                    running.pop()
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(self.scheduler.stats['export']['granted'], 6)
+
+    def test_fifo(self):
+        """``SlotScheduler`` hands out slots in the order they were asked for"""
+        order = []
+        self.scheduler.acquire('import')
+
+        def work(number):
+            with self.scheduler.slot('import', MagicMock()):
+                order.append(number)
+
+        threads = []
+        for number in range(4):
+            thread = threading.Thread(target=work, args=(number,))
+            thread.start()
+            threads.append(thread)
+            self._wait_for_queue('import', number + 1)
+        self.scheduler.release('import')
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, [0, 1, 2, 3])
+
+    def test_kinds_independent(self):
+        """``SlotScheduler`` an import does not wait on exports"""
+        self.scheduler.acquire('export')
+        self.scheduler.acquire('export')
+        waited = self.scheduler.acquire('import')
+
+        self.assertTrue(waited < 1)
+
+    def test_queue_time(self):
+        """``SlotScheduler`` records how long callers waited for a slot"""
+        self.scheduler.acquire('import')
+        timer = threading.Timer(0.2, self.scheduler.release, args=('import',))
+        timer.start()
+        waited = self.scheduler.acquire('import')
+        timer.join()
+        stats = self.scheduler.stats['import']
+
+        self.assertTrue(waited >= 0.15)
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['max_wait_seconds'], waited)
+
+    def test_slot_releases(self):
+        """``SlotScheduler`` the slot is given back when the block raises"""
+        with self.assertRaises(RuntimeError):
+            with self.scheduler.slot('import', MagicMock()):
+                raise RuntimeError('testing')
+        waited = self.scheduler.acquire('import')
+
+        self.assertTrue(waited < 1)
+
+    def test_broker(self):
+        """``SlotScheduler`` holds a broker token for the duration of the slot"""
+        broker = MagicMock()
+        scheduler = admission.SlotScheduler({'import': 1}, broker=broker)
+        with scheduler.slot('import', MagicMock()):
+            broker.acquire.assert_called_with('import')
+            self.assertFalse(broker.release.called)
+
+        broker.release.assert_called_with(broker.acquire.return_value)
+
+
+    def test_set_limit(self):
+        """``SlotScheduler`` raising the limit lets waiters in right away"""
+        self.scheduler.acquire('import')
+        thread = threading.Thread(target=self.scheduler.acquire, args=('import',))
+        thread.start()
+        self._wait_for_queue('import', 1)
+        self.scheduler.set_limit('import', 2)
+        thread.join(timeout=1)
+
+        self.assertFalse(thread.is_alive())
+
+    def test_set_limit_lower(self):
+        """``SlotScheduler`` lowering the limit keeps freed slots until the new limit is met"""
+        self.scheduler.acquire('export')
+        self.scheduler.acquire('export')
+        self.scheduler.set_limit('export', 1)
+        thread = threading.Thread(target=self.scheduler.acquire, args=('export',))
+        thread.start()
+        self._wait_for_queue('export', 1)
+        self.scheduler.release('export')
+
+        self.assertEqual(self.scheduler.waiting('export'), 1)
+        self.scheduler.release('export')
+        thread.join(timeout=1)
+        self.assertFalse(thread.is_alive())
+
+    def test_controller(self):
+        """``SlotScheduler`` reports every slot to its controller, and applies the new limit"""
+        controller = MagicMock()
+        controller.limit = 1
+        controller.record.return_value = 3
+        scheduler = admission.SlotScheduler({'import': 1}, controllers={'import': controller})
+        with scheduler.slot('import', MagicMock()) as grant:
+            grant.nbytes = 100
+
+        _, the_kwargs = controller.record.call_args
+        self.assertEqual(the_kwargs, {'nbytes': 100, 'error': False})
+        self.assertEqual(scheduler.limits['import'], 3)
+
+    def test_controller_excludes_queue(self):
+        """``SlotScheduler`` does not count time spent waiting for the slot as the work's latency"""
+        controller = MagicMock()
+        controller.limit = 1
+        controller.record.return_value = 1
+        broker = MagicMock()
+        broker.acquire.side_effect = lambda kind: time.sleep(0.3)
+        scheduler = admission.SlotScheduler({'import': 1}, broker=broker, controllers={'import': controller})
+        with scheduler.slot('import', MagicMock()) as grant:
+            pass
+
+        the_args, _ = controller.record.call_args
+        self.assertTrue(the_args[0] < 0.1)
+        self.assertTrue(grant.waited >= 0.3)
+
+    def test_broker_fails(self):
+        """``SlotScheduler`` gives back the slot if the broker can't hand out a token"""
+        broker = MagicMock()
+        broker.acquire.side_effect = RuntimeError('testing')
+        scheduler = admission.SlotScheduler({'import': 1}, broker=broker)
+        with self.assertRaises(RuntimeError):
+            with scheduler.slot('import', MagicMock()):
+                pass
+
+        self.assertTrue(scheduler.acquire('import') < 0.1)
+
+    def test_controller_errors(self):
+        """``SlotScheduler`` tells the controller about failures, but not user errors"""
+        controller = MagicMock()
+        controller.limit = 1
+        controller.record.return_value = 1
+        scheduler = admission.SlotScheduler({'import': 1}, controllers={'import': controller})
+        for error, expected in [(ValueError, False), (RuntimeError, True)]:
+            with self.assertRaises(error):
+                with scheduler.slot('import', MagicMock()):
+                    raise error('testing')
+            _, the_kwargs = controller.record.call_args
+            self.assertEqual(the_kwargs['error'], expected)
+
+
+class SimulatedDatastore(object):
+    """A datastore that takes longer per byte once it has more than ``capacity`` uploads"""
+    def __init__(self, capacity, seconds_per_gb=10.0):
+        self.capacity = capacity
+        self.seconds_per_gb = seconds_per_gb
+
+    def run(self, controller, rounds):
+        """Every round, ``limit`` uploads of 1GB run at once; returns the limit of every round"""
+        limits = []
+        for _ in range(rounds):
+            concurrency = controller.limit
+            limits.append(concurrency)
+            duration = self.seconds_per_gb * max(1.0, concurrency / self.capacity)
+            for _ in range(concurrency):
+                controller.record(duration, nbytes=2**30)
+        return limits
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+    """A set of test cases for the AdaptiveLimit object"""
+
+    def test_increase(self):
+        """``AdaptiveLimit`` adds a slot after a healthy window"""
+        controller = admission.AdaptiveLimit('import', start=4, floor=1, ceiling=10)
+        for _ in range(4):
+            limit = controller.record(1.0)
+
+        self.assertEqual(limit, 5)
+        self.assertEqual(controller.decisions[-1]['reason'], 'healthy')
+
+    def test_waits_for_window(self):
+        """``AdaptiveLimit`` does not decide until it has a window of results"""
+        controller = admission.AdaptiveLimit('import', start=6, floor=1, ceiling=10)
+        for _ in range(5):
+            limit = controller.record(1.0)
+
+        self.assertEqual(limit, 6)
+        self.assertEqual(len(controller.decisions), 0)
+
+    def test_errors(self):
+        """``AdaptiveLimit`` cuts the limit in half when work fails"""
+        controller = admission.AdaptiveLimit('import', start=8, floor=1, ceiling=10)
+        for number in range(8):
+            limit = controller.record(1.0, error=number == 0)
+
+        self.assertEqual(limit, 4)
+        self.assertEqual(controller.decisions[-1]['reason'], 'errors')
+
+    def test_latency(self):
+        """``AdaptiveLimit`` backs off when work gets slower than the baseline"""
+        controller = admission.AdaptiveLimit('import', start=4, floor=1, ceiling=10)
+        for _ in range(4):
+            controller.record(1.0)
+        for _ in range(5):
+            limit = controller.record(2.0)
+
+        self.assertEqual(limit, 2)
+        self.assertEqual(controller.decisions[-1]['reason'], 'latency')
+        self.assertEqual(controller.baselines, {'byte': None, 'operation': 1.0})
+
+    def test_per_byte(self):
+        """``AdaptiveLimit`` big uploads taking longer is not a sign of saturation"""
+        controller = admission.AdaptiveLimit('import', start=4, floor=1, ceiling=10)
+        for _ in range(4):
+            controller.record(1.0, nbytes=100)
+        for _ in range(5):
+            limit = controller.record(10.0, nbytes=1000)
+
+        self.assertEqual(limit, 6)
+
+    def test_separate_windows(self):
+        """``AdaptiveLimit`` per byte and per operation results never share a window, or a baseline"""
+        controller = admission.AdaptiveLimit('import', start=4, floor=1, ceiling=10)
+        for _ in range(4):
+            controller.record(0.001, nbytes=100)
+        for _ in range(5):
+            # Way more seconds than per byte; but no slower than the last operations
+            limit = controller.record(1.0)
+
+        self.assertEqual(limit, 6)
+        self.assertEqual([x['unit'] for x in controller.decisions], ['byte', 'operation'])
+        self.assertEqual(controller.baselines, {'byte': 0.00001, 'operation': 1.0})
+
+    def test_floor_ceiling(self):
+        """``AdaptiveLimit`` keeps the limit between the floor and ceiling"""
+        controller = admission.AdaptiveLimit('import', start=2, floor=2, ceiling=4)
+        for _ in range(20):
+            controller.record(1.0)
+        self.assertEqual(controller.limit, 4)
+        for _ in range(20):
+            controller.record(1.0, error=True)
+        self.assertEqual(controller.limit, 2)
+
+    def test_simulated(self):
+        """``AdaptiveLimit`` settles near what the datastore can handle, and follows it when it changes"""
+        datastore = SimulatedDatastore(capacity=8)
+        controller = admission.AdaptiveLimit('import', start=1, floor=1, ceiling=32)
+        datastore.run(controller, rounds=20)
+        settled = datastore.run(controller, rounds=50)
+
+        # Never below what the datastore can handle, and never more than 50% over
+        self.assertTrue(min(settled) >= 8)
+        self.assertTrue(max(settled) <= 12)
+
+        datastore.capacity = 3
+        datastore.run(controller, rounds=10)
+        settled = datastore.run(controller, rounds=50)
+
+        self.assertTrue(min(settled) >= 2)
+        self.assertTrue(max(settled) <= 5)
+
+
+# Holds an import slot for a moment, then prints when it had it
+HOLD_SLOT = """
+import sys, time
+from unittest.mock import MagicMock
+from vlab_deployment_api.lib.worker import admission
+scheduler = admission.SlotScheduler({'import': 1},
+                                    broker=admission.FileSemaphore(sys.argv[1], {'import': 1}))
+with scheduler.slot('import', MagicMock()):
+    start = time.time()
+    time.sleep(0.3)
+    print(start, time.time())
+"""
+
+
+class TestFileSemaphore(unittest.TestCase):
+    """A set of test cases for the FileSemaphore object"""
+
+    def setUp(self):
+        """Every test gets one import slot, in an empty directory"""
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+        self.semaphore = admission.FileSemaphore(self.lock_dir, {'import': 1, 'export': 2})
+
+    def test_acquire(self):
+        """``FileSemaphore`` hands out every slot at once"""
+        tokens = [self.semaphore.acquire('export') for _ in range(2)]
+        for token in tokens:
+            self.semaphore.release(token)
+
+    def test_waits(self):
+        """``FileSemaphore`` acquire blocks until a slot is released"""
+        token = self.semaphore.acquire('import')
+        got = threading.Event()
+        def acquire():
+            self.semaphore.release(self.semaphore.acquire('import'))
+            got.set()
+        thread = threading.Thread(target=acquire, daemon=True)
+        thread.start()
+
+        self.assertFalse(got.wait(0.5))
+        self.semaphore.release(token)
+        self.assertTrue(got.wait(5))
+
+    def test_processes(self):
+        """``SlotScheduler`` with a FileSemaphore limits the slots across every process"""
+        workers = [subprocess.Popen([sys.executable, '-c', HOLD_SLOT, self.lock_dir], stdout=subprocess.PIPE)
+                   for _ in range(3)]
+        held = sorted(tuple(float(x) for x in worker.communicate(timeout=30)[0].split()) for worker in workers)
+
+        for (_, end), (start, _) in zip(held, held[1:]):
+            self.assertTrue(end <= start)
+
+    def test_process_dies(self):
+        """``FileSemaphore`` a slot held by a process that dies is free again"""
+        script = ('import sys; from vlab_deployment_api.lib.worker import admission; '
+                  'admission.FileSemaphore(sys.argv[1], {"import": 1}).acquire("import"); '
+                  'print("acquired", flush=True); sys.stdin.read()')
+        holder = subprocess.Popen([sys.executable, '-c', script, self.lock_dir],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.assertEqual(holder.stdout.readline().strip(), b'acquired')
+        holder.kill()
+        holder.wait()
+
+        self.semaphore.release(self.semaphore.acquire('import'))
+
+
+class TestBrokerSemaphore(unittest.TestCase):
+    """A set of test cases for the BrokerSemaphore object"""
+
+    def setUp(self):
+        """Every test gets two import tokens, in an in-memory broker"""
+        self.semaphore = admission.BrokerSemaphore('memory://', {'import': 2})
+        self.semaphore.seed()
+
+    @patch.object(admission.time, 'sleep')
+    def test_acquire(self, fake_sleep):
+        """``BrokerSemaphore`` blocks once every token is held, until one is released"""
+        first = self.semaphore.acquire('import')
+        self.semaphore.acquire('import')
+        fake_sleep.side_effect = lambda _: self.semaphore.release(first)
+        self.semaphore.acquire('import')
+
+        self.assertEqual(fake_sleep.call_count, 1)
+
+    def test_seed(self):
+        """``BrokerSemaphore`` seeding drops any old tokens"""
+        self.semaphore.seed()
+        self.semaphore.acquire('import')
+        self.semaphore.acquire('import')
+
+        with patch.object(admission.time, 'sleep') as fake_sleep:
+            fake_sleep.side_effect = [RuntimeError('no more tokens')]
+            with self.assertRaises(RuntimeError):
+                self.semaphore.acquire('import')
+
+
+class TestMakeScheduler(unittest.TestCase):
+    """A set of test cases for the ``_make_scheduler`` function"""
+
+    def make_scheduler(self, **kwargs):
+        """Make a scheduler with some constants changed"""
+        new_const = admission.const._replace(VLAB_IMPORT_SLOTS=5, VLAB_EXPORT_SLOTS=2, VLAB_SLOTS_FLOOR=1,
+                                             VLAB_SLOT_BROKER='', **kwargs)
+        with patch.object(admission, 'const', new_const):
+            return admission._make_scheduler()
+
+    def test_static(self):
+        """``_make_scheduler`` shares as many slots across processes as each process has"""
+        scheduler = self.make_scheduler(VLAB_SLOTS_CEILING=0)
+
+        self.assertEqual(scheduler.limits, {'import': 5, 'export': 2})
+        self.assertEqual(scheduler.broker.limits, {'import': 5, 'export': 2})
+
+    def test_adaptive(self):
+        """``_make_scheduler`` shares enough slots across processes for the limit to grow to the ceiling"""
+        scheduler = self.make_scheduler(VLAB_SLOTS_CEILING=8)
+
+        self.assertEqual(scheduler.limits, {'import': 5, 'export': 2})
+        self.assertEqual(scheduler.broker.limits, {'import': 8, 'export': 8})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,428 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the catalog.py module
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_deployment_api.lib import template_meta_data
+from vlab_deployment_api.lib.worker import catalog
+
+
+def make_template(location, name, owner='alice', summary='a template'):
+    """Write a deployment template, like ``templates.create`` would"""
+    template_dir = os.path.join(location, name)
+    os.makedirs(template_dir, exist_ok=True)
+    meta = {'owner': owner, 'email': '', 'summary': summary,
+            'machines': {'vm01': {'ip': '1.2.3.4', 'kind': 'CentOS', 'ports': [22]}}}
+    with open(os.path.join(template_dir, template_meta_data.META_FILE_NAME), 'w') as the_file:
+        ujson.dump(meta, the_file)
+    with open(os.path.join(template_dir, 'vm01.ova'), 'w') as the_file:
+        the_file.write('not really an OVA')
+
+
+class TestTemplateCatalog(unittest.TestCase):
+    """A set of test cases for the TemplateCatalog object"""
+
+    def setUp(self):
+        """Every test gets a directory of templates"""
+        self.location = tempfile.mkdtemp()
+        new_const = template_meta_data.const._replace(VLAB_DEPLOYMENT_TEMPLATE_DIR=self.location)
+        patcher = patch.object(template_meta_data, 'const', new_const)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.location)
+        make_template(self.location, 'foo')
+        make_template(self.location, 'bar', owner='bob')
+        self.catalog = catalog.TemplateCatalog(ttl=300)
+
+    def test_templates(self):
+        """``TemplateCatalog`` templates returns the meta data of every template"""
+        output = self.catalog.templates(self.location)
+
+        self.assertEqual(set(output.keys()), {'foo', 'bar'})
+        self.assertEqual(output['bar']['owner'], 'bob')
+        self.assertEqual(output['foo']['machines']['vm01']['ova_path'], os.path.join(self.location, 'foo', 'vm01.ova'))
+
+    def test_cached(self):
+        """``TemplateCatalog`` only reads the meta data of a template once"""
+        self.catalog.templates(self.location)
+        self.catalog.templates(self.location)
+
+        self.assertEqual(self.catalog.stats['loads'], 2)
+        self.assertEqual(self.catalog.stats['scans'], 1)
+
+    def test_new_template(self):
+        """``TemplateCatalog`` notices new templates, and only reads the new one"""
+        self.catalog.templates(self.location)
+        make_template(self.location, 'baz')
+
+        output = self.catalog.templates(self.location)
+
+        self.assertTrue('baz' in output)
+        self.assertEqual(self.catalog.stats['loads'], 3)
+
+    def test_deleted_template(self):
+        """``TemplateCatalog`` notices deleted templates"""
+        self.catalog.templates(self.location)
+        shutil.rmtree(os.path.join(self.location, 'foo'))
+
+        output = self.catalog.templates(self.location)
+
+        self.assertEqual(set(output.keys()), {'bar'})
+
+    def test_hidden(self):
+        """``TemplateCatalog`` ignores hidden directories (templates being made, the chunk store)"""
+        make_template(self.location, '.baz')
+        os.makedirs(os.path.join(self.location, '.chunks'))
+
+        output = self.catalog.names(self.location)
+
+        self.assertEqual(set(output), {'foo', 'bar'})
+
+    def test_unreadable(self):
+        """``TemplateCatalog`` templates skips templates without meta data, but names does not"""
+        os.makedirs(os.path.join(self.location, 'broken'))
+
+        self.assertFalse('broken' in self.catalog.templates(self.location))
+        self.assertTrue('broken' in self.catalog.names(self.location))
+
+    def test_invalidate(self):
+        """``TemplateCatalog`` re-reads a template once it's invalidated"""
+        self.catalog.templates(self.location)
+        make_template(self.location, 'foo', summary='new summary')
+        self.catalog.invalidate('foo')
+
+        output = self.catalog.templates(self.location)
+
+        self.assertEqual(output['foo']['summary'], 'new summary')
+
+    def test_sweep(self):
+        """``TemplateCatalog`` notices changed meta data once the TTL expires"""
+        self.catalog.ttl = 0
+        self.catalog.templates(self.location)
+        meta_file = os.path.join(self.location, 'foo', template_meta_data.META_FILE_NAME)
+        make_template(self.location, 'foo', summary='a changed summary')
+        # Some file systems only track mtime to the second
+        stamp = time.time() + 5
+        os.utime(meta_file, (stamp, stamp))
+
+        output = self.catalog.templates(self.location)
+
+        self.assertEqual(output['foo']['summary'], 'a changed summary')
+
+    def test_no_sweep(self):
+        """``TemplateCatalog`` does not check every template on every listing"""
+        self.catalog.templates(self.location)
+        with patch.object(catalog, '_template_key') as fake_template_key:
+            self.catalog.templates(self.location)
+
+        self.assertFalse(fake_template_key.called)
+
+    def test_owned_by(self):
+        """``TemplateCatalog`` owned_by returns only the templates a user owns"""
+        output = self.catalog.owned_by(self.location, 'bob')
+
+        self.assertEqual(list(output.keys()), ['bar'])
+
+    def test_owned_by_nothing(self):
+        """``TemplateCatalog`` owned_by returns an empty dictionary for users without templates"""
+        self.assertEqual(self.catalog.owned_by(self.location, 'carol'), {})
+
+    def test_owned_by_new_owner(self):
+        """``TemplateCatalog`` the owner index follows a template that's given to someone else"""
+        self.catalog.templates(self.location)
+        make_template(self.location, 'foo', owner='bob')
+        self.catalog.invalidate('foo')
+
+        self.assertEqual(set(self.catalog.owned_by(self.location, 'bob').keys()), {'foo', 'bar'})
+        self.assertEqual(self.catalog.owned_by(self.location, 'alice'), {})
+
+    def test_owned_by_cost(self):
+        """``TemplateCatalog`` owned_by does not look at templates the user doesn't own"""
+        for idx in range(50):
+            make_template(self.location, 'other{}'.format(idx), owner='carol')
+        self.catalog.templates(self.location)
+        loads = self.catalog.stats['loads']
+        with patch.object(catalog, 'get_meta') as fake_get_meta:
+            self.catalog.owned_by(self.location, 'bob')
+
+        self.assertFalse(fake_get_meta.called)
+        self.assertEqual(self.catalog.stats['loads'], loads)
+
+    def test_invalidate_one(self):
+        """``TemplateCatalog`` invalidating one template does not rescan the directory"""
+        self.catalog.templates(self.location)
+        self.catalog.invalidate('foo')
+        self.catalog.templates(self.location)
+
+        self.assertEqual(self.catalog.stats['scans'], 1)
+        self.assertEqual(self.catalog.stats['loads'], 3)
+
+    def test_invalidate_deleted(self):
+        """``TemplateCatalog`` a template deleted by this worker is gone right away"""
+        self.catalog.templates(self.location)
+        shutil.rmtree(os.path.join(self.location, 'foo'))
+        self.catalog.invalidate('foo')
+
+        self.assertTrue(self.catalog.path(self.location, 'foo') is None)
+        self.assertEqual(self.catalog.owned_by(self.location, 'alice'), {})
+
+    def test_path(self):
+        """``TemplateCatalog`` path returns where a template lives"""
+        output = self.catalog.path(self.location, 'foo')
+
+        self.assertEqual(output, os.path.join(self.location, 'foo'))
+
+    def test_path_missing(self):
+        """``TemplateCatalog`` path returns None when there's no such template"""
+        self.assertTrue(self.catalog.path(self.location, 'baz') is None)
+
+    def test_query(self):
+        """``TemplateCatalog`` query returns templates in order of name"""
+        make_template(self.location, 'baz', owner='bob')
+
+        output = self.catalog.query(self.location)
+
+        self.assertEqual([x[0] for x in output], ['bar', 'baz', 'foo'])
+
+    def test_query_owner(self):
+        """``TemplateCatalog`` query can find the templates of one owner, by name prefix"""
+        make_template(self.location, 'baz', owner='bob')
+        make_template(self.location, 'quux', owner='bob')
+
+        output = self.catalog.query(self.location, owner='bob', prefix='ba')
+
+        self.assertEqual([x[0] for x in output], ['bar', 'baz'])
+
+    def test_query_page(self):
+        """``TemplateCatalog`` query returns the templates after a name, up to a limit"""
+        make_template(self.location, 'baz')
+
+        output = self.catalog.query(self.location, after='bar', limit=1)
+
+        self.assertEqual([x[0] for x in output], ['baz'])
+
+    def test_query_readable(self):
+        """``TemplateCatalog`` query can skip templates without meta data"""
+        os.makedirs(os.path.join(self.location, 'broken'))
+
+        self.assertTrue('broken' in [x[0] for x in self.catalog.query(self.location)])
+        self.assertFalse('broken' in [x[0] for x in self.catalog.query(self.location, readable=True)])
+
+    def test_location(self):
+        """``TemplateCatalog`` starts over when the template directory changes"""
+        self.catalog.templates(self.location)
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+
+        self.assertEqual(self.catalog.templates(other), {})
+
+    def test_slow_read(self):
+        """``TemplateCatalog`` does not hold up other listings while reading meta data"""
+        self.catalog.templates(self.location)
+        self.catalog.invalidate('foo')
+        reading = threading.Event()
+        release = threading.Event()
+        get_meta = catalog.get_meta
+        def slow_get_meta(name):
+            if name == 'foo':
+                reading.set()
+                release.wait(10)
+            return get_meta(name)
+        with patch.object(catalog, 'get_meta', slow_get_meta):
+            slow = threading.Thread(target=self.catalog.templates, args=(self.location,))
+            slow.start()
+            reading.wait(10)
+            other = threading.Thread(target=self.catalog.owned_by, args=(self.location, 'bob'))
+            other.start()
+            other.join(2)
+            blocked = other.is_alive()
+            release.set()
+            slow.join(10)
+            other.join(10)
+
+        self.assertFalse(blocked)
+
+    def test_stale_refresh(self):
+        """``TemplateCatalog`` does not let an older listing undo what a newer one found"""
+        self.catalog.templates(self.location)
+        make_template(self.location, 'foo', summary='new summary')
+        self.catalog.invalidate('foo')
+        reading = threading.Event()
+        release = threading.Event()
+        get_meta = catalog.get_meta
+        old_meta = get_meta('foo')
+        old_meta['summary'] = 'old summary'
+        def slow_get_meta(name):
+            if threading.current_thread().name == 'slow':
+                reading.set()
+                release.wait(10)
+                return old_meta
+            return get_meta(name)
+        with patch.object(catalog, 'get_meta', slow_get_meta):
+            slow = threading.Thread(target=self.catalog.templates, args=(self.location,), name='slow')
+            slow.start()
+            reading.wait(10)
+            self.catalog.invalidate('foo')
+            self.catalog.templates(self.location)
+            release.set()
+            slow.join(10)
+
+        output = self.catalog.templates(self.location)
+
+        self.assertEqual(output['foo']['summary'], 'new summary')
+
+
+class TestListImages(unittest.TestCase):
+    """A set of test cases for the ``list_images`` function"""
+
+    @patch.object(catalog, 'CATALOG', catalog.TemplateCatalog(ttl=30))
+    @patch.object(catalog.os, 'listdir')
+    def test_list_images(self, fake_listdir):
+        """``list_images`` Returns a list of available deployments that can be deployed"""
+        fake_listdir.return_value = ['myDeployment']
+
+        output = catalog.list_images()
+        expected = ['myDeployment']
+
+        # set() avoids ordering issue in test
+        self.assertEqual(set(output), set(expected))
+
+    @patch.object(catalog, 'CATALOG', catalog.TemplateCatalog(ttl=30))
+    @patch.object(catalog, 'get_meta')
+    @patch.object(catalog.os, 'listdir')
+    def test_list_images_verbose(self, fake_listdir, fake_get_meta):
+        """``list_images`` Returns more detail template info when passed the verbose=True argument"""
+        fake_get_meta.return_value = {'info' : 'extra details'}
+        fake_listdir.return_value = ['myDeployment']
+
+        output = catalog.list_images(verbose=True)
+        expected = [{'myDeployment' : {'info' : 'extra details'}}]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(catalog, 'CATALOG', catalog.TemplateCatalog(ttl=30))
+    @patch.object(catalog, 'get_meta')
+    @patch.object(catalog.os, 'listdir')
+    def test_list_images_filters(self, fake_listdir, fake_get_meta):
+        """``list_images`` Filters templates by owner, kind and name prefix"""
+        metas = {'alphaOne': {'owner': 'sam', 'machines': {'vm01': {'kind': 'OneFS'}}},
+                 'alphaTwo': {'owner': 'sam', 'machines': {'vm01': {'kind': 'CentOS'}}},
+                 'beta': {'owner': 'sam', 'machines': {'vm01': {'kind': 'OneFS'}}},
+                 'gamma': {'owner': 'bob', 'machines': {'vm01': {'kind': 'OneFS'}}}}
+        fake_listdir.return_value = list(metas.keys())
+        fake_get_meta.side_effect = lambda x: metas[x]
+
+        output = catalog.list_images(owner='sam', kind='OneFS', prefix='alpha')
+
+        self.assertEqual(output, ['alphaOne'])
+
+    @patch.object(catalog, 'CATALOG', catalog.TemplateCatalog(ttl=30))
+    @patch.object(catalog, 'get_meta')
+    @patch.object(catalog.os, 'listdir')
+    def test_list_images_fields(self, fake_listdir, fake_get_meta):
+        """``list_images`` Only includes the requested fields of the meta data"""
+        fake_listdir.return_value = ['myDeployment']
+        fake_get_meta.return_value = {'owner': 'sam', 'email': 'sam@vlab.local', 'summary': 'my template',
+                                      'machines': {'vm02': {'kind': 'OneFS'}, 'vm01': {'kind': 'OneFS'}}}
+
+        output = catalog.list_images(fields=['summary', 'machine_names'])
+        expected = [{'myDeployment': {'summary': 'my template', 'machine_names': ['vm01', 'vm02']}}]
+
+        self.assertEqual(output, expected)
+
+    def test_list_images_bad_field(self):
+        """``list_images`` Raises ValueError for unknown fields"""
+        with self.assertRaises(ValueError):
+            catalog.list_images(fields=['password'])
+
+    @patch.object(catalog, 'CATALOG', catalog.TemplateCatalog(ttl=30))
+    @patch.object(catalog, 'get_meta')
+    @patch.object(catalog.os, 'listdir')
+    def test_list_images_pages(self, fake_listdir, fake_get_meta):
+        """``list_images`` Pages through every template, in order of name"""
+        fake_listdir.return_value = ['t{}'.format(x) for x in range(5)]
+        fake_get_meta.return_value = {'owner': 'sam', 'machines': {}}
+
+        pages = []
+        cursor = None
+        while True:
+            page = catalog.list_images(verbose=True, limit=2, cursor=cursor)
+            pages.append([list(x.keys())[0] for x in page])
+            cursor = catalog.next_cursor(page, 2)
+            if cursor is None:
+                break
+
+        self.assertEqual(pages, [['t0', 't1'], ['t2', 't3'], ['t4']])
+
+    def test_list_images_bad_cursor(self):
+        """``list_images`` Raises ValueError for a cursor it didn't make"""
+        with self.assertRaises(ValueError):
+            catalog.list_images(limit=2, cursor='not a cursor!')
+
+
+class TestTemplateCatalogIndexed(unittest.TestCase):
+    """A set of test cases for the TemplateCatalog object, with meta data in SQLite"""
+
+    def setUp(self):
+        """Every test gets a directory of templates, with their meta data in SQLite"""
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        new_const = template_meta_data.const._replace(VLAB_DEPLOYMENT_TEMPLATE_DIR=self.location,
+                                                      VLAB_TEMPLATE_META_STORE='sqlite',
+                                                      VLAB_TEMPLATE_META_DB=os.path.join(self.location, '.meta.sqlite'))
+        patcher = patch.object(template_meta_data, 'const', new_const)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(template_meta_data._store().close)
+        for name, owner, kind in [('foo', 'alice', 'CentOS'), ('bar', 'bob', 'OneFS'), ('baz', 'bob', 'CentOS')]:
+            make_template(self.location, name, owner=owner)
+            meta = template_meta_data.meta_store.JsonStore(self.location).read(name)
+            meta['machines']['vm01']['kind'] = kind
+            template_meta_data._store().write(name, meta)
+        self.catalog = catalog.TemplateCatalog(ttl=300)
+
+    def test_owned_by(self):
+        """``TemplateCatalog`` owned_by finds templates with the index, not by reading each one"""
+        with patch.object(catalog, 'get_meta') as fake_get_meta:
+            output = self.catalog.owned_by(self.location, 'bob')
+
+        self.assertEqual(set(output.keys()), {'bar', 'baz'})
+        self.assertEqual(output['bar']['machines']['vm01']['ova_path'], os.path.join(self.location, 'bar', 'vm01.ova'))
+        self.assertFalse(fake_get_meta.called)
+        self.assertEqual(self.catalog.stats['indexed'], 1)
+
+    def test_query_kind(self):
+        """``TemplateCatalog`` query finds templates by kind with the index"""
+        with patch.object(catalog, 'get_meta') as fake_get_meta:
+            output = self.catalog.query(self.location, kind='CentOS')
+
+        self.assertEqual([x[0] for x in output], ['baz', 'foo'])
+        self.assertFalse(fake_get_meta.called)
+
+    def test_query_page(self):
+        """``TemplateCatalog`` query pages through what the index finds"""
+        first = self.catalog.query(self.location, owner='bob', limit=1)
+        second = self.catalog.query(self.location, owner='bob', after=first[-1][0], limit=1)
+        third = self.catalog.query(self.location, owner='bob', prefix='baz')
+
+        self.assertEqual([x[0] for x in first + second + third], ['bar', 'baz', 'baz'])
+
+    def test_query_no_filter(self):
+        """``TemplateCatalog`` query without an owner or kind still uses the catalog"""
+        output = self.catalog.query(self.location, prefix='ba')
+
+        self.assertEqual([x[0] for x in output], ['bar', 'baz'])
+        self.assertEqual(self.catalog.stats['indexed'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the chunk_store.py module
+"""
+import io
+import os
+import random
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_inf_common.vmware import Ova
+
+from vlab_deployment_api.lib.worker import chunk_store, ova_cache
+from tests.test_ova_cache import make_ova
+
+
+def random_bytes(size, seed):
+    """Repeatable, incompressible test data"""
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+class TestChunkStore(unittest.TestCase):
+    """A set of test cases for the ChunkStore object and friends"""
+
+    def setUp(self):
+        """Every test gets an empty store, and an OVA that's a few chunks big"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = chunk_store.ChunkStore(os.path.join(self.tmp.name, '.chunks'))
+        self.disk = random_bytes(3 * 1024 * 1024, seed=1)
+        self.ova_file = self._make_ova('vm.ova', self.disk)
+        with open(self.ova_file, 'rb') as the_file:
+            self.ova_data = the_file.read()
+
+    def _make_ova(self, name, disk):
+        ova_file = os.path.join(self.tmp.name, name)
+        make_ova(ova_file, {'vm-disk1.vmdk': disk})
+        return ova_file
+
+    def _put(self, ova_file):
+        manifest = ova_file.replace('.ova', chunk_store.MANIFEST_SUFFIX)
+        self.store.put(ova_file, manifest)
+        return manifest
+
+    def test_chunk_boundaries(self):
+        """``chunk_boundaries`` returns chunks that are within the size limits, and add up to the file"""
+        chunks = list(chunk_store.chunk_boundaries(io.BytesIO(self.ova_data)))
+
+        self.assertEqual(b''.join(chunks), self.ova_data)
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks[:-1]:
+            self.assertTrue(chunk_store.MIN_CHUNK <= len(chunk) <= chunk_store.MAX_CHUNK)
+
+    def test_chunk_boundaries_read_size(self):
+        """``chunk_boundaries`` finds the same chunks no matter how the file is read"""
+        expected = list(chunk_store.chunk_boundaries(io.BytesIO(self.ova_data)))
+        with patch.object(chunk_store, 'READ_SIZE', 100000):
+            output = list(chunk_store.chunk_boundaries(io.BytesIO(self.ova_data)))
+
+        self.assertEqual(output, expected)
+
+    def test_chunk_boundaries_shifted(self):
+        """``chunk_boundaries`` finds the same chunks after sectors are inserted before them"""
+        data = random_bytes(8 * 1024 * 1024, seed=2)
+        shifted = random_bytes(3 * chunk_store.SECTOR_SIZE, seed=3) + data
+        first = list(chunk_store.chunk_boundaries(io.BytesIO(data)))
+        second = set(chunk_store.chunk_boundaries(io.BytesIO(shifted)))
+
+        shared = [x for x in first if x in second]
+
+        self.assertTrue(len(shared) >= len(first) - 2)
+
+    def test_chunk_boundaries_zeros(self):
+        """``chunk_boundaries`` makes the biggest chunks it can out of a zero filled disk"""
+        chunks = list(chunk_store.chunk_boundaries(io.BytesIO(bytes(9 * 1024 * 1024))))
+
+        self.assertEqual([len(x) for x in chunks], [chunk_store.MAX_CHUNK, chunk_store.MAX_CHUNK, 1024 * 1024])
+
+    def test_boundary_sectors(self):
+        """``boundary_sectors`` only looks at whole sectors, between start and end"""
+        data = random_bytes(4 * 1024 * 1024, seed=4)
+        found = chunk_store.boundary_sectors(data)
+        offset = (found[0] - 1) * chunk_store.SECTOR_SIZE
+
+        output = chunk_store.boundary_sectors(data, offset, len(data) - 100)
+
+        self.assertEqual(output, [x - found[0] + 1 for x in found if x < len(data) // chunk_store.SECTOR_SIZE - 1])
+
+    def test_put(self):
+        """``ChunkStore`` - put replaces the OVA with a manifest"""
+        manifest = self._put(self.ova_file)
+
+        self.assertFalse(os.path.exists(self.ova_file))
+        self.assertEqual(chunk_store.read_manifest(manifest)['size'], len(self.ova_data))
+
+    def test_roundtrip(self):
+        """``ChunkedHandle`` reads back the exact OVA that was stored"""
+        handle = chunk_store.ChunkedHandle(self._put(self.ova_file), store=self.store)
+        try:
+            self.assertEqual(handle.read(), self.ova_data)
+            handle.seek(12345)
+            self.assertEqual(handle.read(777777), self.ova_data[12345:12345 + 777777])
+            self.assertEqual(handle.tell(), 12345 + 777777)
+            self.assertEqual(handle.read(0), b'')
+        finally:
+            handle.close()
+
+    def test_dedup(self):
+        """``ChunkStore`` only saves the chunks that differ between similar OVAs"""
+        disk = bytearray(self.disk)
+        disk[2 * 1024 * 1024:2 * 1024 * 1024 + 10] = b'x' * 10
+        other_ova = self._make_ova('other.ova', bytes(disk))
+        first = chunk_store.read_manifest(self._put(self.ova_file))
+        second = chunk_store.read_manifest(self._put(other_ova))
+        shared = {x for x, _ in first['chunks']} & {x for x, _ in second['chunks']}
+
+        self.assertTrue(shared)
+        for digest in shared:
+            self.assertEqual(self.store.refcount(digest), 2)
+
+    def test_release(self):
+        """``ChunkStore`` - release deletes the chunks no other manifest uses"""
+        other_ova = self._make_ova('other.ova', self.disk)
+        first = self._put(self.ova_file)
+        second = self._put(other_ova)
+        digests = [x for x, _ in chunk_store.read_manifest(first)['chunks']]
+
+        self.store.release(first)
+        self.assertTrue(all(os.path.exists(self.store.chunk_path(x)) for x in digests))
+        self.store.release(second)
+        self.assertFalse(any(os.path.exists(self.store.chunk_path(x)) for x in digests))
+        self.assertEqual(self.store.refcount(digests[0]), 0)
+
+    def test_retain(self):
+        """``ChunkStore`` - retain makes another manifest that keeps the chunks alive"""
+        first = self._put(self.ova_file)
+        second = os.path.join(self.tmp.name, 'copy.manifest')
+        self.store.retain(first, second)
+        digests = [x for x, _ in chunk_store.read_manifest(first)['chunks']]
+
+        self.store.release(first)
+        self.assertTrue(all(os.path.exists(self.store.chunk_path(x)) for x in digests))
+        self.assertEqual(chunk_store.read_manifest(second), chunk_store.read_manifest(first))
+
+    def test_retain_missing(self):
+        """``ChunkStore`` - retain raises FileNotFoundError if a chunk is gone"""
+        first = self._put(self.ova_file)
+        digests = [x for x, _ in chunk_store.read_manifest(first)['chunks']]
+        os.remove(self.store.chunk_path(digests[0]))
+        second = os.path.join(self.tmp.name, 'copy.manifest')
+
+        with self.assertRaises(FileNotFoundError):
+            self.store.retain(first, second)
+        self.assertFalse(os.path.exists(second))
+        self.assertEqual(self.store.refcount(digests[1]), 1)
+
+    def test_put_restores_collected_chunks(self):
+        """``ChunkStore`` - put writes chunks deleted by a concurrent release back"""
+        other_ova = self._make_ova('other.ova', self.disk)
+        first = self._put(self.ova_file)
+        digests = [x for x, _ in chunk_store.read_manifest(first)['chunks']]
+        # Simulates the last reference being dropped after the chunks were
+        # written, but before put took the lock
+        os.remove(self.store.chunk_path(digests[0]))
+        self.store.release(first)
+        second = self._put(other_ova)
+
+        handle = chunk_store.ChunkedHandle(second, store=self.store)
+        try:
+            self.assertEqual(handle.read(), self.ova_data)
+        finally:
+            handle.close()
+
+    def test_open_ova(self):
+        """``open_ova`` can deploy from the manifest of an OVA in the chunk store"""
+        expected = Ova(self.ova_file)
+        manifest = self._put(self.ova_file)
+        store = chunk_store.STORE
+        chunk_store.STORE = self.store
+        self.addCleanup(setattr, chunk_store, 'STORE', store)
+        output = ova_cache.open_ova(manifest)
+        try:
+            self.assertEqual(output.ovf, expected.ovf)
+            self.assertEqual(output.networks, expected.networks)
+            self.assertEqual(output._disks['vm-disk1.vmdk'].read(), self.disk)
+        finally:
+            output.close()
+            expected.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
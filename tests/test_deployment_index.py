@@ -0,0 +1,289 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the deployment_index.py module
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import deployment_index
+from .fake_vcenter import FakeVSphere, patched
+
+DEPLOYED = {'component': 'myTemplate', 'deployment': True, 'created': 1234,
+            'version': 'n/a', 'configured': True, 'generation': 1}
+
+
+class TestDeploymentIndex(unittest.TestCase):
+    """A set of test cases for the DeploymentIndex object"""
+
+    def setUp(self):
+        """Every test gets an empty directory for entries"""
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+        self.index = deployment_index.DeploymentIndex(ttl=60, lock_dir=self.lock_dir)
+
+    def test_lookup_unknown(self):
+        """``DeploymentIndex`` - lookup returns None for a user it knows nothing about"""
+        self.assertTrue(self.index.lookup('alice') is None)
+
+    def test_record(self):
+        """``DeploymentIndex`` - lookup returns what was recorded"""
+        self.index.record('bob', 'myTemplate')
+
+        self.assertEqual(self.index.lookup('bob'), 'myTemplate')
+
+    def test_record_no_deployment(self):
+        """``DeploymentIndex`` - "no deployment" is remembered too"""
+        self.index.record('alice', 'myTemplate')
+        self.index.record('alice', '')
+
+        self.assertEqual(self.index.lookup('alice'), '')
+
+    def test_shared(self):
+        """``DeploymentIndex`` - every index using the same directory (i.e. in other processes) sees the same entries"""
+        other = deployment_index.DeploymentIndex(ttl=60, lock_dir=self.lock_dir)
+        self.index.record('alice', 'myTemplate')
+        other.record('alice', '')
+
+        self.assertEqual(self.index.lookup('alice'), '')
+
+    @patch.object(deployment_index.time, 'time')
+    def test_ttl(self, fake_time):
+        """``DeploymentIndex`` - entries expire after the TTL"""
+        fake_time.return_value = 100
+        self.index.record('alice', 'myTemplate')
+        fake_time.return_value = 160
+
+        self.assertTrue(self.index.lookup('alice') is None)
+
+    @patch.object(deployment_index.time, 'time')
+    def test_pending(self, fake_time):
+        """``DeploymentIndex`` - the entry of a deploy in progress lasts past the TTL"""
+        fake_time.return_value = 100
+        with self.index.claim('alice'):
+            self.index.record('alice', 'myTemplate', pending=True)
+            fake_time.return_value = 1000
+
+            self.assertEqual(self.index.lookup('alice'), 'myTemplate')
+
+    def test_pending_abandoned(self):
+        """``DeploymentIndex`` - the entry of a deploy in progress is not trusted once its claim is let go"""
+        with self.index.claim('alice'):
+            self.index.record('alice', 'myTemplate', pending=True)
+
+        self.assertTrue(self.index.lookup('alice') is None)
+
+    def test_corrupt(self):
+        """``DeploymentIndex`` - an unreadable entry means the index doesn't know"""
+        with open(os.path.join(self.lock_dir, 'alice.deployment'), 'w') as the_file:
+            the_file.write('{"template": ')
+
+        self.assertTrue(self.index.lookup('alice') is None)
+
+    def test_invalidate(self):
+        """``DeploymentIndex`` - invalidate forgets a user"""
+        self.index.record('alice', 'myTemplate')
+        self.index.invalidate('alice')
+
+        self.assertTrue(self.index.lookup('alice') is None)
+
+    def test_clear(self):
+        """``DeploymentIndex`` - clear forgets every user, but not their claims"""
+        self.index.record('alice', 'myTemplate')
+        self.index.record('bob', '')
+        with self.index.claim('alice'):
+            self.index.clear()
+
+            self.assertTrue(self.index.lookup('alice') is None)
+            self.assertTrue(self.index.lookup('bob') is None)
+            self.assertTrue(os.path.exists(os.path.join(self.lock_dir, 'alice.lock')))
+
+
+class TestClaim(unittest.TestCase):
+    """A set of test cases for ``DeploymentIndex.claim``"""
+
+    def setUp(self):
+        """Every test gets an empty directory for claims"""
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+        self.index = deployment_index.DeploymentIndex(ttl=60, lock_dir=self.lock_dir)
+
+    def test_claim(self):
+        """``DeploymentIndex`` - a second claim of the same user raises ValueError"""
+        with self.index.claim('alice'):
+            with self.assertRaises(ValueError):
+                with self.index.claim('alice'):
+                    pass
+
+    def test_claim_other_user(self):
+        """``DeploymentIndex`` - claims of different users don't block each other"""
+        with self.index.claim('alice'):
+            with self.index.claim('bob'):
+                pass
+
+    def test_claim_released(self):
+        """``DeploymentIndex`` - a user can be claimed again once the claim is let go"""
+        with self.index.claim('alice'):
+            pass
+        with self.index.claim('alice'):
+            pass
+
+    def test_claim_other_process(self):
+        """``DeploymentIndex`` - a claim held by another worker process is honored"""
+        script = ('import sys; from vlab_deployment_api.lib.worker import deployment_index; '
+                  'index = deployment_index.DeploymentIndex(ttl=60, lock_dir=sys.argv[1]); '
+                  'claim = index.claim("alice"); claim.__enter__(); '
+                  'print("claimed", flush=True); sys.stdin.read()')
+        holder = subprocess.Popen([sys.executable, '-c', script, self.lock_dir],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), b'claimed')
+            with self.assertRaises(ValueError):
+                with self.index.claim('alice'):
+                    pass
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        # The claim goes away with the process
+        with self.index.claim('alice'):
+            pass
+
+
+class TestWriteThrough(unittest.TestCase):
+    """The create/delete logic keeps the index up to date"""
+
+    def setUp(self):
+        """Every test gets a fake vSphere and a template with a couple of VMs"""
+        self.server = FakeVSphere()
+        self.server.add_user('alice')
+        meta = {'machines': {'vm01': {'ova_path': '/foo.ova', 'kind': 'CentOS'},
+                             'vm02': {'ova_path': '/foo.ova', 'kind': 'CentOS'}}}
+        patcher = patch.object(vmware, 'get_meta', return_value=meta)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deployment_cached(self):
+        """``_check_for_deployment`` - a known deployment does not touch vCenter"""
+        self.server.add_vm('alice', 'vm01-dply', meta=DEPLOYED)
+        with patched(self.server):
+            vmware._check_for_deployment('alice')
+            before = self.server.round_trips
+            vmware._check_for_deployment('alice')
+
+            self.assertEqual(self.server.round_trips, before)
+
+    def test_no_deployment_cached(self):
+        """``_check_for_deployment`` - a known lack of deployment does not touch vCenter"""
+        with patched(self.server):
+            vmware._check_for_deployment('alice')
+            before = self.server.round_trips
+
+            self.assertEqual(vmware._check_for_deployment('alice'), '')
+            self.assertEqual(self.server.round_trips, before)
+
+    def test_create_elsewhere(self):
+        """``create_deployment`` - rejected when another process made a deployment since this one looked"""
+        with patched(self.server):
+            vmware._check_for_deployment('alice')
+            # i.e. a create by a different worker process
+            other = deployment_index.DeploymentIndex(ttl=60, lock_dir=vmware.INDEX.lock_dir)
+            other.record('alice', 'myTemplate')
+
+            with self.assertRaises(ValueError):
+                vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+    def test_delete_elsewhere(self):
+        """``create_deployment`` - allowed when another process deleted the deployment"""
+        self.server.add_vm('alice', 'vm01-dply', meta=DEPLOYED)
+        with patched(self.server):
+            vmware._check_for_deployment('alice')
+            # i.e. a delete by a different worker process
+            other = deployment_index.DeploymentIndex(ttl=60, lock_dir=vmware.INDEX.lock_dir)
+            with patch.object(vmware, 'INDEX', other):
+                vmware.delete_deployment('alice', 'myTemplate', MagicMock())
+
+            vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+            self.assertEqual(len(self.server.vms('alice')), 2)
+
+    def test_create_claimed(self):
+        """``create_deployment`` - rejected while another create holds the user's claim"""
+        with patched(self.server):
+            with vmware.INDEX.claim('alice'):
+                with self.assertRaises(ValueError):
+                    vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+            self.assertEqual(self.server.vms('alice'), [])
+
+    def test_create(self):
+        """``create_deployment`` - records the template deployed"""
+        with patched(self.server):
+            vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+            self.assertEqual(vmware.INDEX.lookup('alice'), 'myTemplate')
+
+    def test_create_in_progress(self):
+        """``create_deployment`` - the deployment is known while its VMs are still being made"""
+        seen = []
+        with patched(self.server):
+            real_create_vm = vmware._create_vm
+            def create_vm(*args, **kwargs):
+                seen.append(vmware.INDEX.lookup('alice'))
+                return real_create_vm(*args, **kwargs)
+            with patch.object(vmware, '_create_vm', create_vm):
+                vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+        self.assertEqual(seen, ['myTemplate', 'myTemplate'])
+
+    def test_create_rejects_second(self):
+        """``create_deployment`` - a second create is rejected from the index"""
+        with patched(self.server):
+            vmware.create_deployment('alice', 'myTemplate', MagicMock())
+            with self.assertRaises(ValueError):
+                vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+    def test_create_failure(self):
+        """``create_deployment`` - invalidates the user when a VM fails to deploy"""
+        with patched(self.server):
+            with patch.object(vmware, '_create_vm', side_effect=RuntimeError('testing')):
+                with self.assertRaises(RuntimeError):
+                    vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+            self.assertTrue(vmware.INDEX.lookup('alice') is None)
+
+    def test_delete(self):
+        """``delete_deployment`` - records that the user has no deployment"""
+        with patched(self.server):
+            vmware.create_deployment('alice', 'myTemplate', MagicMock())
+            vmware.delete_deployment('alice', 'myTemplate', MagicMock())
+
+            self.assertEqual(vmware.INDEX.lookup('alice'), '')
+
+    def test_delete_failure(self):
+        """``delete_deployment`` - invalidates the user when a VM fails to be destroyed"""
+        self.server.add_vm('alice', 'vm01-dply', meta=DEPLOYED)
+        with patched(self.server):
+            vmware.INDEX.record('alice', 'myTemplate')
+            with patch.object(vmware, '_teardown', side_effect=RuntimeError('testing')):
+                with self.assertRaises(RuntimeError):
+                    vmware.delete_deployment('alice', 'myTemplate', MagicMock())
+
+            self.assertTrue(vmware.INDEX.lookup('alice') is None)
+
+    def test_rebuild(self):
+        """``_check_for_deployment`` - an unknown user is looked up in vCenter"""
+        self.server.add_vm('alice', 'vm01-dply', meta=DEPLOYED)
+        with patched(self.server):
+            output = vmware._check_for_deployment('alice')
+
+            self.assertEqual(output, 'myTemplate')
+            self.assertEqual(vmware.INDEX.lookup('alice'), 'myTemplate')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,10 @@
 """
 A suite of tests for the deployment object
 """
+import sys
+import sqlite3
 import unittest
+import subprocess
 from unittest.mock import patch, MagicMock
 
 import ujson
@@ -12,6 +15,7 @@ from vlab_api_common.http_auth import generate_v2_test_token
 
 
 from vlab_deployment_api.lib.views import deployment
+from vlab_deployment_api.lib.worker import catalog
 
 
 class TestDeploymentView(unittest.TestCase):
@@ -140,5 +144,142 @@ class TestDeploymentView(unittest.TestCase):
 
         self.assertEqual(the_args, expected)
 
+    def test_image_query(self):
+        """DeploymentView - GET on /api/2/inf/deployment/image passes filters, fields and paging to the task"""
+        self.app.get('/api/2/inf/deployment/image?owner=sam&kind=OneFS&prefix=my&fields=summary,machine_names&limit=10&cursor=abc',
+                     headers={'X-Auth': self.token})
+        _, the_kwargs = self.celery_app.send_task.call_args
+        expected = {'owner': 'sam', 'kind': 'OneFS', 'prefix': 'my', 'fields': ['summary', 'machine_names'],
+                    'limit': 10, 'cursor': 'abc'}
+
+        self.assertEqual(the_kwargs['kwargs'], expected)
+
+    def test_image_bad_limit(self):
+        """DeploymentView - GET on /api/2/inf/deployment/image returns HTTP 400 for a bad limit"""
+        resp = self.app.get('/api/2/inf/deployment/image?limit=lots',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.celery_app.send_task.called)
+
+    def test_image_limit_too_big(self):
+        """DeploymentView - GET on /api/2/inf/deployment/image returns HTTP 400 when the limit is too big"""
+        resp = self.app.get('/api/2/inf/deployment/image?limit=100000',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_image_bad_field(self):
+        """DeploymentView - GET on /api/2/inf/deployment/image returns HTTP 400 for an unknown field"""
+        resp = self.app.get('/api/2/inf/deployment/image?fields=summary,password',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(catalog, 'list_images')
+    def test_image_inline(self, fake_list_images):
+        """DeploymentView - GET on /api/2/inf/deployment/image?inline=true responds with the images"""
+        fake_list_images.return_value = ['myTemplate']
+        with patch.object(deployment, 'const', deployment.const._replace(VLAB_CATALOG_INLINE=True)):
+            resp = self.app.get('/api/2/inf/deployment/image?inline=true',
+                                headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'image': ['myTemplate']})
+        self.assertFalse(self.celery_app.send_task.called)
+
+    @patch.object(catalog, 'list_images')
+    def test_image_inline_page(self, fake_list_images):
+        """DeploymentView - GET on /api/2/inf/deployment/image?inline=true includes the next cursor"""
+        fake_list_images.return_value = ['t1', 't2']
+        with patch.object(deployment, 'const', deployment.const._replace(VLAB_CATALOG_INLINE=True)):
+            resp = self.app.get('/api/2/inf/deployment/image?inline=true&limit=2',
+                                headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.json['content']['next'], catalog.next_cursor(['t1', 't2'], 2))
+
+    @patch.object(catalog, 'list_images')
+    def test_image_inline_error(self, fake_list_images):
+        """DeploymentView - GET on /api/2/inf/deployment/image?inline=true returns HTTP 400 for a bad query"""
+        fake_list_images.side_effect = ValueError('Invalid cursor')
+        with patch.object(deployment, 'const', deployment.const._replace(VLAB_CATALOG_INLINE=True)):
+            resp = self.app.get('/api/2/inf/deployment/image?inline=true&cursor=junk',
+                                headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['error'], 'Invalid cursor')
+
+    @patch.object(catalog, 'list_images')
+    def test_image_inline_unavailable(self, fake_list_images):
+        """DeploymentView - GET on /api/2/inf/deployment/image?inline=true returns HTTP 503 when the templates can't be read"""
+        with patch.object(deployment, 'const', deployment.const._replace(VLAB_CATALOG_INLINE=True)):
+            for error in [OSError('Stale file handle'), sqlite3.OperationalError('unable to open database file')]:
+                fake_list_images.side_effect = error
+                resp = self.app.get('/api/2/inf/deployment/image?inline=true',
+                                    headers={'X-Auth': self.token})
+
+                self.assertEqual(resp.status_code, 503)
+                self.assertTrue(resp.json['error'].startswith('Unable to read the template catalog'))
+
+    def test_api_imports(self):
+        """DeploymentView - the API does not load the worker, only the catalog when it's used"""
+        script = ('import sys; from vlab_deployment_api.lib.views import deployment; '
+                  'deployment.catalog_reader(); '
+                  'print(sorted(x for x in sys.modules if x.startswith("vlab_deployment_api.lib.worker.")))')
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.DEVNULL).decode()
+        loaded = eval(output)
+
+        self.assertEqual(loaded, ['vlab_deployment_api.lib.worker.catalog', 'vlab_deployment_api.lib.worker.progress'])
+
+    def test_image_inline_disabled(self):
+        """DeploymentView - GET on /api/2/inf/deployment/image?inline=true still makes a task, unless the server allows it"""
+        resp = self.app.get('/api/2/inf/deployment/image?inline=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(self.celery_app.send_task.called)
+
+    def test_task_progress(self):
+        """DeploymentView - GET on ./task includes the progress of a running task"""
+        info = {'machines': {'vm01-dply': {'phase': 'uploading', 'bytes': 10, 'total': 100, 'eta': 90}},
+                'bytes': 10, 'total': 100, 'eta': 90, 'elapsed': 10}
+        self.celery_app.AsyncResult.return_value.status = 'PROGRESS'
+        self.celery_app.AsyncResult.return_value.info = info
+        resp = self.app.get('/api/2/inf/deployment/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['progress'], info)
+
+    def test_task_retry_after(self):
+        """DeploymentView - GET on ./task sets the Retry-After header based on the ETA of the task"""
+        self.celery_app.AsyncResult.return_value.status = 'PROGRESS'
+        self.celery_app.AsyncResult.return_value.info = {'eta': 200}
+        resp = self.app.get('/api/2/inf/deployment/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.headers['Retry-After'], '20')
+
+    def test_task_pending(self):
+        """DeploymentView - GET on ./task returns HTTP 202 when the task has not started"""
+        self.celery_app.AsyncResult.return_value.status = 'PENDING'
+        self.celery_app.AsyncResult.return_value.info = None
+        resp = self.app.get('/api/2/inf/deployment/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertFalse('progress' in resp.json['content'])
+
+    def test_task_success(self):
+        """DeploymentView - GET on ./task returns the result of a finished task"""
+        self.celery_app.AsyncResult.return_value.status = 'SUCCESS'
+        self.celery_app.AsyncResult.return_value.result = {'content': {'worked': True}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/deployment/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'worked': True})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the export.py module
+"""
+import os
+import time
+import hashlib
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import requests
+from pyVmomi import vim
+
+from vlab_deployment_api.lib.worker import export
+
+
+class FakeResponse(object):
+    """Stands in for a streamed ``requests.Response``"""
+    def __init__(self, data, delay=0):
+        self.data = data
+        self.delay = delay
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        time.sleep(self.delay)
+        for idx in range(0, len(self.data), chunk_size):
+            yield self.data[idx:idx + chunk_size]
+
+    def close(self):
+        pass
+
+
+class TestBandwidth(unittest.TestCase):
+    """A set of test cases for the Bandwidth object"""
+
+    @patch.object(export.time, 'sleep')
+    def test_limit(self, fake_sleep):
+        """``Bandwidth`` makes callers wait once the budget is spent"""
+        bandwidth = export.Bandwidth(rate=1000)
+        bandwidth.consume(1000)
+        bandwidth.consume(500)
+
+        waited = sum(x[0][0] for x in fake_sleep.call_args_list)
+        self.assertAlmostEqual(waited, 0.5, places=1)
+
+    @patch.object(export.time, 'sleep')
+    def test_unlimited(self, fake_sleep):
+        """``Bandwidth`` never waits when the rate is zero"""
+        bandwidth = export.Bandwidth(rate=0)
+        bandwidth.consume(10**12)
+
+        self.assertFalse(fake_sleep.called)
+
+
+class TestMakeOva(unittest.TestCase):
+    """A set of test cases for the ``make_ova`` function"""
+
+    def setUp(self):
+        """Every test gets a VM with three disks to export"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.disks = {'disk-{}.vmdk'.format(x): os.urandom(300 * 1024) for x in range(3)}
+        self.devices = [vim.HttpNfcLease.DeviceUrl(key='/vm-1/{}'.format(x), url='https://esxi/{}'.format(x),
+                                                    disk=True, targetId=x) for x in sorted(self.disks.keys())]
+        self.lease = MagicMock()
+        self.lease.info.deviceUrl = self.devices
+        self.lease.info.totalDiskCapacityInKB = 1024
+        self.the_vm = MagicMock()
+        self.the_vm.name = 'myVM-dply'
+        self.the_vm.ExportVm.return_value = self.lease
+        for target, attr in ((export.virtual_machine, 'power'),
+                             (export.virtual_machine, '_block_on_lease')):
+            patcher = patch.object(target, attr)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(export.virtual_machine, 'get_vm_ovf_xml', return_value='<Envelope/>')
+        self.fake_get_vm_ovf_xml = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get(self, delay=0):
+        """Make a fake ``requests.get`` that serves the VM's disks"""
+        return lambda url, **kwargs: FakeResponse(self.disks[url.split('/')[-1]], delay=delay)
+
+    def test_ova(self):
+        """``make_ova`` writes the OVF, then the manifest, then the disks"""
+        with patch.object(export.requests, 'get', side_effect=self._get()):
+            output = export.make_ova(MagicMock(), self.the_vm, self.tmp.name, MagicMock(), ova_name='myVM')
+
+        with tarfile.open(output) as the_ova:
+            names = the_ova.getnames()
+            manifest = the_ova.extractfile('myVM-dply.mf').read().decode()
+            disk = the_ova.extractfile('disk-1.vmdk').read()
+        expected = ['myVM-dply.ovf', 'myVM-dply.mf'] + sorted(self.disks.keys())
+
+        self.assertEqual(output, os.path.join(self.tmp.name, 'myVM.ova'))
+        self.assertEqual(names, expected)
+        self.assertEqual(disk, self.disks['disk-1.vmdk'])
+        self.assertTrue('SHA256(disk-1.vmdk)= {}'.format(hashlib.sha256(disk).hexdigest()) in manifest)
+        self.assertTrue('SHA256(myVM-dply.ovf)= {}'.format(hashlib.sha256(b'<Envelope/>').hexdigest()) in manifest)
+        self.assertEqual(os.listdir(self.tmp.name), ['myVM.ova'])
+
+    def test_ovf_sizes(self):
+        """``make_ova`` describes the size of every disk in the OVF"""
+        with patch.object(export.requests, 'get', side_effect=self._get()):
+            export.make_ova(MagicMock(), self.the_vm, self.tmp.name, MagicMock())
+
+        device_ovfs = self.fake_get_vm_ovf_xml.call_args[0][1]
+        output = {x.path: x.size for x in device_ovfs}
+        expected = {x: len(y) for x, y in self.disks.items()}
+
+        self.assertEqual(output, expected)
+
+    def test_concurrent(self):
+        """``make_ova`` downloads every disk at the same time"""
+        with patch.object(export.requests, 'get', side_effect=self._get(delay=0.2)):
+            start = time.time()
+            export.make_ova(MagicMock(), self.the_vm, self.tmp.name, MagicMock())
+            elapsed = time.time() - start
+
+        self.assertTrue(elapsed < 0.5)
+
+    def test_lease_complete(self):
+        """``make_ova`` completes the export lease"""
+        with patch.object(export.requests, 'get', side_effect=self._get()):
+            export.make_ova(MagicMock(), self.the_vm, self.tmp.name, MagicMock())
+
+        self.lease.HttpNfcLeaseProgress.assert_called_with(100)
+        self.assertTrue(self.lease.HttpNfcLeaseComplete.called)
+
+    def test_failure(self):
+        """``make_ova`` aborts the lease, and cleans up, when a disk fails to download"""
+        with patch.object(export.requests, 'get', side_effect=requests.exceptions.ConnectionError('testing')):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                export.make_ova(MagicMock(), self.the_vm, self.tmp.name, MagicMock())
+
+        self.assertTrue(self.lease.HttpNfcLeaseAbort.called)
+        self.assertFalse(self.lease.HttpNfcLeaseComplete.called)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+
+class TestExportProgress(unittest.TestCase):
+    """A set of test cases for the ExportProgress object"""
+
+    def test_percent(self):
+        """``ExportProgress`` reports the share of bytes downloaded, but never 100 until complete"""
+        progress = export.ExportProgress(MagicMock(), total=1000, logger=MagicMock())
+        progress.add(500)
+        half = progress.percent
+        progress.add(5000)
+
+        self.assertEqual(half, 50)
+        self.assertEqual(progress.percent, 99)
+
+    def test_keep_alive(self):
+        """``ExportProgress`` updates the lease while the export runs"""
+        lease = MagicMock()
+        with export.ExportProgress(lease, total=1000, logger=MagicMock(), interval=0.01):
+            time.sleep(0.1)
+
+        self.assertTrue(lease.HttpNfcLeaseProgress.call_count > 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
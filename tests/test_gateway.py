@@ -0,0 +1,117 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the gateway.py module
+"""
+import unittest
+
+from vlab_deployment_api.lib import gateway
+from .fake_gateway import FakeGateway, PORTMAP_PATH
+
+HEADERS = {'X-Auth': 'aaa.bbb.ccc'}
+
+
+class TestGatewayClient(unittest.TestCase):
+    """A set of test cases for the GatewayClient object"""
+
+    def setUp(self):
+        """Every test gets a stand-in gateway, and a client for it"""
+        self.gateway = FakeGateway().start()
+        self.addCleanup(self.gateway.stop)
+        self.client = self.gateway.client(concurrency=4)
+        self.addCleanup(self.client.close)
+
+    def test_url(self):
+        """``GatewayClient`` the gateway of a user is a subdomain of the vLab server"""
+        client = gateway.GatewayClient(fqdn='vlab.local', concurrency=1, timeout=1)
+
+        self.assertEqual(client.url('homer', PORTMAP_PATH), 'https://homer.vlab.local/api/1/ipam/portmap')
+
+    def test_session(self):
+        """``GatewayClient`` uses one session per gateway"""
+        self.assertTrue(self.client.session('homer') is self.client.session('homer'))
+        self.assertFalse(self.client.session('homer') is self.client.session('marge'))
+
+    def test_session_not_verified(self):
+        """``GatewayClient`` does not verify the self-signed certs of gateways"""
+        self.assertFalse(self.client.session('homer').verify)
+
+    def test_max_gateways(self):
+        """``GatewayClient`` closes the least recently used session"""
+        self.client.max_gateways = 2
+        first = self.client.session('homer')
+        self.client.session('marge')
+        self.client.session('homer')
+        self.client.session('bart')
+
+        self.assertEqual(list(self.client._sessions.keys()), ['homer', 'bart'])
+        self.assertTrue(self.client.session('homer') is first)
+
+    def test_keep_alive(self):
+        """``GatewayClient`` requests to the same gateway reuse the connection"""
+        for _ in range(5):
+            self.client.request('homer', 'get', PORTMAP_PATH, headers=HEADERS).raise_for_status()
+
+        self.assertEqual(self.gateway.stats['connections'], 1)
+
+
+class TestBatch(unittest.TestCase):
+    """A set of test cases for the Batch object"""
+
+    def setUp(self):
+        """Every test gets a stand-in gateway, and a client for it"""
+        self.gateway = FakeGateway(latency=0.02).start()
+        self.addCleanup(self.gateway.stop)
+        self.client = self.gateway.client(concurrency=4)
+        self.addCleanup(self.client.close)
+
+    def test_batch(self):
+        """``Batch`` returns every response, in the order submitted"""
+        with self.client.batch('homer', HEADERS) as batch:
+            for port in range(10):
+                batch.submit('post', PORTMAP_PATH, json={'target_port': port})
+        output = [x.json()['content']['conn_port'] for x in batch.wait()]
+
+        self.assertEqual(len(set(output)), 10)
+        self.assertEqual(sorted(x['target_port'] for x in self.gateway.portmaps['homer'].values()), list(range(10)))
+
+    def test_concurrency(self):
+        """``Batch`` has no more requests in flight than the client allows"""
+        with self.client.batch('homer', HEADERS) as batch:
+            for port in range(20):
+                batch.submit('post', PORTMAP_PATH, json={'target_port': port})
+
+        self.assertTrue(1 < self.gateway.stats['max_in_flight'] <= 4)
+        self.assertTrue(self.gateway.stats['connections'] <= 4)
+
+    def test_errors(self):
+        """``Batch`` sends every request, then raises GatewayError with every failure"""
+        self.gateway.fail(times=3)
+        with self.assertRaises(gateway.GatewayError) as the_error:
+            with self.client.batch('homer', HEADERS) as batch:
+                for port in range(10):
+                    batch.submit('post', PORTMAP_PATH, json={'target_port': port})
+
+        self.assertEqual(len(the_error.exception.errors), 3)
+        self.assertEqual(len(self.gateway.portmaps['homer']), 7)
+        self.assertEqual(self.client.stats['errors'], 3)
+
+    def test_unreachable(self):
+        """``Batch`` reports a gateway that can't be reached as an error"""
+        client = gateway.GatewayClient(fqdn='', concurrency=2, timeout=1, url_format='http://127.0.0.1:1/{username}')
+        with self.assertRaises(gateway.GatewayError) as the_error:
+            with client.batch('homer', HEADERS) as batch:
+                batch.submit('get', PORTMAP_PATH)
+
+        self.assertTrue('GET /api/1/ipam/portmap failed' in the_error.exception.errors[0])
+
+    def test_headers(self):
+        """``Batch`` sends its headers with every request"""
+        with self.assertRaises(gateway.GatewayError) as the_error:
+            with self.client.batch('homer') as batch:
+                batch.submit('get', PORTMAP_PATH)
+
+        self.assertTrue('401' in the_error.exception.errors[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the integrity.py module
+"""
+import io
+import os
+import hashlib
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_deployment_api.lib.worker import integrity
+from vlab_deployment_api.lib.worker import chunk_store
+
+OVF = b'<Envelope><VirtualSystem ovf:id="vm01"/></Envelope>'
+
+
+def make_ova(path, files, digests=None):
+    """Write an OVA with a manifest, like ``export.make_ova`` does"""
+    if digests is None:
+        digests = {x: hashlib.sha256(y).hexdigest() for x, y in files.items()}
+    manifest = ''.join('SHA256({})= {}\n'.format(x, y) for x, y in digests.items()).encode()
+    with tarfile.open(path, 'w') as the_tar:
+        for name, data in list(files.items()) + [('vm01.mf', manifest)]:
+            info = tarfile.TarInfo(name=name)
+            info.size = len(data)
+            the_tar.addfile(info, io.BytesIO(data))
+
+
+class TestIntegrity(unittest.TestCase):
+    """A set of test cases for integrity.py"""
+
+    def setUp(self):
+        """Every test gets an OVA with an OVF, a disk and a manifest"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.ova_file = os.path.join(self.tmp.name, 'vm01.ova')
+        self.contents = {'vm01.ovf': OVF, 'vm01-disk1.vmdk': os.urandom(5000)}
+        make_ova(self.ova_file, self.contents)
+        self.files = integrity.ova_digests(self.ova_file)
+
+    def test_ova_digests(self):
+        """``ova_digests`` returns the SHA256 and size of every file in the manifest"""
+        expected = {x: {'sha256': hashlib.sha256(y).hexdigest(), 'size': len(y)} for x, y in self.contents.items()}
+
+        self.assertEqual(self.files, expected)
+
+    def test_ova_digests_unlisted(self):
+        """``ova_digests`` leaves out files the manifest doesn't list"""
+        make_ova(self.ova_file, self.contents, digests={'vm01.ovf': hashlib.sha256(OVF).hexdigest()})
+
+        self.assertEqual(list(integrity.ova_digests(self.ova_file).keys()), ['vm01.ovf'])
+
+    def test_ova_digests_manifest(self):
+        """``ova_digests`` works for OVAs in the chunk store"""
+        store = chunk_store.ChunkStore(os.path.join(self.tmp.name, '.chunks'))
+        manifest = os.path.join(self.tmp.name, 'vm01.manifest')
+        store.put(self.ova_file, manifest)
+
+        with patch.object(chunk_store, 'STORE', store):
+            output = integrity.ova_digests(manifest)
+
+        self.assertEqual(output, self.files)
+
+    def test_verify_ova(self):
+        """``verify_ova`` finds no problems with an intact OVA"""
+        self.assertEqual(integrity.verify_ova(self.ova_file, self.files), [])
+
+    def test_verify_ova_corrupt(self):
+        """``verify_ova`` reports a file that doesn't match its digest"""
+        make_ova(self.ova_file, dict(self.contents, **{'vm01-disk1.vmdk': os.urandom(5000)}))
+
+        problems = integrity.verify_ova(self.ova_file, self.files)
+
+        self.assertEqual(len(problems), 1)
+        self.assertTrue('vm01-disk1.vmdk' in problems[0])
+
+    def test_verify_ova_truncated(self):
+        """``verify_ova`` reports a file that's the wrong size"""
+        make_ova(self.ova_file, dict(self.contents, **{'vm01-disk1.vmdk': b'short'}))
+
+        problems = integrity.verify_ova(self.ova_file, self.files)
+
+        self.assertTrue('5 bytes' in problems[0])
+
+    def test_verify_ova_missing(self):
+        """``verify_ova`` reports files that are not in the OVA, and OVAs that don't exist"""
+        make_ova(self.ova_file, {'vm01.ovf': OVF})
+
+        self.assertEqual(len(integrity.verify_ova(self.ova_file, self.files)), 1)
+        self.assertEqual(len(integrity.verify_ova(self.ova_file + '.nope', self.files)), 1)
+
+    @patch.object(integrity, 'get_meta')
+    def test_verify_template(self, fake_get_meta):
+        """``verify_template`` checks every machine that has digests recorded"""
+        fake_get_meta.return_value = {'machines': {'vm01': {'ova_path': self.ova_file, 'files': self.files},
+                                                   'vm02': {'ova_path': '/nope/vm02.ova'}}}
+
+        checked, problems = integrity.verify_template('foo')
+
+        self.assertEqual(checked, 2)
+        self.assertEqual(problems, [])
+
+    @patch.object(integrity, 'get_meta')
+    def test_verify(self, fake_get_meta):
+        """``verify`` returns the result of every template"""
+        fake_get_meta.return_value = {'machines': {'vm01': {'ova_path': self.ova_file, 'files': self.files}}}
+
+        output = integrity.verify(['foo', 'bar'], workers=2, rate=0)
+
+        self.assertEqual(output, {'foo': (2, []), 'bar': (2, [])})
+
+
+if __name__ == '__main__':
+    unittest.main()
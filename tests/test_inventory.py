@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the inventory.py module
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from pyVmomi import vim, vmodl
+
+from vlab_deployment_api.lib.worker import inventory
+from vlab_deployment_api.lib.worker import vmware
+from .fake_vcenter import FakeVSphere, patched
+
+DEPLOYED = {'component': 'myTemplate', 'deployment': True, 'created': 1234,
+            'version': 'n/a', 'configured': True, 'generation': 1}
+NOT_DEPLOYED = {'component': 'OneFS', 'created': 1234, 'version': '8.2.0',
+                'configured': True, 'generation': 1}
+
+
+class TestInventory(unittest.TestCase):
+    """A set of test cases for the inventory.py module"""
+
+    def test_to_record(self):
+        """``_to_record`` converts a PropertyCollector result into a dictionary"""
+        vm = vim.VirtualMachine('vm-1')
+        props = [vmodl.DynamicProperty(name='name', val='myVM'),
+                 vmodl.DynamicProperty(name='config.annotation', val='{"component": "CentOS"}'),
+                 vmodl.DynamicProperty(name='runtime.powerState', val='poweredOn'),
+                 vmodl.DynamicProperty(name='guest.net', val=vim.vm.GuestInfo.NicInfo.Array([vim.vm.GuestInfo.NicInfo(ipAddress=['1.2.3.4', 'fe80::1'])])),
+                 vmodl.DynamicProperty(name='network', val=vim.Network.Array([vim.Network('network-1')]))]
+        result = vmodl.query.PropertyCollector.ObjectContent(obj=vm, propSet=props)
+
+        output = inventory._to_record(result)
+        expected = {'vm': vm, 'moid': 'vm-1', 'name': 'myVM', 'meta': {'component': 'CentOS'},
+                    'state': 'poweredOn', 'ips': ['1.2.3.4'], 'network_moids': ['network-1']}
+
+        self.assertEqual(output, expected)
+
+    def test_to_record_no_config(self):
+        """``_to_record`` sets the same default meta data as ``get_info`` when a VM has no notes"""
+        result = vmodl.query.PropertyCollector.ObjectContent(obj=vim.VirtualMachine('vm-1'), propSet=[])
+
+        output = inventory._to_record(result)['meta']
+        expected = {'component': 'Unknown', 'created': 0, 'version': 'Unknown',
+                    'generation': 0, 'configured': False}
+
+        self.assertEqual(output, expected)
+
+    def test_get_vms(self):
+        """``get_vms`` returns a record for every VM in the folder"""
+        server = FakeVSphere()
+        server.add_user('alice')
+        server.add_vm('alice', 'vm01', meta=DEPLOYED, ips=['1.2.3.4'])
+        server.add_vm('alice', 'vm02', meta=NOT_DEPLOYED)
+        with patched(server):
+            with vmware.borrow() as vcenter:
+                folder = vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+                records = inventory.get_vms(vcenter, folder)
+
+        output = {x['name']: x['meta'] for x in records}
+        expected = {'vm01': DEPLOYED, 'vm02': NOT_DEPLOYED}
+
+        self.assertEqual(output, expected)
+
+    def test_get_details(self):
+        """``get_details`` returns the same keys as ``virtual_machine.get_info``"""
+        server = FakeVSphere()
+        server.add_user('alice')
+        server.add_vm('alice', 'vm01', meta=DEPLOYED, ips=['1.2.3.4'])
+        with patched(server):
+            with vmware.borrow() as vcenter:
+                folder = vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+                record = inventory.get_vms(vcenter, folder)[0]
+                output = inventory.get_details(vcenter, record, 'alice')
+                expected = vmware.virtual_machine.get_info(vcenter, record['vm'], 'alice')
+
+        self.assertEqual(output, expected)
+
+
+class TestRoundTrips(unittest.TestCase):
+    """The number of calls to vCenter must not grow with the number of VMs a user owns"""
+
+    def _round_trips(self, operation, vm_count):
+        """Count the vCenter API calls an operation makes for a folder with ``vm_count`` extra VMs"""
+        server = FakeVSphere()
+        server.add_user('alice')
+        for idx in range(vm_count):
+            server.add_vm('alice', 'other{}'.format(idx), meta=NOT_DEPLOYED)
+        server.add_vm('alice', 'vm01-dply', meta=DEPLOYED, state='poweredOff')
+        server.add_vm('alice', 'vm02-dply', meta=DEPLOYED, state='poweredOff')
+        with patched(server):
+            before = server.round_trips
+            operation()
+            return server.round_trips - before
+
+    def test_show_deployment(self):
+        """``show_deployment`` makes the same number of vCenter calls for 1 or 40 VMs in a folder"""
+        small = self._round_trips(lambda: vmware.show_deployment('alice'), 1)
+        large = self._round_trips(lambda: vmware.show_deployment('alice'), 40)
+
+        self.assertEqual(small, large)
+
+    def test_check_for_deployment(self):
+        """``_check_for_deployment`` makes the same number of vCenter calls for 1 or 40 VMs in a folder"""
+        small = self._round_trips(lambda: vmware._check_for_deployment('alice'), 1)
+        large = self._round_trips(lambda: vmware._check_for_deployment('alice'), 40)
+
+        self.assertEqual(small, large)
+
+    def test_delete_deployment(self):
+        """``delete_deployment`` makes the same number of vCenter calls for 1 or 40 VMs in a folder"""
+        delete = lambda: vmware.delete_deployment('alice', 'myTemplate', MagicMock())
+        small = self._round_trips(delete, 1)
+        large = self._round_trips(delete, 40)
+
+        self.assertEqual(small, large)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the lineage.py module
+"""
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import lineage
+from vlab_deployment_api.lib.worker import vcenter_pool
+from .fake_vcenter import FakeVSphere, patched
+
+
+class TestLineage(unittest.TestCase):
+    """A set of test cases for lineage.py, against VMs deployed (and powered on) in a fake vCenter"""
+
+    def setUp(self):
+        """Every test gets a template with an OVA, and a fake vSphere to deploy it into"""
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        os.makedirs(os.path.join(self.location, 'foo'))
+        self.ova_file = os.path.join(self.location, 'foo', 'vm01.ova')
+        with open(self.ova_file, 'w') as the_file:
+            the_file.write('not really an OVA')
+        self.server = FakeVSphere()
+        self.server.add_user('alice')
+
+    def deploy(self):
+        """Deploy the template's VM the way a deployment does; returns the moId of the VM"""
+        with patched(self.server):
+            vmware._create_vm(self.ova_file, 'vm01-dply', 'foo', 'alice', 'CentOS', MagicMock())
+        return [x for x in self.server.vms('alice') if self.server.objects[x]['name'] == 'vm01-dply'][0]
+
+    def reusable_ova(self, moid):
+        """What ``reusable_ova`` says about a deployed VM"""
+        with patched(self.server):
+            with vcenter_pool.borrow() as vcenter:
+                the_vm = self.server.ref(moid, vcenter._conn._stub)
+                return lineage.reusable_ova(the_vm, the_vm.config, self.location)
+
+    def test_source_meta(self):
+        """``source_meta`` records the template, the OVA and a changeId for every disk"""
+        moid = self.deploy()
+        source = ujson.loads(self.server.objects[moid]['annotation'])['source']
+
+        self.assertEqual(source['template'], 'foo')
+        self.assertEqual(source['ova'], 'vm01.ova')
+        self.assertEqual(list(source['disks'].keys()), ['2000'])
+        self.assertFalse(None in source['disks'].values())
+
+    def test_track_changes_removes_snapshot(self):
+        """``track_changes`` does not leave the baseline snapshot behind"""
+        moid = self.deploy()
+
+        self.assertTrue(self.server.objects[moid].get('snapshot') is None)
+        self.assertEqual(self.server.calls['RemoveSnapshot_Task'], 1)
+
+    def test_reusable_ova(self):
+        """``reusable_ova`` returns the source OVA of a VM that was powered on, but not changed"""
+        moid = self.deploy()
+
+        self.assertEqual(self.server.objects[moid]['powerState'], 'poweredOn')
+        self.assertEqual(self.reusable_ova(moid), self.ova_file)
+        self.assertTrue(self.server.objects[moid].get('snapshot') is None)
+
+    def test_reusable_ova_changed(self):
+        """``reusable_ova`` returns None once a disk has changed"""
+        moid = self.deploy()
+        self.server.write_disk(moid)
+
+        self.assertTrue(self.reusable_ova(moid) is None)
+
+    def test_reusable_ova_no_tracking(self):
+        """``reusable_ova`` returns None for a VM that change tracking could not be turned on for"""
+        self.server.fail('ReconfigVM_Task')
+        moid = self.deploy()
+
+        self.assertTrue(self.reusable_ova(moid) is None)
+
+    def test_reusable_ova_tracking_reset(self):
+        """``reusable_ova`` returns None when vCenter no longer knows the baseline"""
+        moid = self.deploy()
+        self.server.reset_tracking(moid)
+
+        self.assertTrue(self.reusable_ova(moid) is None)
+
+    def test_reusable_ova_replaced(self):
+        """``reusable_ova`` returns None if the template was made again since"""
+        moid = self.deploy()
+        os.remove(self.ova_file)
+        with open(self.ova_file, 'w') as the_file:
+            the_file.write('a different OVA')
+
+        self.assertTrue(self.reusable_ova(moid) is None)
+
+    def test_reusable_ova_no_source(self):
+        """``reusable_ova`` returns None for VMs deployed before sources were recorded"""
+        moid = self.deploy()
+        for annotation in ('', 'not json', ujson.dumps({'component': 'foo'})):
+            self.server.objects[moid]['annotation'] = annotation
+
+            self.assertTrue(self.reusable_ova(moid) is None)
+
+    def test_link_ova(self):
+        """``link_ova`` hard links the OVA into the new template"""
+        new_ova = os.path.join(self.location, 'bar.ova')
+
+        self.assertTrue(lineage.link_ova(self.ova_file, new_ova))
+        self.assertEqual(os.stat(new_ova).st_ino, os.stat(self.ova_file).st_ino)
+
+    @patch.object(lineage.fcntl, 'ioctl')
+    @patch.object(lineage.os, 'link')
+    def test_link_ova_unsupported(self, fake_link, fake_ioctl):
+        """``link_ova`` returns False, and leaves nothing behind, if the OVA can't be linked"""
+        fake_link.side_effect = OSError(errno.EXDEV, 'Invalid cross-device link')
+        fake_ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'Operation not supported')
+        new_ova = os.path.join(self.location, 'bar.ova')
+
+        self.assertFalse(lineage.link_ova(self.ova_file, new_ova))
+        self.assertFalse(os.path.exists(new_ova))
+
+    @patch.object(lineage.chunk_store, 'STORE')
+    def test_link_ova_manifest(self, fake_STORE):
+        """``link_ova`` takes another reference to the chunks of a manifest"""
+        lineage.link_ova('/templates/foo/vm01.manifest', '/templates/.bar/vm01.manifest')
+
+        fake_STORE.retain.assert_called_with('/templates/foo/vm01.manifest', '/templates/.bar/vm01.manifest')
+
+
+if __name__ == '__main__':
+    unittest.main()
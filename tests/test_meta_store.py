@@ -0,0 +1,303 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the meta_store.py module
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from vlab_deployment_api.lib import meta_store
+from vlab_deployment_api.lib import template_meta_data
+from .test_catalog import make_template
+
+
+def make_meta(owner='alice', kind='CentOS'):
+    """The meta data of a template with one machine"""
+    return {'owner': owner, 'email': '', 'summary': 'a template',
+            'machines': {'vm01': {'ip': '1.2.3.4', 'kind': kind, 'ports': [22]}}}
+
+
+class TestJsonStore(unittest.TestCase):
+    """A set of test cases for the JsonStore object"""
+
+    def setUp(self):
+        """Every test gets a directory with two templates"""
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        make_template(self.location, 'foo')
+        make_template(self.location, 'bar', owner='bob')
+        self.store = meta_store.JsonStore(self.location)
+
+    def test_read(self):
+        """``JsonStore`` read returns the contents of meta.json"""
+        self.assertEqual(self.store.read('bar')['owner'], 'bob')
+
+    def test_write(self):
+        """``JsonStore`` write replaces meta.json"""
+        self.store.write('foo', make_meta(owner='carol'))
+
+        self.assertEqual(self.store.read('foo')['owner'], 'carol')
+
+    def test_version(self):
+        """``JsonStore`` version changes when the meta data is written"""
+        before = self.store.version('foo')
+        self.store.write('foo', make_meta(owner='someone with a longer name'))
+
+        self.assertNotEqual(self.store.version('foo'), before)
+
+    def test_version_missing(self):
+        """``JsonStore`` version is None for templates without meta data"""
+        self.assertTrue(self.store.version('baz') is None)
+
+    def test_find(self):
+        """``JsonStore`` find filters by owner"""
+        self.assertEqual(list(self.store.find(owner='bob').keys()), ['bar'])
+
+    def test_find_kind(self):
+        """``JsonStore`` find filters by the kind of machine"""
+        self.assertEqual(self.store.find(kind='OneFS'), {})
+        self.assertEqual(set(self.store.find(kind='CentOS').keys()), {'foo', 'bar'})
+
+    def test_find_page(self):
+        """``JsonStore`` find returns templates in order of name, a page at a time"""
+        self.assertEqual(list(self.store.find().keys()), ['bar', 'foo'])
+        self.assertEqual(list(self.store.find(after='bar').keys()), ['foo'])
+        self.assertEqual(list(self.store.find(limit=1).keys()), ['bar'])
+        self.assertEqual(list(self.store.find(prefix='f').keys()), ['foo'])
+
+
+class TestSqliteStore(unittest.TestCase):
+    """A set of test cases for the SqliteStore object"""
+
+    def setUp(self):
+        """Every test gets an empty database"""
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.store = meta_store.SqliteStore(os.path.join(location, 'meta.sqlite'))
+        self.addCleanup(self.store.close)
+
+    def test_read(self):
+        """``SqliteStore`` read returns what was written"""
+        self.store.write('foo', make_meta())
+
+        self.assertEqual(self.store.read('foo'), make_meta())
+
+    def test_read_missing(self):
+        """``SqliteStore`` read raises FileNotFoundError, like a missing meta.json"""
+        with self.assertRaises(FileNotFoundError):
+            self.store.read('foo')
+
+    def test_read_only(self):
+        """``SqliteStore`` opened read only reads the database, without writing to it or its directory"""
+        self.store.write('foo', make_meta())
+        self.store.close()
+        location = os.path.dirname(self.store.db_path)
+        os.chmod(location, 0o555)
+        self.addCleanup(os.chmod, location, 0o755)
+        before = sorted(os.listdir(location))
+        reader = meta_store.SqliteStore(self.store.db_path, read_only=True)
+        self.addCleanup(reader.close)
+
+        self.assertEqual(reader.read('foo'), make_meta())
+        self.assertEqual(list(reader.find(owner='alice')), ['foo'])
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.write('bar', make_meta())
+        self.assertEqual(sorted(os.listdir(location)), before)
+
+    def test_read_only_missing(self):
+        """``SqliteStore`` opened read only does not make a missing database"""
+        db_path = os.path.join(os.path.dirname(self.store.db_path), 'other.sqlite')
+        reader = meta_store.SqliteStore(db_path, read_only=True)
+        self.addCleanup(reader.close)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.read('foo')
+        self.assertFalse(os.path.exists(db_path))
+
+    def test_hidden(self):
+        """``SqliteStore`` templates being created are not visible until published"""
+        self.store.write('foo', make_meta(), hidden=True)
+
+        with self.assertRaises(FileNotFoundError):
+            self.store.read('foo')
+        self.assertTrue(self.store.version('foo') is None)
+        self.store.publish('foo')
+        self.assertEqual(self.store.read('foo')['owner'], 'alice')
+
+    def test_hidden_exists(self):
+        """``SqliteStore`` creating a template does not overwrite an existing one"""
+        self.store.write('foo', make_meta())
+
+        with self.assertRaises(ValueError):
+            self.store.write('foo', make_meta(owner='bob'), hidden=True)
+        self.assertEqual(self.store.read('foo')['owner'], 'alice')
+
+    def test_version(self):
+        """``SqliteStore`` version changes on every write"""
+        self.store.write('foo', make_meta())
+        before = self.store.version('foo')
+        self.store.write('foo', make_meta())
+
+        self.assertNotEqual(self.store.version('foo'), before)
+
+    def test_delete(self):
+        """``SqliteStore`` delete forgets the template, and its machines"""
+        self.store.write('foo', make_meta(kind='OneFS'))
+        self.store.delete('foo')
+
+        self.assertTrue(self.store.version('foo') is None)
+        self.assertEqual(self.store.find(kind='OneFS'), {})
+
+    def test_find(self):
+        """``SqliteStore`` find filters by owner and kind"""
+        self.store.write('foo', make_meta(owner='alice', kind='OneFS'))
+        self.store.write('bar', make_meta(owner='bob', kind='OneFS'))
+        self.store.write('baz', make_meta(owner='bob', kind='CentOS'))
+        self.store.write('new', make_meta(owner='bob', kind='OneFS'), hidden=True)
+
+        self.assertEqual(set(self.store.find().keys()), {'foo', 'bar', 'baz'})
+        self.assertEqual(set(self.store.find(owner='bob').keys()), {'bar', 'baz'})
+        self.assertEqual(set(self.store.find(kind='OneFS').keys()), {'foo', 'bar'})
+        self.assertEqual(set(self.store.find(owner='bob', kind='OneFS').keys()), {'bar'})
+
+    def test_find_page(self):
+        """``SqliteStore`` find returns templates in order of name, a page at a time"""
+        for name in ['foo', 'bar', 'baz', 'b_z']:
+            self.store.write(name, make_meta())
+
+        self.assertEqual(list(self.store.find().keys()), ['b_z', 'bar', 'baz', 'foo'])
+        self.assertEqual(list(self.store.find(after='bar', limit=1).keys()), ['baz'])
+        self.assertEqual(list(self.store.find(prefix='ba').keys()), ['bar', 'baz'])
+        self.assertEqual(list(self.store.find(prefix='B').keys()), [])
+
+    def test_rollback(self):
+        """``SqliteStore`` nothing in a failed transaction is kept"""
+        self.store.write('foo', make_meta())
+        with self.assertRaises(RuntimeError):
+            with self.store.transaction():
+                self.store.write('foo', make_meta(owner='bob'))
+                raise RuntimeError('testing')
+
+        self.assertEqual(self.store.read('foo')['owner'], 'alice')
+
+    def test_transaction_isolated(self):
+        """``SqliteStore`` a read-check-write is not interleaved with another thread's"""
+        self.store.write('foo', dict(make_meta(), summary='0'))
+
+        def bump():
+            for _ in range(20):
+                with self.store.transaction():
+                    meta = self.store.read('foo')
+                    meta['summary'] = str(int(meta['summary']) + 1)
+                    self.store.write('foo', meta)
+            self.store.close()
+
+        threads = [threading.Thread(target=bump) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.store.read('foo')['summary'], '80')
+
+
+class TestMigrate(unittest.TestCase):
+    """A set of test cases for the ``migrate`` function"""
+
+    def setUp(self):
+        """Every test gets a directory of templates, and an empty database"""
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        make_template(self.location, 'foo')
+        make_template(self.location, 'bar', owner='bob')
+        make_template(self.location, '.baz')
+        os.makedirs(os.path.join(self.location, 'broken'))
+        self.store = meta_store.SqliteStore(os.path.join(self.location, '.meta.sqlite'))
+        self.addCleanup(self.store.close)
+
+    def test_migrate(self):
+        """``migrate`` copies every meta.json, skipping hidden and broken templates"""
+        copied, skipped = meta_store.migrate(self.location, self.store)
+
+        self.assertEqual(copied, 2)
+        self.assertEqual(set(self.store.find().keys()), {'foo', 'bar'})
+        self.assertEqual(self.store.read('bar'), meta_store.JsonStore(self.location).read('bar'))
+
+    def test_migrate_again(self):
+        """``migrate`` does not overwrite templates already in the database"""
+        meta_store.migrate(self.location, self.store)
+        self.store.write('foo', make_meta(owner='carol'))
+
+        copied, _ = meta_store.migrate(self.location, self.store)
+
+        self.assertEqual(copied, 0)
+        self.assertEqual(self.store.read('foo')['owner'], 'carol')
+
+
+class TestStoreFor(unittest.TestCase):
+    """A set of test cases for the ``store_for`` function"""
+
+    def test_store_for(self):
+        """``store_for`` opens a backend once"""
+        first = meta_store.store_for('json', '/templates', '/templates/.meta.sqlite')
+        second = meta_store.store_for('json', '/templates', '/templates/.meta.sqlite')
+
+        self.assertTrue(first is second)
+
+    def test_store_for_unknown(self):
+        """``store_for`` raises ValueError for an unknown backend"""
+        with self.assertRaises(ValueError):
+            meta_store.store_for('mongo', '/templates', '/templates/.meta.sqlite')
+
+
+class TestTemplateMetaData(unittest.TestCase):
+    """A set of test cases for template_meta_data, with the SQLite backend"""
+
+    def setUp(self):
+        """Every test gets a template directory, and meta data in SQLite"""
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        new_const = template_meta_data.const._replace(VLAB_DEPLOYMENT_TEMPLATE_DIR=self.location,
+                                                      VLAB_TEMPLATE_META_STORE='sqlite',
+                                                      VLAB_TEMPLATE_META_DB=os.path.join(self.location, '.meta.sqlite'))
+        patcher = patch.object(template_meta_data, 'const', new_const)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(template_meta_data._store().close)
+
+    def test_create(self):
+        """``template_meta_data`` a template made like ``templates.create`` does it is readable"""
+        os.makedirs(os.path.join(self.location, '.foo'))
+        with open(os.path.join(self.location, '.foo', 'vm01.ova'), 'w') as the_file:
+            the_file.write('not really an OVA')
+        template_meta_data.set_meta('foo', 'alice', '', 'a template', make_meta()['machines'])
+        os.rename(os.path.join(self.location, '.foo'), os.path.join(self.location, 'foo'))
+        template_meta_data.publish_meta('foo')
+
+        meta = template_meta_data.get_meta('foo')
+
+        self.assertEqual(meta['machines']['vm01']['ova_path'], os.path.join(self.location, 'foo', 'vm01.ova'))
+        self.assertFalse(os.path.exists(os.path.join(self.location, 'foo', template_meta_data.META_FILE_NAME)))
+
+    def test_update_meta(self):
+        """``template_meta_data`` update_meta changes the owner in the index"""
+        template_meta_data._store().write('foo', make_meta())
+
+        template_meta_data.update_meta('foo', username='alice', owner='bob')
+
+        self.assertEqual(list(template_meta_data.find_meta(owner='bob').keys()), ['foo'])
+
+    def test_update_meta_not_owner(self):
+        """``template_meta_data`` update_meta still raises ValueError if the user does not own the template"""
+        template_meta_data._store().write('foo', make_meta())
+
+        with self.assertRaises(ValueError):
+            template_meta_data.update_meta('foo', username='bob', owner='bob')
+
+
+if __name__ == '__main__':
+    unittest.main()
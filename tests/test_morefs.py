@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the morefs.py module
+"""
+import time
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from pyVmomi import vim
+
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import morefs
+from .fake_vcenter import FakeVSphere, patched
+
+META = {'owner': 'alice',
+        'machines': {'vm0{}'.format(x): {'ova_path': '/templates/t/vm0{}.ova'.format(x), 'kind': 'CentOS'} for x in range(5)}}
+
+
+class TestMorefCache(unittest.TestCase):
+    """A set of test cases for the MorefCache object, against a fake vCenter"""
+
+    def setUp(self):
+        """Every test gets a fake vSphere with a couple of users"""
+        self.server = FakeVSphere()
+        self.server.add_user('alice')
+        self.server.add_user('bob')
+
+    def test_lookup(self):
+        """``MorefCache`` lookups return the object, bound to the session asking for it"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                folder = vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+
+                self.assertEqual(folder._moId, self.server.folder('alice'))
+                self.assertTrue(folder._stub is vcenter._conn._stub)
+
+    def test_shared(self):
+        """``MorefCache`` one scan is shared by every session"""
+        with patched(self.server, pool_size=2):
+            with vmware.borrow() as first, vmware.borrow() as second:
+                first.get_by_name(name='alice', vimtype=vim.Folder)
+                output = second.get_by_name(name='bob', vimtype=vim.Folder)
+
+            self.assertTrue(output._stub is second._conn._stub)
+            self.assertEqual(morefs.MOREFS.stats['scans'], 1)
+
+    def test_missing(self):
+        """``MorefCache`` raises ValueError, like ``get_by_name``, for an object that does not exist"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with self.assertRaises(ValueError):
+                    vcenter.get_by_name(name='carol', vimtype=vim.Folder)
+
+    def test_new_object(self):
+        """``MorefCache`` rescans when asked for an object created after the last scan"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+                self.server.add_user('carol')
+                folder = vcenter.get_by_name(name='carol', vimtype=vim.Folder)
+                network = vcenter.networks['carol_frontend']
+
+        self.assertEqual(folder._moId, self.server.folder('carol'))
+        self.assertEqual(network._moId, self.server.network('carol_frontend'))
+
+    def test_stale(self):
+        """``MorefCache`` notices an object that was deleted and re-created"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+                self.server.remove(self.server.folder('alice'))
+                self.server.add_folder('alice')
+                folder = vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+
+            self.assertEqual(folder._moId, self.server.folder('alice'))
+            self.assertEqual(morefs.MOREFS.stats['stale'], 1)
+
+    def test_ttl(self):
+        """``MorefCache`` rescans once the TTL has passed"""
+        cache = morefs.MorefCache(ttl=0.05)
+        with patched(self.server):
+            with patch.object(morefs, 'MOREFS', cache):
+                with vmware.borrow() as vcenter:
+                    vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+                    vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+                    time.sleep(0.06)
+                    vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+
+        self.assertEqual(cache.stats['scans'], 2)
+
+    def test_invalidate(self):
+        """``MorefCache`` invalidate makes the next lookup scan again"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+                morefs.MOREFS.invalidate(vim.Folder)
+                vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+
+            self.assertEqual(morefs.MOREFS.stats['scans'], 2)
+
+    def test_single_flight(self):
+        """``MorefCache`` threads racing on a cold cache share one scan"""
+        with patched(self.server, pool_size=5):
+            def lookup():
+                with vmware.borrow() as vcenter:
+                    vcenter.get_by_name(name='alice', vimtype=vim.Folder)
+
+            threads = [threading.Thread(target=lookup) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(morefs.MOREFS.stats['scans'], 1)
+
+    def test_networks(self):
+        """``CachedvCenter`` networks maps every network name to its object"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                networks = vcenter.networks
+
+                self.assertEqual(sorted(networks.keys()), ['alice_backend', 'alice_frontend', 'bob_backend', 'bob_frontend'])
+                self.assertEqual(networks['bob_backend']._moId, self.server.network('bob_backend'))
+                with self.assertRaises(KeyError):
+                    networks['carol_frontend']
+
+    def test_deploy_scans_once(self):
+        """Deploying a 5 VM template scans for folders and networks at most once each"""
+        with patched(self.server):
+            with patch.object(vmware, 'get_meta', return_value=META):
+                vmware.create_deployment('bob', 't', MagicMock())
+
+            self.assertEqual(len(self.server.vms('bob')), 5)
+            self.assertTrue(morefs.MOREFS.stats['scans'] <= 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
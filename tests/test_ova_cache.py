@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the ova_cache.py module
+"""
+import io
+import os
+import hashlib
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_inf_common.vmware import Ova
+
+from vlab_deployment_api.lib.worker import ova_cache
+
+OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope>
+  <NetworkSection>
+    <Network ovf:name="frontend">
+    </Network>
+    <Network ovf:name="backend">
+    </Network>
+  </NetworkSection>
+</Envelope>
+"""
+
+
+def make_ova(path, disks):
+    """Write an OVA with an OVF and some (fake) disks"""
+    with tarfile.open(path, 'w') as the_tar:
+        for name, data in [('vm.ovf', OVF.encode())] + list(disks.items()):
+            info = tarfile.TarInfo(name=name)
+            info.size = len(data)
+            the_tar.addfile(info, io.BytesIO(data))
+
+
+class TestOvaCache(unittest.TestCase):
+    """A set of test cases for the DescriptorCache object and friends"""
+
+    def setUp(self):
+        """Every test gets an OVA with two disks"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.ova_file = os.path.join(self.tmp.name, 'vm.ova')
+        self.disks = {'vm-disk1.vmdk': os.urandom(5000), 'vm-disk2.vmdk': os.urandom(700)}
+        make_ova(self.ova_file, self.disks)
+
+    def test_matches_ova(self):
+        """``CachedOva`` has the same OVF, networks and disks as ``Ova``"""
+        expected = Ova(self.ova_file)
+        output = ova_cache.CachedOva(self.ova_file, ova_cache.parse(self.ova_file))
+        try:
+            self.assertEqual(output.ovf, expected.ovf)
+            self.assertEqual(output.networks, expected.networks)
+            self.assertEqual(sorted(output.vmdks), sorted(expected.vmdks))
+            for name in expected.vmdks:
+                self.assertEqual(output._disks[name].read(), expected._disks[name].read())
+                self.assertEqual(Ova._get_tarfile_size(output._disks[name]), len(self.disks[name]))
+        finally:
+            output.close()
+            expected.close()
+
+    def test_tar_member(self):
+        """``TarMember`` supports reading in chunks and seeking back to the start"""
+        ova = ova_cache.CachedOva(self.ova_file, ova_cache.parse(self.ova_file))
+        disk = ova._disks['vm-disk1.vmdk']
+        try:
+            chunks = []
+            chunk = disk.read(1024)
+            while chunk:
+                chunks.append(chunk)
+                chunk = disk.read(1024)
+            disk.seek(0, 0)
+
+            self.assertEqual(b''.join(chunks), self.disks['vm-disk1.vmdk'])
+            self.assertEqual(disk.read(10), self.disks['vm-disk1.vmdk'][:10])
+        finally:
+            ova.close()
+
+    def test_tar_member_verified(self):
+        """``TarMember`` checks a disk against its digest as it's read"""
+        files = {x: {'sha256': hashlib.sha256(y).hexdigest(), 'size': len(y)} for x, y in self.disks.items()}
+        ova = ova_cache.CachedOva(self.ova_file, ova_cache.parse(self.ova_file), files=files)
+        disk = ova._disks['vm-disk1.vmdk']
+        try:
+            while disk.read(1024):
+                pass
+            disk.seek(0, 0)
+
+            self.assertEqual(disk.read(), self.disks['vm-disk1.vmdk'])
+        finally:
+            ova.close()
+
+    def test_tar_member_corrupt(self):
+        """``TarMember`` raises ValueError once a corrupt disk is read to the end"""
+        files = {'vm-disk1.vmdk': {'sha256': hashlib.sha256(b'something else').hexdigest(), 'size': 5000}}
+        ova = ova_cache.CachedOva(self.ova_file, ova_cache.parse(self.ova_file), files=files)
+        disk = ova._disks['vm-disk1.vmdk']
+        try:
+            disk.read(4096)
+            with self.assertRaises(ValueError):
+                disk.read(4096)
+        finally:
+            ova.close()
+
+    def test_tar_member_seek(self):
+        """``TarMember`` stops checking once a read skips part of the disk"""
+        files = {'vm-disk1.vmdk': {'sha256': hashlib.sha256(b'something else').hexdigest(), 'size': 5000}}
+        ova = ova_cache.CachedOva(self.ova_file, ova_cache.parse(self.ova_file), files=files)
+        disk = ova._disks['vm-disk1.vmdk']
+        try:
+            disk.seek(1000)
+
+            self.assertEqual(disk.read(), self.disks['vm-disk1.vmdk'][1000:])
+        finally:
+            ova.close()
+
+    def test_hit(self):
+        """``DescriptorCache`` only parses an OVA once"""
+        cache = ova_cache.DescriptorCache(max_bytes=1024 * 1024)
+        with patch.object(ova_cache, 'parse', wraps=ova_cache.parse) as fake_parse:
+            first = cache.get(self.ova_file)
+            second = cache.get(self.ova_file)
+
+        self.assertTrue(first is second)
+        self.assertEqual(fake_parse.call_count, 1)
+        self.assertEqual(cache.stats['hits'], 1)
+
+    def test_replaced(self):
+        """``DescriptorCache`` parses an OVA again once it changes, and drops the old entry"""
+        cache = ova_cache.DescriptorCache(max_bytes=1024 * 1024)
+        cache.get(self.ova_file)
+        make_ova(self.ova_file, {'vm-disk1.vmdk': b'a' * 10})
+        stat = os.stat(self.ova_file)
+        os.utime(self.ova_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        output = cache.get(self.ova_file)
+
+        self.assertEqual(list(output.disks.keys()), ['vm-disk1.vmdk'])
+        self.assertEqual(len(cache._entries), 1)
+
+    def test_budget(self):
+        """``DescriptorCache`` evicts the least recently used entries to stay in budget"""
+        others = []
+        for idx in range(3):
+            other = os.path.join(self.tmp.name, 'other{}.ova'.format(idx))
+            make_ova(other, {'disk.vmdk': b'a'})
+            others.append(other)
+        size = ova_cache.parse(others[0]).nbytes
+        cache = ova_cache.DescriptorCache(max_bytes=size * 2)
+        cache.get(others[0])
+        cache.get(others[1])
+        cache.get(others[0])
+        cache.get(others[2])
+
+        output = sorted(x[0] for x in cache._entries.keys())
+        expected = sorted([others[0], others[2]])
+
+        self.assertEqual(output, expected)
+        self.assertTrue(cache.nbytes <= cache.max_bytes)
+
+    def test_too_big(self):
+        """``DescriptorCache`` does not cache a descriptor bigger than the whole budget"""
+        cache = ova_cache.DescriptorCache(max_bytes=10)
+        cache.get(self.ova_file)
+
+        self.assertEqual(cache.nbytes, 0)
+
+    @patch.object(ova_cache, 'Ova')
+    def test_open_ova_url(self, fake_Ova):
+        """``open_ova`` does not cache OVAs that are not local files"""
+        ova_cache.open_ova('https://some-server/vm.ova')
+
+        self.assertTrue(fake_Ova.called)
+
+    def test_open_ova(self):
+        """``open_ova`` returns a CachedOva for a local file"""
+        output = ova_cache.open_ova(self.ova_file)
+        output.close()
+
+        self.assertTrue(isinstance(output, ova_cache.CachedOva))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the progress.py module
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib.worker import progress
+
+
+class TestTaskProgress(unittest.TestCase):
+    """A set of test cases for the TaskProgress object"""
+
+    def setUp(self):
+        """Every test gets a fake Celery task"""
+        self.task = MagicMock()
+        self.task.request.id = 'some-task-id'
+
+    def test_phase_published(self):
+        """``TaskProgress`` publishes a custom Celery state when a machine changes phase"""
+        task_progress = progress.TaskProgress(self.task)
+        task_progress.machine('vm01').phase(progress.QUEUED)
+
+        _, the_kwargs = self.task.update_state.call_args
+        self.assertEqual(the_kwargs['state'], 'PROGRESS')
+        self.assertEqual(the_kwargs['task_id'], 'some-task-id')
+        self.assertEqual(the_kwargs['meta']['machines']['vm01']['phase'], 'queued')
+
+    def test_no_task(self):
+        """``TaskProgress`` publishes nothing without a task"""
+        task_progress = progress.TaskProgress()
+        task_progress.machine('vm01').phase(progress.QUEUED)
+
+        self.assertEqual(task_progress.snapshot()['machines']['vm01']['phase'], 'queued')
+
+    def test_no_task_id(self):
+        """``TaskProgress`` publishes nothing when the task is called directly (i.e. not via Celery)"""
+        self.task.request.id = None
+        task_progress = progress.TaskProgress(self.task)
+        task_progress.machine('vm01').phase(progress.QUEUED)
+
+        self.assertFalse(self.task.update_state.called)
+
+    def test_bytes(self):
+        """``TaskProgress`` samples the meter of a phase that moves bytes"""
+        moved = [0]
+        task_progress = progress.TaskProgress(self.task)
+        task_progress.machine('vm01').phase(progress.UPLOADING, total=100, meter=lambda: moved[0])
+        moved[0] = 25
+
+        info = task_progress.snapshot()
+
+        self.assertEqual(info['bytes'], 25)
+        self.assertEqual(info['total'], 100)
+        self.assertEqual(info['machines']['vm01']['bytes'], 25)
+
+    def test_eta(self):
+        """``TaskProgress`` estimates the time left from the rate so far"""
+        task_progress = progress.TaskProgress(self.task)
+        with patch.object(progress.time, 'time') as fake_time:
+            fake_time.return_value = 1000
+            task_progress.machine('vm01').phase(progress.UPLOADING, total=100, meter=lambda: 25)
+            fake_time.return_value = 1010
+            info = task_progress.snapshot()
+
+        # 25 bytes in 10 seconds -> 75 bytes in 30 seconds
+        self.assertEqual(info['eta'], 30)
+
+    def test_eta_slowest(self):
+        """``TaskProgress`` the ETA of the task is the ETA of the slowest machine"""
+        task_progress = progress.TaskProgress(self.task)
+        with patch.object(progress.time, 'time') as fake_time:
+            fake_time.return_value = 1000
+            task_progress.machine('vm01').phase(progress.UPLOADING, total=100, meter=lambda: 50)
+            task_progress.machine('vm02').phase(progress.UPLOADING, total=100, meter=lambda: 10)
+            fake_time.return_value = 1010
+            info = task_progress.snapshot()
+
+        self.assertEqual(info['eta'], 90)
+
+    def test_eta_unknown(self):
+        """``TaskProgress`` there's no ETA until some bytes have moved"""
+        task_progress = progress.TaskProgress(self.task)
+        task_progress.machine('vm01').phase(progress.UPLOADING, total=100, meter=lambda: 0)
+
+        self.assertTrue(task_progress.snapshot()['eta'] is None)
+
+    def test_bytes_kept(self):
+        """``TaskProgress`` bytes moved in one phase are still counted in the next"""
+        task_progress = progress.TaskProgress(self.task)
+        task_progress.machine('vm01').phase(progress.UPLOADING, total=100, meter=lambda: 100)
+        task_progress.machine('vm01').phase(progress.POWERING_ON)
+
+        info = task_progress.snapshot()
+
+        self.assertEqual(info['machines']['vm01']['bytes'], 100)
+        self.assertEqual(info['machines']['vm01']['phase'], 'powering on')
+        self.assertTrue(info['eta'] is None)
+
+    def test_periodic(self):
+        """``TaskProgress`` publishes byte counts periodically, while bytes are moving"""
+        with progress.TaskProgress(self.task, interval=0.01) as task_progress:
+            task_progress.machine('vm01').phase(progress.UPLOADING, total=100, meter=lambda: 1)
+            time.sleep(0.1)
+
+        self.assertTrue(self.task.update_state.call_count > 2)
+
+    def test_idle(self):
+        """``TaskProgress`` does not publish periodically when no bytes are moving"""
+        with progress.TaskProgress(self.task, interval=0.01) as task_progress:
+            task_progress.machine('vm01').phase(progress.WAITING_FOR_IP)
+            time.sleep(0.1)
+
+        self.assertEqual(self.task.update_state.call_count, 1)
+
+
+class TestPollAfter(unittest.TestCase):
+    """A set of test cases for the ``poll_after`` function"""
+
+    def test_no_eta(self):
+        """``poll_after`` uses a default when there's no ETA"""
+        self.assertEqual(progress.poll_after({'eta': None}), progress.DEFAULT_POLL)
+
+    def test_no_info(self):
+        """``poll_after`` uses a default when the task hasn't published anything"""
+        self.assertEqual(progress.poll_after(None), progress.DEFAULT_POLL)
+
+    def test_bounded(self):
+        """``poll_after`` stays between MIN_POLL and MAX_POLL"""
+        self.assertEqual(progress.poll_after({'eta': 1}), progress.MIN_POLL)
+        self.assertEqual(progress.poll_after({'eta': 99999}), progress.MAX_POLL)
+
+
+if __name__ == '__main__':
+    unittest.main()
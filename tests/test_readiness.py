@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the readiness.py module
+"""
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import readiness
+from .fake_vcenter import FakeVSphere, patched
+
+
+class TestStrategies(unittest.TestCase):
+    """A set of test cases for picking what "ready" means per kind of VM"""
+
+    def test_onefs(self):
+        """``strategy_for`` OneFS nodes do not wait for an IP"""
+        self.assertTrue(isinstance(readiness.strategy_for('OneFS'), readiness.NoWait))
+
+    def test_default(self):
+        """``strategy_for`` everything else waits for an IP"""
+        self.assertTrue(readiness.strategy_for('CentOS') is readiness.DEFAULT_STRATEGY)
+
+    def test_register(self):
+        """``register`` defines a strategy for a kind of VM"""
+        strategy = MagicMock()
+        with patch.dict(readiness.STRATEGIES):
+            readiness.register('Windows', strategy)
+
+            self.assertTrue(readiness.strategy_for('windows') is strategy)
+
+    def test_any_ip(self):
+        """``AnyIp`` is ready once any NIC has an IP"""
+        nic1 = MagicMock()
+        nic1.ipAddress = []
+        nic2 = MagicMock()
+        nic2.ipAddress = ['10.7.1.2']
+
+        self.assertFalse(readiness.AnyIp().ready({}))
+        self.assertFalse(readiness.AnyIp().ready({'guest.net': [nic1]}))
+        self.assertTrue(readiness.AnyIp().ready({'guest.net': [nic1, nic2]}))
+
+
+class TestReadinessWatcher(unittest.TestCase):
+    """A set of test cases for the ReadinessWatcher object, against a fake vCenter"""
+
+    def setUp(self):
+        """Every test gets a fake vSphere with one user"""
+        self.server = FakeVSphere()
+        self.server.add_user('alice')
+
+    def _watch(self, vcenter, watcher, moid, strategy=None):
+        the_vm = self.server.ref(moid, vcenter._conn._stub)
+        watcher.watch(the_vm, strategy or readiness.DEFAULT_STRATEGY)
+
+    def test_ready(self):
+        """``ReadinessWatcher`` returns once a VM obtains an IP"""
+        moid = self.server.add_vm('alice', 'vm01')
+        timer = threading.Timer(0.1, lambda: self.server.objects[moid].update(ips=['10.7.1.2']))
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with readiness.ReadinessWatcher(vcenter) as watcher:
+                    self._watch(vcenter, watcher, moid)
+                    timer.start()
+                    watcher.wait(timeout=5)
+
+                    self.assertEqual(watcher.pending, 0)
+
+    def test_many(self):
+        """``ReadinessWatcher`` one watcher waits on every VM of a deployment"""
+        moids = [self.server.add_vm('alice', 'vm0{}'.format(x)) for x in range(5)]
+        def assign_ips():
+            for moid in moids:
+                self.server.objects[moid]['ips'] = ['10.7.1.2']
+        timer = threading.Timer(0.1, assign_ips)
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with readiness.ReadinessWatcher(vcenter) as watcher:
+                    for moid in moids:
+                        self._watch(vcenter, watcher, moid)
+                    self.assertEqual(watcher.pending, 5)
+                    timer.start()
+                    watcher.wait(timeout=5)
+
+                    self.assertEqual(watcher.pending, 0)
+
+    def test_no_wait(self):
+        """``ReadinessWatcher`` VMs that need nothing are never sent to vCenter"""
+        moid = self.server.add_vm('alice', 'node-1')
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with readiness.ReadinessWatcher(vcenter) as watcher:
+                    self._watch(vcenter, watcher, moid, strategy=readiness.NoWait())
+                    watcher.wait(timeout=1)
+
+                    self.assertEqual(watcher.pending, 0)
+                    self.assertEqual(self.server.calls['CreateFilter'], 0)
+
+    def test_timeout(self):
+        """``ReadinessWatcher`` raises RuntimeError if a VM never obtains an IP"""
+        moid = self.server.add_vm('alice', 'vm01')
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with readiness.ReadinessWatcher(vcenter) as watcher:
+                    self._watch(vcenter, watcher, moid)
+                    with self.assertRaises(RuntimeError):
+                        watcher.wait(timeout=1)
+
+    def test_callback(self):
+        """``ReadinessWatcher`` calls the callback of each VM once it's ready"""
+        ready = MagicMock()
+        waiting = MagicMock()
+        moid1 = self.server.add_vm('alice', 'vm01', ips=['10.7.1.2'])
+        moid2 = self.server.add_vm('alice', 'node-1')
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with readiness.ReadinessWatcher(vcenter) as watcher:
+                    watcher.watch(self.server.ref(moid1, vcenter._conn._stub), readiness.DEFAULT_STRATEGY, callback=ready)
+                    watcher.watch(self.server.ref(moid2, vcenter._conn._stub), readiness.NoWait(), callback=waiting)
+                    watcher.wait(timeout=5)
+
+        self.assertEqual(ready.call_count, 1)
+        self.assertEqual(waiting.call_count, 1)
+
+    def test_close(self):
+        """``ReadinessWatcher`` destroys the PropertyCollector upon exit"""
+        moid = self.server.add_vm('alice', 'vm01', ips=['10.7.1.2'])
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with readiness.ReadinessWatcher(vcenter) as watcher:
+                    self._watch(vcenter, watcher, moid)
+                    watcher.wait(timeout=5)
+
+        self.assertEqual(self.server.calls['DestroyPropertyCollector'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
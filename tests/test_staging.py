@@ -0,0 +1,179 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the staging.py module, and the clone deploy mode
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import staging
+from .fake_vcenter import FakeVSphere, patched
+
+META = {'owner': 'alice',
+        'machines': {'vm01': {'ova_path': '/templates/myTemplate/vm01.ova', 'kind': 'CentOS'},
+                     'vm02': {'ova_path': '/templates/myTemplate/vm02.ova', 'kind': 'CentOS'}}}
+
+
+def _const(mode):
+    """Make a copy of the constants, with a different deploy mode"""
+    return const._replace(VLAB_DEPLOY_MODE=mode)
+
+
+class TestStaging(unittest.TestCase):
+    """A set of test cases for staging and cloning templates"""
+
+    def setUp(self):
+        """Every test gets a fake vSphere where alice owns a template, and bob wants to deploy it"""
+        self.server = FakeVSphere()
+        self.server.add_folder(const.VLAB_STAGING_FOLDER)
+        self.server.add_user('alice')
+        self.server.add_user('bob')
+        patcher = patch.object(vmware, 'get_meta', return_value=META)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _staged(self):
+        """The props of every staged VM"""
+        return [self.server.objects[x] for x in self.server.vms(const.VLAB_STAGING_FOLDER)]
+
+    def test_stage_template(self):
+        """``stage_template`` makes a powered off copy, with a snapshot, of every machine"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+
+        staged = self._staged()
+        self.assertEqual(len(staged), 2)
+        self.assertEqual({x['powerState'] for x in staged}, {'poweredOff'})
+        self.assertTrue(all(x.get('snapshot') for x in staged))
+
+    def test_get_staged(self):
+        """``get_staged`` maps the machine name of a template to its staged VM"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            with vmware.borrow() as vcenter:
+                output = sorted(staging.get_staged(vcenter, 'myTemplate').keys())
+
+        self.assertEqual(output, ['vm01', 'vm02'])
+
+    def test_unstage_template(self):
+        """``unstage_template`` destroys the staged VMs of only that template"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            vmware.stage_template('otherTemplate', 'alice', MagicMock())
+            vmware.unstage_template('myTemplate', MagicMock())
+
+        output = {x['annotation'].count('otherTemplate') for x in self._staged()}
+        self.assertEqual(len(self._staged()), 2)
+        self.assertEqual(output, {1})
+
+    def test_restage(self):
+        """``stage_template`` replaces VMs staged earlier for a template of the same name"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+
+        self.assertEqual(len(self._staged()), 2)
+
+    def test_linked_clone(self):
+        """``create_deployment`` makes linked clones on the user's networks instead of uploading OVAs"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            uploads = self.server.calls['ImportVApp']
+            with patch.object(vmware, 'const', _const('linked_clone')):
+                output = vmware.create_deployment('bob', 'myTemplate', MagicMock())
+
+        clones = [self.server.objects[x] for x in self.server.vms('bob')]
+        networks = {self.server.objects[y]['name'] for x in clones for y in x['networks']}
+        self.assertEqual(sorted(output.keys()), ['vm01-dply', 'vm02-dply'])
+        self.assertEqual(self.server.calls['ImportVApp'], uploads)
+        self.assertEqual({x['linked'] for x in clones}, {True})
+        self.assertEqual({x['powerState'] for x in clones}, {'poweredOn'})
+        self.assertEqual(networks, {'bob_frontend'})
+
+    def test_full_clone(self):
+        """``create_deployment`` makes full clones when the deploy mode is 'clone'"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            with patch.object(vmware, 'const', _const('clone')):
+                vmware.create_deployment('bob', 'myTemplate', MagicMock())
+
+        clones = [self.server.objects[x] for x in self.server.vms('bob')]
+        self.assertEqual({x['linked'] for x in clones}, {False})
+
+    def test_backend_nic(self):
+        """``create_deployment`` connects a NIC on the owner's backend network to the user's backend network"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            for moid in self.server.vms(const.VLAB_STAGING_FOLDER):
+                self.server.objects[moid]['networks'].append(self.server.network('alice_backend'))
+            with patch.object(vmware, 'const', _const('linked_clone')):
+                vmware.create_deployment('bob', 'myTemplate', MagicMock())
+
+        clone = self.server.objects[self.server.vms('bob')[0]]
+        networks = [self.server.objects[x]['name'] for x in clone['networks']]
+        self.assertEqual(networks, ['bob_frontend', 'bob_backend'])
+
+    def test_ova_fallback(self):
+        """``create_deployment`` uploads the OVA when a template is not staged"""
+        with patched(self.server):
+            with patch.object(vmware, 'const', _const('linked_clone')):
+                vmware.create_deployment('bob', 'myTemplate', MagicMock())
+
+        self.assertEqual(self.server.calls['ImportVApp'], 2)
+        self.assertEqual(self.server.calls['CloneVM_Task'], 0)
+
+    def test_ova_mode(self):
+        """``create_deployment`` ignores staged VMs when the deploy mode is 'ova'"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            with patch.object(vmware, 'const', _const('ova')):
+                vmware.create_deployment('bob', 'myTemplate', MagicMock())
+
+        self.assertEqual(self.server.calls['CloneVM_Task'], 0)
+
+
+class TestNoStagingFolder(unittest.TestCase):
+    """A set of test cases for staging before the staging folder exists"""
+
+    def setUp(self):
+        """Every test gets a fake vSphere without a staging folder"""
+        self.server = FakeVSphere()
+        self.server.add_user('alice')
+        patcher = patch.object(vmware, 'get_meta', return_value=META)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stage_template(self):
+        """``stage_template`` makes the staging folder"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+
+        self.assertEqual(len(self.server.vms(const.VLAB_STAGING_FOLDER)), 2)
+
+    def test_stage_template_twice(self):
+        """``stage_template`` uses the staging folder made by an earlier stage"""
+        with patched(self.server):
+            vmware.stage_template('myTemplate', 'alice', MagicMock())
+            vmware.stage_template('otherTemplate', 'alice', MagicMock())
+
+        self.assertEqual(len(self.server.vms(const.VLAB_STAGING_FOLDER)), 4)
+
+    def test_get_staged(self):
+        """``get_staged`` nothing is staged when there's no staging folder"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                output = staging.get_staged(vcenter, 'myTemplate')
+
+        self.assertEqual(output, {})
+
+    def test_unstage_template(self):
+        """``unstage_template`` has nothing to destroy when there's no staging folder"""
+        with patched(self.server):
+            vmware.unstage_template('myTemplate', MagicMock())
+
+        self.assertEqual(self.server.calls['Destroy_Task'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,10 @@ from unittest.mock import patch, MagicMock
 
 from requests.exceptions import RequestException
 
+from vlab_deployment_api.lib.gateway import GatewayError
+
 from vlab_deployment_api.lib.worker import tasks
+from vlab_deployment_api.lib.worker import progress
 
 
 class TestTasks(unittest.TestCase):
@@ -32,9 +35,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(tasks, 'create_port_maps')
+    @patch.object(tasks, 'PortMapper')
     @patch.object(tasks, 'vmware')
-    def test_create_ok(self, fake_vmware, fake_create_port_maps):
+    def test_create_ok(self, fake_vmware, fake_PortMapper):
         """``create`` returns a dictionary when everything works as expected"""
         fake_vmware.create_deployment.return_value = {'worked': True}
 
@@ -47,9 +50,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(tasks, 'create_port_maps')
+    @patch.object(tasks, 'PortMapper')
     @patch.object(tasks, 'vmware')
-    def test_create_value_error(self, fake_vmware, fake_create_port_maps):
+    def test_create_value_error(self, fake_vmware, fake_PortMapper):
         """``create`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.create_deployment.side_effect = [ValueError("testing")]
 
@@ -62,11 +65,32 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(tasks, 'create_port_maps')
+    @patch.object(tasks, 'PortMapper')
+    @patch.object(tasks, 'vmware')
+    def test_create_other_error(self, fake_vmware, fake_PortMapper):
+        """``create`` sets the error in the dictionary when the deploy raises something besides ValueError"""
+        def create_deployment(username, template, logger, task_progress, on_deployed):
+            task_progress.set_phase('vm01-dply', progress.READY)
+            task_progress.set_phase('vm02-dply', progress.WAITING_FOR_IP)
+            raise RuntimeError('Timed out waiting on 1 VMs')
+        fake_vmware.create_deployment.side_effect = create_deployment
+
+        output = tasks.create(username='bob',
+                              user_token='aaa.bbb.ccc',
+                              template='myDeployment',
+                              client_ip='1.2.3.4',
+                              txn_id='myId')
+        expected = {'content' : {'vm01-dply': {'phase': 'ready'}, 'vm02-dply': {'phase': 'waiting for ip'}},
+                    'error': 'Unable to deploy myDeployment. Error: Timed out waiting on 1 VMs',
+                    'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'PortMapper')
     @patch.object(tasks, 'vmware')
-    def test_create_portmap_error(self, fake_vmware, fake_create_port_maps):
+    def test_create_portmap_error(self, fake_vmware, fake_PortMapper):
         """``create`` sets the error in the dictionary when there's an issue creating all portmap rules"""
-        fake_create_port_maps.side_effect = [RequestException("testing")]
+        fake_PortMapper.return_value.__exit__.side_effect = [RequestException("testing")]
         fake_vmware.create_deployment.return_value = {'things': 'stuff'}
 
         output = tasks.create(username='bob',
@@ -78,6 +102,37 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'PortMapper')
+    @patch.object(tasks, 'vmware')
+    def test_create_portmap_error_per_machine(self, fake_vmware, fake_PortMapper):
+        """``create`` reports the portmap rules that failed with each VM"""
+        fake_PortMapper.return_value.__exit__.side_effect = [GatewayError(['oops'], {'vm01-dply': ['oops']})]
+        fake_vmware.create_deployment.return_value = {'vm01-dply': {'ips': ['1.2.3.4']}, 'vm02-dply': {'ips': ['1.2.3.5']}}
+
+        output = tasks.create(username='bob',
+                              user_token='aaa.bbb.ccc',
+                              template='myDeployment',
+                              client_ip='1.2.3.4',
+                              txn_id='myId')
+
+        self.assertEqual(output['content']['vm01-dply']['portmap_errors'], ['oops'])
+        self.assertFalse('portmap_errors' in output['content']['vm02-dply'])
+
+    @patch.object(tasks, 'PortMapper')
+    @patch.object(tasks, 'vmware')
+    def test_create_pipelines_portmaps(self, fake_vmware, fake_PortMapper):
+        """``create`` makes the portmap rules of each VM as soon as it's deployed"""
+        fake_vmware.create_deployment.return_value = {}
+
+        tasks.create(username='bob',
+                     user_token='aaa.bbb.ccc',
+                     template='myDeployment',
+                     client_ip='1.2.3.4',
+                     txn_id='myId')
+        _, the_kwargs = fake_vmware.create_deployment.call_args
+
+        self.assertEqual(the_kwargs['on_deployed'], fake_PortMapper.return_value.__enter__.return_value.add)
+
     @patch.object(tasks, 'delete_port_maps')
     @patch.object(tasks, 'vmware')
     def test_delete_ok(self, fake_vmware, fake_delete_port_maps):
@@ -111,25 +166,44 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(tasks, 'vmware')
-    def test_images(self, fake_vmware):
+    @patch.object(tasks, 'catalog')
+    def test_images(self, fake_catalog):
         """``images`` returns a dictionary when everything works as expected"""
-        fake_vmware.list_images.return_value = ['myDeployment']
+        fake_catalog.list_images.return_value = ['myDeployment']
 
         output = tasks.images(txn_id='myId', verbose=False)
         expected = {'content' : {'image' : ['myDeployment']}, 'error': None, 'params' : {}}
 
         self.assertEqual(output, expected)
 
-    @patch.object(tasks, 'vmware')
-    def test_images_verbose(self, fake_vmware):
-        """``images`` passes the verbose flag to the VMware lib"""
+    @patch.object(tasks, 'catalog')
+    def test_images_verbose(self, fake_catalog):
+        """``images`` passes the verbose flag to the catalog"""
         tasks.images(txn_id='myId', verbose=True)
 
-        the_args, the_kwargs = fake_vmware.list_images.call_args
+        the_args, the_kwargs = fake_catalog.list_images.call_args
 
         self.assertTrue(the_kwargs['verbose'])
 
+    @patch.object(tasks.catalog, 'list_images')
+    def test_images_page(self, fake_list_images):
+        """``images`` includes the cursor of the next page when a limit is given"""
+        fake_list_images.return_value = ['template1', 'template2']
+
+        output = tasks.images(txn_id='myId', verbose=False, limit=2)
+
+        self.assertEqual(output['content']['image'], ['template1', 'template2'])
+        self.assertTrue(output['content']['next'] is not None)
+
+    @patch.object(tasks.catalog, 'list_images')
+    def test_images_error(self, fake_list_images):
+        """``images`` sets the error when the query is bad"""
+        fake_list_images.side_effect = ValueError('testing')
+
+        output = tasks.images(txn_id='myId', verbose=False, cursor='bogus')
+
+        self.assertEqual(output['error'], 'testing')
+
     @patch.object(tasks.templates, 'show')
     def test_show_templates(self, fake_show):
         """``show_templates`` returns a dictionary when everything works as expected"""
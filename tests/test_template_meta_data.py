@@ -3,9 +3,12 @@
 A suite of tests for the functions in template_meta_data.py module
 """
 import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
+from vlab_deployment_api.lib import meta_store
 from vlab_deployment_api.lib import template_meta_data
 
 
@@ -24,6 +27,75 @@ class TestGetMeta(unittest.TestCase):
 
         self.assertEqual(meta, expected)
 
+    @patch.object(template_meta_data.os, 'listdir')
+    @patch.object(template_meta_data, '_read_meta')
+    def test_get_meta_manifest(self, fake_read_meta, fake_listdir):
+        """``_get_meta`` sets the ova_path to the manifest of OVAs in the chunk store"""
+        fake_listdir.return_value = ['someVM.manifest', 'aFile.json']
+        fake_read_meta.return_value = {"machines": {"someVM": {"ip": "1.2.3.4", "kind": "foo", "manifest": "someVM.manifest"}}}
+
+        meta = template_meta_data.get_meta(template='foo')
+        expected = '/templates/foo/someVM.manifest'
+
+        self.assertEqual(meta['machines']['someVM']['ova_path'], expected)
+
+
+class TestOvaFiles(unittest.TestCase):
+    """A set of test cases for remembering where the OVAs of a template are"""
+
+    def setUp(self):
+        """Every test gets a template directory with one OVA"""
+        self.template_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.template_dir)
+        with open(os.path.join(self.template_dir, 'vm01.ova'), 'w') as the_file:
+            the_file.write('not really an OVA')
+        patcher = patch.dict(template_meta_data._OVA_FILES, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ova_files(self):
+        """``_ova_files`` maps each machine to its OVA file"""
+        output = template_meta_data._ova_files(self.template_dir)
+
+        self.assertEqual(output, {'vm01': 'vm01.ova'})
+
+    def test_ova_files_cached(self):
+        """``_ova_files`` only lists the directory once, while it's unchanged"""
+        with patch.object(template_meta_data.os, 'listdir', wraps=os.listdir) as fake_listdir:
+            template_meta_data._ova_files(self.template_dir)
+            template_meta_data._ova_files(self.template_dir)
+
+        self.assertEqual(fake_listdir.call_count, 1)
+
+    def test_ova_files_changed(self):
+        """``_ova_files`` notices new OVAs"""
+        template_meta_data._ova_files(self.template_dir)
+        with open(os.path.join(self.template_dir, 'vm02.ova'), 'w') as the_file:
+            the_file.write('not really an OVA')
+        # Some file systems only track mtime to the second
+        info = os.stat(self.template_dir)
+        os.utime(self.template_dir, ns=(info.st_atime_ns, info.st_mtime_ns + 5 * 10**9))
+
+        output = template_meta_data._ova_files(self.template_dir)
+
+        self.assertEqual(output, {'vm01': 'vm01.ova', 'vm02': 'vm02.ova'})
+
+    def test_ova_files_by_path(self):
+        """``_ova_files`` remembers OVAs by the directory they're in"""
+        template_meta_data._ova_files(self.template_dir)
+
+        self.assertEqual(list(template_meta_data._OVA_FILES.keys()), [os.path.abspath(self.template_dir)])
+
+    def test_ova_files_deleted(self):
+        """``_ova_files`` forgets about deleted templates"""
+        template_meta_data._ova_files(self.template_dir)
+        shutil.rmtree(self.template_dir)
+
+        with self.assertRaises(OSError):
+            template_meta_data._ova_files(self.template_dir)
+        self.assertEqual(template_meta_data._OVA_FILES, {})
+        os.makedirs(self.template_dir)
+
 
 class TestSetMeta(unittest.TestCase):
     """A set of test cases for the ``set_meta`` function"""
@@ -110,7 +182,7 @@ class TestMapMachine(unittest.TestCase):
 class TestInternalFuncs(unittest.TestCase):
     """A set of test cases for the private/internal functions"""
 
-    @patch.object(template_meta_data, 'open')
+    @patch.object(meta_store, 'open')
     def test_write_meta(self, fake_open):
         """``template_meta_data`` - _write_meta opens the correct file for writing"""
         meta = {'foo': 'bar'}
@@ -121,7 +193,7 @@ class TestInternalFuncs(unittest.TestCase):
 
         self.assertEqual(the_args, expected)
 
-    @patch.object(template_meta_data, 'open')
+    @patch.object(meta_store, 'open')
     def test_read_meta(self, fake_open):
         """``template_meta_data`` - _read_meta returns the expected data"""
         fake_open.return_value.__enter__.return_value.read.return_value = '{"machines": {"someVM": {"ip": "1.2.3.4", "kind": "foo"}}}'
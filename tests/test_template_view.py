@@ -11,6 +11,7 @@ from vlab_api_common import flask_common
 from vlab_api_common.http_auth import generate_v2_test_token
 
 from vlab_deployment_api.lib.views import deployment
+from vlab_deployment_api.lib.worker import catalog
 
 
 class TestTemplateView(unittest.TestCase):
@@ -64,6 +65,25 @@ class TestTemplateView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(catalog, 'owned_templates')
+    def test_get_inline(self, fake_show):
+        """TemplateView - GET on /api/2/inf/template?inline=true responds with your templates"""
+        fake_show.return_value = {'myTemplate': {'owner': 'bob'}}
+        with patch.object(deployment, 'const', deployment.const._replace(VLAB_CATALOG_INLINE=True)):
+            resp = self.app.get('/api/2/inf/template?inline=true',
+                                headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myTemplate': {'owner': 'bob'}})
+        self.assertEqual(fake_show.call_args[0][0], 'bob')
+
+    def test_get_inline_disabled(self):
+        """TemplateView - GET on /api/2/inf/template?inline=true still makes a task, unless the server allows it"""
+        resp = self.app.get('/api/2/inf/template?inline=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
     def test_post_task(self):
         """TemplateView - POST on /api/2/inf/template returns a task-id"""
         the_json = {"machines" : ['myVM01'],
@@ -159,6 +179,18 @@ class TestTemplateView(unittest.TestCase):
 
         self.assertEqual(resp.status_code, expected)
 
+    def test_task_progress(self):
+        """TemplateView - GET on ./task includes the progress of a running task"""
+        info = {'machines': {'vm01': {'phase': 'exporting', 'bytes': 10, 'total': 100, 'eta': 90}},
+                'bytes': 10, 'total': 100, 'eta': 90, 'elapsed': 10}
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PROGRESS'
+        self.app.application.celery_app.AsyncResult.return_value.info = info
+        resp = self.app.get('/api/2/inf/template/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['progress'], info)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,16 +1,30 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the ``templates.py`` module"""
+import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import catalog
+from vlab_deployment_api.lib.worker import trash
 from vlab_deployment_api.lib.worker import templates
+from vlab_deployment_api.lib.worker import integrity
+from .fake_vcenter import FakeVSphere, patched, templates_in
 
 
 class TestShow(unittest.TestCase):
     """A set of test cases for the ``show`` function"""
 
-    @patch.object(templates.os, 'listdir')
-    @patch.object(templates, 'get_meta')
+    def setUp(self):
+        """Every test gets an empty catalog of templates"""
+        patcher = patch.object(templates, 'CATALOG', catalog.TemplateCatalog(ttl=30))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(catalog.os, 'listdir')
+    @patch.object(catalog, 'get_meta')
     def test_show(self, fake_get_meta, fake_listdir):
         """``templates`` - show returns a dictionary of meta-data for templates a user owns"""
         fake_listdir.return_value = ['foo']
@@ -21,8 +35,8 @@ class TestShow(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(templates.os, 'listdir')
-    @patch.object(templates, 'get_meta')
+    @patch.object(catalog.os, 'listdir')
+    @patch.object(catalog, 'get_meta')
     def test_show_none(self, fake_get_meta, fake_listdir):
         """``templates`` - show returns an empty dictionary if a user owns no templates"""
         fake_listdir.return_value = ['foo']
@@ -33,6 +47,16 @@ class TestShow(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(catalog.os, 'listdir')
+    @patch.object(catalog, 'get_meta')
+    def test_show_hidden(self, fake_get_meta, fake_listdir):
+        """``templates`` - show ignores hidden directories (i.e. the chunk store)"""
+        fake_listdir.return_value = ['foo', '.chunks']
+        fake_get_meta.return_value = {'owner': "jill"}
+        templates.show('jill', MagicMock())
+
+        fake_get_meta.assert_called_once_with('foo')
+
 
 class TestCreate(unittest.TestCase):
     """A set of test cases for the ``create`` function"""
@@ -52,12 +76,12 @@ class TestCreate(unittest.TestCase):
     @patch.object(templates, 'check_for_template')
     @patch.object(templates.os, 'makedirs')
     @patch.object(templates.vmware, '_make_ova')
-    @patch.object(templates.shutil, 'rmtree')
+    @patch.object(templates.trash, 'discard')
     @patch.object(templates, 'create_machine_meta')
     @patch.object(templates, 'lookup_email_addr')
     @patch.object(templates.os, 'rename')
     def test_create(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
-        fake_rmtree, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
         fake_set_meta):
         """``templates`` - create returns None"""
         output = templates.create(self.username,
@@ -69,17 +93,74 @@ class TestCreate(unittest.TestCase):
 
         self.assertTrue(output is None)
 
+    @patch.object(templates, 'const')
+    @patch.object(templates.vmware, 'stage_template')
     @patch.object(templates, 'set_meta')
     @patch.object(templates, 'as_completed')
     @patch.object(templates, 'check_for_template')
     @patch.object(templates.os, 'makedirs')
     @patch.object(templates.vmware, '_make_ova')
-    @patch.object(templates.shutil, 'rmtree')
+    @patch.object(templates.trash, 'discard')
+    @patch.object(templates, 'create_machine_meta')
+    @patch.object(templates, 'lookup_email_addr')
+    @patch.object(templates.os, 'rename')
+    def test_create_stages(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_set_meta, fake_stage_template, fake_const):
+        """``templates`` - create stages the new template in vCenter when deployments are cloned"""
+        fake_const.VLAB_DEPLOY_MODE = 'linked_clone'
+        fake_const.VLAB_DEPLOYMENT_TEMPLATE_DIR = '/templates'
+        fake_const.VLAB_DEPLOY_CONCURRENT_VMS = 2
+        templates.create(self.username,
+                         self.template,
+                         self.machines,
+                         self.portmaps,
+                         self.summary,
+                         self.logger)
+
+        fake_stage_template.assert_called_with(self.template, self.username, self.logger)
+
+    @patch.object(templates, 'const')
+    @patch.object(templates.vmware, 'stage_template')
+    @patch.object(templates, 'set_meta')
+    @patch.object(templates, 'as_completed')
+    @patch.object(templates, 'check_for_template')
+    @patch.object(templates.os, 'makedirs')
+    @patch.object(templates.vmware, '_make_ova')
+    @patch.object(templates.trash, 'discard')
+    @patch.object(templates, 'create_machine_meta')
+    @patch.object(templates, 'lookup_email_addr')
+    @patch.object(templates.os, 'rename')
+    def test_create_stage_fails(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_set_meta, fake_stage_template, fake_const):
+        """``templates`` - create does not fail when staging the published template fails"""
+        fake_const.VLAB_DEPLOY_MODE = 'linked_clone'
+        fake_const.VLAB_DEPLOYMENT_TEMPLATE_DIR = '/templates'
+        fake_const.VLAB_DEPLOY_CONCURRENT_VMS = 2
+        for error in [ValueError('testing'), RuntimeError('testing'), templates.vmodl.fault.SystemError(reason='testing')]:
+            fake_stage_template.side_effect = error
+            output = templates.create(self.username,
+                                      self.template,
+                                      self.machines,
+                                      self.portmaps,
+                                      self.summary,
+                                      self.logger)
+
+            self.assertTrue(output is None)
+        self.assertEqual(self.logger.error.call_count, 3)
+
+    @patch.object(templates, 'set_meta')
+    @patch.object(templates, 'as_completed')
+    @patch.object(templates, 'check_for_template')
+    @patch.object(templates.os, 'makedirs')
+    @patch.object(templates.vmware, '_make_ova')
+    @patch.object(templates.trash, 'discard')
     @patch.object(templates, 'create_machine_meta')
     @patch.object(templates, 'lookup_email_addr')
     @patch.object(templates.os, 'rename')
     def test_create_rename(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
-        fake_rmtree, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
         fake_set_meta):
         """``templates`` - create makes the template directory unhidden when successful"""
         templates.create(self.username,
@@ -99,12 +180,12 @@ class TestCreate(unittest.TestCase):
     @patch.object(templates, 'check_for_template')
     @patch.object(templates.os, 'makedirs')
     @patch.object(templates.vmware, '_make_ova')
-    @patch.object(templates.shutil, 'rmtree')
+    @patch.object(templates.trash, 'discard')
     @patch.object(templates, 'create_machine_meta')
     @patch.object(templates, 'lookup_email_addr')
     @patch.object(templates.os, 'rename')
     def test_create_template_exists(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
-        fake_rmtree, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
         fake_set_meta):
         """``templates`` - create raises ValueError if the template already exists"""
         fake_check_for_template.side_effect = [FileExistsError('testing')]
@@ -121,12 +202,12 @@ class TestCreate(unittest.TestCase):
     @patch.object(templates, 'check_for_template')
     @patch.object(templates.os, 'makedirs')
     @patch.object(templates.vmware, '_make_ova')
-    @patch.object(templates.shutil, 'rmtree')
+    @patch.object(templates.trash, 'discard')
     @patch.object(templates, 'create_machine_meta')
     @patch.object(templates, 'lookup_email_addr')
     @patch.object(templates.os, 'rename')
     def test_create_template_exception(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
-        fake_rmtree, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
         fake_set_meta):
         """``templates`` - create raises ValueError if template creation raises an exception"""
         fake_future = MagicMock()
@@ -146,12 +227,12 @@ class TestCreate(unittest.TestCase):
     @patch.object(templates, 'check_for_template')
     @patch.object(templates.os, 'makedirs')
     @patch.object(templates.vmware, '_make_ova')
-    @patch.object(templates.shutil, 'rmtree')
+    @patch.object(templates.trash, 'discard')
     @patch.object(templates, 'create_machine_meta')
     @patch.object(templates, 'lookup_email_addr')
     @patch.object(templates.os, 'rename')
     def test_create_template_error(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
-        fake_rmtree, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
         fake_set_meta):
         """``templates`` - create raises ValueError if unable to create the template"""
         fake_future = MagicMock()
@@ -171,12 +252,12 @@ class TestCreate(unittest.TestCase):
     @patch.object(templates, 'check_for_template')
     @patch.object(templates.os, 'makedirs')
     @patch.object(templates.vmware, '_make_ova')
-    @patch.object(templates.shutil, 'rmtree')
+    @patch.object(templates.trash, 'discard')
     @patch.object(templates, 'create_machine_meta')
     @patch.object(templates, 'lookup_email_addr')
     @patch.object(templates.os, 'rename')
     def test_create_template_fails_cleanup(self, fake_rename, fake_lookup_email_addr, fake_create_machine_meta,
-        fake_rmtree, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
+        fake_discard, fake_make_ova, fake_makedirs, fake_check_for_template, fake_as_completed,
         fake_set_meta):
         """``templates`` - create deletes the partial template when unable to create the whole template"""
         fake_future = MagicMock()
@@ -193,35 +274,114 @@ class TestCreate(unittest.TestCase):
         except ValueError:
             pass
 
-        self.assertTrue(fake_rmtree.called)
+        self.assertTrue(fake_discard.called)
 
 
 class TestDelete(unittest.TestCase):
     """A set of test cases for the ``delete`` function"""
 
-    @patch.object(templates.shutil, 'rmtree')
-    @patch.object(templates.os, 'listdir')
+    def setUp(self):
+        """Every test gets an empty catalog of templates"""
+        patcher = patch.object(templates, 'CATALOG', catalog.TemplateCatalog(ttl=30))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(templates.trash, 'discard')
+    @patch.object(catalog.os, 'listdir')
     @patch.object(templates, 'get_meta')
-    def test_delete(self, fake_get_meta, fake_listdir, fake_rmtree):
+    def test_delete(self, fake_get_meta, fake_listdir, fake_discard):
         """``templates`` delete returns None upon success"""
         fake_listdir.return_value = ['someTemplate']
         fake_get_meta.return_value = {'owner': "jill"}
 
-        output = templates.delete('jill', 'someTemplate')
+        output = templates.delete('jill', 'someTemplate', MagicMock())
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(templates.shutil, 'rmtree')
-    @patch.object(templates.os, 'listdir')
+    @patch.object(templates.trash, 'discard')
+    @patch.object(catalog.os, 'listdir')
     @patch.object(templates, 'get_meta')
-    def test_delete_error(self, fake_get_meta, fake_listdir, fake_rmtree):
+    def test_delete_error(self, fake_get_meta, fake_listdir, fake_discard):
         """``templates`` delete raises ValueError if a user tries to delete a template they do not own."""
         fake_listdir.return_value = ['someTemplate']
         fake_get_meta.return_value = {'owner': "jill"}
 
         with self.assertRaises(ValueError):
-            templates.delete('bob', 'someTemplate')
+            templates.delete('bob', 'someTemplate', MagicMock())
+
+    @patch.object(templates.chunk_store, 'STORE')
+    @patch.object(templates.glob, 'glob')
+    @patch.object(templates.trash, 'discard')
+    @patch.object(catalog.os, 'listdir')
+    @patch.object(templates, 'get_meta')
+    def test_delete_chunks(self, fake_get_meta, fake_listdir, fake_discard, fake_glob, fake_STORE):
+        """``templates`` delete releases the chunks of the template's OVAs"""
+        fake_listdir.return_value = ['someTemplate']
+        fake_get_meta.return_value = {'owner': "jill"}
+        fake_glob.return_value = ['/templates/someTemplate/vm01.manifest']
+
+        templates.delete('jill', 'someTemplate', MagicMock())
+
+        fake_STORE.release.assert_called_with('/templates/someTemplate/vm01.manifest')
+
+    @patch.object(templates.trash, 'discard')
+    @patch.object(catalog.os, 'listdir')
+    @patch.object(templates, 'get_meta')
+    def test_delete_missing(self, fake_get_meta, fake_listdir, fake_discard):
+        """``templates`` delete does nothing when there's no such template"""
+        fake_listdir.return_value = ['otherTemplate']
+
+        templates.delete('jill', 'someTemplate', MagicMock())
+
+        self.assertFalse(fake_discard.called)
+        self.assertFalse(fake_get_meta.called)
+
+
+class TestSaveMachine(unittest.TestCase):
+    """A set of test cases for the ``_save_machine`` function"""
+
+    @patch.object(templates, 'const')
+    @patch.object(templates.chunk_store, 'STORE')
+    @patch.object(templates.vmware, '_make_ova')
+    def test_save_machine(self, fake_make_ova, fake_STORE, fake_const):
+        """``templates`` - _save_machine leaves the OVA alone by default"""
+        fake_const.VLAB_TEMPLATE_STORAGE = 'files'
+        fake_make_ova.return_value = ('/templates/.foo/vm01.ova', 'CentOS', '')
+
+        output = templates._save_machine('lisa', 'vm01', '/templates/.foo', MagicMock(), MagicMock())
+        expected = ('/templates/.foo/vm01.ova', 'CentOS', '')
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_STORE.put.called)
+
+    @patch.object(templates, 'const')
+    @patch.object(templates.chunk_store, 'STORE')
+    @patch.object(templates.vmware, '_make_ova')
+    def test_save_machine_chunks(self, fake_make_ova, fake_STORE, fake_const):
+        """``templates`` - _save_machine moves the OVA into the chunk store when configured to"""
+        fake_const.VLAB_TEMPLATE_STORAGE = 'chunks'
+        fake_make_ova.return_value = ('/templates/.foo/vm01.ova', 'CentOS', '')
+
+        output = templates._save_machine('lisa', 'vm01', '/templates/.foo', MagicMock(), MagicMock())
+        expected = ('/templates/.foo/vm01.manifest', 'CentOS', '')
+
+        self.assertEqual(output, expected)
+        fake_STORE.put.assert_called_with('/templates/.foo/vm01.ova', '/templates/.foo/vm01.manifest')
+
+    @patch.object(templates, 'const')
+    @patch.object(templates.chunk_store, 'STORE')
+    @patch.object(templates.vmware, '_make_ova')
+    def test_save_machine_reused(self, fake_make_ova, fake_STORE, fake_const):
+        """``templates`` - _save_machine does not store a reused manifest again"""
+        fake_const.VLAB_TEMPLATE_STORAGE = 'chunks'
+        fake_make_ova.return_value = ('/templates/.foo/vm01.manifest', 'CentOS', '')
+
+        output = templates._save_machine('lisa', 'vm01', '/templates/.foo', MagicMock(), MagicMock())
+        expected = ('/templates/.foo/vm01.manifest', 'CentOS', '')
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_STORE.put.called)
 
 
 class TestModify(unittest.TestCase):
@@ -235,6 +395,15 @@ class TestModify(unittest.TestCase):
 
         self.assertTrue(fake_lookup_email_addr.called)
 
+    @patch.object(templates, 'CATALOG')
+    @patch.object(templates, 'lookup_email_addr')
+    @patch.object(templates, 'update_meta')
+    def test_modify_catalog(self, fake_update_meta, fake_lookup_email_addr, fake_CATALOG):
+        """``templates`` modify makes the catalog re-read the template"""
+        templates.modify('alice', 'someTemplate', 'What a cool template', 'bob')
+
+        fake_CATALOG.invalidate.assert_called_once_with('someTemplate')
+
 
 class TestFunctions(unittest.TestCase):
     """A suite of test cases for the miscellaneous functions in the ``templates.py`` module"""
@@ -260,5 +429,85 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(output, expected)
 
 
+
+class TestAgainstFakeVCenter(unittest.TestCase):
+    """A set of test cases for making, and deploying, templates against a fake vCenter"""
+
+    def setUp(self):
+        """Every test gets a fake vSphere where alice has a VM to make a template from"""
+        self.template_dir = tempfile.mkdtemp()
+        self.server = FakeVSphere()
+        self.server.add_user('alice')
+        self.server.add_vm('alice', 'vm01', meta={'component': 'CentOS'}, ips=['192.168.1.2'])
+        self.portmaps = [{'name': 'vm01', 'target_addr': '192.168.1.2', 'target_ports': [22]}]
+        self.logger = MagicMock()
+
+    def tearDown(self):
+        """Remove the templates made by the test"""
+        shutil.rmtree(self.template_dir)
+
+    def test_create(self):
+        """``templates`` create exports every VM into an OVA, which can then be deployed"""
+        with patched(self.server), templates_in(self.template_dir):
+            templates.create('alice', 'myTemplate', ['vm01'], self.portmaps, 'a summary', self.logger)
+            images = catalog.list_images()
+            deployment = vmware.create_deployment('alice', 'myTemplate', self.logger)
+
+        self.assertEqual(images, ['myTemplate'])
+        self.assertTrue(os.path.isfile(os.path.join(self.template_dir, 'myTemplate', 'vm01.ova')))
+        self.assertEqual(list(deployment.keys()), ['vm01-dply'])
+
+    def test_create_digests(self):
+        """``templates`` create records the digest of every file in the OVAs, and they verify"""
+        with patched(self.server), templates_in(self.template_dir):
+            templates.create('alice', 'myTemplate', ['vm01'], self.portmaps, 'a summary', self.logger)
+            files = templates.get_meta('myTemplate')['machines']['vm01']['files']
+            checked, problems = integrity.verify_template('myTemplate')
+
+        self.assertEqual(sorted(files.keys()), ['vm01-disk1.vmdk', 'vm01.ovf'])
+        self.assertEqual(checked, 2)
+        self.assertEqual(problems, [])
+
+    def test_create_from_deployment(self):
+        """``templates`` create reuses the OVA of a deployed VM that hasn't changed"""
+        with patched(self.server), templates_in(self.template_dir):
+            templates.create('alice', 'myTemplate', ['vm01'], self.portmaps, 'a summary', self.logger)
+            vmware.create_deployment('alice', 'myTemplate', self.logger)
+            downloads = self.server.calls['download']
+            templates.create('alice', 'copy', ['vm01-dply'], self.portmaps, 'a summary', self.logger)
+        source = os.stat(os.path.join(self.template_dir, 'myTemplate', 'vm01.ova'))
+        copy = os.stat(os.path.join(self.template_dir, 'copy', 'vm01.ova'))
+
+        self.assertEqual(self.server.calls['download'], downloads)
+        self.assertEqual(copy.st_ino, source.st_ino)
+
+    def test_create_from_changed_deployment(self):
+        """``templates`` create exports a deployed VM whose disk has changed"""
+        with patched(self.server), templates_in(self.template_dir):
+            templates.create('alice', 'myTemplate', ['vm01'], self.portmaps, 'a summary', self.logger)
+            vmware.create_deployment('alice', 'myTemplate', self.logger)
+            moid = [x for x in self.server.vms('alice') if self.server.objects[x]['name'] == 'vm01-dply'][0]
+            self.server.write_disk(moid)
+            downloads = self.server.calls['download']
+            templates.create('alice', 'copy', ['vm01-dply'], self.portmaps, 'a summary', self.logger)
+        source = os.stat(os.path.join(self.template_dir, 'myTemplate', 'vm01.ova'))
+        copy = os.stat(os.path.join(self.template_dir, 'copy', 'vm01.ova'))
+
+        self.assertEqual(self.server.calls['download'], downloads + 1)
+        self.assertNotEqual(copy.st_ino, source.st_ino)
+
+    def test_create_failure(self):
+        """``templates`` create leaves nothing behind when an export fails"""
+        self.server.fail('download')
+        with patched(self.server), templates_in(self.template_dir):
+            with self.assertRaises(ValueError):
+                templates.create('alice', 'myTemplate', ['vm01'], self.portmaps, 'a summary', self.logger)
+        trash_dir = os.path.join(self.template_dir, trash.TRASH_NAME)
+        trash.Reclaimer(trash_dir, rate=0).reclaim()
+
+        self.assertEqual(os.listdir(self.template_dir), [trash.TRASH_NAME])
+        self.assertEqual(os.listdir(trash_dir), [trash.LOCK_NAME])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the trash.py module
+"""
+import os
+import fcntl
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib.worker import trash
+
+
+def make_file(path, size):
+    """Write a file of ``size`` bytes"""
+    with open(path, 'wb') as the_file:
+        the_file.write(b'a' * size)
+
+
+class TestDiscard(unittest.TestCase):
+    """A set of test cases for the ``discard`` function"""
+
+    def setUp(self):
+        """Every test gets a template directory, with one template"""
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.template = os.path.join(self.location, 'myTemplate')
+        os.makedirs(self.template)
+        make_file(os.path.join(self.template, 'vm01.ova'), 1024)
+        patcher = patch.object(trash, 'RECLAIMER')
+        self.fake_reclaimer = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_discard(self):
+        """``discard`` moves the directory into the trash"""
+        new_path = trash.discard(self.template)
+
+        self.assertFalse(os.path.exists(self.template))
+        self.assertEqual(os.path.dirname(new_path), os.path.join(self.location, trash.TRASH_NAME))
+        self.assertTrue(os.path.isfile(os.path.join(new_path, 'vm01.ova')))
+
+    def test_discard_wakes_reclaimer(self):
+        """``discard`` lets the reclaimer know there's new trash"""
+        trash.discard(self.template)
+
+        self.assertTrue(self.fake_reclaimer.start.called)
+
+    def test_discard_hidden(self):
+        """``discard`` does not hide templates that were being created within the trash"""
+        hidden = os.path.join(self.location, '.newTemplate')
+        os.makedirs(hidden)
+
+        new_path = trash.discard(hidden)
+
+        self.assertTrue(os.path.basename(new_path).startswith('newTemplate.'))
+
+    def test_discard_twice(self):
+        """``discard`` the same template can be deleted more than once"""
+        first = trash.discard(self.template)
+        os.makedirs(self.template)
+        second = trash.discard(self.template)
+
+        self.assertNotEqual(first, second)
+
+    @patch.object(trash.os, 'rename')
+    def test_discard_fallback(self, fake_rename):
+        """``discard`` deletes the directory right away when it can't be moved into the trash"""
+        fake_rename.side_effect = OSError('Invalid cross-device link')
+
+        trash.discard(self.template)
+
+        self.assertFalse(os.path.exists(self.template))
+        self.assertFalse(self.fake_reclaimer.start.called)
+
+
+class TestReclaimer(unittest.TestCase):
+    """A set of test cases for the Reclaimer object"""
+
+    def setUp(self):
+        """Every test gets a trash directory with one deleted template"""
+        self.trash_dir = os.path.join(tempfile.mkdtemp(), trash.TRASH_NAME)
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.trash_dir))
+        self.deleted = os.path.join(self.trash_dir, 'myTemplate.1234')
+        os.makedirs(os.path.join(self.deleted, 'nested'))
+        make_file(os.path.join(self.deleted, 'vm01.ova'), 3000)
+        make_file(os.path.join(self.deleted, 'nested', 'meta.json'), 10)
+        self.reclaimer = trash.Reclaimer(self.trash_dir, rate=0)
+
+    def test_reclaimable(self):
+        """``reclaimable`` counts the bytes of every file in the trash"""
+        self.assertEqual(trash.reclaimable(self.trash_dir), 3010)
+
+    def test_reclaimable_links(self):
+        """``reclaimable`` does not count files that have other links"""
+        os.link(os.path.join(self.deleted, 'vm01.ova'), os.path.join(os.path.dirname(self.trash_dir), 'vm01.ova'))
+
+        self.assertEqual(trash.reclaimable(self.trash_dir), 10)
+
+    def test_reclaim(self):
+        """``Reclaimer`` deletes everything in the trash"""
+        output = self.reclaimer.reclaim()
+
+        self.assertTrue(output)
+        self.assertEqual(os.listdir(self.trash_dir), [trash.LOCK_NAME])
+        self.assertEqual(self.reclaimer.stats['reclaimed'], 3010)
+        self.assertEqual(self.reclaimer.stats['entries'], 1)
+
+    def test_reclaim_no_trash(self):
+        """``Reclaimer`` has nothing to do when nothing was ever deleted"""
+        shutil.rmtree(self.trash_dir)
+
+        self.assertTrue(self.reclaimer.reclaim())
+
+    def test_reclaim_throttled(self):
+        """``Reclaimer`` paces the unlinks by the size of each file"""
+        self.reclaimer._bandwidth = MagicMock()
+
+        self.reclaimer.reclaim()
+        amounts = [x[0][0] for x in self.reclaimer._bandwidth.consume.call_args_list]
+
+        self.assertEqual(sorted(amounts), [10, 3000])
+
+    def test_reclaim_links(self):
+        """``Reclaimer`` does not count files that have other links against the rate limit"""
+        other = os.path.join(os.path.dirname(self.trash_dir), 'vm01.ova')
+        os.link(os.path.join(self.deleted, 'vm01.ova'), other)
+
+        self.reclaimer.reclaim()
+
+        self.assertEqual(os.path.getsize(other), 3000)
+        self.assertFalse(os.path.exists(self.deleted))
+        self.assertEqual(self.reclaimer.stats['reclaimed'], 10)
+
+    def test_reclaim_locked(self):
+        """``Reclaimer`` leaves the trash alone while another worker is reclaiming it"""
+        lock_file = os.open(os.path.join(self.trash_dir, trash.LOCK_NAME), os.O_CREAT | os.O_RDWR)
+        self.addCleanup(os.close, lock_file)
+        # flock locks belong to the open file, so another open of it can't take the lock
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        output = self.reclaimer.reclaim()
+
+        self.assertFalse(output)
+        self.assertTrue(os.path.exists(self.deleted))
+
+    def test_reclaim_open_file(self):
+        """``Reclaimer`` does not change a file that's still being read (i.e. by a deploy)"""
+        with open(os.path.join(self.deleted, 'vm01.ova'), 'rb') as the_file:
+            the_file.read(1000)
+            self.reclaimer.reclaim()
+            data = the_file.read()
+
+        self.assertEqual(data, b'a' * 2000)
+        self.assertFalse(os.path.exists(self.deleted))
+
+    def test_start(self):
+        """``Reclaimer`` start empties the trash in the background"""
+        self.reclaimer.start()
+        for _ in range(100):
+            if not os.path.exists(self.deleted):
+                break
+            self.reclaimer._thread.join(0.05)
+
+        self.assertFalse(os.path.exists(self.deleted))
+
+
+if __name__ == '__main__':
+    unittest.main()
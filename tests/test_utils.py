@@ -3,7 +3,10 @@
 import unittest
 from unittest.mock import patch, MagicMock
 
+from requests.exceptions import RequestException
+
 from vlab_deployment_api.lib import utils
+from .fake_gateway import FakeGateway
 
 
 class TestUtils(unittest.TestCase):
@@ -62,69 +65,145 @@ class TestUtils(unittest.TestCase):
 
         self.assertTrue(fake_Connection.return_value.unbind.called)
 
+
+class TestPortMaps(unittest.TestCase):
+    """A set of test cases for making, and deleting, port maps against a stand-in gateway"""
+
+    def setUp(self):
+        """Every test gets a gateway with no port maps"""
+        self.gateway = FakeGateway().start()
+        self.addCleanup(self.gateway.stop)
+        patcher = patch.object(utils, 'GATEWAYS', self.gateway.client())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(utils.GATEWAYS.close)
+        self.logger = MagicMock()
+
+    @patch.object(utils, 'get_meta')
+    def test_create_port_maps(self, fake_get_meta):
+        """``utils`` - create_port_maps makes a rule for every port of every VM"""
+        fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22, 443]},
+                                                   'vm02' : {'ip': '3.3.3.4', 'kind': 'Donut', 'ports':[22]}}}
+        utils.create_port_maps('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger)
+
+        output = sorted((x['target_name'], x['target_port']) for x in self.gateway.portmaps['homer'].values())
+        expected = [('vm01-dply', 22), ('vm01-dply', 443), ('vm02-dply', 22)]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(utils, 'get_meta')
+    def test_create_port_maps_reuses_connections(self, fake_get_meta):
+        """``utils`` - create_port_maps does not make a new connection for every rule"""
+        fake_get_meta.return_value = {'machines': {'vm{:02}'.format(x) : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22, 443, 8080]}
+                                                   for x in range(6)}}
+        utils.create_port_maps('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger)
+
+        self.assertEqual(self.gateway.stats['requests'], 18)
+        self.assertTrue(self.gateway.stats['connections'] <= utils.GATEWAYS.concurrency)
+
     @patch.object(utils, 'get_meta')
-    @patch.object(utils.requests, 'post')
-    def test_create_port_maps(self, fake_post, fake_get_meta):
-        """``utils`` - create_port_maps constructs the correct URL"""
-        username = 'homer'
-        template = 'doh'
-        user_token = 'aaa.bbb.ccc'
-        client_ip = '1.2.3.4'
-        logger = MagicMock()
+    def test_create_port_maps_progress(self, fake_get_meta):
+        """``utils`` - create_port_maps marks every VM as done once its rules are made"""
         fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22, 443]}}}
-        utils.create_port_maps(username, template, user_token, client_ip, logger)
+        task_progress = utils.progress.TaskProgress()
+        utils.create_port_maps('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger, task_progress)
+
+        output = task_progress.snapshot()['machines']['vm01-dply']['phase']
+
+        self.assertEqual(output, utils.progress.DONE)
+
+    @patch.object(utils, 'get_meta')
+    def test_create_port_maps_raises(self, fake_get_meta):
+        """``utils`` - create_port_maps raises RequestException, listing every rule that failed"""
+        fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22, 443, 8080]}}}
+        self.gateway.fail(times=2)
 
-        the_args, _ = fake_post.call_args
-        expected = ('https://homer.vlab.local/api/1/ipam/portmap',)
+        with self.assertRaises(RequestException) as the_error:
+            utils.create_port_maps('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger)
 
-        self.assertEqual(the_args, expected)
+        self.assertEqual(len(the_error.exception.errors), 2)
+        self.assertEqual(len(self.gateway.portmaps['homer']), 1)
 
     @patch.object(utils, 'get_meta')
-    @patch.object(utils.requests, 'post')
-    def test_create_port_maps_raises(self, fake_post, fake_get_meta):
-        """``utils`` - create_port_maps raises an exception if the HTTP request fails"""
-        username = 'homer'
-        template = 'doh'
-        user_token = 'aaa.bbb.ccc'
-        client_ip = '1.2.3.4'
-        logger = MagicMock()
+    def test_port_mapper_add(self, fake_get_meta):
+        """``utils`` - PortMapper sends the rules of a VM as soon as it's added"""
+        fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22, 443]},
+                                                   'vm02' : {'ip': '3.3.3.4', 'kind': 'Donut', 'ports':[22]}}}
+        with utils.PortMapper('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger) as mapper:
+            mapper.add('vm01-dply')
+
+        output = sorted((x['target_name'], x['target_port']) for x in self.gateway.portmaps['homer'].values())
+        expected = [('vm01-dply', 22), ('vm01-dply', 443)]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(utils, 'get_meta')
+    def test_port_mapper_failed(self, fake_get_meta):
+        """``utils`` - PortMapper reports the rules that failed with each VM"""
+        fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22]},
+                                                   'vm02' : {'ip': '3.3.3.4', 'kind': 'Donut', 'ports':[22]}}}
+        with self.assertRaises(RequestException) as the_error:
+            with utils.PortMapper('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger) as mapper:
+                mapper.add('vm01-dply')
+                mapper._batch._futures[0].result()
+                self.gateway.fail()
+                mapper.add('vm02-dply')
+
+        self.assertEqual(list(the_error.exception.failed.keys()), ['vm02-dply'])
+
+    @patch.object(utils, 'get_meta')
+    def test_port_mapper_deploy_error(self, fake_get_meta):
+        """``utils`` - PortMapper does not mask an error raised while deploying"""
+        fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22]}}}
+        with self.assertRaises(ValueError):
+            with utils.PortMapper('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger) as mapper:
+                mapper.add('vm01-dply')
+                raise ValueError('testing')
+
+    @patch.object(utils, 'get_meta')
+    def test_port_mapper_deploy_error_deletes(self, fake_get_meta):
+        """``utils`` - PortMapper deletes the rules it made when the deploy fails"""
         fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22, 443]}}}
-        utils.create_port_maps(username, template, user_token, client_ip, logger)
+        keep = self.gateway.add('homer', {'target_name': 'vm02', 'target_port': 22, 'target_component': 'other'})
+        with self.assertRaises(RuntimeError):
+            with utils.PortMapper('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger) as mapper:
+                mapper.add('vm01-dply')
+                raise RuntimeError('testing')
+
+        self.assertEqual(list(self.gateway.portmaps['homer'].keys()), [keep])
 
-        self.assertTrue(fake_post.return_value.raise_for_status.called)
+    @patch.object(utils, 'get_meta')
+    def test_port_mapper_deploy_error_delete_fails(self, fake_get_meta):
+        """``utils`` - PortMapper raises the deploy error, even if deleting its rules fails"""
+        fake_get_meta.return_value = {'machines': {'vm01' : {'ip': '3.3.3.3', 'kind': 'Donut', 'ports':[22]}}}
+        with self.assertRaises(ValueError):
+            with utils.PortMapper('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger) as mapper:
+                mapper.add('vm01-dply')
+                mapper._futures[0].result()
+                self.gateway.fail()
+                raise ValueError('testing')
 
-    @patch.object(utils.requests, 'delete')
-    @patch.object(utils.requests, 'get')
-    def test_delete_port_maps(self, fake_get, fake_delete):
-        """``utils`` - delete_port_maps looks up existing port forwarding rules"""
-        username = 'homer'
-        template = 'doh'
-        user_token = 'aaa.bbb.ccc'
-        client_ip = '1.2.3.4'
-        logger = MagicMock()
-        fake_get.return_value.json.return_value = {'content': {'ports': {'50024': {'name': 'foo', 'target_addr': '1.2.3.4', 'target_port' : '443',  'component': 'myTemplate'}}}}
+        self.assertEqual(len(self.gateway.portmaps['homer']), 1)
+        self.assertTrue(self.logger.error.called)
 
-        utils.delete_port_maps(username, template, user_token, client_ip, logger)
+    def test_delete_port_maps(self):
+        """``utils`` - delete_port_maps deletes only the rules of the deployment"""
+        self.gateway.add('homer', {'target_name': 'vm01-dply', 'target_port': 22, 'target_component': 'doh'})
+        self.gateway.add('homer', {'target_name': 'vm01-dply', 'target_port': 443, 'target_component': 'doh'})
+        keep = self.gateway.add('homer', {'target_name': 'vm02', 'target_port': 22, 'target_component': 'other'})
 
-        self.assertTrue(fake_get.called)
+        utils.delete_port_maps('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger)
 
-    @patch.object(utils.requests, 'delete')
-    @patch.object(utils.requests, 'get')
-    def test_delete_port_maps_error(self, fake_get, fake_delete):
+        self.assertEqual(list(self.gateway.portmaps['homer'].keys()), [keep])
+
+    def test_delete_port_maps_error(self):
         """``utils`` - delete_port_maps Raises RuntimeError is deleting a rule fails"""
-        username = 'homer'
-        template = 'doh'
-        user_token = 'aaa.bbb.ccc'
-        client_ip = '1.2.3.4'
-        logger = MagicMock()
-        fake_get.return_value.json.return_value = {'content': {'ports': {'50024': {'name': 'foo', 'target_addr': '1.2.3.4', 'target_port' : '443',  'component': 'myTemplate'}}}}
-        fake_resp = MagicMock()
-        fake_resp.ok = False
-        fake_resp.content = b'someError'
-        fake_delete.return_value = fake_resp
+        self.gateway.add('homer', {'target_name': 'vm01-dply', 'target_port': 22, 'target_component': 'doh'})
+        self.gateway.add('homer', {'target_name': 'vm01-dply', 'target_port': 443, 'target_component': 'doh'})
+        with patch.object(self.gateway, 'remove', return_value=False):
+            with self.assertRaises(RuntimeError):
+                utils.delete_port_maps('homer', 'doh', 'aaa.bbb.ccc', '1.2.3.4', self.logger)
 
-        with self.assertRaises(RuntimeError):
-            utils.delete_port_maps(username, template, user_token, client_ip, logger)
 
 
 
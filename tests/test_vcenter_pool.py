@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the vcenter_pool.py module
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_deployment_api.lib.worker import vcenter_pool
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import admission
+from .fake_vcenter import FakeVSphere, patched
+
+
+class TestSessionPool(unittest.TestCase):
+    """A set of test cases for the ``SessionPool`` object"""
+
+    @patch.object(vcenter_pool, 'CachedvCenter')
+    def test_reuses_sessions(self, fake_vCenter):
+        """``SessionPool`` - Reuses a returned session instead of logging in again"""
+        pool = vcenter_pool.SessionPool(max_size=2, keepalive=300)
+        with pool.session():
+            pass
+        with pool.session():
+            pass
+
+        self.assertEqual(fake_vCenter.call_count, 1)
+
+    @patch.object(vcenter_pool, 'CachedvCenter')
+    def test_max_size(self, fake_vCenter):
+        """``SessionPool`` - Raises RuntimeError when every session is in use past the timeout"""
+        pool = vcenter_pool.SessionPool(max_size=1, keepalive=300, borrow_timeout=0.01)
+        pool.borrow()
+
+        with self.assertRaises(RuntimeError):
+            pool.borrow()
+
+    @patch.object(vcenter_pool, 'CachedvCenter')
+    def test_login_failure(self, fake_vCenter):
+        """``SessionPool`` - A failed login does not use up a slot in the pool"""
+        fake_vCenter.side_effect = [RuntimeError('testing'), MagicMock()]
+        pool = vcenter_pool.SessionPool(max_size=1, keepalive=300, borrow_timeout=0.01)
+        try:
+            pool.borrow()
+        except RuntimeError:
+            pass
+        pool.borrow()
+
+        self.assertEqual(fake_vCenter.call_count, 2)
+
+    @patch.object(vcenter_pool.time, 'time')
+    @patch.object(vcenter_pool, 'CachedvCenter')
+    def test_relogin_expired(self, fake_vCenter, fake_time):
+        """``SessionPool`` - Logs in again when an idle session has expired"""
+        fake_time.side_effect = [0, 0, 1000, 1000]
+        expired = MagicMock()
+        expired.content.sessionManager.currentSession = None
+        fake_vCenter.side_effect = [expired, MagicMock()]
+        pool = vcenter_pool.SessionPool(max_size=1, keepalive=300)
+        pool._start_keeper = MagicMock()
+        pool.give_back(pool.borrow())
+        pool.borrow()
+
+        self.assertTrue(expired.close.called)
+
+    @patch.object(vcenter_pool, 'CachedvCenter')
+    def test_not_authenticated(self, fake_vCenter):
+        """``SessionPool`` - Discards a session that vCenter no longer considers logged in"""
+        pool = vcenter_pool.SessionPool(max_size=1, keepalive=300)
+        try:
+            with pool.session():
+                raise vcenter_pool.vim.fault.NotAuthenticated()
+        except vcenter_pool.vim.fault.NotAuthenticated:
+            pass
+        with pool.session():
+            pass
+
+        self.assertEqual(fake_vCenter.call_count, 2)
+
+    @patch.object(vcenter_pool, 'CachedvCenter')
+    def test_clears_network_cache(self, fake_vCenter):
+        """``SessionPool`` - Returned sessions do not keep a stale network cache"""
+        pool = vcenter_pool.SessionPool(max_size=1, keepalive=300)
+        with pool.session() as vcenter:
+            vcenter._net_cache = {'foo': 'bar'}
+
+        self.assertTrue(fake_vCenter.return_value._net_cache is None)
+
+    @patch.object(vcenter_pool, 'CachedvCenter')
+    def test_close(self, fake_vCenter):
+        """``SessionPool`` - close logs out idle sessions"""
+        pool = vcenter_pool.SessionPool(max_size=1, keepalive=300)
+        with pool.session():
+            pass
+        pool.close()
+
+        self.assertTrue(fake_vCenter.return_value.close.called)
+
+
+class TestLoginsPerOperation(unittest.TestCase):
+    """Deploying a multi-VM template should not log into vCenter once per VM"""
+
+    # How many uploads overlap depends on thread timing, and so does how many
+    # sessions the first deploy leaves in the pool; one slot makes it the same every time
+    @patch.object(vmware, 'SLOTS', admission.SlotScheduler({'import': 1, 'export': 1}))
+    @patch.object(vmware, 'get_meta')
+    def test_create_deployment(self, fake_get_meta):
+        """``create_deployment`` - A second deploy needs zero new vCenter logins"""
+        fake_get_meta.return_value = {'machines': {'vm{}'.format(x): {'ova_path': '/foo.ova', 'kind': 'CentOS'} for x in range(5)}}
+        server = FakeVSphere()
+        server.add_user('alice')
+        with patched(server):
+            vmware.create_deployment('alice', 'myTemplate', MagicMock())
+            logins = server.calls['login']
+            vmware.delete_deployment('alice', 'myTemplate', MagicMock())
+            vmware.create_deployment('alice', 'myTemplate', MagicMock())
+
+        self.assertTrue(logins <= 5)
+        self.assertEqual(server.calls['login'], logins)
+
+
+if __name__ == '__main__':
+    unittest.main()
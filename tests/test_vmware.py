@@ -2,31 +2,56 @@
 """
 A suite of tests for the functions in vmware.py
 """
+import os
+import time
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
+from pyVmomi import vim
+
 from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import progress
+from vlab_deployment_api.lib.worker import ova_cache
+from vlab_deployment_api.lib.worker.deployment_index import DeploymentIndex
+from .fake_vcenter import FakeVSphere, patched, fake_deploy_from_ova
+from .test_ova_cache import make_ova
+
+DEPLOYED = {'component': 'OneFS', 'deployment': True, 'created': 1234,
+            'version': 'n/a', 'configured': True, 'generation': 1}
 
 
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_show_deployment(self, fake_vCenter, fake_consume_task, fake_get_info):
+    def setUp(self):
+        """Start every test without any cached knowledge of deployments"""
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        patcher = patch.object(vmware, 'INDEX', DeploymentIndex(ttl=60, lock_dir=lock_dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(vmware.inventory, 'get_details')
+    @patch.object(vmware.inventory, 'get_vms')
+    @patch.object(vmware, 'borrow')
+    def test_show_deployment(self, fake_borrow, fake_get_vms, fake_get_details):
         """``deployment`` returns a dictionary when everything works as expected"""
         fake_vm = MagicMock()
         fake_vm.name = 'Deployment'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'someDeployment',
+        fake_borrow.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_vms.return_value = [{'vm': fake_vm,
+                                      'name': fake_vm.name,
+                                      'meta': {'component': 'someDeployment',
                                                'deployment' : True,
                                                'created': 1234,
                                                'version': 'n/a',
                                                'configured': True,
-                                               'generation': 1}}
+                                               'generation': 1}}]
+        fake_get_details.side_effect = lambda vcenter, record, username: {'meta': record['meta']}
 
         output = vmware.show_deployment(username='alice')
         expected = {'Deployment': {'meta': {'component': 'someDeployment',
@@ -37,51 +62,73 @@ class TestVMware(unittest.TestCase):
                                             'generation': 1}}}
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_deployment(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware.inventory, 'get_vms')
+    @patch.object(vmware, '_teardown')
+    @patch.object(vmware, 'borrow')
+    def test_delete_deployment(self, fake_borrow, fake_teardown, fake_get_vms):
         """``delete_deployment`` returns None when everything works as expected"""
         fake_logger = MagicMock()
+        fake_teardown.return_value = {}
         fake_vm = MagicMock()
         fake_vm.name = 'DeploymentBox'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'someDeployment',
+        fake_borrow.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_vms.return_value = [{'vm': fake_vm,
+                                      'name': fake_vm.name,
+                                      'meta': {'component': 'someDeployment',
                                                'deployment' : True,
                                                'created': 1234,
                                                'version': 'n/a',
                                                'configured': True,
-                                               'generation': 1}}
+                                               'generation': 1}}]
 
         output = vmware.delete_deployment(username='bob', machine_name='DeploymentBox', logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_deployment_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware.inventory, 'get_vms')
+    @patch.object(vmware, '_teardown')
+    @patch.object(vmware, 'borrow')
+    def test_delete_deployment_value_error(self, fake_borrow, fake_teardown, fake_get_vms):
         """``delete_deployment`` raises ValueError when unable to find requested vm for deletion"""
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'win10'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'someOtherComponent',
+        fake_borrow.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_vms.return_value = [{'vm': fake_vm,
+                                      'name': fake_vm.name,
+                                      'meta': {'component': 'someOtherComponent',
                                                'created': 1234,
                                                'version': 'n/a',
                                                'configured': True,
-                                               'generation': 1}}
+                                               'generation': 1}}]
 
         with self.assertRaises(ValueError):
             vmware.delete_deployment(username='bob', machine_name='myOtherDeploymentBox', logger=fake_logger)
 
+    @patch.object(vmware.inventory, 'get_vms')
+    @patch.object(vmware, '_teardown')
+    @patch.object(vmware, 'borrow')
+    def test_delete_deployment_teardown_errors(self, fake_borrow, fake_teardown, fake_get_vms):
+        """``delete_deployment`` raises ValueError when some VMs could not be destroyed"""
+        fake_logger = MagicMock()
+        fake_teardown.return_value = {'DeploymentBox': 'testing'}
+        fake_get_vms.return_value = [{'vm': MagicMock(),
+                                      'name': 'DeploymentBox',
+                                      'meta': {'component': 'someDeployment',
+                                               'deployment' : True,
+                                               'created': 1234,
+                                               'version': 'n/a',
+                                               'configured': True,
+                                               'generation': 1}}]
+
+        with self.assertRaises(ValueError):
+            vmware.delete_deployment(username='bob', machine_name='DeploymentBox', logger=fake_logger)
+
     @patch.object(vmware, '_check_for_deployment')
     @patch.object(vmware, 'get_meta')
     @patch.object(vmware, 'ThreadPoolExecutor')
@@ -97,21 +144,27 @@ class TestVMware(unittest.TestCase):
 
         self.assertTrue(fake_ThreadPoolExecutor.called)
 
+    @patch.object(vmware, '_wait_until_ready')
     @patch.object(vmware, '_check_for_deployment')
     @patch.object(vmware, 'get_meta')
     @patch.object(vmware, 'ThreadPoolExecutor')
     @patch.object(vmware, 'as_completed')
-    def test_create_deployment(self, fake_as_completed, fake_ThreadPoolExecutor, fake_get_meta, fake_check_for_deployment):
+    def test_create_deployment(self, fake_as_completed, fake_ThreadPoolExecutor, fake_get_meta, fake_check_for_deployment, fake_wait_until_ready):
         """``create_deployment`` return info about each VM created in the deployment"""
         username = 'louis'
         template = 'someTemplate'
         logger = MagicMock()
         fake_check_for_deployment.return_value = ''
+        fake_vm1 = MagicMock()
+        fake_vm2 = MagicMock()
         fake_future1 = MagicMock()
-        fake_future1.result.return_value = {"vm01-dply" : {"details": True}}
+        fake_future1.result.return_value = fake_vm1
         fake_future2 = MagicMock()
-        fake_future2.result.return_value = {"vm02-dply" : {'details' : True}}
-        fake_as_completed.return_value = [fake_future1, fake_future2]
+        fake_future2.result.return_value = fake_vm2
+        fake_executor = fake_ThreadPoolExecutor.return_value.__enter__.return_value
+        fake_executor.submit.side_effect = [fake_future1, fake_future2]
+        fake_as_completed.side_effect = lambda futures: list(futures)
+        fake_wait_until_ready.return_value = {'vm01-dply': {'details': True}, 'vm02-dply': {'details': True}}
         fake_get_meta.return_value = {'machines':{
                                          'vm01':{
                                             'ova_path': '/path/to/vm01.ova',
@@ -129,6 +182,33 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(deployments, expected)
 
+    @patch.object(vmware, '_wait_until_ready')
+    @patch.object(vmware, '_check_for_deployment')
+    @patch.object(vmware, 'get_meta')
+    @patch.object(vmware, 'ThreadPoolExecutor')
+    @patch.object(vmware, 'as_completed')
+    def test_create_deployment_waits_once(self, fake_as_completed, fake_ThreadPoolExecutor, fake_get_meta, fake_check_for_deployment, fake_wait_until_ready):
+        """``create_deployment`` waits for every new VM to be ready at once, with the kind of each VM"""
+        logger = MagicMock()
+        fake_check_for_deployment.return_value = ''
+        fake_vm1 = MagicMock()
+        fake_vm2 = MagicMock()
+        fake_future1 = MagicMock()
+        fake_future1.result.return_value = fake_vm1
+        fake_future2 = MagicMock()
+        fake_future2.result.return_value = fake_vm2
+        fake_executor = fake_ThreadPoolExecutor.return_value.__enter__.return_value
+        fake_executor.submit.side_effect = [fake_future1, fake_future2]
+        fake_as_completed.side_effect = lambda futures: list(futures)
+        fake_get_meta.return_value = {'machines': {'vm01': {'ova_path': '/path/to/vm01.ova', 'kind': 'OneFS'},
+                                                   'vm02': {'ova_path': '/path/to/vm02.ova', 'kind': 'CentOS'}}}
+
+        vmware.create_deployment('louis', 'someTemplate', logger)
+        new_vms = fake_wait_until_ready.call_args[0][0]
+
+        self.assertEqual(fake_wait_until_ready.call_count, 1)
+        self.assertEqual(sorted(new_vms, key=lambda x: x[1]), [(fake_vm2, 'CentOS'), (fake_vm1, 'OneFS')])
+
     @patch.object(vmware, '_check_for_deployment')
     @patch.object(vmware, 'get_meta')
     @patch.object(vmware, 'ThreadPoolExecutor')
@@ -142,77 +222,56 @@ class TestVMware(unittest.TestCase):
         with self.assertRaises(ValueError):
             vmware.create_deployment(username, template, logger)
 
-    @patch.object(vmware.os, 'listdir')
-    def test_list_images(self, fake_listdir):
-        """``list_template`` - Returns a list of available deployments that can be deployed"""
-        fake_listdir.return_value = ['myDeployment']
-
-        output = vmware.list_images()
-        expected = ['myDeployment']
-
-        # set() avoids ordering issue in test
-        self.assertEqual(set(output), set(expected))
-
-    @patch.object(vmware, 'get_meta')
-    @patch.object(vmware.os, 'listdir')
-    def test_list_images_verbose(self, fake_listdir, fake_get_meta):
-        """``list_template`` - Returns more detail template info when passed the verbose=True argument"""
-        fake_get_meta.return_value = {'info' : 'extra details'}
-        fake_listdir.return_value = ['myDeployment']
-
-        output = vmware.list_images(verbose=True)
-        expected = [{'myDeployment' : {'info' : 'extra details'}}]
-
-        self.assertEqual(output, expected)
-
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_check_for_deployment(self, fake_vCenter, fake_consume_task, fake_get_info):
+    @patch.object(vmware.inventory, 'get_vms')
+    @patch.object(vmware, 'borrow')
+    def test_check_for_deployment(self, fake_borrow, fake_get_vms):
         """``_check_for_deployment`` - returns an empty string when no deployments exists"""
         fake_folder = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'isi01-1'
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'OneFS',
+        fake_borrow.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_vms.return_value = [{'vm': fake_vm,
+                                      'name': fake_vm.name,
+                                      'meta': {'component': 'OneFS',
                                                'deployment' : False,
                                                'created': 1234,
                                                'version': 'n/a',
                                                'configured': True,
-                                               'generation': 1}}
+                                               'generation': 1}}]
         output = vmware._check_for_deployment(username='lisa')
         expected = ''
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_check_for_deployment_found(self, fake_vCenter, fake_consume_task, fake_get_info):
+    @patch.object(vmware.inventory, 'get_vms')
+    @patch.object(vmware, 'borrow')
+    def test_check_for_deployment_found(self, fake_borrow, fake_get_vms):
         """``_check_for_deployment`` - returns an empty string when no deployments exists"""
         fake_folder = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'isi01-1'
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'MyAwesomeDeployment',
+        fake_borrow.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_vms.return_value = [{'vm': fake_vm,
+                                      'name': fake_vm.name,
+                                      'meta': {'component': 'MyAwesomeDeployment',
                                                'deployment' : True,
                                                'created': 1234,
                                                'version': 'n/a',
                                                'configured': True,
-                                               'generation': 1}}
+                                               'generation': 1}}]
         output = vmware._check_for_deployment(username='lisa')
         expected = 'MyAwesomeDeployment'
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, 'vCenter')
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware, 'borrow')
+    @patch.object(vmware, 'open_ova')
     @patch.object(vmware, '_get_network_mapping')
     @patch.object(vmware, 'virtual_machine')
-    def test_create_vm(self, fake_virtual_machine, fake_get_network_mapping, fake_Ova, fake_vCenter):
-        """``_create_vm`` Returns info about the newly created VM upon success"""
+    def test_create_vm(self, fake_virtual_machine, fake_get_network_mapping, fake_Ova, fake_borrow):
+        """``_create_vm`` Returns the newly created VM upon success"""
         ova_file = '/path/to/some.ova'
         machine_name  = 'myNewVM'
         template = 'theTemplate'
@@ -224,10 +283,11 @@ class TestVMware(unittest.TestCase):
         fake_virtual_machine.deploy_from_ova.return_value = the_vm
         fake_virtual_machine.get_info.return_value = {'details': "about the vm"}
 
-        info = vmware._create_vm(ova_file, machine_name, template, username, vm_kind, logger)
-        expected = {'myNewVM': {'details': 'about the vm'}}
+        output = vmware._create_vm(ova_file, machine_name, template, username, vm_kind, logger)
 
-        self.assertEqual(info, expected)
+        self.assertTrue(output is the_vm)
+        # Waiting for an IP happens once, for the whole deployment
+        self.assertFalse(fake_virtual_machine.get_info.called)
 
 
     def test_get_network_mapping(self):
@@ -294,10 +354,11 @@ class TestVMware(unittest.TestCase):
         with self.assertRaises(ValueError):
             vmware._make_onefs_network_map(ova_networks, fake_vcenter.networks, front_end, back_end)
 
+    @patch.object(vmware.os.path, 'getsize')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'make_ova')
-    @patch.object(vmware, 'vCenter')
-    def test_make_ova(self, fake_vCenter, fake_make_ova, fake_get_info):
+    @patch.object(vmware.export, 'make_ova')
+    @patch.object(vmware, 'borrow')
+    def test_make_ova(self, fake_borrow, fake_make_ova, fake_get_info, fake_getsize):
         """``_make_ova`` - Returns a tuple with the location of the new OVA upon success"""
         username = 'bart'
         machine_name = 'cowabunga'
@@ -307,7 +368,7 @@ class TestVMware(unittest.TestCase):
         fake_vm.name = 'cowabunga'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_borrow.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
         fake_make_ova.return_value = '/path/to/cowabunga.ova'
         fake_get_info.return_value = {'meta': {'component': 'CentOS'}}
 
@@ -317,9 +378,9 @@ class TestVMware(unittest.TestCase):
         self.assertEqual(output, expected)
 
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'make_ova')
-    @patch.object(vmware, 'vCenter')
-    def test_make_ova_error(self, fake_vCenter, fake_make_ova, fake_get_info):
+    @patch.object(vmware.export, 'make_ova')
+    @patch.object(vmware, 'borrow')
+    def test_make_ova_error(self, fake_borrow, fake_make_ova, fake_get_info):
         """``_make_ova`` - Returns a tuple with an error message upon failure"""
         username = 'bart'
         machine_name = 'vm01'
@@ -329,7 +390,7 @@ class TestVMware(unittest.TestCase):
         fake_vm.name = 'cowabunga'
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_borrow.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
         fake_make_ova.return_value = '/path/to/cowabunga.ova'
 
         output = vmware._make_ova(username, machine_name, template_dir, logger)
@@ -338,5 +399,91 @@ class TestVMware(unittest.TestCase):
         self.assertEqual(output, expected)
 
 
+
+class TestTeardown(unittest.TestCase):
+    """A set of test cases for ``delete_deployment`` against a fake vCenter"""
+
+    def setUp(self):
+        """Every test gets a 6 node deployment, where each task takes a little while"""
+        self.server = FakeVSphere(task_seconds=0.1)
+        self.server.add_user('alice')
+        self.vm_ids = [self.server.add_vm('alice', 'isi0{}-dply'.format(x), meta=DEPLOYED) for x in range(6)]
+
+    def test_concurrent(self):
+        """``delete_deployment`` powers off and destroys every VM at the same time"""
+        with patched(self.server):
+            start = time.time()
+            vmware.delete_deployment('alice', 'OneFS', MagicMock())
+            elapsed = time.time() - start
+
+        # one VM after another would take 6 * (power off + destroy) = 1.2 seconds
+        self.assertTrue(elapsed < 0.6)
+        self.assertEqual(self.server.vms('alice'), [])
+
+    def test_skips_powered_off(self):
+        """``delete_deployment`` does not power off VMs that are already off"""
+        for moid in self.vm_ids:
+            self.server.objects[moid]['powerState'] = 'poweredOff'
+        with patched(self.server):
+            vmware.delete_deployment('alice', 'OneFS', MagicMock())
+
+        self.assertEqual(self.server.calls['PowerOffVM_Task'], 0)
+        self.assertEqual(self.server.vms('alice'), [])
+
+    def test_errors_collected(self):
+        """``delete_deployment`` destroys every VM it can, then reports the ones it could not"""
+        self.server.objects[self.vm_ids[0]]['destroy_fault'] = vim.fault.FileLocked(msg='testing')
+        with patched(self.server):
+            with self.assertRaises(ValueError) as the_error:
+                vmware.delete_deployment('alice', 'OneFS', MagicMock())
+
+        self.assertEqual(self.server.vms('alice'), [self.vm_ids[0]])
+        self.assertTrue('isi00-dply: testing' in str(the_error.exception))
+
+
+class TestCreateVM(unittest.TestCase):
+    """A set of test cases for ``_create_vm`` deploying a real OVA into a fake vCenter"""
+
+    def setUp(self):
+        """Every test gets an OVA with two disks, and a fake vSphere to deploy it into"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.ova_file = os.path.join(self.tmp.name, 'vm01.ova')
+        make_ova(self.ova_file, {'vm-disk1.vmdk': os.urandom(5000), 'vm-disk2.vmdk': os.urandom(700)})
+        self.server = FakeVSphere()
+        self.server.add_user('alice')
+
+    @staticmethod
+    def deploy_from_ova(vcenter, ova, **kwargs):
+        """Read every disk like the real ``deploy_from_ova``, then make the VM"""
+        for disk in ova._disks.values():
+            disk.read()
+        return fake_deploy_from_ova(vcenter, ova, **kwargs)
+
+    def create_vm(self, tracker):
+        """Deploy the OVA with the real ``open_ova``; returns the VM"""
+        with patched(self.server):
+            with patch.object(vmware, 'open_ova', ova_cache.open_ova):
+                with patch.object(vmware.virtual_machine, 'deploy_from_ova', self.deploy_from_ova):
+                    return vmware._create_vm(self.ova_file, 'vm01-dply', 'foo', 'alice', 'CentOS',
+                                             MagicMock(), tracker=tracker)
+
+    def test_cached_ova(self):
+        """``_create_vm`` deploys and powers on a VM from a ``CachedOva``"""
+        the_vm = self.create_vm(progress.machine(None, 'vm01-dply'))
+
+        self.assertEqual(self.server.objects[the_vm._moId]['powerState'], 'poweredOn')
+
+    def test_cached_ova_progress(self):
+        """``_create_vm`` the bytes uploaded are still reported once the OVA is closed"""
+        task_progress = progress.TaskProgress()
+        self.create_vm(progress.machine(task_progress, 'vm01-dply'))
+
+        machine = task_progress.snapshot()['machines']['vm01-dply']
+        self.assertEqual(machine['phase'], progress.POWERING_ON)
+        self.assertTrue(machine['bytes'] > 5700)
+        self.assertTrue(machine['bytes'] <= machine['total'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the watch.py module
+"""
+import unittest
+
+from pyVmomi import vim
+
+from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import watch
+from .fake_vcenter import FakeVSphere, patched
+
+
+class TestTaskWatcher(unittest.TestCase):
+    """A set of test cases for the TaskWatcher object"""
+
+    def setUp(self):
+        """Every test gets a fake vSphere with a user that owns a couple of VMs"""
+        self.server = FakeVSphere(task_seconds=0.05)
+        self.server.add_user('alice')
+        self.vm_ids = [self.server.add_vm('alice', 'vm{}'.format(x)) for x in range(2)]
+
+    def test_callbacks(self):
+        """``TaskWatcher`` - runs the callback of every task once it's done"""
+        done = []
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with watch.TaskWatcher(vcenter) as watcher:
+                    for moid in self.vm_ids:
+                        task = self.server.ref(moid, vcenter._conn._stub).PowerOffVM_Task()
+                        watcher.watch(task, lambda task, error: done.append(error))
+                    watcher.wait(timeout=5)
+
+        self.assertEqual(done, [None, None])
+
+    def test_error(self):
+        """``TaskWatcher`` - passes the fault of a failed task to the callback"""
+        done = []
+        self.server.objects[self.vm_ids[0]]['powerState'] = 'poweredOff'
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with watch.TaskWatcher(vcenter) as watcher:
+                    task = self.server.ref(self.vm_ids[0], vcenter._conn._stub).PowerOffVM_Task()
+                    watcher.watch(task, lambda task, error: done.append(error))
+                    watcher.wait(timeout=5)
+
+        self.assertTrue(isinstance(done[0], vim.fault.InvalidPowerState))
+
+    def test_chained(self):
+        """``TaskWatcher`` - waits on tasks that callbacks start"""
+        done = []
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                the_vm = self.server.ref(self.vm_ids[0], vcenter._conn._stub)
+                with watch.TaskWatcher(vcenter) as watcher:
+                    def powered_off(task, error):
+                        watcher.watch(the_vm.Destroy_Task(), lambda task, error: done.append(error))
+                    watcher.watch(the_vm.PowerOffVM_Task(), powered_off)
+                    watcher.wait(timeout=5)
+
+        self.assertEqual(done, [None])
+        self.assertFalse(self.vm_ids[0] in self.server.objects)
+
+    def test_timeout(self):
+        """``TaskWatcher`` - raises RuntimeError if the tasks take too long"""
+        self.server.task_seconds = 30
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with watch.TaskWatcher(vcenter) as watcher:
+                    task = self.server.ref(self.vm_ids[0], vcenter._conn._stub).PowerOffVM_Task()
+                    watcher.watch(task, lambda task, error: None)
+                    with self.assertRaises(RuntimeError):
+                        watcher.wait(timeout=1)
+
+    def test_close(self):
+        """``TaskWatcher`` - destroys its PropertyCollector when done"""
+        with patched(self.server):
+            with vmware.borrow() as vcenter:
+                with watch.TaskWatcher(vcenter):
+                    pass
+
+        self.assertEqual(self.server.calls['DestroyPropertyCollector'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
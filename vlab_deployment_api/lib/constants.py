@@ -25,6 +25,35 @@ DEFINED = OrderedDict([
             ('VLAB_DEPLOYMENT_TEMPLATE_DIR', environ.get('VLAB_DEPLOYMENT_TEMPLATE_DIR', '/templates')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
             ('VLAB_DEPLOY_CONCURRENT_VMS', int(environ.get('VLAB_DEPLOY_CONCURRENT_VMS', 5))),
+            ('VLAB_DEPLOY_READY_TIMEOUT', int(environ.get('VLAB_DEPLOY_READY_TIMEOUT', 600))),
+            ('VLAB_VCENTER_POOL_SIZE', int(environ.get('VLAB_VCENTER_POOL_SIZE', 10))),
+            ('VLAB_VCENTER_KEEPALIVE', int(environ.get('VLAB_VCENTER_KEEPALIVE', 300))),
+            ('VLAB_MOREF_CACHE_TTL', int(environ.get('VLAB_MOREF_CACHE_TTL', 300))),
+            ('VLAB_DEPLOYMENT_INDEX_TTL', int(environ.get('VLAB_DEPLOYMENT_INDEX_TTL', 120))),
+            ('VLAB_DEPLOYMENT_LOCK_DIR', environ.get('VLAB_DEPLOYMENT_LOCK_DIR', '/tmp/vlab_deployment_locks')),
+            ('VLAB_DEPLOY_MODE', environ.get('VLAB_DEPLOY_MODE', 'ova')),
+            ('VLAB_STAGING_FOLDER', environ.get('VLAB_STAGING_FOLDER', 'vlab_deployment_staging')),
+            ('VLAB_EXPORT_CONCURRENT_DISKS', int(environ.get('VLAB_EXPORT_CONCURRENT_DISKS', 4))),
+            ('VLAB_EXPORT_BANDWIDTH', int(environ.get('VLAB_EXPORT_BANDWIDTH', 0))),
+            ('VLAB_TEMPLATE_STORAGE', environ.get('VLAB_TEMPLATE_STORAGE', 'files')),
+            ('VLAB_CHUNK_STORE_DIR', environ.get('VLAB_CHUNK_STORE_DIR', '/templates/.chunks')),
+            ('VLAB_IMPORT_SLOTS', int(environ.get('VLAB_IMPORT_SLOTS', 5))),
+            ('VLAB_EXPORT_SLOTS', int(environ.get('VLAB_EXPORT_SLOTS', 2))),
+            ('VLAB_SLOTS_FLOOR', int(environ.get('VLAB_SLOTS_FLOOR', 1))),
+            ('VLAB_SLOTS_CEILING', int(environ.get('VLAB_SLOTS_CEILING', 0))),
+            ('VLAB_SLOT_BROKER', environ.get('VLAB_SLOT_BROKER', '')),
+            ('VLAB_SLOT_LOCK_DIR', environ.get('VLAB_SLOT_LOCK_DIR', '/tmp/vlab_deployment_slots')),
+            ('VLAB_OVA_CACHE_BYTES', int(environ.get('VLAB_OVA_CACHE_BYTES', 64 * 1024 * 1024))),
+            ('VLAB_TEMPLATE_CATALOG_TTL', int(environ.get('VLAB_TEMPLATE_CATALOG_TTL', 30))),
+            ('VLAB_RECLAIM_BANDWIDTH', int(environ.get('VLAB_RECLAIM_BANDWIDTH', 32 * 1024 * 1024))),
+            ('VLAB_CATALOG_INLINE', environ.get('VLAB_CATALOG_INLINE', '').lower() in ('1', 'true', 'yes')),
+            ('VLAB_TEMPLATE_META_STORE', environ.get('VLAB_TEMPLATE_META_STORE', 'json')),
+            ('VLAB_TEMPLATE_META_DB', environ.get('VLAB_TEMPLATE_META_DB', '/templates/.meta.sqlite')),
+            ('VLAB_TEMPLATE_META_READ_ONLY', environ.get('VLAB_TEMPLATE_META_READ_ONLY', '').lower() in ('1', 'true', 'yes')),
+            ('VLAB_VERIFY_WORKERS', int(environ.get('VLAB_VERIFY_WORKERS', 4))),
+            ('VLAB_VERIFY_BANDWIDTH', int(environ.get('VLAB_VERIFY_BANDWIDTH', 64 * 1024 * 1024))),
+            ('VLAB_GATEWAY_CONCURRENCY', int(environ.get('VLAB_GATEWAY_CONCURRENCY', 8))),
+            ('VLAB_GATEWAY_TIMEOUT', int(environ.get('VLAB_GATEWAY_TIMEOUT', 30))),
             ('AUTH_LDAP_URL', environ.get('AUTH_LDAP_URL', 'ldaps://localhost')),
             ('AUTH_BIND_USER', environ.get('AUTH_BIND_USER', 'noone')),
             ('AUTH_BIND_PASSWORD_LOCATION', environ.get('AUTH_BIND_PASSWORD', '/etc/vlab/ldap_creds.txt')),
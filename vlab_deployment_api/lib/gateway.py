@@ -0,0 +1,241 @@
+# -*- coding: UTF-8 -*-
+"""
+A client for the gateways (NAT firewalls) of users' labs.
+
+Every request to ``https://<user>.<VLAB_FQDN>`` used to be a new TCP connection
+and TLS handshake, made one after another. A template with several VMs, each with
+a few control ports, spent longer making port maps than deploying the VMs. The
+client keeps a ``requests.Session`` (with a keep-alive connection pool) per
+gateway, and a ``Batch`` sends many requests to one gateway at the same time:
+
+    with GATEWAYS.batch(username, headers) as batch:
+        for payload in payloads:
+            batch.submit('post', '/api/1/ipam/portmap', json=payload)
+
+Failed requests don't stop the others; every error is raised at the end, in one
+``GatewayError``.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from vlab_deployment_api.lib import const
+
+
+class GatewayError(requests.exceptions.RequestException):
+    """One or more requests to a gateway failed.
+
+    :param errors: A description of every failed request.
+    :type errors: List
+
+    :param failed: The errors of every tag (see ``Batch.submit``) that had a failed request.
+    :type failed: Dictionary
+    """
+    def __init__(self, errors, failed=None):
+        super(GatewayError, self).__init__('\n'.join(errors))
+        self.errors = errors
+        self.failed = failed or {}
+
+
+class GatewayClient(object):
+    """Talks to the gateways of users' labs, reusing connections.
+
+    :param fqdn: The domain that every gateway is a subdomain of.
+    :type fqdn: String
+
+    :param concurrency: How many requests a batch can have in flight at once.
+    :type concurrency: Integer
+
+    :param timeout: How many seconds to wait on a gateway before giving up on a request.
+    :type timeout: Integer
+
+    :param max_gateways: How many gateways to keep connections open to; the least recently used are closed.
+    :type max_gateways: Integer
+
+    :param url_format: How to get from a username to the address of their gateway.
+    :type url_format: String
+    """
+    def __init__(self, fqdn, concurrency, timeout, max_gateways=32, url_format='https://{username}.{fqdn}'):
+        self.fqdn = fqdn
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.max_gateways = max_gateways
+        self.url_format = url_format
+        self.stats = {'sessions': 0, 'requests': 0, 'errors': 0}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def url(self, username, path=''):
+        """The address of something on a user's gateway
+
+        :Returns: String
+        """
+        return self.url_format.format(username=username, fqdn=self.fqdn) + path
+
+    def session(self, username):
+        """Obtain the session for a user's gateway, making it the first time.
+
+        :Returns: requests.Session
+
+        :param username: The owner of the gateway.
+        :type username: String
+        """
+        with self._lock:
+            the_session = self._sessions.get(username, None)
+            if the_session is not None:
+                self._sessions.move_to_end(username)
+                return the_session
+            the_session = requests.Session()
+            # One connection per request a batch can have in flight; more just wait
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency, pool_block=True)
+            the_session.mount('https://', adapter)
+            the_session.mount('http://', adapter)
+            the_session.verify = False # user gateways have a self-signed cert
+            self._sessions[username] = the_session
+            self.stats['sessions'] += 1
+            while len(self._sessions) > self.max_gateways:
+                _, oldest = self._sessions.popitem(last=False)
+                oldest.close()
+            return the_session
+
+    def request(self, username, method, path, **kwargs):
+        """Send one request to a user's gateway.
+
+        :Returns: requests.Response
+
+        :Raises: requests.exceptions.RequestException
+
+        :param username: The owner of the gateway.
+        :type username: String
+
+        :param method: The HTTP method; i.e. 'get'
+        :type method: String
+
+        :param path: What to request; i.e. '/api/1/ipam/portmap'
+        :type path: String
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self.stats['requests'] += 1
+        return self.session(username).request(method, self.url(username, path), **kwargs)
+
+    def batch(self, username, headers=None):
+        """Send many requests to a user's gateway, at the same time.
+
+        :Returns: Batch
+
+        :param username: The owner of the gateway.
+        :type username: String
+
+        :param headers: Sent with every request of the batch; i.e. the auth token.
+        :type headers: Dictionary
+        """
+        return Batch(self, username, headers)
+
+    def close(self):
+        """Close the connections to every gateway.
+
+        :Returns: None
+        """
+        with self._lock:
+            for the_session in self._sessions.values():
+                the_session.close()
+            self._sessions.clear()
+
+
+class Batch(object):
+    """Requests to one gateway, sent by a bounded number of threads.
+
+    Use it in a ``with`` statement, or call ``wait`` when every request has been submitted.
+
+    :param client: Where the connections to the gateway come from.
+    :type client: GatewayClient
+
+    :param username: The owner of the gateway.
+    :type username: String
+
+    :param headers: Sent with every request.
+    :type headers: Dictionary
+    """
+    def __init__(self, client, username, headers=None):
+        self.client = client
+        self.username = username
+        self.headers = headers or {}
+        self.errors = []
+        self.failed = {}
+        self._futures = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=client.concurrency)
+
+    def submit(self, method, path, tag=None, **kwargs):
+        """Queue a request; it's sent as soon as a thread is free.
+
+        :Returns: concurrent.futures.Future - the response, or None if the request failed
+
+        :param method: The HTTP method; i.e. 'post'
+        :type method: String
+
+        :param path: What to request; i.e. '/api/1/ipam/portmap'
+        :type path: String
+
+        :param tag: Optionally, what the request is for (i.e. a VM); errors are also grouped by tag.
+        :type tag: String
+        """
+        future = self._executor.submit(self._send, method, path, tag, kwargs)
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        """Block until every request is done.
+
+        :Returns: List - the response of every request, in the order submitted (None for failures)
+
+        :Raises: GatewayError
+        """
+        self._executor.shutdown(wait=True)
+        responses = [x.result() for x in self._futures]
+        if self.errors:
+            raise GatewayError(self.errors, self.failed)
+        return responses
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        if exc_type is not None:
+            # Let what's in flight finish, but don't mask the original error
+            self._executor.shutdown(wait=True)
+            return
+        self.wait()
+
+    def _send(self, method, path, tag, kwargs):
+        """Make one request, recording (instead of raising) any failure"""
+        headers = dict(self.headers)
+        headers.update(kwargs.pop('headers', {}))
+        resp = None
+        error = ''
+        try:
+            resp = self.client.request(self.username, method, path, headers=headers, **kwargs)
+        except requests.exceptions.RequestException as doh:
+            error = '{} {} failed: {}'.format(method.upper(), path, doh)
+        else:
+            if not resp.ok:
+                error = '{} {} failed: {} {}'.format(method.upper(), path, resp.status_code,
+                                                     resp.content.decode(errors='replace'))
+                resp = None
+        if error:
+            with self._lock:
+                self.errors.append(error)
+                if tag is not None:
+                    self.failed.setdefault(tag, []).append(error)
+            with self.client._lock:
+                self.client.stats['errors'] += 1
+        return resp
+
+
+GATEWAYS = GatewayClient(fqdn=const.VLAB_FQDN,
+                         concurrency=const.VLAB_GATEWAY_CONCURRENCY,
+                         timeout=const.VLAB_GATEWAY_TIMEOUT)
@@ -0,0 +1,462 @@
+# -*- coding: UTF-8 -*-
+"""
+Where the meta data of deployment templates is kept.
+
+``const.VLAB_TEMPLATE_META_STORE`` picks the backend:
+
+* ``json`` (the default) keeps a ``meta.json`` in every template directory,
+  like it always has. Finding templates by owner or kind means reading every file.
+* ``sqlite`` keeps every template in one SQLite database
+  (``const.VLAB_TEMPLATE_META_DB``), indexed by name, owner and kind. Updates
+  are transactions, so two workers changing the same template can't lose a write.
+  The database must live on storage with working POSIX locks; a local disk, or
+  an NFS mount with ``lock``.
+
+Run ``python -m vlab_deployment_api.lib.meta_store migrate`` once, before
+switching to ``sqlite``, to import the existing ``meta.json`` files.
+
+Processes that only read meta data (i.e. the API, with the templates mounted
+read only) set ``const.VLAB_TEMPLATE_META_READ_ONLY``; the database is then
+opened read only, and never created or changed.
+
+The OVAs themselves always stay in the template directories.
+"""
+import os
+import sys
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+import ujson
+
+from vlab_deployment_api.lib import const
+
+META_FILE_NAME = 'meta.json'
+
+
+class JsonStore(object):
+    """Keeps the meta data of a template in a ``meta.json`` file in its directory.
+
+    :param location: The directory that deployment templates live in.
+    :type location: String
+    """
+    # ``find`` reads every template
+    indexed = False
+
+    def __init__(self, location):
+        self.location = location
+
+    def meta_path(self, template, hidden=False):
+        """The location of a template's ``meta.json`` file
+
+        :Returns: String
+
+        :param template: The name of the deployment template
+        :type template: String
+
+        :param hidden: Set to True for a template that's currently being created.
+        :type hidden: Boolean
+        """
+        if hidden:
+            template_dir = os.path.join(self.location, '.{}'.format(template))
+        else:
+            template_dir = os.path.join(self.location, template)
+        return os.path.join(template_dir, META_FILE_NAME)
+
+    def read(self, template):
+        """Obtain the meta data of a template.
+
+        :Returns: Dictionary
+
+        :Raises: OSError, ValueError
+
+        :param template: The name of the deployment template
+        :type template: String
+        """
+        with open(self.meta_path(template)) as the_file:
+            meta = ujson.load(the_file)
+        return meta
+
+    def write(self, template, meta, hidden=False):
+        """Replace the meta data of a template.
+
+        :Returns: None
+
+        :param template: The name of the deployment template
+        :type template: String
+
+        :param meta: The meta data.
+        :type meta: Dictionary
+
+        :param hidden: Set to True for a template that's currently being created.
+        :type hidden: Boolean
+        """
+        with open(self.meta_path(template, hidden=hidden), 'w') as the_file:
+            ujson.dump(meta, the_file)
+
+    @contextmanager
+    def transaction(self):
+        """The reads/writes in a ``with`` statement are not isolated; files have no transactions"""
+        yield
+
+    def publish(self, template):
+        """Renaming the hidden directory is what makes a new template visible.
+
+        :Returns: None
+        """
+        pass
+
+    def delete(self, template):
+        """The ``meta.json`` file is deleted along with the template directory.
+
+        :Returns: None
+        """
+        pass
+
+    def version(self, template):
+        """Changes whenever the meta data of a template changes
+
+        :Returns: Tuple, or None if the template has no meta data
+        """
+        try:
+            info = os.stat(self.meta_path(template))
+        except OSError:
+            return None
+        return (info.st_ino, info.st_mtime_ns, info.st_size)
+
+    def find(self, owner=None, kind=None, prefix='', after=None, limit=None):
+        """Every template, optionally only those of one owner and/or with one kind of machine.
+
+        :Returns: Dictionary - template name -> meta data, in order of the name
+
+        :param owner: Only return templates this user owns.
+        :type owner: String
+
+        :param kind: Only return templates with a machine of this kind; i.e. OneFS
+        :type kind: String
+
+        :param prefix: Only return templates with names that start with this.
+        :type prefix: String
+
+        :param after: Only return templates with names that sort after this one.
+        :type after: String
+
+        :param limit: Return at most this many templates.
+        :type limit: Integer
+        """
+        found = {}
+        for template in sorted(os.listdir(self.location)):
+            if template.startswith('.') or not template.startswith(prefix) or (after is not None and template <= after):
+                continue
+            try:
+                meta = self.read(template)
+            except (OSError, ValueError):
+                continue
+            if matches(meta, owner, kind):
+                found[template] = meta
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+
+class SqliteStore(object):
+    """Keeps the meta data of every template in one SQLite database.
+
+    Every thread gets its own connection. The whole meta data document is kept,
+    plus the owner and the kinds of machines in indexed columns.
+
+    :param db_path: The location of the SQLite database file.
+    :type db_path: String
+
+    :param read_only: Only read the database; it must already exist.
+    :type read_only: Boolean
+    """
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS templates (name TEXT PRIMARY KEY,'
+              '                                      owner TEXT,'
+              '                                      pending INTEGER NOT NULL DEFAULT 0,'
+              '                                      revision INTEGER NOT NULL DEFAULT 1,'
+              '                                      meta TEXT NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS templates_owner ON templates (owner)',
+              'CREATE TABLE IF NOT EXISTS machines (template TEXT NOT NULL,'
+              '                                     name TEXT NOT NULL,'
+              '                                     kind TEXT,'
+              '                                     PRIMARY KEY (template, name))',
+              'CREATE INDEX IF NOT EXISTS machines_kind ON machines (kind)']
+    # ``find`` looks up owners and kinds in an index
+    indexed = True
+
+    def __init__(self, db_path, read_only=False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self._local = threading.local()
+        if read_only:
+            return
+        with self.transaction() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.read_only:
+                # Never takes a write lock, or makes a journal, so a read only mount works
+                uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self.db_path)))
+                conn = sqlite3.connect(uri, timeout=30, isolation_level=None, uri=True)
+            else:
+                # Transactions are managed by hand; see ``transaction``
+                conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the reads/writes in a ``with`` statement as one transaction.
+
+        The database is locked for writing from the start, so a read-check-write
+        can't be interleaved with another worker's. Nested transactions join the
+        outermost one.
+
+        :Returns: sqlite3.Connection
+        """
+        conn = self._conn
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+    def read(self, template):
+        """Obtain the meta data of a template.
+
+        :Returns: Dictionary
+
+        :Raises: FileNotFoundError
+
+        :param template: The name of the deployment template
+        :type template: String
+        """
+        row = self._conn.execute('SELECT meta FROM templates WHERE name = ? AND pending = 0', (template,)).fetchone()
+        if row is None:
+            # What reading a missing meta.json raises
+            raise FileNotFoundError('No meta data for template {}'.format(template))
+        return ujson.loads(row[0])
+
+    def write(self, template, meta, hidden=False):
+        """Replace the meta data of a template.
+
+        :Returns: None
+
+        :Raises: ValueError
+
+        :param template: The name of the deployment template
+        :type template: String
+
+        :param meta: The meta data.
+        :type meta: Dictionary
+
+        :param hidden: Set to True for a template that's currently being created; see ``publish``
+        :type hidden: Boolean
+        """
+        with self.transaction() as conn:
+            row = conn.execute('SELECT pending, revision FROM templates WHERE name = ?', (template,)).fetchone()
+            if row is not None and hidden and not row[0]:
+                raise ValueError('A template named {} already exists'.format(template))
+            revision = row[1] + 1 if row is not None else 1
+            conn.execute('INSERT OR REPLACE INTO templates (name, owner, pending, revision, meta) VALUES (?, ?, ?, ?, ?)',
+                         (template, meta.get('owner', None), int(hidden), revision, ujson.dumps(meta)))
+            conn.execute('DELETE FROM machines WHERE template = ?', (template,))
+            conn.executemany('INSERT INTO machines (template, name, kind) VALUES (?, ?, ?)',
+                             [(template, x, y.get('kind', None)) for x, y in meta.get('machines', {}).items()
+                              if isinstance(y, dict)])
+
+    def publish(self, template):
+        """Make a template written with ``hidden=True`` visible.
+
+        :Returns: None
+
+        :param template: The name of the deployment template
+        :type template: String
+        """
+        with self.transaction() as conn:
+            conn.execute('UPDATE templates SET pending = 0, revision = revision + 1 WHERE name = ?', (template,))
+
+    def delete(self, template):
+        """Forget the meta data of a template.
+
+        :Returns: None
+
+        :param template: The name of the deployment template
+        :type template: String
+        """
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM machines WHERE template = ?', (template,))
+            conn.execute('DELETE FROM templates WHERE name = ?', (template,))
+
+    def version(self, template):
+        """Changes whenever the meta data of a template changes
+
+        :Returns: Integer, or None if the template has no meta data
+        """
+        row = self._conn.execute('SELECT revision FROM templates WHERE name = ? AND pending = 0', (template,)).fetchone()
+        return row[0] if row is not None else None
+
+    def find(self, owner=None, kind=None, prefix='', after=None, limit=None):
+        """Every template, optionally only those of one owner and/or with one kind of machine.
+
+        :Returns: Dictionary - template name -> meta data, in order of the name
+
+        :param owner: Only return templates this user owns.
+        :type owner: String
+
+        :param kind: Only return templates with a machine of this kind; i.e. OneFS
+        :type kind: String
+
+        :param prefix: Only return templates with names that start with this.
+        :type prefix: String
+
+        :param after: Only return templates with names that sort after this one.
+        :type after: String
+
+        :param limit: Return at most this many templates.
+        :type limit: Integer
+        """
+        sql = 'SELECT name, meta FROM templates WHERE pending = 0'
+        args = []
+        if owner is not None:
+            sql += ' AND owner = ?'
+            args.append(owner)
+        if kind is not None:
+            sql += ' AND name IN (SELECT template FROM machines WHERE kind = ?)'
+            args.append(kind)
+        if prefix:
+            # Not LIKE; that's case insensitive, and treats _ and % as wildcards
+            sql += ' AND substr(name, 1, ?) = ?'
+            args += [len(prefix), prefix]
+        if after is not None:
+            sql += ' AND name > ?'
+            args.append(after)
+        sql += ' ORDER BY name'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        return {x: ujson.loads(y) for x, y in self._conn.execute(sql, args)}
+
+    def close(self):
+        """Close the connection of the calling thread
+
+        :Returns: None
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def matches(meta, owner=None, kind=None):
+    """Does the meta data of a template pass the filters of ``find``?
+
+    :Returns: Boolean
+
+    :param meta: The meta data of a template.
+    :type meta: Dictionary
+
+    :param owner: The template must be owned by this user.
+    :type owner: String
+
+    :param kind: The template must have a machine of this kind.
+    :type kind: String
+    """
+    if owner is not None and meta.get('owner', None) != owner:
+        return False
+    if kind is not None:
+        machines = meta.get('machines', {}).values()
+        return any(isinstance(x, dict) and x.get('kind', None) == kind for x in machines)
+    return True
+
+
+STORES = {'json': lambda location, db_path, read_only: JsonStore(location),
+          'sqlite': lambda location, db_path, read_only: SqliteStore(db_path, read_only=read_only)}
+_OPENED = {}
+_OPENED_LOCK = threading.Lock()
+
+
+def store_for(kind, location, db_path, read_only=False):
+    """Obtain the meta data backend, opening it the first time.
+
+    :Returns: JsonStore or SqliteStore
+
+    :Raises: ValueError
+
+    :param kind: Which backend; a key of ``STORES``.
+    :type kind: String
+
+    :param location: The directory that deployment templates live in.
+    :type location: String
+
+    :param db_path: The location of the SQLite database file.
+    :type db_path: String
+
+    :param read_only: Only read the meta data; see ``SqliteStore``
+    :type read_only: Boolean
+    """
+    if kind not in STORES:
+        raise ValueError('Unknown template meta data store {}; must be one of {}'.format(kind, sorted(STORES.keys())))
+    key = (kind, location, db_path, bool(read_only))
+    with _OPENED_LOCK:
+        if key not in _OPENED:
+            _OPENED[key] = STORES[kind](location, db_path, bool(read_only))
+        return _OPENED[key]
+
+
+def migrate(location, destination):
+    """Copy the ``meta.json`` of every template into another backend.
+
+    Safe to run more than once; templates the destination already has are skipped.
+
+    :Returns: Tuple - (templates copied, templates skipped)
+
+    :param location: The directory that deployment templates live in.
+    :type location: String
+
+    :param destination: Where the meta data should live from now on.
+    :type destination: SqliteStore
+    """
+    source = JsonStore(location)
+    copied = skipped = 0
+    with destination.transaction():
+        for template in sorted(os.listdir(location)):
+            if template.startswith('.') or destination.version(template) is not None:
+                skipped += 1
+                continue
+            try:
+                meta = source.read(template)
+            except (OSError, ValueError):
+                # Not a template, or a broken one
+                skipped += 1
+                continue
+            destination.write(template, meta)
+            copied += 1
+    return copied, skipped
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['migrate']:
+        sys.exit('Usage: VLAB_TEMPLATE_META_DB=<path> python -m {} migrate'.format(__spec__.name))
+    copied, skipped = migrate(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, SqliteStore(const.VLAB_TEMPLATE_META_DB))
+    print('Copied {} templates into {}; skipped {}'.format(copied, const.VLAB_TEMPLATE_META_DB, skipped))
@@ -1,12 +1,17 @@
 # -*- coding: UTF-8 -*-
 """This module handles reading/writing/updating the meta data for a deployment template"""
 import os
-
-import ujson
+import threading
 
 from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib import meta_store
+from vlab_deployment_api.lib.meta_store import META_FILE_NAME
 
-META_FILE_NAME = 'meta.json'
+# template directory -> (version of the directory, {machine name: OVA file name})
+_OVA_FILES = {}
+_OVA_FILES_LOCK = threading.Lock()
+# How often ``get_meta`` touched the file system, vs. used what it already knew
+IO_STATS = {'stat': 0, 'listdir': 0, 'hits': 0}
 
 """
 {"owner": <username>,
@@ -17,6 +22,8 @@ META_FILE_NAME = 'meta.json'
         "ip": <the primary IP - used to make portmap rules in NAT firewall>,
         "kind": <the type of VM; i.e. OneFS, InsightIQ, etc>,
         "ova_path": <The file system location of the OVA for this VM>,
+        "manifest": <Only for OVAs in the chunk store; the file name of the OVA's manifest>,
+        "files": {<file in the OVA>: {"sha256": <hex digest>, "size": <bytes>}},
         "ports": [<the TCP ports of the VM's control path>]
     }
  }
@@ -32,16 +39,7 @@ def get_meta(template):
     :type template: String
     """
     meta = _read_meta(template)
-    template_dir = os.path.dirname(_get_template_path(template))
-    # dynamically add the 'ova_path' attribute
-    # This avoids a "cache invalidation is hard" problem when the ``const.VLAB_DEPLOYMENT_TEMPLATE_DIR``
-    # value changes in the future.
-    for dir_item in os.listdir(template_dir):
-        if not dir_item.endswith('.ova'):
-            continue
-        machine_name = dir_item.replace('.ova', '')
-        ova_path = os.path.join(template_dir, dir_item)
-        meta['machines'][machine_name]['ova_path'] = ova_path
+    _add_ova_paths(template, meta)
     return meta
 
 
@@ -88,15 +86,88 @@ def update_meta(template, username='', owner=None, summary=None, email=None):
     :param email: The new email of the deployment template owner.
     :type email: String
     """
-    meta = _read_meta(template)
-    if meta['owner'] == username:
-        new_meta = {'owner': owner, 'email': email, 'summary': summary}
-        new_meta = {x:y for x,y in new_meta.items() if y is not None}
-        meta.update(new_meta)
-        _write_meta(template, meta)
-    else:
-        error = 'Unable to update templates you do not own. {} currently owned by {}'.format(template, meta['owner'])
-        raise ValueError(error)
+    # The ownership check and the write must see the same meta data
+    with _store().transaction():
+        meta = _read_meta(template)
+        if meta['owner'] == username:
+            new_meta = {'owner': owner, 'email': email, 'summary': summary}
+            new_meta = {x:y for x,y in new_meta.items() if y is not None}
+            meta.update(new_meta)
+            _write_meta(template, meta)
+        else:
+            error = 'Unable to update templates you do not own. {} currently owned by {}'.format(template, meta['owner'])
+            raise ValueError(error)
+
+
+def publish_meta(template):
+    """Make the meta data written by ``set_meta`` visible, once the template is done being created.
+
+    :Returns: None
+
+    :param template: The name of the deployment template.
+    :type template: String
+    """
+    _store().publish(template)
+
+
+def delete_meta(template):
+    """Forget the meta data of a deleted deployment template.
+
+    :Returns: None
+
+    :param template: The name of the deployment template.
+    :type template: String
+    """
+    _store().delete(template)
+
+
+def meta_version(template):
+    """Obtain something that changes whenever the meta data of a template changes.
+
+    :Returns: Object, or None if the template has no meta data
+
+    :param template: The name of the deployment template.
+    :type template: String
+    """
+    return _store().version(template)
+
+
+def find_meta(owner=None, kind=None, prefix='', after=None, limit=None):
+    """Look up templates by owner, and/or by the kind of machines in them.
+
+    :Returns: Dictionary - template name -> meta data, in order of the name
+
+    :param owner: Only find the templates this user owns.
+    :type owner: String
+
+    :param kind: Only find templates with a machine of this kind; i.e. OneFS
+    :type kind: String
+
+    :param prefix: Only find templates with names that start with this.
+    :type prefix: String
+
+    :param after: Only find templates with names that sort after this one.
+    :type after: String
+
+    :param limit: Find at most this many templates.
+    :type limit: Integer
+    """
+    found = _store().find(owner=owner, kind=kind, prefix=prefix, after=after, limit=limit)
+    for template, meta in found.items():
+        try:
+            _add_ova_paths(template, meta)
+        except OSError:
+            # Being deleted
+            pass
+    return found
+
+
+def meta_indexed():
+    """Can ``find_meta`` look up owners and kinds without reading every template?
+
+    :Returns: Boolean
+    """
+    return _store().indexed
 
 
 def map_machine(name, ip, kind, ports):
@@ -121,6 +192,84 @@ def map_machine(name, ip, kind, ports):
     return machine
 
 
+def _add_ova_paths(template, meta):
+    """Set the ``ova_path`` of every machine in the meta data of a template.
+
+    :Returns: None
+
+    :Raises: OSError
+
+    :param template: The name of the deployment template
+    :type template: String
+
+    :param meta: The meta data of the template.
+    :type meta: Dictionary
+    """
+    template_dir = os.path.dirname(_get_template_path(template))
+    # dynamically add the 'ova_path' attribute
+    # This avoids a "cache invalidation is hard" problem when the ``const.VLAB_DEPLOYMENT_TEMPLATE_DIR``
+    # value changes in the future; the OVA files are remembered by the resolved
+    # directory, so a new ``const.VLAB_DEPLOYMENT_TEMPLATE_DIR`` never sees old paths.
+    for machine_name, dir_item in _ova_files(template_dir).items():
+        ova_path = os.path.join(template_dir, dir_item)
+        meta['machines'][machine_name]['ova_path'] = ova_path
+    # OVAs in the chunk store are deployed from their manifest
+    for machine in meta['machines'].values():
+        if 'manifest' in machine:
+            machine['ova_path'] = os.path.join(template_dir, machine['manifest'])
+
+
+def _ova_files(template_dir):
+    """Find the OVA of every machine in a template.
+
+    The answer is remembered until the directory is modified (i.e. an OVA is
+    added, removed or renamed), so most calls cost one ``stat`` instead of a
+    ``listdir``.
+
+    :Returns: Dictionary - machine name -> file name of the OVA
+
+    :param template_dir: The directory of the deployment template.
+    :type template_dir: String
+    """
+    template_dir = os.path.abspath(template_dir)
+    IO_STATS['stat'] += 1
+    try:
+        info = os.stat(template_dir)
+    except OSError:
+        version = None
+    else:
+        version = (info.st_ino, info.st_mtime_ns)
+    with _OVA_FILES_LOCK:
+        if version is None:
+            _OVA_FILES.pop(template_dir, None)
+        else:
+            known = _OVA_FILES.get(template_dir, None)
+            if known is not None and known[0] == version:
+                IO_STATS['hits'] += 1
+                return known[1]
+    IO_STATS['listdir'] += 1
+    ova_files = {}
+    for dir_item in os.listdir(template_dir):
+        if not dir_item.endswith('.ova'):
+            continue
+        ova_files[dir_item.replace('.ova', '')] = dir_item
+    if version is not None:
+        with _OVA_FILES_LOCK:
+            _OVA_FILES[template_dir] = (version, ova_files)
+    return ova_files
+
+
+def _store():
+    """The backend that meta data is kept in; see ``meta_store``
+
+    :Returns: vlab_deployment_api.lib.meta_store.JsonStore or vlab_deployment_api.lib.meta_store.SqliteStore
+    """
+    return meta_store.store_for(const.VLAB_TEMPLATE_META_STORE,
+                                const.VLAB_DEPLOYMENT_TEMPLATE_DIR,
+                                const.VLAB_TEMPLATE_META_DB,
+                                read_only=const.VLAB_TEMPLATE_META_READ_ONLY)
+
+
 def _write_meta(template, meta, hidden=False):
     """Makes the code DRYer - Overwrites existing content.
 
@@ -132,9 +281,7 @@ def _write_meta(template, meta, hidden=False):
     :param meta: The contents to write to the meta data file.
     :type meta: Dictionary
     """
-    template_path = _get_template_path(template, hidden=hidden)
-    with open(template_path, 'w') as the_file:
-        ujson.dump(meta, the_file)
+    _store().write(template, meta, hidden=hidden)
 
 
 def _read_meta(template):
@@ -145,10 +292,7 @@ def _read_meta(template):
     :param template: The name of the deployment template
     :type template: String
     """
-    template_path = _get_template_path(template)
-    with open(template_path) as the_file:
-        meta = ujson.load(the_file)
-    return meta
+    return _store().read(template)
 
 
 def _get_template_path(template, hidden=False):
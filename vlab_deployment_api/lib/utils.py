@@ -1,12 +1,17 @@
 # -*- coding: UTF-8 -*-
 """A collection of generic utility functions"""
+import threading
+
 import ldap3
-import requests
 
 from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.gateway import GATEWAYS, GatewayError
+from vlab_deployment_api.lib.worker import progress
 from vlab_deployment_api.lib.worker.vmware import VM_NAME_APPEND
 from vlab_deployment_api.lib.template_meta_data import get_meta
 
+PORTMAP_PATH = '/api/1/ipam/portmap'
+
 
 def lookup_email_addr(username):
     """Query LDAP to find the email address of a user.
@@ -36,9 +41,12 @@ def lookup_email_addr(username):
     return email
 
 
-def create_port_maps(username, template, user_token, client_ip, logger):
+def create_port_maps(username, template, user_token, client_ip, logger, task_progress=None):
     """Add port forwarding rules to the NAT firewall of a user's lab.
 
+    Every rule is sent at the same time, over the pooled connections to the gateway.
+    To make the rules of each VM as soon as it's deployed, use ``PortMapper`` instead.
+
     :Returns: None
 
     :Raises: requests.exceptions.RequestException
@@ -51,19 +59,146 @@ def create_port_maps(username, template, user_token, client_ip, logger):
 
     :param client_ip: The IP that issued the request.
     :type client_ip: String
+
+    :param task_progress: Optionally, where to report the progress of every VM.
+    :type task_progress: vlab_deployment_api.lib.worker.progress.TaskProgress
     """
-    url = 'https://{}.{}/api/1/ipam/portmap'.format(username, const.VLAB_FQDN)
-    headers = {'X-Auth' : user_token, 'X-Forwarded-For': client_ip}
-    portmaps = get_meta(template)['machines']
-    for vm_name, info in portmaps.items():
+    with PortMapper(username, template, user_token, client_ip, logger, task_progress) as mapper:
+        for vm_name in mapper.machines.keys():
+            mapper.add('{}{}'.format(vm_name, VM_NAME_APPEND))
+
+
+class PortMapper(object):
+    """Makes the port forwarding rules of a deployment, one VM at a time.
+
+    Add each VM as soon as it's deployed; its rules are sent while the other VMs
+    are still uploading. Leaving the ``with`` statement waits for every rule, and
+    raises ``GatewayError`` (a RequestException) listing the errors of every VM.
+    If the deploy fails instead, the rules made so far are deleted.
+
+    :param username: The name of the vLab user.
+    :type usernamne: String
+
+    :param template: The name of the template being deployed.
+    :type template: String
+
+    :param user_token: The JWT auth token of the user.
+    :type user_token: String
+
+    :param client_ip: The IP that issued the request.
+    :type client_ip: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param task_progress: Optionally, where to report the progress of every VM.
+    :type task_progress: vlab_deployment_api.lib.worker.progress.TaskProgress
+    """
+    def __init__(self, username, template, user_token, client_ip, logger, task_progress=None):
+        self.username = username
+        self.template = template
+        self.logger = logger
+        self._task_progress = task_progress
+        self._headers = {'X-Auth' : user_token, 'X-Forwarded-For': client_ip}
+        self._machines = None
+        self._batch = None
+        self._futures = []
+
+    @property
+    def machines(self):
+        """The meta data of every machine in the template; read the first time it's needed"""
+        if self._machines is None:
+            self._machines = get_meta(self.template)['machines']
+        return self._machines
+
+    def __enter__(self):
+        self._batch = GATEWAYS.batch(self.username, self._headers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        if exc_type is not None:
+            # The deploy failed; let what's in flight finish, but don't mask the error
+            self._batch.__exit__(exc_type, exc_value, the_traceback)
+            self._undo()
+            return
+        self._batch.wait()
+
+    def add(self, deploy_name):
+        """Send the port forwarding rules of one VM.
+
+        :Returns: None
+
+        :param deploy_name: The name of the deployed VM; i.e. vm01-dply
+        :type deploy_name: String
+        """
+        vm_name = deploy_name[:-len(VM_NAME_APPEND)] if deploy_name.endswith(VM_NAME_APPEND) else deploy_name
+        info = self.machines[vm_name]
+        self.logger.debug('Making %s port maps for %s', len(info['ports']), deploy_name)
+        tracker = progress.machine(self._task_progress, deploy_name)
+        tracker.phase(progress.PORTMAPS)
+        futures = []
         for tcp_port in info['ports']:
             payload = {'target_addr': info['ip'],
                        'target_port': tcp_port,
-                       'target_name': '{}{}'.format(vm_name, VM_NAME_APPEND),
-                       'target_component': template,
+                       'target_name': deploy_name,
+                       'target_component': self.template,
                       }
-            resp = requests.post(url, json=payload, headers=headers, verify=False) # user gateways have a self-signed cert
-            resp.raise_for_status()
+            futures.append(self._batch.submit('post', PORTMAP_PATH, tag=deploy_name, json=payload))
+        self._futures.extend(futures)
+        _done_when_mapped(tracker, futures)
+
+    def _undo(self):
+        """Delete the rules made before the deploy failed, so none are left pointing at it.
+
+        Errors are logged instead of raised; they'd mask why the deploy failed.
+
+        :Returns: None
+        """
+        conn_ports = []
+        for future in self._futures:
+            resp = future.result()
+            if resp is None:
+                continue
+            try:
+                conn_ports.append(resp.json()['content']['conn_port'])
+            except (ValueError, KeyError, TypeError) as doh:
+                self.logger.error('Unable to find the port map made by %s: %s', resp.request.body, doh)
+        if not conn_ports:
+            return
+        self.logger.info('Deleting %s port maps of a failed deploy', len(conn_ports))
+        try:
+            with GATEWAYS.batch(self.username, self._headers) as batch:
+                for conn_port in conn_ports:
+                    batch.submit('delete', PORTMAP_PATH, json={'conn_port': int(conn_port)})
+        except GatewayError as doh:
+            self.logger.error('Unable to delete the port maps of a failed deploy: %s', doh)
+
+
+def _done_when_mapped(tracker, futures):
+    """Mark a VM as done once every one of its port maps is made.
+
+    :Returns: None
+
+    :param tracker: Where the progress of the VM is reported.
+    :type tracker: vlab_deployment_api.lib.worker.progress.MachineProgress
+
+    :param futures: The requests that make the port maps of the VM.
+    :type futures: List
+    """
+    if not futures:
+        tracker.phase(progress.DONE)
+        return
+    lock = threading.Lock()
+    pending = set(futures)
+    def mapped(future):
+        # Futures run their callbacks on whichever thread finishes them
+        with lock:
+            pending.discard(future)
+            finished = not pending
+        if finished and all(x.result() is not None for x in futures):
+            tracker.phase(progress.DONE)
+    for future in futures:
+        future.add_done_callback(mapped)
 
 
 def delete_port_maps(username, template, user_token, client_ip, logger):
@@ -82,14 +217,11 @@ def delete_port_maps(username, template, user_token, client_ip, logger):
     :param client_ip: The IP that issued the request.
     :type client_ip: String
     """
-    url = 'https://{}.{}/api/1/ipam/portmap'.format(username, const.VLAB_FQDN)
     headers = {'X-Auth' : user_token, 'X-Forwarded-For': client_ip}
-    all_ports = requests.get(url, params={'component': template}, headers=headers, verify=False).json()['content']['ports']
-    errors = []
-    for port in all_ports.keys():
-        resp = requests.delete(url, json={'conn_port': int(port)}, headers=headers, verify=False)
-        if not resp.ok:
-            errors.append(resp.content.decode(errors='replace'))
-    if errors:
-        msg = '\n'.join(errors)
-        raise RuntimeError(msg)
+    all_ports = GATEWAYS.request(username, 'get', PORTMAP_PATH, params={'component': template}, headers=headers).json()['content']['ports']
+    try:
+        with GATEWAYS.batch(username, headers) as batch:
+            for port in all_ports.keys():
+                batch.submit('delete', PORTMAP_PATH, json={'conn_port': int(port)})
+    except GatewayError as doh:
+        raise RuntimeError('\n'.join(doh.errors))
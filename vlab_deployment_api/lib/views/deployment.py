@@ -2,6 +2,8 @@
 """
 Defines the HTTP API for working with deployments in vLab.
 """
+import sqlite3
+
 import ujson
 from flask import current_app
 from flask_classy import request, route, Response
@@ -11,12 +13,112 @@ from vlab_api_common import describe, get_logger, requires, validate_input
 
 
 from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker import progress
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_DEPLOYMENT_LOG_LEVEL)
 
 
-class DeploymentView(MachineView):
+def answer_inline(args):
+    """Should a read of the template catalog be answered right away, instead of by a task?
+
+    Only when the API can read the template directory (``const.VLAB_CATALOG_INLINE``),
+    and the client asked with ``inline=true``; clients that poll tasks keep working.
+
+    :Returns: Boolean
+
+    :param args: The query parameters of the request.
+    :type args: werkzeug.datastructures.MultiDict
+    """
+    if not const.VLAB_CATALOG_INLINE:
+        return False
+    inline = args.get('inline', '')
+    return inline.lower().startswith('t') or inline.startswith('1')
+
+
+def catalog_reader():
+    """The template catalog, loaded the first time the API answers a read inline.
+
+    Only the catalog (and the template meta data) is imported; the rest of the
+    worker, like the vCenter sessions, admission control and the gateway
+    client, is never loaded by the API. Set ``VLAB_TEMPLATE_META_READ_ONLY``
+    for the API; it only has a read only view of the templates.
+
+    :Returns: Module
+    """
+    from vlab_deployment_api.lib.worker import catalog
+    return catalog
+
+
+def inline_response(username, func, *args, **kwargs):
+    """Run a read of the template catalog in the API, and respond like the task would have.
+
+    :Returns: Tuple - (body, HTTP status code)
+
+    :param username: The user making the request.
+    :type username: String
+
+    :param func: Returns the "content" of the response; raises ValueError for bad input.
+    :type func: Callable
+    """
+    resp = {'user': username, 'content': {}, 'error': None, 'params': {}}
+    try:
+        resp['content'] = func(*args, **kwargs)
+    except ValueError as doh:
+        resp['error'] = '{}'.format(doh)
+        return ujson.dumps(resp), 400
+    except (OSError, sqlite3.Error) as doh:
+        # i.e. the template share is unavailable; the client can ask for a task instead
+        logger.error('Unable to read the template catalog: %s', doh)
+        resp['error'] = 'Unable to read the template catalog: {}'.format(doh)
+        return ujson.dumps(resp), 503
+    return ujson.dumps(resp), 200
+
+
+class ProgressView(MachineView):
+    """Adds the progress published by long running tasks to the ``/task`` end point"""
+
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=MachineView.TASK_ARGS)
+    def handle_task(self, *args, **kwargs):
+        """End point for checking the status of Celery tasks
+
+        While a task is running, the response includes where the task is at
+        (the phase of every machine, bytes moved, and an ETA), and the
+        Retry-After header says when asking again is worthwhile.
+        """
+        resp = {'user': kwargs['token']['username'], 'content' : {}}
+        if request.args.get('task-id', None) and kwargs.get('tid', None):
+            resp['error'] = 'task-id supplied in URL and as param'
+            return ujson.dumps(resp), 400
+
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        if task_id is None:
+            resp['error'] = "no task id provided"
+            return ujson.dumps(resp), 400
+
+        result = current_app.celery_app.AsyncResult(task_id)
+        resp['content']['status'] = result.status
+        if result.status == 'SUCCESS':
+            resp.update(result.result)
+            # Same contract as ``TaskView.handle_task``; every task returns an "error" key
+            if result.result['error']:
+                resp['error'] = result.result['error']
+                return ujson.dumps(resp), 400
+            return ujson.dumps(result.result), 200
+        elif result.status == 'FAILURE':
+            return ujson.dumps(resp), 500
+        elif result.status == progress.STATE:
+            resp['content']['progress'] = result.info
+        http_resp = Response(ujson.dumps(resp))
+        http_resp.status_code = 202
+        http_resp.headers.add('Retry-After', str(progress.poll_after(result.info)))
+        return http_resp
+
+
+class DeploymentView(ProgressView):
     """API end points for vLab deployments"""
     route_base = '/api/2/inf/deployment'
     RESOURCE = 'deployment'
@@ -53,6 +155,41 @@ class DeploymentView(MachineView):
                                 "description": "Include extra details about the images/templates available for deployment.",
                                 "type": "boolean",
                                 "default": False,
+                            },
+                            "owner": {
+                                "description": "Only include templates owned by this user.",
+                                "type": "string"
+                            },
+                            "kind": {
+                                "description": "Only include templates with a machine of this kind; i.e. OneFS",
+                                "type": "string"
+                            },
+                            "prefix": {
+                                "description": "Only include templates with names that start with this.",
+                                "type": "string"
+                            },
+                            "fields": {
+                                "description": "Comma separated parts of the template details to include. Implies verbose.",
+                                "type": "array",
+                                "items": {
+                                    "type": "string",
+                                    "enum": ["owner", "email", "summary", "machines", "machine_names"]
+                                }
+                            },
+                            "limit": {
+                                "description": "Include at most this many templates. The response includes a 'next' cursor for the following page.",
+                                "type": "integer",
+                                "minimum": 1,
+                                "maximum": 1000
+                            },
+                            "cursor": {
+                                "description": "The 'next' cursor from the previous page.",
+                                "type": "string"
+                            },
+                            "inline": {
+                                "description": "Respond with the images (HTTP 200) instead of a task, if the server allows it.",
+                                "type": "boolean",
+                                "default": False
                             }
                         }
                        }
@@ -121,7 +258,14 @@ class DeploymentView(MachineView):
             verbose = False
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        task = current_app.celery_app.send_task('deployment.images', [verbose, txn_id])
+        try:
+            query = self._image_query(request.args)
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        if answer_inline(request.args):
+            return inline_response(username, catalog_reader().image_content, verbose, query)
+        task = current_app.celery_app.send_task('deployment.images', [verbose, txn_id], kwargs=query)
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -129,7 +273,37 @@ class DeploymentView(MachineView):
         return resp
 
 
-class TemplateView(MachineView):
+    def _image_query(self, args):
+        """Obtain the filters, projection and paging of the ``/image`` end point
+
+        :Returns: Dictionary
+
+        :Raises: ValueError
+
+        :param args: The query parameters of the request.
+        :type args: werkzeug.datastructures.MultiDict
+        """
+        params = self.TEMPLATES_SCHEMA['properties']
+        query = {x: args[x] for x in ('owner', 'kind', 'prefix', 'cursor') if args.get(x, '')}
+        if args.get('fields', ''):
+            fields = [x.strip() for x in args['fields'].split(',') if x.strip()]
+            allowed = params['fields']['items']['enum']
+            unknown = [x for x in fields if x not in allowed]
+            if unknown:
+                raise ValueError('Unknown field(s): {}. Must be one of {}'.format(', '.join(unknown), ', '.join(allowed)))
+            query['fields'] = fields
+        if args.get('limit', ''):
+            try:
+                limit = int(args['limit'])
+            except ValueError:
+                raise ValueError('limit must be an integer, not {}'.format(args['limit']))
+            if not params['limit']['minimum'] <= limit <= params['limit']['maximum']:
+                raise ValueError('limit must be between {} and {}'.format(params['limit']['minimum'], params['limit']['maximum']))
+            query['limit'] = limit
+        return query
+
+
+class TemplateView(ProgressView):
     """API end points for vLab deployment templates"""
     route_base = '/api/2/inf/template'
     RESOURCE = 'deployment'
@@ -230,6 +404,8 @@ class TemplateView(MachineView):
         username = kwargs['token']['username']
         resp_data = {'user' : username}
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        if answer_inline(request.args):
+            return inline_response(username, catalog_reader().owned_templates, username)
         task = current_app.celery_app.send_task('deployment.show_template', [username, txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
@@ -0,0 +1,471 @@
+# -*- coding: UTF-8 -*-
+"""
+Worker-wide admission control for OVA uploads and exports.
+
+``const.VLAB_DEPLOY_CONCURRENT_VMS`` only bounds the thread pool of a single
+task, so a few deploy (and create template) tasks running on the same worker
+multiply the number of streams fighting over one NIC and datastore. Every
+upload waits for an ``import`` slot, and every export for an ``export`` slot,
+from ``SLOTS``; the number of slots of each kind is shared by every task on
+the worker, and slots are handed out first come, first served.
+
+Setting ``const.VLAB_SLOTS_CEILING`` makes the number of slots adaptive; see
+``AdaptiveLimit``. The slots shared across processes (below) then number the
+ceiling, and the adaptive limit decides how many of them a process takes.
+
+Celery runs tasks in many (prefork) processes, so the slots are also limited
+across every process on the node; each slot is a file in
+``const.VLAB_SLOT_LOCK_DIR`` that a holder keeps an exclusive ``flock`` on (see
+``FileSemaphore``). If a process dies, its locks go with it.
+
+Setting ``const.VLAB_SLOT_BROKER`` to a broker URL instead limits the slots across
+every worker node. Each slot is then a token (message) in a queue on the
+broker, which a holder keeps un-acknowledged; if a worker dies, the broker puts
+its tokens back. Seed the queues once, before any worker uses them::
+
+    python -m vlab_deployment_api.lib.worker.admission seed
+"""
+import os
+import sys
+import time
+import fcntl
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from kombu import Connection
+from vlab_api_common import get_logger
+
+from vlab_deployment_api.lib import const
+
+logger = get_logger(__name__, loglevel=const.VLAB_DEPLOYMENT_LOG_LEVEL)
+
+QUEUE_PREFIX = 'vlab.deployment.slots'
+# How often (in seconds) to ask the broker for a token, while none are free
+POLL_INTERVAL = 2
+# How often (in seconds) to try the slot files again, while every one is locked
+LOCK_POLL_INTERVAL = 0.2
+
+# AdaptiveLimit tuning; see its docstring
+MIN_SAMPLES = 4
+LATENCY_TOLERANCE = 1.25
+MAX_ERROR_RATE = 0.05
+MIN_GRADIENT = 0.5
+ERROR_BACKOFF = 0.5
+BASELINE_WINDOWS = 20
+DECISION_HISTORY = 50
+# What the latency of a slot is measured per; see AdaptiveLimit
+UNITS = ('byte', 'operation')
+
+
+class Grant(object):
+    """What ``SlotScheduler.slot`` yields. Set ``nbytes`` to how much data the
+    work moved, so the slot's latency can be compared to work of other sizes.
+
+    :param waited: How many seconds were spent waiting for the slot.
+    :type waited: Float
+    """
+    __slots__ = ('waited', 'nbytes')
+
+    def __init__(self, waited):
+        self.waited = waited
+        self.nbytes = 0
+
+
+class SlotScheduler(object):
+    """Hands out a limited number of slots, in the order they were asked for.
+
+    :param limits: The number of slots of each kind; i.e. ``{'import': 5, 'export': 2}``
+    :type limits: Dictionary
+
+    :param broker: Optionally, limit the slots across many processes (or worker nodes) too.
+    :type broker: FileSemaphore or BrokerSemaphore
+
+    :param controllers: Optionally, adjust the limit of a kind of slot; kind -> ``AdaptiveLimit``
+    :type controllers: Dictionary
+    """
+    def __init__(self, limits, broker=None, controllers=None):
+        self.limits = dict(limits)
+        self.broker = broker
+        self.controllers = controllers or {}
+        for kind, controller in self.controllers.items():
+            self.limits[kind] = controller.limit
+        self.stats = {x: {'granted': 0, 'queued': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0} for x in limits}
+        self._in_use = {x: 0 for x in limits}
+        self._waiters = {x: deque() for x in limits}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, kind, logger=logger):
+        """Hold a slot for the duration of a ``with`` statement.
+
+        :Returns: Grant
+
+        :param kind: The kind of slot; i.e. ``import`` or ``export``.
+        :type kind: String
+
+        :param logger: An object for logging messages
+        :type logger: logging.LoggerAdapter
+        """
+        start = time.monotonic()
+        self.acquire(kind)
+        token = None
+        if self.broker is not None:
+            try:
+                token = self.broker.acquire(kind)
+            except BaseException:
+                self.release(kind)
+                raise
+        waited = time.monotonic() - start
+        if waited >= 1:
+            logger.info('Waited %.1f seconds for an %s slot', waited, kind)
+        grant = Grant(waited)
+        error = False
+        # Only the work counts; time spent queued says nothing about how busy vCenter is
+        start = time.monotonic()
+        try:
+            yield grant
+        except ValueError:
+            # A user error (i.e. no such network) says nothing about how busy vCenter is
+            raise
+        except BaseException:
+            error = True
+            raise
+        finally:
+            if token is not None:
+                self.broker.release(token)
+            self.release(kind)
+            controller = self.controllers.get(kind, None)
+            if controller is not None:
+                limit = controller.record(time.monotonic() - start, nbytes=grant.nbytes, error=error)
+                self.set_limit(kind, limit)
+
+    def acquire(self, kind):
+        """Block until a slot is free. Use ``slot`` instead, unless you must
+        acquire and release in different places.
+
+        :Returns: Float - how many seconds were spent waiting
+
+        :param kind: The kind of slot; i.e. ``import`` or ``export``.
+        :type kind: String
+        """
+        start = time.monotonic()
+        ticket = None
+        with self._lock:
+            if self._in_use[kind] < self.limits[kind] and not self._waiters[kind]:
+                self._in_use[kind] += 1
+            else:
+                ticket = threading.Event()
+                self._waiters[kind].append(ticket)
+                self.stats[kind]['queued'] += 1
+        if ticket is not None:
+            # ``release`` hands its slot directly to the oldest waiter, so a new
+            # caller can never cut in line.
+            ticket.wait()
+        waited = time.monotonic() - start
+        with self._lock:
+            stats = self.stats[kind]
+            stats['granted'] += 1
+            stats['wait_seconds'] += waited
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+        return waited
+
+    def release(self, kind):
+        """Give back a slot obtained via ``acquire``.
+
+        :Returns: None
+
+        :param kind: The kind of slot; i.e. ``import`` or ``export``.
+        :type kind: String
+        """
+        with self._lock:
+            if self._waiters[kind] and self._in_use[kind] <= self.limits[kind]:
+                self._waiters[kind].popleft().set()
+            else:
+                self._in_use[kind] -= 1
+
+    def set_limit(self, kind, limit):
+        """Change how many slots of a kind there are. Lowering the limit never
+        interrupts work; the extra slots just aren't handed out again.
+
+        :Returns: None
+
+        :param kind: The kind of slot; i.e. ``import`` or ``export``.
+        :type kind: String
+
+        :param limit: The new number of slots.
+        :type limit: Integer
+        """
+        with self._lock:
+            self.limits[kind] = limit
+            while self._waiters[kind] and self._in_use[kind] < limit:
+                self._in_use[kind] += 1
+                self._waiters[kind].popleft().set()
+
+    def waiting(self, kind):
+        """How many callers are queued for a kind of slot
+
+        :Returns: Integer
+
+        :param kind: The kind of slot; i.e. ``import`` or ``export``.
+        :type kind: String
+        """
+        with self._lock:
+            return len(self._waiters[kind])
+
+
+class AdaptiveLimit(object):
+    """Picks the number of slots from how the work that held them went (AIMD).
+
+    Every slot reports how long its work took (from when the slot was granted),
+    how many bytes it moved, and if it failed. Work that moved bytes is measured
+    in seconds per byte, and other work in seconds per operation; the two are
+    never compared, so each has its own windows and baseline. Once there's a
+    window of results of one kind (at least as many as the limit), the
+    controller decides:
+
+    * more than ``MAX_ERROR_RATE`` failed: cut the limit in half
+    * the average seconds per byte (or operation) is more than ``LATENCY_TOLERANCE``
+      times the baseline: the datastore/vCenter is saturated, so scale the limit
+      by baseline / average (but never by less than ``MIN_GRADIENT``)
+    * otherwise, add one slot
+
+    The baseline is the best window average of the last ``BASELINE_WINDOWS``
+    windows, so it follows a datastore that's permanently gotten slower.
+
+    :param kind: The kind of slot; only used in log messages.
+    :type kind: String
+
+    :param start: The initial limit.
+    :type start: Integer
+
+    :param floor: The lowest the limit can go.
+    :type floor: Integer
+
+    :param ceiling: The highest the limit can go.
+    :type ceiling: Integer
+    """
+    def __init__(self, kind, start, floor, ceiling):
+        self.kind = kind
+        self.floor = max(floor, 1)
+        self.ceiling = max(ceiling, self.floor)
+        self.limit = min(max(start, self.floor), self.ceiling)
+        self.decisions = deque(maxlen=DECISION_HISTORY)
+        self._samples = {x: [] for x in UNITS}
+        self._windows = {x: deque(maxlen=BASELINE_WINDOWS) for x in UNITS}
+        self._lock = threading.Lock()
+
+    @property
+    def baselines(self):
+        """The best seconds per byte, and per operation, seen recently; None until there's a window
+
+        :Returns: Dictionary - unit -> Float or None
+        """
+        with self._lock:
+            return {x: min(y) if y else None for x, y in self._windows.items()}
+
+    def record(self, duration, nbytes=0, error=False):
+        """Add the result of one unit of work, and get the (possibly new) limit.
+
+        :Returns: Integer
+
+        :param duration: How many seconds the work held its slot.
+        :type duration: Float
+
+        :param nbytes: How much data the work moved; zero if unknown.
+        :type nbytes: Integer
+
+        :param error: Set to True if the work failed.
+        :type error: Boolean
+        """
+        with self._lock:
+            if nbytes:
+                unit = 'byte'
+                cost = duration / nbytes
+            else:
+                unit = 'operation'
+                cost = duration
+            self._samples[unit].append((cost, error))
+            if len(self._samples[unit]) < max(self.limit, MIN_SAMPLES):
+                return self.limit
+            samples, self._samples[unit] = self._samples[unit], []
+            error_rate = sum(1 for x in samples if x[1]) / len(samples)
+            succeeded = [x[0] for x in samples if not x[1]]
+            latency = sum(succeeded) / len(succeeded) if succeeded else None
+            windows = self._windows[unit]
+            if latency is not None:
+                windows.append(latency)
+            baseline = min(windows) if windows else None
+            if error_rate > MAX_ERROR_RATE:
+                limit = int(self.limit * ERROR_BACKOFF)
+                reason = 'errors'
+            elif baseline and latency > baseline * LATENCY_TOLERANCE:
+                # Scale down by how much slower the work got; that's roughly
+                # the concurrency the datastore handles before slowing down.
+                gradient = max(baseline / latency, MIN_GRADIENT)
+                limit = min(int(self.limit * gradient), self.limit - 1)
+                reason = 'latency'
+            else:
+                limit = self.limit + 1
+                reason = 'healthy'
+            limit = min(max(limit, self.floor), self.ceiling)
+            decision = {'time': time.time(), 'old_limit': self.limit, 'limit': limit, 'reason': reason,
+                        'unit': unit, 'latency': latency, 'baseline': baseline, 'error_rate': error_rate}
+            self.decisions.append(decision)
+            if limit != self.limit:
+                logger.info('Changing %s slots from %s to %s (%s)', self.kind, self.limit, limit, reason)
+            self.limit = limit
+            return limit
+
+
+class FileSemaphore(object):
+    """Limits slots across every process on a node, via a lock file per slot.
+
+    :param lock_dir: Where the lock files are kept; every process sharing it shares the slots.
+    :type lock_dir: String
+
+    :param limits: The number of slots of each kind; i.e. ``{'import': 5, 'export': 2}``
+    :type limits: Dictionary
+    """
+    def __init__(self, lock_dir, limits):
+        self.lock_dir = lock_dir
+        self.limits = dict(limits)
+
+    def acquire(self, kind):
+        """Block until a slot of a given kind is locked.
+
+        :Returns: File - the locked slot; give it to ``release`` when done.
+
+        :param kind: The kind of slot; i.e. ``import`` or ``export``.
+        :type kind: String
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        while True:
+            for number in range(self.limits[kind]):
+                the_file = open(os.path.join(self.lock_dir, '{}.{}.lock'.format(kind, number)), 'a')
+                try:
+                    fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    the_file.close()
+                else:
+                    return the_file
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self, token):
+        """Give back a slot obtained via ``acquire``.
+
+        :Returns: None
+
+        :param token: The locked slot.
+        :type token: File
+        """
+        # Closing the file lets go of the lock
+        token.close()
+
+
+class BrokerSemaphore(object):
+    """Limits slots across every worker node, via tokens in a broker queue.
+
+    :param url: The message broker to keep the tokens in.
+    :type url: String
+
+    :param limits: The number of slots of each kind; i.e. ``{'import': 5, 'export': 2}``
+    :type limits: Dictionary
+    """
+    def __init__(self, url, limits):
+        self.url = url
+        self.limits = dict(limits)
+
+    def seed(self):
+        """Fill every queue with its tokens; anything already in them is dropped.
+        Only run when no worker holds a token, otherwise there'll be extra slots.
+
+        :Returns: None
+        """
+        with Connection(self.url) as conn:
+            for kind, limit in self.limits.items():
+                queue = conn.SimpleQueue(_queue_name(kind))
+                queue.clear()
+                for number in range(limit):
+                    queue.put({'kind': kind, 'token': number})
+                queue.close()
+
+    def acquire(self, kind):
+        """Block until a token of a given kind is obtained.
+
+        :Returns: Tuple - (connection, queue, message); give it to ``release`` when done.
+
+        :param kind: The kind of slot; i.e. ``import`` or ``export``.
+        :type kind: String
+        """
+        # Un-acked messages are bound to their connection, so every holder
+        # needs its own.
+        conn = Connection(self.url)
+        queue = conn.SimpleQueue(_queue_name(kind))
+        try:
+            while True:
+                try:
+                    # One at a time; a blocking consumer could prefetch every token
+                    message = queue.get_nowait()
+                except queue.Empty:
+                    time.sleep(POLL_INTERVAL)
+                else:
+                    return conn, queue, message
+        except BaseException:
+            queue.close()
+            conn.close()
+            raise
+
+    def release(self, token):
+        """Give back a token obtained via ``acquire``.
+
+        :Returns: None
+
+        :param token: The token to give back.
+        :type token: Tuple
+        """
+        conn, queue, message = token
+        try:
+            message.requeue()
+        finally:
+            queue.close()
+            conn.close()
+
+
+def _queue_name(kind):
+    return '{}.{}'.format(QUEUE_PREFIX, kind)
+
+
+def task_workers():
+    """How many threads a task should use for uploads/exports. When the slots
+    are adaptive, a single task must be able to use every slot.
+
+    :Returns: Integer
+    """
+    return max(const.VLAB_DEPLOY_CONCURRENT_VMS, const.VLAB_SLOTS_CEILING)
+
+
+def _make_scheduler():
+    limits = {'import': const.VLAB_IMPORT_SLOTS, 'export': const.VLAB_EXPORT_SLOTS}
+    shared = dict(limits)
+    controllers = {}
+    if const.VLAB_SLOTS_CEILING:
+        for kind, start in limits.items():
+            controllers[kind] = AdaptiveLimit(kind, start, const.VLAB_SLOTS_FLOOR, const.VLAB_SLOTS_CEILING)
+            # Both hold a fixed number of slots; adapting happens per process,
+            # so there must be enough shared slots for the limit to grow into
+            shared[kind] = max(start, const.VLAB_SLOTS_CEILING)
+    if const.VLAB_SLOT_BROKER:
+        broker = BrokerSemaphore(const.VLAB_SLOT_BROKER, shared)
+    else:
+        broker = FileSemaphore(const.VLAB_SLOT_LOCK_DIR, shared)
+    return SlotScheduler(limits, broker=broker, controllers=controllers)
+
+
+SLOTS = _make_scheduler()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['seed'] or not isinstance(SLOTS.broker, BrokerSemaphore):
+        sys.exit('Usage: VLAB_SLOT_BROKER=<url> python -m {} seed'.format(__spec__.name))
+    SLOTS.broker.seed()
@@ -0,0 +1,452 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-memory catalog of every deployment template, and its meta data.
+
+Listing templates used to ``os.listdir`` the template directory, then call
+``get_meta`` (another ``listdir``, plus a JSON parse) for every template. On an
+NFS share with hundreds of templates, that took seconds. The catalog loads the
+meta data once, and keeps it fresh by checking modification times:
+
+* The template directory is ``stat``'d on every listing. Templates are created
+  (renamed from a hidden directory) and deleted as a whole, so this one call
+  notices both.
+* A change to the meta data of an existing template only changes its own
+  ``meta_version``, so every template is checked at most once every
+  ``const.VLAB_TEMPLATE_CATALOG_TTL`` seconds. Changes made by this worker call ``invalidate``, and show up right away.
+
+The catalog also indexes templates by owner, so finding the templates a user
+owns costs as much as the number of templates they own. When the meta data
+backend has indexes of its own (``const.VLAB_TEMPLATE_META_STORE`` is
+``sqlite``), finding templates by owner or kind is one query of those instead.
+
+inotify is not used; NFS clients never see events for changes made by another
+client, and mtimes work everywhere. The file system is only read while no
+lock is held, so one slow read doesn't hold up every other listing.
+"""
+import os
+import time
+import base64
+import threading
+from collections import defaultdict
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.meta_store import matches
+from vlab_deployment_api.lib.template_meta_data import get_meta, meta_version, find_meta, meta_indexed
+
+# What ``list_images`` can project the meta data of a template down to
+IMAGE_FIELDS = ('owner', 'email', 'summary', 'machines', 'machine_names')
+
+
+class TemplateCatalog(object):
+    """A thread safe catalog of deployment templates.
+
+    The meta data returned is shared by every caller; treat it as read only.
+
+    :param ttl: How many seconds the meta data of a template is trusted without checking it.
+    :type ttl: Integer
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.stats = {'listings': 0, 'scans': 0, 'sweeps': 0, 'loads': 0, 'indexed': 0}
+        self._location = None
+        self._root_key = None
+        self._swept = 0
+        # template name -> (key, meta); meta is None when it can't be read
+        self._entries = {}
+        # owner -> names of the templates they own
+        self._owners = defaultdict(set)
+        # templates changed by this worker, that must be read again
+        self._stale = set()
+        # Every refresh gets a ticket; what it found is only kept when nothing newer is known
+        self._ticket = 0
+        self._floor = 0
+        self._root_ticket = 0
+        # template name -> ticket of the refresh that last changed it
+        self._tickets = {}
+        self._lock = threading.Lock()
+
+    def templates(self, location):
+        """Every template (that has readable meta data) in a directory.
+
+        :Returns: Dictionary - template name -> meta data
+
+        :param location: The directory that deployment templates live in.
+        :type location: String
+        """
+        self._refresh(location)
+        with self._lock:
+            return {x: y[1] for x, y in self._entries.items() if y[1] is not None}
+
+    def owned_by(self, location, owner):
+        """The templates a user owns.
+
+        :Returns: Dictionary - template name -> meta data
+
+        :param location: The directory that deployment templates live in.
+        :type location: String
+
+        :param owner: The name of the user.
+        :type owner: String
+        """
+        if meta_indexed():
+            self.stats['indexed'] += 1
+            return find_meta(owner=owner)
+        self._refresh(location)
+        with self._lock:
+            return {x: self._entries[x][1] for x in self._owners.get(owner, ())}
+
+    def path(self, location, template):
+        """Where a template lives.
+
+        :Returns: String, or None when there's no such template
+
+        :param location: The directory that deployment templates live in.
+        :type location: String
+
+        :param template: The name of the template.
+        :type template: String
+        """
+        self._refresh(location)
+        with self._lock:
+            if template not in self._entries:
+                return None
+            return os.path.join(location, template)
+
+    def query(self, location, owner=None, kind=None, prefix='', after=None, limit=None, readable=False):
+        """Find templates, in order of their name.
+
+        Names are filtered (by owner, prefix and ``after``) before any meta data
+        is looked at, and the search stops once ``limit`` templates are found.
+
+        :Returns: List - (template name, meta data) tuples; the meta data is None when it can't be read
+
+        :param location: The directory that deployment templates live in.
+        :type location: String
+
+        :param owner: Only find the templates this user owns.
+        :type owner: String
+
+        :param kind: Only find templates with a machine of this kind; i.e. OneFS
+        :type kind: String
+
+        :param prefix: Only find templates with names that start with this.
+        :type prefix: String
+
+        :param after: Only find templates with names that sort after this one.
+        :type after: String
+
+        :param limit: Find at most this many templates. Default is every template.
+        :type limit: Integer
+
+        :param readable: Skip templates that have no (readable) meta data.
+        :type readable: Boolean
+        """
+        if (owner is not None or kind is not None) and meta_indexed():
+            # Every template the backend finds has readable meta data
+            self.stats['indexed'] += 1
+            return list(find_meta(owner=owner, kind=kind, prefix=prefix, after=after, limit=limit).items())
+        self._refresh(location)
+        with self._lock:
+            if owner is not None:
+                names = self._owners.get(owner, ())
+            else:
+                names = self._entries.keys()
+            names = sorted(x for x in names if x.startswith(prefix) and (after is None or x > after))
+            found = []
+            for name in names:
+                meta = self._entries[name][1]
+                if meta is None and (readable or kind is not None):
+                    continue
+                if kind is not None and not matches(meta, kind=kind):
+                    continue
+                found.append((name, meta))
+                if limit is not None and len(found) >= limit:
+                    break
+            return found
+
+    def names(self, location):
+        """The name of every template in a directory.
+
+        :Returns: List
+
+        :param location: The directory that deployment templates live in.
+        :type location: String
+        """
+        self._refresh(location)
+        with self._lock:
+            return list(self._entries.keys())
+
+    def invalidate(self, template=None):
+        """Forget what's known about a template, so it's read again on the next listing.
+
+        :Returns: None
+
+        :param template: The template that changed. Default is every template.
+        :type template: String
+        """
+        with self._lock:
+            if template is None:
+                self._reset(self._location)
+            else:
+                self._stale.add(template)
+
+    def _refresh(self, location):
+        """Bring the catalog up to date.
+
+        The file system is read without holding the lock, so a slow NFS read
+        doesn't block every other listing; the results are swapped in at the end.
+        A refresh never undoes what a newer one found.
+        """
+        with self._lock:
+            self.stats['listings'] += 1
+            if location != self._location:
+                self._reset(location)
+            self._ticket += 1
+            ticket = self._ticket
+            known = {x: y[0] for x, y in self._entries.items()}
+            root_known = self._root_key
+            stale = set(self._stale)
+            self._stale.clear()
+            now = time.time()
+            sweep = now - self._swept >= self.ttl
+            if sweep:
+                # Only one listing at a time needs to do it
+                self._swept = now
+        loaded = {}
+        gone = set()
+        root_key = _key(location)
+        scan = root_key is None or root_key != root_known
+        if scan:
+            names = {x for x in os.listdir(location) if not x.startswith('.')}
+            gone = set(known.keys()) - names
+            for name in names - set(known.keys()):
+                loaded[name] = _read(location, name)
+        for name in stale - set(loaded.keys()) - gone:
+            if os.path.isdir(os.path.join(location, name)):
+                loaded[name] = _read(location, name)
+            else:
+                # i.e. deleted by this worker
+                gone.add(name)
+        if sweep:
+            for name, key in known.items():
+                if name not in loaded and name not in gone and _template_key(location, name) != key:
+                    loaded[name] = _read(location, name)
+        with self._lock:
+            if ticket <= self._floor:
+                # The catalog was reset while reading; what was read may be out of date
+                return
+            self.stats['scans'] += scan
+            self.stats['sweeps'] += sweep
+            self.stats['loads'] += len(loaded)
+            for name in gone:
+                if self._tickets.get(name, 0) < ticket:
+                    self._drop(name)
+                    self._tickets[name] = ticket
+            for name, (key, meta) in loaded.items():
+                if self._tickets.get(name, 0) < ticket:
+                    self._drop(name)
+                    self._entries[name] = (key, meta)
+                    if meta is not None:
+                        self._owners[meta.get('owner')].add(name)
+                    self._tickets[name] = ticket
+            if scan and ticket > self._root_ticket:
+                self._root_key = root_key
+                self._root_ticket = ticket
+
+    def _reset(self, location):
+        """Forget every template; the caller must hold the lock"""
+        self._location = location
+        self._root_key = None
+        self._root_ticket = 0
+        self._entries.clear()
+        self._owners.clear()
+        self._stale.clear()
+        self._tickets.clear()
+        # Refreshes already reading the file system have nothing to add
+        self._floor = self._ticket
+
+    def _drop(self, name):
+        """Remove a template from the catalog, and the owner index"""
+        _, meta = self._entries.pop(name, (None, None))
+        if meta is not None:
+            owned = self._owners.get(meta.get('owner'), set())
+            owned.discard(name)
+            if not owned:
+                self._owners.pop(meta.get('owner'), None)
+
+
+def _read(location, name):
+    """Read the meta data of one template
+
+    :Returns: Tuple - (key, meta data); the meta data is None when it can't be read
+    """
+    # Taken before reading, so a change made mid-read is noticed next time
+    key = _template_key(location, name)
+    try:
+        meta = get_meta(name)
+    except (OSError, ValueError, KeyError):
+        # Being deleted, a stray file, or meta data being written
+        meta = None
+    return key, meta
+
+
+def _key(path):
+    """Identifies a version of a file/directory; None when it doesn't exist
+
+    :Returns: Tuple
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_ino, info.st_mtime_ns, info.st_size)
+
+
+def _template_key(location, name):
+    """Changes whenever a template's files, or its meta data, change
+
+    :Returns: Tuple
+    """
+    return (_key(os.path.join(location, name)), meta_version(name))
+
+
+def list_images(verbose=False, owner=None, kind=None, prefix='', fields=None, limit=None, cursor=None):
+    """Obtain a list of available versions of Deployment that can be created
+
+    The filters are applied to the catalog of templates, so templates that are
+    filtered out (or are past the end of the page) are never looked at.
+
+    :Returns: List
+
+    :Raises: ValueError
+
+    :param verbose: Include details about each deployment template.
+    :type verbose: Boolean
+
+    :param owner: Only list the templates this user owns.
+    :type owner: String
+
+    :param kind: Only list templates with a machine of this kind; i.e. OneFS
+    :type kind: String
+
+    :param prefix: Only list templates with names that start with this.
+    :type prefix: String
+
+    :param fields: Only include these parts of the meta data; see ``IMAGE_FIELDS``. Implies ``verbose``.
+    :type fields: List
+
+    :param limit: List at most this many templates; see ``next_cursor``
+    :type limit: Integer
+
+    :param cursor: Where the previous page ended.
+    :type cursor: String
+    """
+    if fields:
+        unknown = set(fields) - set(IMAGE_FIELDS)
+        if unknown:
+            raise ValueError('Unknown field(s): {}. Must be one of {}'.format(', '.join(sorted(unknown)), ', '.join(IMAGE_FIELDS)))
+        verbose = True
+    plain = not (owner or kind or prefix or limit or cursor)
+    if verbose:
+        # This exists so the API can return handy info. The deployments service
+        # is unique, in that the templates are created and managed by users.
+        # The other services (like OneFS, InsightIQ, etc) are all managed by the
+        # sysadmin. So returning a simple list of what's available works for those
+        # services. The default of "False" is so we automatically mimic the behavior
+        # of those services when the RESTful API gets called; just give them a
+        # simple list of what's available. As an API client/consumer, I always get
+        # annoyed when two similar API end points return different data structures...
+        if plain:
+            images = CATALOG.templates(const.VLAB_DEPLOYMENT_TEMPLATE_DIR).items()
+        else:
+            images = CATALOG.query(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, owner=owner, kind=kind, prefix=prefix,
+                                   after=_decode_cursor(cursor), limit=limit, readable=True)
+        answer = [{template: _project(meta, fields)} for template, meta in images]
+    elif plain:
+        answer = CATALOG.names(const.VLAB_DEPLOYMENT_TEMPLATE_DIR)
+    else:
+        images = CATALOG.query(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, owner=owner, kind=kind, prefix=prefix,
+                               after=_decode_cursor(cursor), limit=limit)
+        answer = [template for template, _ in images]
+    return answer
+
+
+def owned_templates(username):
+    """The templates a user owns; what ``templates.show`` responds with
+
+    :Returns: Dictionary - template name -> meta data
+
+    :param username: The name of the user.
+    :type username: String
+    """
+    return CATALOG.owned_by(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, username)
+
+
+def image_content(verbose, query):
+    """The "content" the ``deployment.images`` task responds with; see ``list_images``
+
+    :Returns: Dictionary
+
+    :Raises: ValueError
+
+    :param verbose: Include details about each deployment template.
+    :type verbose: Boolean
+
+    :param query: Filters, projection and paging; the keyword arguments of ``list_images``
+    :type query: Dictionary
+    """
+    found = list_images(verbose=verbose, **query)
+    content = {'image': found}
+    if query.get('limit', None):
+        content['next'] = next_cursor(found, query['limit'])
+    return content
+
+
+def next_cursor(images, limit):
+    """The cursor for the page after the one ``list_images`` returned.
+
+    :Returns: String, or None when there are no more pages
+
+    :param images: What ``list_images`` returned.
+    :type images: List
+
+    :param limit: The ``limit`` passed to ``list_images``
+    :type limit: Integer
+    """
+    if not images or len(images) < limit:
+        return None
+    last = images[-1]
+    if isinstance(last, dict):
+        last = list(last.keys())[0]
+    return base64.urlsafe_b64encode(last.encode()).decode()
+
+
+def _decode_cursor(cursor):
+    """Obtain the name of the last template of the previous page
+
+    :Returns: String
+
+    :Raises: ValueError
+    """
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def _project(meta, fields):
+    """Trim the meta data of a template down to some fields
+
+    :Returns: Dictionary
+    """
+    if not fields:
+        return meta
+    projected = {x: meta.get(x, None) for x in fields if x != 'machine_names'}
+    if 'machine_names' in fields:
+        projected['machine_names'] = sorted(meta.get('machines', {}).keys())
+    return projected
+
+
+CATALOG = TemplateCatalog(ttl=const.VLAB_TEMPLATE_CATALOG_TTL)
@@ -0,0 +1,362 @@
+# -*- coding: UTF-8 -*-
+"""
+A content-addressed store for the OVAs of deployment templates.
+
+Users make lots of templates from the same base images, so most of the bytes
+in one OVA are also in several others. When ``const.VLAB_TEMPLATE_STORAGE`` is
+``chunks``, an OVA is split into content-defined chunks, every chunk is saved
+once (named by its SHA256) in ``const.VLAB_CHUNK_STORE_DIR``, and the template
+keeps a small manifest instead of the OVA. ``ChunkedHandle`` reads the original
+OVA back out of the chunks, so deploying never rebuilds the file.
+
+Chunk boundaries are picked per 512 byte sector (a hash of the sector decides
+if a chunk ends there). Tar members and VMDK grains are sector aligned, so
+boundaries land in the same place in near-identical files. The hash of every
+sector in a buffer is computed at once, with bytes operations that run in C;
+Python only loops over the boundaries found, not the millions of sectors in a disk.
+
+Every chunk has a reference count, kept in ``refcounts.json`` and guarded by an
+``fcntl`` lock, so many workers can share the store. A chunk is deleted when
+the last manifest using it is released.
+"""
+import os
+import fcntl
+import bisect
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_deployment_api.lib import const
+
+MANIFEST_SUFFIX = '.manifest'
+SECTOR_SIZE = 512
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+# Where the bytes that are hashed lie in a sector
+HASH_OFFSETS = range(0, SECTOR_SIZE, 32)
+# A chunk ends after a sector where both bytes of the hash are zero, once the
+# second is masked; one sector in 256 * 8, so chunks are about 1MB on average
+HASH_MASK = 0x07
+
+
+def _gear(seed):
+    """A translation table of pseudo-random bytes; the same on every worker, forever
+
+    :Returns: Bytes
+    """
+    return bytes(hashlib.sha256('{}:{}'.format(seed, x).encode()).digest()[0] for x in range(256))
+
+
+GEARS = [(_gear('a{}'.format(x)), _gear('b{}'.format(x))) for x in HASH_OFFSETS]
+MASK_TABLE = bytes(x & HASH_MASK for x in range(256))
+
+
+def boundary_sectors(data, start=0, end=None):
+    """Find the sectors that a chunk can end after.
+
+    :Returns: List - the index of every such sector (counting from ``start``), in order
+
+    :param data: Part of a file; sector aligned.
+    :type data: bytes or bytearray
+
+    :param start: Where in ``data`` to start looking; sector aligned.
+    :type start: Integer
+
+    :param end: Where in ``data`` to stop looking. Defaults to the end; a partial sector at the end is skipped.
+    :type end: Integer
+    """
+    end = len(data) if end is None else end
+    count = (end - start) // SECTOR_SIZE
+    if count <= 0:
+        return []
+    end = start + count * SECTOR_SIZE
+    first = 0
+    second = 0
+    for offset, (gear_a, gear_b) in zip(HASH_OFFSETS, GEARS):
+        # Byte ``offset`` of every sector, in one (C speed) slice
+        column = data[start + offset:end:SECTOR_SIZE]
+        first ^= int.from_bytes(column.translate(gear_a), 'little')
+        second ^= int.from_bytes(column.translate(gear_b), 'little')
+    second = int.from_bytes(second.to_bytes(count, 'little').translate(MASK_TABLE), 'little')
+    hashes = (first | second).to_bytes(count, 'little')
+    found = []
+    index = hashes.find(0)
+    while index != -1:
+        found.append(index)
+        index = hashes.find(0, index + 1)
+    return found
+
+
+def chunk_boundaries(the_file):
+    """Split a file into content-defined chunks.
+
+    :Returns: Generator - yields the bytes of every chunk, in order
+
+    :param the_file: An opened (binary) file
+    :type the_file: io.BufferedReader
+    """
+    # The current chunk starts at data[0]; sectors before ``scanned`` can't end it
+    data = bytearray()
+    scanned = 0
+    while True:
+        buf = the_file.read(READ_SIZE)
+        if not buf:
+            break
+        data += buf
+        whole = len(data) - len(data) % SECTOR_SIZE
+        start = 0
+        with memoryview(data) as view:
+            for index in boundary_sectors(data, scanned, whole):
+                end = scanned + (index + 1) * SECTOR_SIZE
+                while end - start > MAX_CHUNK:
+                    yield bytes(view[start:start + MAX_CHUNK])
+                    start += MAX_CHUNK
+                if end - start >= MIN_CHUNK:
+                    yield bytes(view[start:end])
+                    start = end
+            while whole - start >= MAX_CHUNK:
+                yield bytes(view[start:start + MAX_CHUNK])
+                start += MAX_CHUNK
+        del data[:start]
+        scanned = whole - start
+    if data:
+        yield bytes(data)
+
+
+class ChunkStore(object):
+    """Saves, reads, and garbage collects chunks.
+
+    :param location: The directory to keep chunks in.
+    :type location: String
+    """
+    def __init__(self, location):
+        self.location = location
+
+    def chunk_path(self, digest):
+        """Where the chunk with a given SHA256 lives
+
+        :Returns: String
+
+        :param digest: The SHA256 (hex) of a chunk
+        :type digest: String
+        """
+        return os.path.join(self.location, 'objects', digest[:2], digest)
+
+    def put(self, ova_file, manifest_file):
+        """Move an OVA into the store, leaving a manifest in its place.
+
+        :Returns: None
+
+        :param ova_file: The OVA to move into the store; it's deleted once stored.
+        :type ova_file: String
+
+        :param manifest_file: Where to save the manifest that describes the OVA.
+        :type manifest_file: String
+        """
+        chunks = []
+        with open(ova_file, 'rb') as the_file:
+            for data in chunk_boundaries(the_file):
+                digest = hashlib.sha256(data).hexdigest()
+                self._write_chunk(digest, data)
+                chunks.append([digest, len(data)])
+        with self._locked() as refcounts:
+            for digest, size in chunks:
+                refcounts[digest] = refcounts.get(digest, 0) + 1
+            # A chunk that was already stored could have been garbage
+            # collected before we took the lock; put those back.
+            missing = {x for x, _ in chunks if not os.path.exists(self.chunk_path(x))}
+            if missing:
+                self._restore(ova_file, chunks, missing)
+        manifest = {'size': sum(x[1] for x in chunks), 'chunks': chunks}
+        with open(manifest_file, 'w') as the_file:
+            ujson.dump(manifest, the_file)
+        os.remove(ova_file)
+
+    def retain(self, manifest_file, new_manifest_file):
+        """Use the chunks of a stored OVA in another manifest, without reading the OVA.
+
+        :Returns: None
+
+        :Raises: FileNotFoundError when a chunk of the manifest is gone
+
+        :param manifest_file: The manifest of an OVA that's already stored.
+        :type manifest_file: String
+
+        :param new_manifest_file: Where to save the new manifest.
+        :type new_manifest_file: String
+        """
+        manifest = read_manifest(manifest_file)
+        with self._locked() as refcounts:
+            for digest, _ in manifest['chunks']:
+                if not os.path.exists(self.chunk_path(digest)):
+                    raise FileNotFoundError('Chunk {} of {} is missing'.format(digest, manifest_file))
+            for digest, _ in manifest['chunks']:
+                refcounts[digest] = refcounts.get(digest, 0) + 1
+        with open(new_manifest_file, 'w') as the_file:
+            ujson.dump(manifest, the_file)
+
+    def release(self, manifest_file):
+        """Drop the references a manifest holds, deleting chunks no longer used.
+
+        :Returns: None
+
+        :param manifest_file: The manifest of an OVA being deleted.
+        :type manifest_file: String
+        """
+        manifest = read_manifest(manifest_file)
+        with self._locked() as refcounts:
+            for digest, _ in manifest['chunks']:
+                count = refcounts.get(digest, 0) - 1
+                if count > 0:
+                    refcounts[digest] = count
+                    continue
+                refcounts.pop(digest, None)
+                try:
+                    os.remove(self.chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def refcount(self, digest):
+        """How many manifests use a chunk
+
+        :Returns: Integer
+
+        :param digest: The SHA256 (hex) of a chunk
+        :type digest: String
+        """
+        with self._locked() as refcounts:
+            return refcounts.get(digest, 0)
+
+    def _write_chunk(self, digest, data):
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'wb') as the_file:
+            the_file.write(data)
+        # Atomic, so readers never see a partial chunk
+        os.rename(tmp_path, path)
+
+    def _restore(self, ova_file, chunks, missing):
+        with open(ova_file, 'rb') as the_file:
+            for digest, size in chunks:
+                data = the_file.read(size)
+                if digest in missing:
+                    self._write_chunk(digest, data)
+
+    @contextmanager
+    def _locked(self):
+        """Hold the store-wide lock, and yield the refcounts; changes are saved on exit"""
+        os.makedirs(self.location, exist_ok=True)
+        refcounts_file = os.path.join(self.location, 'refcounts.json')
+        with open(os.path.join(self.location, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(refcounts_file) as the_file:
+                        refcounts = ujson.load(the_file)
+                except FileNotFoundError:
+                    refcounts = {}
+                yield refcounts
+                tmp_file = '{}.tmp'.format(refcounts_file)
+                with open(tmp_file, 'w') as the_file:
+                    ujson.dump(refcounts, the_file)
+                os.rename(tmp_file, refcounts_file)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_manifest(manifest_file):
+    """Load a manifest
+
+    :Returns: Dictionary
+
+    :param manifest_file: The location of a manifest
+    :type manifest_file: String
+    """
+    with open(manifest_file) as the_file:
+        return ujson.load(the_file)
+
+
+class ChunkedHandle(object):
+    """Reads an OVA out of the chunk store, like it was one file.
+
+    Has the same interface as ``vlab_inf_common.vmware.ova.FileHandle``, so an
+    ``Ova`` object can use it.
+
+    :param manifest_file: The manifest of the OVA.
+    :type manifest_file: String
+
+    :param store: Where the chunks live. Defaults to ``STORE``.
+    :type store: ChunkStore
+    """
+    def __init__(self, manifest_file, store=None):
+        self.filename = manifest_file
+        self._store = store if store is not None else STORE
+        manifest = read_manifest(manifest_file)
+        self._chunks = manifest['chunks']
+        self._starts = []
+        position = 0
+        for _, size in self._chunks:
+            self._starts.append(position)
+            position += size
+        self.st_size = position
+        self.offset = 0
+        self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current[1].close()
+            self._current = None
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.offset = offset
+        elif whence == 1:
+            self.offset += offset
+        elif whence == 2:
+            self.offset = self.st_size + offset
+        return self.offset
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def read(self, amount=-1):
+        if amount is None or amount < 0:
+            amount = self.st_size - self.offset
+        parts = []
+        while amount > 0 and self.offset < self.st_size:
+            index = bisect.bisect_right(self._starts, self.offset) - 1
+            digest, size = self._chunks[index]
+            within = self.offset - self._starts[index]
+            the_file = self._open(index, digest)
+            the_file.seek(within)
+            data = the_file.read(min(amount, size - within))
+            parts.append(data)
+            self.offset += len(data)
+            amount -= len(data)
+        return b''.join(parts)
+
+    def progress(self):
+        prog = int(100.0 * self.offset / max(self.st_size, 1))
+        return min(prog, 100.0)
+
+    def _open(self, index, digest):
+        """Keeps the current chunk open, since reads are mostly sequential"""
+        if self._current is None or self._current[0] != index:
+            self.close()
+            self._current = (index, open(self._store.chunk_path(digest), 'rb'))
+        return self._current[1]
+
+
+STORE = ChunkStore(const.VLAB_CHUNK_STORE_DIR)
@@ -0,0 +1,174 @@
+# -*- coding: UTF-8 -*-
+"""
+Remembers which deployment (if any) each user currently has.
+
+Only one deployment per lab is allowed, and finding out if a user already has
+one means asking vCenter about every VM the user owns. The create/delete logic
+writes what it does through to this index, so the common creates (there's
+already a deployment, or the last one was deleted) are answered without
+talking to vCenter.
+
+Entries are files in ``const.VLAB_DEPLOYMENT_LOCK_DIR``, next to the claims, so
+every worker process sharing the directory sees the same answers; a delete in
+one process is seen by a create in another. A create holds the user's claim
+(see ``DeploymentIndex.claim``) while it checks and deploys, so two creates for
+the same lab can't both see "no deployment".
+
+Entries expire after ``const.VLAB_DEPLOYMENT_INDEX_TTL`` seconds. That bounds
+how stale an entry can get when a worker node with a different lock directory
+changes the same lab. The entry of a deploy in progress lasts until the deploy
+ends (or the claim of its create is let go), however long that takes.
+"""
+import os
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_deployment_api.lib import const
+
+ENTRY_SUFFIX = '.deployment'
+
+
+class DeploymentIndex(object):
+    """A mapping of username to the name of their deployed template, shared by
+    every thread and process using the same ``lock_dir``.
+
+    :param ttl: How many seconds an entry can be trusted.
+    :type ttl: Integer
+
+    :param lock_dir: Where the claim and entry of every user is kept.
+    :type lock_dir: String
+    """
+    def __init__(self, ttl, lock_dir=const.VLAB_DEPLOYMENT_LOCK_DIR):
+        self.ttl = ttl
+        self.lock_dir = lock_dir
+
+    def lookup(self, username):
+        """Find the deployment a user has. An empty string means the user has no
+        deployment, and None means the index doesn't know; vCenter must be checked.
+
+        :Returns: String or None
+
+        :param username: The name of the user.
+        :type username: String
+        """
+        try:
+            with open(self._entry_file(username)) as the_file:
+                entry = ujson.load(the_file)
+        except (OSError, ValueError):
+            # Missing, or written by a process that died part way
+            return None
+        if entry['pending']:
+            # i.e. the process deploying died before it could say how it went
+            if not self._claimed(username):
+                return None
+        elif time.time() >= entry['expires']:
+            return None
+        return entry['template']
+
+    def record(self, username, template, pending=False):
+        """Remember what deployment a user has.
+
+        :Returns: None
+
+        :param username: The name of the user.
+        :type username: String
+
+        :param template: The name of the template deployed; an empty string means no deployment.
+        :type template: String
+
+        :param pending: Set when the deployment is still being created; the entry
+                        lasts until it's recorded again, or the user's claim is let go.
+        :type pending: Boolean
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        entry_file = self._entry_file(username)
+        entry = {'template': template, 'pending': pending, 'expires': time.time() + self.ttl}
+        # Written aside then renamed, so a lookup never reads half an entry
+        tmp_file = '{}.{}.{}.tmp'.format(entry_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w') as the_file:
+            ujson.dump(entry, the_file)
+        os.rename(tmp_file, entry_file)
+
+    def invalidate(self, username):
+        """Forget what's known about a user; the next lookup goes to vCenter.
+
+        Use this whenever a create/delete fails part way, and what's in vCenter
+        is anyone's guess.
+
+        :Returns: None
+
+        :param username: The name of the user.
+        :type username: String
+        """
+        try:
+            os.unlink(self._entry_file(username))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def claim(self, username):
+        """Be the only create for a user's lab, for the duration of a ``with`` statement.
+
+        The claim is an exclusive ``flock`` on a file per user, so it covers every
+        thread and process using ``lock_dir``, and is let go if the process dies.
+
+        :Returns: None
+
+        :Raises: ValueError if the user's lab is already claimed
+
+        :param username: The name of the user.
+        :type username: String
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        the_file = open(self._claim_file(username), 'a')
+        try:
+            try:
+                fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ValueError('A deployment is already being created in the lab of {}'.format(username))
+            yield
+        finally:
+            # Closing the file lets go of the lock
+            the_file.close()
+
+    def clear(self):
+        """Forget everything.
+
+        :Returns: None
+        """
+        try:
+            names = os.listdir(self.lock_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith(ENTRY_SUFFIX):
+                self.invalidate(name[:-len(ENTRY_SUFFIX)])
+
+    def _claimed(self, username):
+        """Is some create holding the user's claim right now?"""
+        try:
+            the_file = open(self._claim_file(username))
+        except FileNotFoundError:
+            return False
+        try:
+            # flock locks belong to the open file, so this conflicts even with
+            # a claim held by this very process
+            fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            the_file.close()
+        return False
+
+    def _claim_file(self, username):
+        return os.path.join(self.lock_dir, '{}.lock'.format(username))
+
+    def _entry_file(self, username):
+        return os.path.join(self.lock_dir, '{}{}'.format(username, ENTRY_SUFFIX))
+
+
+INDEX = DeploymentIndex(ttl=const.VLAB_DEPLOYMENT_INDEX_TTL)
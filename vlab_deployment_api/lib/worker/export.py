@@ -0,0 +1,281 @@
+# -*- coding: UTF-8 -*-
+"""
+Export a VM into an OVA, downloading all of its disks at the same time.
+
+``virtual_machine.make_ova`` downloads one VMDK after another, so exporting a
+VM with several disks is limited by a single HTTP stream. ``make_ova`` in this
+module downloads every disk of the export lease at once (up to
+``const.VLAB_EXPORT_CONCURRENT_DISKS``). It computes a SHA256 of each file as
+it streams by, and keeps the lease alive with real progress while it works.
+The OVA gets an OVF manifest (``.mf``) built from those digests.
+
+The OVF has to be the first file in an OVA, and the OVF can only be made once
+the size of every disk is known. So each disk is spooled to its own file next
+to the OVA, and they're appended to the tar after the OVF and manifest.
+"""
+import os
+import time
+import shutil
+import hashlib
+import tarfile
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from pyVmomi import vim, vmodl
+from vlab_inf_common.vmware import virtual_machine
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker.progress import EXPORTING
+
+CHUNK_SIZE = 256 * 1024
+PROGRESS_INTERVAL = 10
+
+
+class Bandwidth(object):
+    """A token bucket that limits the combined download speed of many threads.
+
+    :param rate: How many bytes per second may be downloaded. Zero means no limit.
+    :type rate: Integer
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Block until ``amount`` bytes fit within the budget.
+
+        :Returns: None
+
+        :param amount: How many bytes were just downloaded.
+        :type amount: Integer
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= amount
+            # Going into debt is fine; every caller waits until its share is paid off
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ExportProgress(threading.Thread):
+    """Keeps an export lease alive, and reports how much has been downloaded.
+
+    Use in a ``with`` statement; the lease is completed when the block exits
+    cleanly, and aborted when it raises.
+
+    :param lease: The export lease of a VM.
+    :type lease: vim.HttpNfcLease
+
+    :param total: Roughly how many bytes the export will be.
+    :type total: Integer
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param interval: How often to update the lease, in seconds.
+    :type interval: Integer
+    """
+    def __init__(self, lease, total, logger, interval=PROGRESS_INTERVAL):
+        super().__init__(daemon=True)
+        self.done = 0
+        self._lease = lease
+        self._total = max(total, 1)
+        self._logger = logger
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        self._finished.set()
+        self.join()
+        if exc_type is None:
+            self._lease.HttpNfcLeaseProgress(100)
+            self._lease.HttpNfcLeaseComplete()
+        else:
+            if isinstance(exc_value, vmodl.MethodFault):
+                fault = exc_value
+            else:
+                fault = vmodl.fault.SystemError(reason=str(exc_value))
+            try:
+                self._lease.HttpNfcLeaseAbort(fault)
+            except vmodl.MethodFault:
+                # The lease already timed out/errored; nothing to clean up
+                pass
+
+    @property
+    def percent(self):
+        """How much of the export is done; stops at 99 until the lease is complete"""
+        return min(99, int(100 * self.done / self._total))
+
+    def add(self, amount):
+        """Record that some bytes were downloaded
+
+        :Returns: None
+
+        :param amount: How many bytes were just downloaded.
+        :type amount: Integer
+        """
+        with self._lock:
+            self.done += amount
+
+    def run(self):
+        while not self._finished.wait(self._interval):
+            percent = self.percent
+            self._lease.HttpNfcLeaseProgress(percent)
+            self._logger.info('Export %s%% done', percent)
+
+
+def make_ova(vcenter, the_vm, template_dir, logger, ova_name='', bandwidth=None, tracker=None):
+    """Export a virtual machine into an OVA. The returned string is the location
+    of the new OVA file.
+
+    :Returns: String
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The virtual machine to export.
+    :type the_vm: vim.VirtualMachine
+
+    :param template_dir: The folder to save the new OVA to.
+    :type template_dir: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param ova_name: Optionally define the name for the OVA. Defaults to the name of the VM.
+    :type ova_name: String
+
+    :param bandwidth: Optionally limit the download speed; can be shared by many exports.
+    :type bandwidth: Bandwidth
+
+    :param tracker: Optionally, where to report how much has been downloaded.
+    :type tracker: vlab_deployment_api.lib.worker.progress.MachineProgress
+    """
+    vm_name = the_vm.name
+    if not ova_name:
+        ova_name = '{}.ova'.format(vm_name)
+    elif not ova_name.endswith('.ova'):
+        ova_name = '{}.ova'.format(ova_name)
+    virtual_machine.power(the_vm, 'off')
+    lease = the_vm.ExportVm()
+    virtual_machine._block_on_lease(lease)
+    save_location = os.path.join(template_dir, vm_name)
+    os.makedirs(save_location, exist_ok=True)
+    try:
+        devices = [x for x in lease.info.deviceUrl if x.disk and x.targetId]
+        cookies = vcenter.cookie()
+        total = (lease.info.totalDiskCapacityInKB or 0) * 1024
+        with ExportProgress(lease, total, logger) as progress:
+            if tracker is not None:
+                tracker.phase(EXPORTING, total=total, meter=lambda: progress.done)
+            with ThreadPoolExecutor(max_workers=const.VLAB_EXPORT_CONCURRENT_DISKS) as executor:
+                futures = [executor.submit(_download_disk, save_location, cookies, x, progress, bandwidth) for x in devices]
+                disks = [x.result() for x in futures]
+        device_ovfs = [x[0] for x in disks]
+        ovf_xml = virtual_machine.get_vm_ovf_xml(the_vm, device_ovfs, vcenter)
+        ova_path = os.path.join(save_location, ova_name)
+        _write_ova(ova_path, '{}.ovf'.format(vm_name), ovf_xml, disks, save_location)
+        ova_location = os.path.join(template_dir, ova_name)
+        os.rename(ova_path, ova_location)
+    finally:
+        shutil.rmtree(save_location, ignore_errors=True)
+    return ova_location
+
+
+def _download_disk(save_location, cookies, device, progress, bandwidth):
+    """Stream one VMDK of an export lease to a file, computing its SHA256 on the way.
+
+    :Returns: Tuple - (vim.OvfManager.OvfFile, hex digest)
+
+    :param save_location: The directory to save the VMDK file to.
+    :type save_location: String
+
+    :param cookies: The vCenter SOAP auth cookie(s) to use.
+    :type cookies: Dictionary
+
+    :param device: The VMDK to download.
+    :type device: vim.HttpNfcLease.DeviceUrl
+
+    :param progress: Where to record how much has been downloaded.
+    :type progress: ExportProgress
+
+    :param bandwidth: Optionally limit the download speed.
+    :type bandwidth: Bandwidth
+    """
+    digest = hashlib.sha256()
+    size = 0
+    vmdk_file = os.path.join(save_location, device.targetId)
+    resp = requests.get(device.url,
+                        stream=True,
+                        headers={'Accept': 'application/x-vnd.vmware-streamVmdk'},
+                        cookies=cookies,
+                        verify=False)
+    try:
+        resp.raise_for_status()
+        with open(vmdk_file, 'wb') as the_file:
+            for block in resp.iter_content(chunk_size=CHUNK_SIZE):
+                if not block:
+                    # filter out keep-alive chunks
+                    continue
+                if bandwidth:
+                    bandwidth.consume(len(block))
+                the_file.write(block)
+                digest.update(block)
+                size += len(block)
+                progress.add(len(block))
+    finally:
+        resp.close()
+    ovf_file = vim.OvfManager.OvfFile(deviceId=device.key, path=device.targetId, size=size)
+    return ovf_file, digest.hexdigest()
+
+
+def _write_ova(ova_path, ovf_name, ovf_xml, disks, save_location):
+    """Make the OVA tar; the OVF goes first, then the manifest, then the disks.
+
+    :Returns: None
+
+    :param ova_path: Where to write the OVA.
+    :type ova_path: String
+
+    :param ovf_name: The file name of the OVF within the OVA.
+    :type ovf_name: String
+
+    :param ovf_xml: The OVF descriptor.
+    :type ovf_xml: String
+
+    :param disks: The OvfFile and SHA256 of every downloaded disk.
+    :type disks: List
+
+    :param save_location: The directory the disks were downloaded to.
+    :type save_location: String
+    """
+    ovf_data = ovf_xml.encode()
+    manifest = ['SHA256({})= {}'.format(ovf_name, hashlib.sha256(ovf_data).hexdigest())]
+    manifest += ['SHA256({})= {}'.format(x.path, y) for x, y in disks]
+    mf_name = '{}.mf'.format(os.path.splitext(ovf_name)[0])
+    with tarfile.open(ova_path, mode='w') as ova:
+        _add_bytes(ova, ovf_name, ovf_data)
+        _add_bytes(ova, mf_name, '\n'.join(manifest).encode() + b'\n')
+        for ovf_file, _ in disks:
+            ova.add(os.path.join(save_location, ovf_file.path), arcname=ovf_file.path)
+
+
+def _add_bytes(the_tar, name, data):
+    info = tarfile.TarInfo(name=name)
+    info.size = len(data)
+    info.mtime = time.time()
+    the_tar.addfile(info, BytesIO(data))
@@ -0,0 +1,189 @@
+# -*- coding: UTF-8 -*-
+"""
+Checks that the OVAs of deployment templates are what was exported.
+
+``export.make_ova`` hashes every file of an OVA as it streams by, and writes
+the digests into the OVA's ``.mf``. When a template is made, ``ova_digests``
+copies them (and the size of every file) into the meta data of each machine, as
+``files``; only the tar headers and the ``.mf`` are read, not the disks.
+
+Deploying checks every VMDK against its digest while it's uploaded (see
+``ova_cache.TarMember``). To check templates at rest, i.e. after a storage
+incident, run::
+
+  python -m vlab_deployment_api.lib.worker.integrity verify [template ...]
+
+Templates are checked in parallel (``const.VLAB_VERIFY_WORKERS``), and all of
+them together read no more than ``const.VLAB_VERIFY_BANDWIDTH`` bytes per second.
+"""
+import os
+import re
+import sys
+import hashlib
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.template_meta_data import get_meta
+from vlab_deployment_api.lib.worker.export import Bandwidth
+from vlab_deployment_api.lib.worker.ova_cache import open_handle
+
+READ_SIZE = 1024 * 1024
+# One line of an OVF manifest, i.e. "SHA256(vm01.ovf)= 6e34..."
+MANIFEST_LINE = re.compile(r'^SHA256\((?P<name>.+)\)= *(?P<digest>[0-9a-fA-F]{64})$')
+
+
+def ova_digests(ova_file):
+    """Obtain the SHA256 and size of every file in an OVA, from the OVA's own manifest.
+
+    Files the manifest doesn't list are left out.
+
+    :Returns: Dictionary - file name -> {'sha256': String, 'size': Integer}
+
+    :Raises: OSError, tarfile.TarError
+
+    :param ova_file: The file system location of an OVA (or its chunk store manifest).
+    :type ova_file: String
+    """
+    sizes = {}
+    digests = {}
+    handle = open_handle(ova_file)
+    try:
+        with tarfile.open(fileobj=handle) as the_tar:
+            for member in the_tar.getmembers():
+                if member.name.endswith('.mf'):
+                    for line in the_tar.extractfile(member).read().decode().splitlines():
+                        match = MANIFEST_LINE.match(line.strip())
+                        if match:
+                            digests[match.group('name')] = match.group('digest').lower()
+                else:
+                    sizes[member.name] = member.size
+    finally:
+        handle.close()
+    return {x: {'sha256': y, 'size': sizes[x]} for x, y in digests.items() if x in sizes}
+
+
+def verify_ova(ova_file, files, bandwidth=None):
+    """Read every file of an OVA, and compare it to the recorded digests.
+
+    :Returns: List - a description of every problem found
+
+    :param ova_file: The file system location of an OVA (or its chunk store manifest).
+    :type ova_file: String
+
+    :param files: The SHA256 and size of every file; see ``ova_digests``.
+    :type files: Dictionary
+
+    :param bandwidth: Optionally limit how fast the OVA is read.
+    :type bandwidth: vlab_deployment_api.lib.worker.export.Bandwidth
+    """
+    problems = []
+    remaining = dict(files)
+    if not os.path.isfile(ova_file):
+        return ['{} does not exist'.format(ova_file)]
+    try:
+        handle = open_handle(ova_file)
+    except (OSError, ValueError) as doh:
+        return ['Unable to open {}: {}'.format(ova_file, doh)]
+    try:
+        with tarfile.open(fileobj=handle) as the_tar:
+            for member in the_tar.getmembers():
+                expected = remaining.pop(member.name, None)
+                if expected is None:
+                    continue
+                if member.size != expected['size']:
+                    problems.append('{} in {} is {} bytes, not {}'.format(member.name, ova_file, member.size, expected['size']))
+                    continue
+                digest = _hash(the_tar.extractfile(member), bandwidth)
+                if digest != expected['sha256']:
+                    problems.append('{} in {} has SHA256 {}, not {}'.format(member.name, ova_file, digest, expected['sha256']))
+    except (OSError, tarfile.TarError) as doh:
+        problems.append('Unable to read {}: {}'.format(ova_file, doh))
+    finally:
+        handle.close()
+    for name in sorted(remaining.keys()):
+        problems.append('{} is missing from {}'.format(name, ova_file))
+    return problems
+
+
+def verify_template(template, bandwidth=None):
+    """Check every OVA of a deployment template.
+
+    :Returns: Tuple - (files checked, list of problems)
+
+    :param template: The name of the deployment template.
+    :type template: String
+
+    :param bandwidth: Optionally limit how fast the OVAs are read.
+    :type bandwidth: vlab_deployment_api.lib.worker.export.Bandwidth
+    """
+    try:
+        meta = get_meta(template)
+    except (OSError, ValueError) as doh:
+        return 0, ['Unable to read the meta data of {}: {}'.format(template, doh)]
+    checked = 0
+    problems = []
+    for machine_name, details in sorted(meta['machines'].items()):
+        files = details.get('files', None)
+        if not files:
+            # Made before digests were recorded; nothing to compare to
+            continue
+        if 'ova_path' not in details:
+            problems.append('No OVA found for {} in template {}'.format(machine_name, template))
+            continue
+        problems += verify_ova(details['ova_path'], files, bandwidth)
+        checked += len(files)
+    return checked, problems
+
+
+def verify(templates, workers=None, rate=None):
+    """Check many deployment templates at once.
+
+    :Returns: Dictionary - template name -> (files checked, list of problems)
+
+    :param templates: The names of the deployment templates to check.
+    :type templates: List
+
+    :param workers: How many templates to check at the same time. Defaults to ``const.VLAB_VERIFY_WORKERS``
+    :type workers: Integer
+
+    :param rate: How many bytes per second all checks may read. Defaults to ``const.VLAB_VERIFY_BANDWIDTH``
+    :type rate: Integer
+    """
+    workers = workers if workers is not None else const.VLAB_VERIFY_WORKERS
+    rate = rate if rate is not None else const.VLAB_VERIFY_BANDWIDTH
+    bandwidth = Bandwidth(rate)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(lambda x: verify_template(x, bandwidth), templates)
+        return dict(zip(templates, results))
+
+
+def _hash(the_file, bandwidth):
+    """The SHA256 of a file-like object, read under the bandwidth limit"""
+    digest = hashlib.sha256()
+    while True:
+        data = the_file.read(READ_SIZE)
+        if not data:
+            break
+        if bandwidth:
+            bandwidth.consume(len(data))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['verify']:
+        sys.exit('Usage: python -m {} verify [template ...]'.format(__spec__.name))
+    templates = sys.argv[2:]
+    if not templates:
+        templates = sorted(x for x in os.listdir(const.VLAB_DEPLOYMENT_TEMPLATE_DIR)
+                           if not x.startswith('.') and os.path.isdir(os.path.join(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, x)))
+    failed = 0
+    for template, (checked, problems) in sorted(verify(templates).items()):
+        if problems:
+            failed += 1
+        print('{}: {} files checked, {} problems'.format(template, checked, len(problems)))
+        for problem in problems:
+            print('  {}'.format(problem))
+    if failed:
+        sys.exit('{} of {} templates failed verification'.format(failed, len(templates)))
@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+"""
+Bulk reads of VM inventory from vCenter.
+
+Every attribute read on a pyVmomi object (i.e. ``vm.runtime.powerState``) is a
+round trip to vCenter, so looping over a folder and calling
+``virtual_machine.get_info`` gets slower with every VM a user owns. The
+functions in this module use a single PropertyCollector request to obtain only
+the properties we need, for every VM in a folder.
+"""
+import ujson
+from pyVmomi import vim, vmodl
+from vlab_inf_common.vmware import virtual_machine
+
+# The properties obtained for every VM; anything else costs another round trip
+VM_PROPERTIES = ['name', 'config.annotation', 'runtime.powerState', 'guest.net', 'network']
+# Mirrors what ``virtual_machine.get_info`` reports for a VM that's still being
+# deployed, or has bogus notes.
+UNKNOWN_META = {'component': 'Unknown',
+                'created': 0,
+                'version': 'Unknown',
+                'generation': 0,
+                'configured': False}
+
+
+def get_vms(vcenter, folder):
+    """Obtain the name, meta data, power state, IPs and networks of every VM in a folder.
+
+    Each item in the returned list is a dictionary with the keys ``vm`` (the
+    pyVmomi object), ``name``, ``meta``, ``state``, ``ips``, ``moid`` and
+    ``network_moids``.
+
+    :Returns: List
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param folder: The VM folder to inventory. Subfolders are not included.
+    :type folder: vim.Folder
+    """
+    results = _retrieve(vcenter, folder, vim.VirtualMachine, VM_PROPERTIES, recursive=False)
+    return [_to_record(x) for x in results]
+
+
+def get_names(vcenter, container, vimtype):
+    """Obtain the name of every object of a type below a container (recursively).
+
+    :Returns: List - (name, pyVmomi object) tuples
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param container: Where to look for objects.
+    :type container: vim.Folder
+
+    :param vimtype: The kind of object to find.
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+    """
+    results = _retrieve(vcenter, container, vimtype, ['name'], recursive=True)
+    answer = []
+    for object_content in results:
+        for prop in object_content.propSet:
+            answer.append((prop.val, object_content.obj))
+    return answer
+
+
+def _retrieve(vcenter, container, vimtype, properties, recursive):
+    """Read some properties of every object of a type in a container, in one request.
+
+    :Returns: List - vmodl.query.PropertyCollector.ObjectContent
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param container: Where to look for objects.
+    :type container: vim.ManagedEntity
+
+    :param vimtype: The kind of object to read.
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param properties: The properties to read from every object.
+    :type properties: List
+
+    :param recursive: Set to True to include objects in sub-containers.
+    :type recursive: Boolean
+    """
+    content = vcenter.content
+    view = content.viewManager.CreateContainerView(container=container,
+                                                   type=[vimtype],
+                                                   recursive=recursive)
+    try:
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView',
+                                                                path='view',
+                                                                skip=False,
+                                                                type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=properties)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        return content.propertyCollector.RetrieveContents([filter_spec])
+    finally:
+        view.DestroyView()
+
+
+def get_details(vcenter, record, username):
+    """Build the same dictionary ``virtual_machine.get_info`` returns, from an
+    inventory record (see ``get_vms``).
+
+    Only the console URL costs extra round trips, so call this just for the VMs
+    you're going to report on.
+
+    :Returns: Dictionary
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param record: One of the items returned by ``get_vms``
+    :type record: Dictionary
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+    """
+    details = {}
+    details['state'] = record['state']
+    details['console'] = virtual_machine._get_vm_console_url(vcenter, record['vm'])
+    details['ips'] = record['ips']
+    details['networks'] = _network_names(vcenter, record['network_moids'], username)
+    details['moid'] = record['moid']
+    details['meta'] = record['meta']
+    return details
+
+
+def _network_names(vcenter, network_moids, username):
+    """Convert the network moIds of a VM into the user-friendly names of the user's networks.
+
+    :Returns: List
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param network_moids: The moIds of the networks a VM is connected to.
+    :type network_moids: List
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+    """
+    prefix = '{}_'.format(username)
+    names = {y._moId: x for x, y in vcenter.networks.items() if x.startswith(username)}
+    return [names[x].replace(prefix, '') for x in network_moids if x in names]
+
+
+def _to_record(object_content):
+    """Turn a PropertyCollector result into a plain dictionary.
+
+    :Returns: Dictionary
+
+    :param object_content: The properties of a single VM
+    :type object_content: vmodl.query.PropertyCollector.ObjectContent
+    """
+    props = {x.name: x.val for x in object_content.propSet}
+    ips = []
+    for nic in props.get('guest.net', []):
+        ips += nic.ipAddress
+    # No point is showing the IPv6 link local addrs if a firewall wont forward them
+    ips = [x for x in ips if not x.startswith('fe80::')]
+    try:
+        meta = ujson.loads(props['config.annotation'])
+    except (KeyError, ValueError, TypeError):
+        # KeyError   -> A VM being deployed has no config
+        # ValueError -> VM created, but notes not updated
+        # TypeError  -> VM failed to be created; notes are None
+        meta = dict(UNKNOWN_META)
+    return {'vm': object_content.obj,
+            'moid': object_content.obj._moId,
+            'name': props.get('name', ''),
+            'meta': meta,
+            'state': props.get('runtime.powerState', ''),
+            'ips': ips,
+            'network_moids': [x._moId for x in props.get('network', [])]}
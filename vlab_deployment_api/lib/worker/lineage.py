@@ -0,0 +1,227 @@
+# -*- coding: UTF-8 -*-
+"""
+Remembers which template, and OVA, a deployed VM came from.
+
+Users often make a template from a deployment they barely touched, and
+exporting every VM again takes tens of minutes. So every deployed VM has
+Changed Block Tracking (CBT) turned on before it's powered on, and its meta
+data records the source template, the source OVA, and a baseline ``changeId``
+for every disk. When a template is made from that VM, vCenter is asked what
+areas of each disk changed since the baseline; if none did, the source OVA is
+linked into the new template instead of exporting the VM.
+
+A disk has no ``changeId`` until CBT is active, which takes a snapshot (or a
+power on). The baseline comes from a snapshot taken while the VM is still
+powered off, and exactly as it was deployed; the snapshot is removed right
+away. Asking what changed also needs a snapshot, so one is taken (and removed)
+when the template is made.
+
+The source OVA is only reused if it's the very same file the VM was deployed
+from (same inode and mtime); a template that was deleted, and made again with
+the same name, has different OVAs.
+"""
+import os
+import errno
+import fcntl
+from contextlib import contextmanager
+
+import ujson
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, consume_task
+
+from vlab_deployment_api.lib.worker import chunk_store
+
+# From linux/fs.h; shares the blocks of one file with another, on file systems that can
+FICLONE = 0x40049409
+SNAPSHOT_NAME = 'vlab-lineage'
+
+
+def track_changes(the_vm):
+    """Turn on Changed Block Tracking, and take the baseline later changes are compared to.
+
+    Without it, a template made from the VM exports it; that's no reason to fail a deployment.
+
+    :Returns: Dictionary - disk key -> changeId; empty if change tracking could not be turned on
+
+    :param the_vm: A newly deployed, and still powered off, VM.
+    :type the_vm: vim.VirtualMachine
+    """
+    spec = vim.vm.ConfigSpec()
+    spec.changeTrackingEnabled = True
+    try:
+        consume_task(the_vm.ReconfigVM_Task(spec))
+        with _snapshot(the_vm, 'The disks as deployed; removed once their changeIds are read.') as snapshot:
+            baseline = change_ids(snapshot.config)
+    except (RuntimeError, vmodl.MethodFault):
+        return {}
+    if None in baseline.values():
+        return {}
+    return baseline
+
+
+def change_ids(config):
+    """The ``changeId`` of every disk of a VM.
+
+    :Returns: Dictionary - disk key -> changeId (None when CBT is off)
+
+    :param config: The configuration of a VM.
+    :type config: vim.vm.ConfigInfo
+    """
+    ids = {}
+    for device in config.hardware.device:
+        if isinstance(device, vim.vm.device.VirtualDisk):
+            ids[str(device.key)] = getattr(device.backing, 'changeId', None)
+    return ids
+
+
+def source_meta(template, ova_file, baseline):
+    """What to record in the meta data of a deployed VM, about where it came from.
+
+    :Returns: Dictionary
+
+    :param template: The name of the deployment template.
+    :type template: String
+
+    :param ova_file: The OVA (or manifest) the VM was deployed from.
+    :type ova_file: String
+
+    :param baseline: The changeId of every disk, as deployed; see ``track_changes``
+    :type baseline: Dictionary
+    """
+    return {'template': template,
+            'ova': os.path.basename(ova_file),
+            'ova_id': _file_id(ova_file),
+            'disks': baseline}
+
+
+def reusable_ova(the_vm, config, location):
+    """Find the OVA a VM was deployed from, if the VM hasn't changed since.
+
+    :Returns: String, or None when the VM has to be exported
+
+    :param the_vm: A deployed VM.
+    :type the_vm: vim.VirtualMachine
+
+    :param config: The configuration of the VM.
+    :type config: vim.vm.ConfigInfo
+
+    :param location: The directory that deployment templates live in.
+    :type location: String
+    """
+    try:
+        source = ujson.loads(config.annotation)['source']
+        recorded = source['disks']
+        ova_file = os.path.join(location, source['template'], source['ova'])
+        ova_id = source['ova_id']
+    except (ValueError, TypeError, KeyError):
+        # Deployed before sources were recorded, or not a deployed VM
+        return None
+    if not recorded or None in recorded.values() or sorted(change_ids(config)) != sorted(recorded):
+        # No baseline, or a disk was added or removed
+        return None
+    if ova_id is None or _file_id(ova_file) != ova_id:
+        return None
+    if not unchanged(the_vm, config, recorded):
+        return None
+    return ova_file
+
+
+def unchanged(the_vm, config, baseline):
+    """Ask vCenter if any area of any disk changed since the baseline.
+
+    :Returns: Boolean - False when something changed, or vCenter can't say
+
+    :param the_vm: A deployed VM.
+    :type the_vm: vim.VirtualMachine
+
+    :param config: The configuration of the VM.
+    :type config: vim.vm.ConfigInfo
+
+    :param baseline: The changeId of every disk, as deployed; see ``track_changes``
+    :type baseline: Dictionary
+    """
+    disks = [x for x in config.hardware.device if isinstance(x, vim.vm.device.VirtualDisk)]
+    try:
+        with _snapshot(the_vm, 'Changes since the VM was deployed are read from here; removed once read.') as snapshot:
+            for disk in disks:
+                offset = 0
+                while offset < disk.capacityInBytes:
+                    info = the_vm.QueryChangedDiskAreas(snapshot=snapshot,
+                                                        deviceKey=disk.key,
+                                                        startOffset=offset,
+                                                        changeId=baseline[str(disk.key)])
+                    if info.changedArea:
+                        return False
+                    if not info.length:
+                        break
+                    offset = info.startOffset + info.length
+    except (RuntimeError, vmodl.MethodFault):
+        # i.e. CBT was reset, and the baseline is gone
+        return False
+    return True
+
+
+def link_ova(ova_file, new_ova):
+    """Put an existing OVA (or manifest) into a new template, without copying the bytes.
+
+    A hard link is tried first, then a reflink. The OVAs of a template are never
+    modified, so sharing them is safe.
+
+    :Returns: Boolean - False when neither works, and the VM must be exported
+
+    :param ova_file: The OVA (or manifest) of the source template.
+    :type ova_file: String
+
+    :param new_ova: Where the new template wants it.
+    :type new_ova: String
+    """
+    if ova_file.endswith(chunk_store.MANIFEST_SUFFIX):
+        # The chunks need another reference, not just another file
+        chunk_store.STORE.retain(ova_file, new_ova)
+        return True
+    try:
+        os.link(ova_file, new_ova)
+        return True
+    except OSError:
+        pass
+    try:
+        with open(ova_file, 'rb') as src, open(new_ova, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError as doh:
+        if doh.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+            raise
+    try:
+        os.remove(new_ova)
+    except FileNotFoundError:
+        pass
+    return False
+
+
+@contextmanager
+def _snapshot(the_vm, description):
+    """A snapshot of a VM's disks, for the duration of a ``with`` statement.
+
+    :Returns: vim.vm.Snapshot
+    """
+    snapshot = consume_task(the_vm.CreateSnapshot_Task(name=SNAPSHOT_NAME,
+                                                       description=description,
+                                                       memory=False,
+                                                       quiesce=False))
+    try:
+        yield snapshot
+    finally:
+        consume_task(snapshot.RemoveSnapshot_Task(removeChildren=False))
+
+
+def _file_id(path):
+    """Identifies one version of a file; None when it doesn't exist
+
+    :Returns: List
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    # A list, so it compares equal after a trip through JSON
+    return [info.st_ino, info.st_mtime_ns]
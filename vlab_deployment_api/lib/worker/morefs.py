@@ -0,0 +1,234 @@
+# -*- coding: UTF-8 -*-
+"""
+A worker-wide cache of where (by moId) user folders and networks live in vCenter.
+
+``vCenter.get_by_name`` walks the inventory, reading the name of every object
+one round trip at a time, and ``vCenter.networks`` does the same for every
+network in vCenter. Deploying a template did both for every VM. Folders and
+networks are rarely created (and almost never deleted), so the name -> moId
+mapping is scanned once (in a single PropertyCollector request) and shared by
+every session for ``const.VLAB_MOREF_CACHE_TTL`` seconds.
+
+A moId is just an identifier; a cached entry is bound to the stub of whichever
+session asks for it. Looking up an object by name verifies the cached moId
+still has that name (one cheap round trip), and rescans when it does not.
+"""
+import time
+import threading
+
+from pyVmomi import vim, vmodl
+from vlab_inf_common.vmware import vCenter
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker import inventory
+
+# The kinds of objects the cache knows how to scan for
+CACHED_TYPES = (vim.Folder, vim.Network)
+
+
+class MorefCache(object):
+    """A thread safe, TTL cache of object name -> moId, per type of object.
+
+    :param ttl: How many seconds a scan of vCenter can be trusted.
+    :type ttl: Integer
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'scans': 0, 'stale': 0}
+        self._scans = {}
+        self._lock = threading.Lock()
+        self._scan_locks = {x: threading.Lock() for x in CACHED_TYPES}
+
+    def lookup(self, vcenter, vimtype, name):
+        """Find an object by name.
+
+        :Returns: pyVmomi.VmomiSupport.ManagedObject
+
+        :Raises: ValueError if there's no such object
+
+        :param vcenter: The session to bind the object to.
+        :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+        :param vimtype: The kind of object; one of ``CACHED_TYPES``.
+        :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+        :param name: The name of the object.
+        :type name: String
+        """
+        asked = time.time()
+        scanned_at, names = self._get(vcenter, vimtype)
+        ref = names.get(name, None)
+        if ref is not None:
+            the_object = _bind(ref, vcenter)
+            if _has_name(the_object, name):
+                with self._lock:
+                    self.stats['hits'] += 1
+                return the_object
+            with self._lock:
+                self.stats['stale'] += 1
+        with self._lock:
+            self.stats['misses'] += 1
+        if scanned_at < asked:
+            # The object is new, gone, or was re-created; only vCenter knows
+            _, names = self._get(vcenter, vimtype, older_than=asked)
+        ref = names.get(name, None)
+        if ref is None:
+            # Same error as ``vCenter.get_by_name``
+            raise ValueError('Unable to locate object named {}'.format(name))
+        return _bind(ref, vcenter)
+
+    def mapping(self, vcenter, vimtype):
+        """Every object of a type, by name. The objects are not verified.
+
+        :Returns: Dictionary
+
+        :param vcenter: The session to bind the objects to.
+        :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+        :param vimtype: The kind of object; one of ``CACHED_TYPES``.
+        :type vimtype: pyVmomi.VmomiSupport.LazyType
+        """
+        _, names = self._get(vcenter, vimtype)
+        return {x: _bind(y, vcenter) for x, y in names.items()}
+
+    def invalidate(self, vimtype=None):
+        """Forget what's cached, so the next lookup scans vCenter.
+
+        :Returns: None
+
+        :param vimtype: Only forget this kind of object. Default is everything.
+        :type vimtype: pyVmomi.VmomiSupport.LazyType
+        """
+        with self._lock:
+            if vimtype is None:
+                self._scans.clear()
+            else:
+                self._scans.pop(vimtype, None)
+
+    def _get(self, vcenter, vimtype, older_than=None):
+        """Obtain the (scan time, name -> (class, moId)) of a type, scanning when needed.
+
+        Only one thread scans a type at a time; everyone else waiting on that
+        scan uses its result.
+        """
+        with self._scan_locks[vimtype]:
+            now = time.time()
+            with self._lock:
+                scan = self._scans.get(vimtype, None)
+            if scan is not None:
+                expired = now - scan[0] >= self.ttl
+                outdated = older_than is not None and scan[0] < older_than
+                if not (expired or outdated):
+                    return scan
+            names = {}
+            for name, the_object in inventory.get_names(vcenter, _container(vcenter, vimtype), vimtype):
+                # ``get_by_name`` returns the first match; so does the cache.
+                # The class matters; i.e. a DistributedVirtualPortgroup is a Network
+                names.setdefault(name, (type(the_object), the_object._moId))
+            scan = (time.time(), names)
+            with self._lock:
+                self._scans[vimtype] = scan
+                self.stats['scans'] += 1
+            return scan
+
+
+class NetworkMap(dict):
+    """The name -> object mapping ``vCenter.networks`` returns, built from the cache.
+
+    Looking up a network by name verifies it, and a network that's too new
+    to be in the cache is found with a rescan.
+
+    :param vcenter: The session that the networks are bound to.
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    def __init__(self, vcenter):
+        super().__init__(MOREFS.mapping(vcenter, vim.Network))
+        self._vcenter = vcenter
+
+    def __getitem__(self, name):
+        try:
+            network = MOREFS.lookup(self._vcenter, vim.Network, name)
+        except ValueError:
+            raise KeyError(name)
+        self[name] = network
+        return network
+
+
+class CachedvCenter(vCenter):
+    """A ``vCenter`` whose lookups of folders and networks use ``MOREFS``.
+
+    :param host: The IP/FDQN to the vCenter server
+    :type host: String
+
+    :param user: The user account to authenticate with on the vCenter server
+    :type user: String
+
+    :param password: The user accounts password
+    :type password: String
+    """
+    def get_by_name(self, vimtype, name, parent=None):
+        """Find an object in vCenter by name, from the defined base_dir.
+
+        :Returns: pyVmomi.VmomiSupport.ManagedObject
+
+        :Raises: ValueError
+
+        :param vimtype: The category of object to find
+        :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+        :param name: The name of the object
+        :type name: String
+
+        :param parent: (Optional) Filter under a parent folder below the base_dir
+        :type parent: String
+        """
+        if parent is None and vimtype in CACHED_TYPES:
+            return MOREFS.lookup(self, vimtype, name)
+        return super().get_by_name(vimtype, name, parent=parent)
+
+    @property
+    def networks(self):
+        """The networks VMs can use; network name -> vim.Network
+
+        :Returns: NetworkMap
+        """
+        return NetworkMap(self)
+
+
+def _bind(ref, vcenter):
+    """Make a usable object out of a cached (class, moId), for a given session
+
+    :Returns: pyVmomi.VmomiSupport.ManagedObject
+    """
+    vimtype, moid = ref
+    return vimtype(moid, stub=vcenter._conn._stub)
+
+
+def _has_name(the_object, name):
+    """Check that a cached moId is still the object we think it is.
+
+    :Returns: Boolean
+
+    :param the_object: The object to check.
+    :type the_object: pyVmomi.VmomiSupport.ManagedObject
+
+    :param name: The name the object had when it was cached.
+    :type name: String
+    """
+    try:
+        return the_object.name == name
+    except vmodl.fault.ManagedObjectNotFound:
+        return False
+
+
+def _container(vcenter, vimtype):
+    """Where ``vCenter.get_by_name``/``vCenter.networks`` look for a type of object
+
+    :Returns: vim.Folder
+    """
+    if vimtype is vim.Network:
+        return vcenter.content.rootFolder
+    return vcenter.get_vm_folder(path=vcenter._base_dir)
+
+
+MOREFS = MorefCache(ttl=const.VLAB_MOREF_CACHE_TTL)
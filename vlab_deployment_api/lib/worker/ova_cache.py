@@ -0,0 +1,268 @@
+# -*- coding: UTF-8 -*-
+"""
+A process-wide cache of parsed OVA descriptors.
+
+Making an ``Ova`` object walks every header in the tar, and reads the OVF out
+of it, before a single byte of disk is uploaded. Popular templates get deployed
+over and over, so the parsed result (the OVF, its networks, and where each VMDK
+lives within the tar) is cached. Entries are keyed by path, mtime and size, so
+a replaced OVA is parsed again, and the least recently used entries are dropped
+once the cache grows past ``const.VLAB_OVA_CACHE_BYTES``.
+
+Given the digests recorded when the template was made (see ``integrity``),
+every VMDK is checked as it's read for upload; a corrupted OVA fails the
+deploy, without a separate pass over the file.
+"""
+import os
+import re
+import hashlib
+import tarfile
+import threading
+from collections import OrderedDict, namedtuple
+
+from vlab_inf_common.vmware import Ova
+from vlab_inf_common.vmware.ova import FileHandle
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker import chunk_store
+
+# What a cached entry costs, on top of the OVF text; the dicts, tuples, etc.
+ENTRY_OVERHEAD = 1024
+DISK_OVERHEAD = 256
+
+Descriptor = namedtuple('Descriptor', 'ovf networks disks nbytes')
+Descriptor.__doc__ = """The parsed parts of an OVA.
+
+``disks`` maps the name of every VMDK to a tuple of (offset, size), which is
+where the file's data starts within the tar, and how many bytes it is.
+"""
+
+
+class DescriptorCache(object):
+    """A thread safe, size bounded LRU cache of OVA descriptors.
+
+    :param max_bytes: Roughly how much memory the cache can use.
+    :type max_bytes: Integer
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ova_file):
+        """Obtain the descriptor of an OVA, parsing the OVA only when it's not cached.
+
+        :Returns: Descriptor
+
+        :param ova_file: The file system location of an OVA.
+        :type ova_file: String
+        """
+        info = os.stat(ova_file)
+        key = (ova_file, info.st_mtime_ns, info.st_size)
+        with self._lock:
+            descriptor = self._entries.get(key, None)
+            if descriptor is not None:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return descriptor
+            self.stats['misses'] += 1
+        # Parse outside of the lock; two threads racing on the same new OVA
+        # just parse it twice.
+        descriptor = parse(ova_file)
+        with self._lock:
+            self._add(key, descriptor)
+        return descriptor
+
+    def clear(self):
+        """Drop every entry.
+
+        :Returns: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _add(self, key, descriptor):
+        if key in self._entries or descriptor.nbytes > self.max_bytes:
+            return
+        # An OVA replaced in place leaves its old entry behind; evict it now
+        # instead of waiting for it to age out.
+        for stale in [x for x in self._entries.keys() if x[0] == key[0]]:
+            self._evict(stale)
+        self._entries[key] = descriptor
+        self.nbytes += descriptor.nbytes
+        while self.nbytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        descriptor = self._entries.pop(key)
+        self.nbytes -= descriptor.nbytes
+        self.stats['evictions'] += 1
+
+
+def parse(ova_file):
+    """Read the OVF, networks, and VMDK locations out of an OVA.
+
+    :Returns: Descriptor
+
+    :param ova_file: The file system location of an OVA.
+    :type ova_file: String
+    """
+    ovf = ''
+    disks = {}
+    handle = open_handle(ova_file)
+    try:
+        with tarfile.open(fileobj=handle) as the_tar:
+            for member in the_tar.getmembers():
+                if member.name.endswith('.vmdk'):
+                    disks[member.name] = (member.offset_data, member.size)
+                elif member.name.endswith('.ovf'):
+                    ovf = the_tar.extractfile(member).read().decode()
+    finally:
+        handle.close()
+    # Same approach as ``Ova.networks``
+    networks = [x.split('=')[1].replace('"', '') for x in re.findall(r'Network ovf:name=[\w\ \"]{1,50}', ovf)]
+    nbytes = ENTRY_OVERHEAD + len(ovf) + sum(len(x) + DISK_OVERHEAD for x in disks.keys())
+    return Descriptor(ovf=ovf, networks=networks, disks=disks, nbytes=nbytes)
+
+
+class CachedOva(Ova):
+    """An ``Ova`` built from a cached descriptor, instead of by parsing the tar.
+
+    :param ova_file: The file system location of an OVA (or its chunk store manifest).
+    :type ova_file: String
+
+    :param descriptor: The parsed OVA
+    :type descriptor: Descriptor
+
+    :param files: Optionally, the SHA256 and size of every file in the OVA, to check disks against.
+    :type files: Dictionary
+    """
+    def __init__(self, ova_file, descriptor, files=None):
+        # Ova.__init__ parses the tar, which is the whole point of not calling it
+        self._spec = None
+        self._lease = None
+        self._host = None
+        self._prog = None
+        self._tar = None
+        self._descriptor = descriptor
+        self._ovf = descriptor.ovf
+        self._handle = open_handle(ova_file)
+        files = files or {}
+        self._disks = {x: TarMember(self._handle, y[0], y[1], sha256=files.get(x, {}).get('sha256', None))
+                       for x, y in descriptor.disks.items()}
+
+    @property
+    def networks(self):
+        """Return a list of network names that a VM has configured"""
+        return list(self._descriptor.networks)
+
+
+class TarMember(object):
+    """A read-only, file-like view of one file within a tar.
+
+    Reads go through the ``FileHandle`` of the OVA, so the deploy progress
+    reported to vCenter keeps working. With a ``sha256``, the data is hashed as
+    it's read from start to end, and the read that reaches the end raises
+    ValueError if the file is corrupt. Seeking anywhere but the start stops the check.
+
+    :param handle: The opened OVA.
+    :type handle: vlab_inf_common.vmware.ova.FileHandle or chunk_store.ChunkedHandle
+
+    :param offset: Where the file's data starts, within the tar.
+    :type offset: Integer
+
+    :param size: How many bytes the file is.
+    :type size: Integer
+
+    :param sha256: Optionally, the hex digest the file should have.
+    :type sha256: String
+    """
+    def __init__(self, handle, offset, size, sha256=None):
+        self._handle = handle
+        self._offset = offset
+        self.size = size
+        self.position = 0
+        self.sha256 = sha256
+        self._digest = hashlib.sha256() if sha256 else None
+
+    def read(self, amount=-1):
+        remaining = self.size - self.position
+        if amount is None or amount < 0 or amount > remaining:
+            amount = remaining
+        if amount == 0:
+            return b''
+        self._handle.seek(self._offset + self.position)
+        data = self._handle.read(amount)
+        self.position += len(data)
+        if self._digest is not None:
+            self._digest.update(data)
+            if self.position == self.size:
+                self._check()
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        elif whence == 2:
+            self.position = self.size + offset
+        self.position = max(0, min(self.position, self.size))
+        if self.sha256:
+            # i.e. Ova seeks back to the start after every deploy
+            self._digest = hashlib.sha256() if self.position == 0 else None
+        return self.position
+
+    def _check(self):
+        """Compare what was read to the recorded digest"""
+        actual = self._digest.hexdigest()
+        self._digest = None
+        if actual != self.sha256:
+            raise ValueError('Corrupt disk in OVA; expected SHA256 {} but read {}'.format(self.sha256, actual))
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+
+def open_handle(ova_file):
+    """Open an OVA, or the manifest of an OVA in the chunk store.
+
+    :Returns: vlab_inf_common.vmware.ova.FileHandle or chunk_store.ChunkedHandle
+
+    :param ova_file: The file system location of an OVA (or its manifest).
+    :type ova_file: String
+    """
+    if ova_file.endswith(chunk_store.MANIFEST_SUFFIX):
+        return chunk_store.ChunkedHandle(ova_file)
+    return FileHandle(ova_file)
+
+
+CACHE = DescriptorCache(max_bytes=const.VLAB_OVA_CACHE_BYTES)
+
+
+def open_ova(ova_file, files=None):
+    """Obtain an ``Ova`` object, using the cached descriptor when possible.
+
+    Only local files (OVAs, and manifests of OVAs in the chunk store) are cached;
+    anything else (i.e. a URL) is handed to ``Ova``, and not checked.
+
+    :Returns: vlab_inf_common.vmware.ova.Ova
+
+    :param ova_file: The file system location of an OVA.
+    :type ova_file: String
+
+    :param files: Optionally, the SHA256 and size of every file in the OVA; see ``integrity.ova_digests``
+    :type files: Dictionary
+    """
+    if not os.path.isfile(ova_file):
+        return Ova(ova_file)
+    return CachedOva(ova_file, CACHE.get(ova_file), files=files)
@@ -0,0 +1,223 @@
+# -*- coding: UTF-8 -*-
+"""
+Publish where a long running task is at, while it runs.
+
+Creating a deployment (or a template) takes 10-30 minutes, and the task used
+to say nothing until it was done. A ``TaskProgress`` tracks the phase of every
+machine in the task, plus how many bytes have been moved (and an ETA) for the
+phases that move bytes. It's published as the custom Celery state ``PROGRESS``,
+so ``handle_task`` in the API can show it to clients.
+
+Phase changes are published right away; byte counts are sampled and published
+every ``PUBLISH_INTERVAL`` seconds while something is moving bytes.
+"""
+import time
+import threading
+
+STATE = 'PROGRESS'
+PUBLISH_INTERVAL = 5
+
+# Deployments
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+CLONING = 'cloning'
+POWERING_ON = 'powering on'
+WAITING_FOR_IP = 'waiting for ip'
+READY = 'ready'
+PORTMAPS = 'portmaps'
+# Templates
+EXPORTING = 'exporting'
+STORING = 'storing'
+# Both
+DONE = 'done'
+
+# How soon clients should ask again, in seconds
+MIN_POLL = 2
+MAX_POLL = 30
+DEFAULT_POLL = 5
+
+
+class TaskProgress(object):
+    """Tracks, and publishes, the progress of every machine in a Celery task.
+
+    Safe to use from many threads. Use in a ``with`` statement, so byte counts
+    are published periodically.
+
+    :param task: The (bound) Celery task to publish progress for. Nothing is published when None.
+    :type task: celery.Task
+
+    :param interval: How often to publish byte counts, in seconds.
+    :type interval: Integer
+    """
+    def __init__(self, task=None, interval=PUBLISH_INTERVAL):
+        # ``task.request`` is thread local; grab the id while we're on the task's thread
+        self._task = task
+        self._task_id = task.request.id if task is not None else None
+        self._interval = interval
+        self._started = time.time()
+        self._machines = {}
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        self._finished.set()
+        self._thread.join()
+
+    def machine(self, name):
+        """Obtain the tracker for one machine of the task
+
+        :Returns: MachineProgress
+
+        :param name: The name of the machine.
+        :type name: String
+        """
+        return MachineProgress(self, name)
+
+    def set_phase(self, name, phase, total=0, meter=None):
+        """Record that a machine moved on to a new phase, and publish it.
+
+        :Returns: None
+
+        :param name: The name of the machine.
+        :type name: String
+
+        :param phase: What the machine is doing now; i.e. ``UPLOADING``
+        :type phase: String
+
+        :param total: How many bytes the phase moves, if it moves bytes.
+        :type total: Integer
+
+        :param meter: Returns how many bytes have been moved so far.
+        :type meter: Callable
+        """
+        with self._lock:
+            previous = self._machines.get(name, None)
+            nbytes = 0
+            if previous is not None and meter is None and not total:
+                # i.e. "powering on" after "uploading"; the bytes uploaded still count
+                if previous['meter'] is not None:
+                    previous['bytes'] = previous['meter']()
+                nbytes, total = previous['bytes'], previous['total']
+            self._machines[name] = {'phase': phase,
+                                    'started': time.time(),
+                                    'total': total,
+                                    'meter': meter,
+                                    'bytes': nbytes}
+        self.publish()
+
+    def snapshot(self):
+        """Where the task is at right now
+
+        :Returns: Dictionary
+        """
+        now = time.time()
+        machines = {}
+        with self._lock:
+            for name, state in self._machines.items():
+                if state['meter'] is not None:
+                    state['bytes'] = state['meter']()
+                machines[name] = {'phase': state['phase'],
+                                  'bytes': state['bytes'],
+                                  'total': state['total'],
+                                  'eta': _eta(state, now)}
+        etas = [x['eta'] for x in machines.values() if x['eta'] is not None]
+        return {'machines': machines,
+                'bytes': sum(x['bytes'] for x in machines.values()),
+                'total': sum(x['total'] for x in machines.values()),
+                # Machines move their bytes at the same time
+                'eta': max(etas) if etas else None,
+                'elapsed': int(now - self._started)}
+
+    def publish(self):
+        """Send the current progress to the result backend
+
+        :Returns: None
+        """
+        if self._task_id is None:
+            return
+        self._task.update_state(task_id=self._task_id, state=STATE, meta=self.snapshot())
+
+    def _run(self):
+        while not self._finished.wait(self._interval):
+            with self._lock:
+                moving = any(x['meter'] is not None for x in self._machines.values())
+            if moving:
+                self.publish()
+
+
+class MachineProgress(object):
+    """The progress of one machine in a task; see ``TaskProgress.machine``
+
+    :param task_progress: The progress of the whole task.
+    :type task_progress: TaskProgress
+
+    :param name: The name of the machine.
+    :type name: String
+    """
+    def __init__(self, task_progress, name):
+        self._task_progress = task_progress
+        self.name = name
+
+    def phase(self, phase, total=0, meter=None):
+        """Record that the machine moved on to a new phase.
+
+        :Returns: None
+
+        :param phase: What the machine is doing now; i.e. ``UPLOADING``
+        :type phase: String
+
+        :param total: How many bytes the phase moves, if it moves bytes.
+        :type total: Integer
+
+        :param meter: Returns how many bytes have been moved so far.
+        :type meter: Callable
+        """
+        self._task_progress.set_phase(self.name, phase, total=total, meter=meter)
+
+
+def machine(progress, name):
+    """Obtain the tracker for one machine, even when there's no progress to track.
+
+    :Returns: MachineProgress
+
+    :param progress: The progress of a task, or None.
+    :type progress: TaskProgress
+
+    :param name: The name of the machine.
+    :type name: String
+    """
+    if progress is None:
+        progress = TaskProgress()
+    return progress.machine(name)
+
+
+def poll_after(info):
+    """How many seconds a client should wait before asking about a task again.
+
+    :Returns: Integer
+
+    :param info: The published progress of a task; see ``TaskProgress.snapshot``
+    :type info: Dictionary
+    """
+    eta = info.get('eta', None) if isinstance(info, dict) else None
+    if eta is None:
+        return DEFAULT_POLL
+    # A handful of polls over the remaining time is plenty
+    return int(max(MIN_POLL, min(MAX_POLL, eta / 10)))
+
+
+def _eta(state, now):
+    """Seconds until a phase has moved all of its bytes, based on the rate so far
+
+    :Returns: Integer or None
+    """
+    if not (state['meter'] is not None and state['total'] and state['bytes']):
+        return None
+    rate = state['bytes'] / max(now - state['started'], 0.001)
+    return int(max(0, state['total'] - state['bytes']) / rate)
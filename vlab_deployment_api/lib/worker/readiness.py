@@ -0,0 +1,183 @@
+# -*- coding: UTF-8 -*-
+"""
+Wait for many newly deployed VMs to be ready (i.e. have an IP), all at once.
+
+``virtual_machine.get_info(..., ensure_ip=True)`` polls a single VM once a
+second, holding a thread and a vCenter session the whole time. Instead, every
+new VM of a deployment is registered with one ``ReadinessWatcher``, which
+blocks in ``WaitForUpdatesEx`` until vCenter reports a change to any of them.
+
+What "ready" means depends on the kind of VM; see ``strategy_for``. Add your
+own via ``register``.
+"""
+import time
+
+from pyVmomi import vim, vmodl
+
+from vlab_deployment_api.lib.worker.watch import MAX_WAIT_SECONDS
+
+
+class NoWait(object):
+    """The VM is ready once it's powered on; i.e. OneFS nodes have no IP until configured"""
+    properties = []
+
+    def ready(self, props):
+        """Decide if a VM is ready
+
+        :Returns: Boolean
+
+        :param props: The current value of every property in ``properties``
+        :type props: Dictionary
+        """
+        return True
+
+
+class AnyIp(object):
+    """The VM is ready once VMware Tools reports an IP for any of its NICs"""
+    properties = ['guest.net']
+
+    def ready(self, props):
+        """Decide if a VM is ready
+
+        :Returns: Boolean
+
+        :param props: The current value of every property in ``properties``
+        :type props: Dictionary
+        """
+        return any(nic.ipAddress for nic in props.get('guest.net', None) or [])
+
+
+DEFAULT_STRATEGY = AnyIp()
+STRATEGIES = {'onefs': NoWait()}
+
+
+def register(kind, strategy):
+    """Define what "ready" means for a kind of VM.
+
+    :Returns: None
+
+    :param kind: The type of VM (i.e. OneFS, CentOS, etc); not case sensitive.
+    :type kind: String
+
+    :param strategy: An object with a ``properties`` list, and a ``ready(props)`` method.
+    :type strategy: Object
+    """
+    STRATEGIES[kind.lower()] = strategy
+
+
+def strategy_for(kind):
+    """Find what "ready" means for a kind of VM.
+
+    :Returns: Object
+
+    :param kind: The type of VM (i.e. OneFS, CentOS, etc)
+    :type kind: String
+    """
+    return STRATEGIES.get(kind.lower(), DEFAULT_STRATEGY)
+
+
+class ReadinessWatcher(object):
+    """Blocks until every watched VM is ready. Use as a context manager, so
+    the PropertyCollector is destroyed when you're done.
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    def __init__(self, vcenter):
+        self._collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+        self._watched = {}
+        self._version = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        self.close()
+
+    def watch(self, the_vm, strategy, callback=None):
+        """Wait on a VM, until ``strategy`` says it's ready.
+
+        :Returns: None
+
+        :param the_vm: The new VM.
+        :type the_vm: vim.VirtualMachine
+
+        :param strategy: What "ready" means for the VM; see ``strategy_for``.
+        :type strategy: Object
+
+        :param callback: Optionally, called (with no arguments) once the VM is ready.
+        :type callback: Callable
+        """
+        if not strategy.properties:
+            # Nothing to wait for, so don't bother vCenter
+            if callback is not None:
+                callback()
+            return
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=the_vm, skip=False)
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=strategy.properties)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        the_filter = self._collector.CreateFilter(filter_spec, partialUpdates=True)
+        self._watched[the_vm._moId] = {'strategy': strategy, 'props': {}, 'filter': the_filter, 'callback': callback}
+
+    @property
+    def pending(self):
+        """How many VMs are not ready yet"""
+        return len(self._watched)
+
+    def wait(self, timeout=600):
+        """Block until every watched VM is ready.
+
+        :Returns: None
+
+        :Raises: RuntimeError if a VM isn't ready in time, or is deleted
+
+        :param timeout: How many seconds to wait for all VMs to be ready
+        :type timeout: Integer
+        """
+        deadline = time.time() + timeout
+        while self._watched:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                msg = 'Unable to obtain an IP within {} seconds for VMs {}'.format(timeout, sorted(self._watched.keys()))
+                raise RuntimeError(msg)
+            max_wait = max(1, min(int(remaining), MAX_WAIT_SECONDS))
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait)
+            update = self._collector.WaitForUpdatesEx(self._version, options)
+            if update is None:
+                continue
+            self._version = update.version
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    self._handle(obj_update)
+
+    def close(self):
+        """Stop watching; destroys the PropertyCollector (and all its filters)
+
+        :Returns: None
+        """
+        self._watched = {}
+        try:
+            self._collector.DestroyPropertyCollector()
+        except vmodl.MethodFault:
+            # the session is already gone, and so is the collector
+            pass
+
+    def _handle(self, obj_update):
+        """Record the changes to a VM, and stop watching it once it's ready"""
+        moid = obj_update.obj._moId
+        watched = self._watched.get(moid)
+        if watched is None:
+            return
+        if obj_update.kind == 'leave':
+            raise RuntimeError('VM {} was deleted before it was ready'.format(moid))
+        for change in obj_update.changeSet:
+            watched['props'][change.name] = change.val
+        if watched['strategy'].ready(watched['props']):
+            self._watched.pop(moid)
+            # The VM won't change in any way we care about; save vCenter the work
+            try:
+                watched['filter'].DestroyPropertyFilter()
+            except vmodl.MethodFault:
+                pass
+            if watched['callback'] is not None:
+                watched['callback']()
@@ -0,0 +1,220 @@
+# -*- coding: UTF-8 -*-
+"""
+Deploy from copies of a template's VMs that already live in vCenter.
+
+Deploying from an OVA uploads every disk, of every VM, from the template
+directory for each deployment. When ``const.VLAB_DEPLOY_MODE`` is ``clone`` or
+``linked_clone``, the VMs of a template are deployed (powered off) into the
+``const.VLAB_STAGING_FOLDER`` folder once, and deployments become a clone that
+vCenter does on the datastore. The folder is created the first time a template
+is staged.
+
+Staged VMs are found via their notes (meta data), which record the template and
+machine they were staged for.
+"""
+import uuid
+import time
+
+from pyVmomi import vim
+from vlab_inf_common.vmware import consume_task
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker import inventory
+
+CLONE_MODES = ('clone', 'linked_clone')
+SNAPSHOT_NAME = 'vlab-staged'
+
+
+def staged_name(machine_name):
+    """Make a unique VM name for a staged copy of a template's machine.
+
+    :Returns: String
+
+    :param machine_name: The name of the machine in the deployment template.
+    :type machine_name: String
+    """
+    return '{}-{}'.format(machine_name, uuid.uuid4().hex[:8])
+
+
+def stage_meta(template, machine_name, kind):
+    """The notes to set on a staged VM.
+
+    :Returns: Dictionary
+
+    :param template: The name of the deployment template.
+    :type template: String
+
+    :param machine_name: The name of the machine in the deployment template.
+    :type machine_name: String
+
+    :param kind: The type of VM (i.e. OneFS, CentOS, etc).
+    :type kind: String
+    """
+    return {'component': kind,
+            'created': time.time(),
+            'version': 'n/a',
+            'generation': 1,
+            'configured': False,
+            'staged_for': template,
+            'machine': machine_name}
+
+
+def make_folder(vcenter):
+    """Create the staging folder, unless it already exists.
+
+    :Returns: None
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    try:
+        vcenter.get_by_name(name=const.VLAB_STAGING_FOLDER, vimtype=vim.Folder)
+    except ValueError:
+        try:
+            vcenter.create_vm_folder('{}/{}'.format(const.INF_VCENTER_TOP_LVL_DIR, const.VLAB_STAGING_FOLDER))
+        except vim.fault.DuplicateName:
+            # i.e. another worker is staging a template too
+            pass
+
+
+def get_staged(vcenter, template):
+    """Find the staged VMs of a deployment template.
+
+    :Returns: Dictionary - machine name -> inventory record (see ``inventory.get_vms``)
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param template: The name of the deployment template.
+    :type template: String
+    """
+    try:
+        folder = vcenter.get_by_name(name=const.VLAB_STAGING_FOLDER, vimtype=vim.Folder)
+    except ValueError:
+        # Nothing has been staged yet; the folder is made by ``make_folder``
+        return {}
+    staged = {}
+    for record in inventory.get_vms(vcenter, folder):
+        if record['meta'].get('staged_for') == template:
+            staged[record['meta']['machine']] = record
+    return staged
+
+
+def snapshot(the_vm):
+    """Take the snapshot that linked clones are made from.
+
+    :Returns: None
+
+    :param the_vm: The staged VM.
+    :type the_vm: vim.VirtualMachine
+    """
+    task = the_vm.CreateSnapshot_Task(name=SNAPSHOT_NAME,
+                                      description='Linked clones of deployments are made from this snapshot.',
+                                      memory=False,
+                                      quiesce=False)
+    consume_task(task)
+
+
+def clone(vcenter, record, folder, machine_name, username, linked):
+    """Make a new (powered on) VM from a staged VM, connected to the user's networks.
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: RuntimeError if the clone fails
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param record: The staged VM, as returned by ``get_staged``.
+    :type record: Dictionary
+
+    :param folder: Where to put the new VM.
+    :type folder: vim.Folder
+
+    :param machine_name: The name to give the new VM.
+    :type machine_name: String
+
+    :param username: The user the new VM is for.
+    :type username: String
+
+    :param linked: Set to True to make a linked clone, instead of copying the disks.
+    :type linked: Boolean
+    """
+    staged_vm = record['vm']
+    relocate_spec = vim.vm.RelocateSpec()
+    relocate_spec.deviceChange = _nic_changes(vcenter, staged_vm, username)
+    spec = vim.vm.CloneSpec(location=relocate_spec, powerOn=True, template=False)
+    if linked:
+        relocate_spec.diskMoveType = 'createNewChildDiskBacking'
+        spec.snapshot = staged_vm.snapshot.currentSnapshot
+    task = staged_vm.CloneVM_Task(folder=folder, name=machine_name, spec=spec)
+    return consume_task(task)
+
+
+def _nic_changes(vcenter, staged_vm, username):
+    """Connect every NIC of the clone to the user's networks. Staged VMs are on
+    the template owner's networks; NICs on a backend network go to the user's
+    backend network, everything else goes to their frontend network.
+
+    :Returns: List
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param staged_vm: The VM being cloned.
+    :type staged_vm: vim.VirtualMachine
+
+    :param username: The user the new VM is for.
+    :type username: String
+    """
+    networks = vcenter.networks
+    try:
+        frontend = networks['{}_frontend'.format(username)]
+        backend = networks['{}_backend'.format(username)]
+    except KeyError as doh:
+        raise ValueError('No network named {}'.format(doh))
+    changes = []
+    for device in staged_vm.config.hardware.device:
+        if not isinstance(device, vim.vm.device.VirtualEthernetCard):
+            continue
+        if _nic_network_name(device, networks).endswith('backend'):
+            device.backing = _backing(backend)
+        else:
+            device.backing = _backing(frontend)
+        changes.append(vim.vm.device.VirtualDeviceSpec(operation='edit', device=device))
+    return changes
+
+
+def _nic_network_name(nic, networks):
+    """Find the name of the network a NIC is connected to.
+
+    :Returns: String
+
+    :param nic: The NIC of a VM.
+    :type nic: vim.vm.device.VirtualEthernetCard
+
+    :param networks: The networks of vCenter; name -> object.
+    :type networks: Dictionary
+    """
+    backing = nic.backing
+    if isinstance(backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo):
+        for name, network in networks.items():
+            if isinstance(network, vim.dvs.DistributedVirtualPortgroup) and network.key == backing.port.portgroupKey:
+                return name
+        return ''
+    return backing.deviceName
+
+
+def _backing(network):
+    """Make the NIC backing for a network.
+
+    :Returns: vim.vm.device.VirtualDevice.BackingInfo
+
+    :param network: The network to connect a NIC to.
+    :type network: vim.Network
+    """
+    if isinstance(network, vim.dvs.DistributedVirtualPortgroup):
+        port = vim.dvs.PortConnection(portgroupKey=network.key,
+                                      switchUuid=network.config.distributedVirtualSwitch.uuid)
+        return vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo(port=port)
+    return vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName=network.name, network=network)
@@ -3,17 +3,27 @@
 Entry point logic for available backend worker tasks
 """
 from celery import Celery
+from celery.signals import worker_process_init
 from requests.exceptions import RequestException
 from vlab_api_common import get_task_logger
 
 from vlab_deployment_api.lib import const
 from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import trash
+from vlab_deployment_api.lib.worker import catalog
 from vlab_deployment_api.lib.worker import templates
-from vlab_deployment_api.lib.utils import create_port_maps, delete_port_maps
+from vlab_deployment_api.lib.worker.progress import TaskProgress
+from vlab_deployment_api.lib.utils import PortMapper, delete_port_maps
 
 app = Celery('deployment', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
 
 
+@worker_process_init.connect
+def start_reclaimer(**kwargs):
+    """Delete templates left in the trash, even if no template is deleted for a while"""
+    trash.RECLAIMER.start()
+
+
 @app.task(name='deployment.show', bind=True)
 def show(self, username, txn_id):
     """Obtain basic information about the deployment in a user's lab.
@@ -64,19 +74,44 @@ def create(self, username, user_token, template, client_ip, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DEPLOYMENT_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+    task_progress = TaskProgress(self)
     try:
-        resp['content'] = vmware.create_deployment(username, template, logger)
-        create_port_maps(username, template, user_token, client_ip, logger)
+        with task_progress:
+            # The rules of each VM are made as soon as it's deployed
+            with PortMapper(username, template, user_token, client_ip, logger, task_progress) as portmaps:
+                resp['content'] = vmware.create_deployment(username, template, logger, task_progress,
+                                                           on_deployed=portmaps.add)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+        resp['content'] = _stopped_at(task_progress)
     except RequestException as doh:
         logger.error("Not all portmap rules created. Error: %s", doh)
         resp['error'] = 'Not all portmap rules created. Error: {}'.format(doh)
+        for machine, errors in getattr(doh, 'failed', {}).items():
+            if machine in resp['content']:
+                resp['content'][machine]['portmap_errors'] = errors
+    except Exception as doh:
+        # i.e. a VM never became ready, or vCenter raised a fault
+        logger.exception('Task failed: %s', doh)
+        resp['error'] = 'Unable to deploy {}. Error: {}'.format(template, doh)
+        resp['content'] = _stopped_at(task_progress)
     logger.info('Task complete')
     return resp
 
 
+def _stopped_at(task_progress):
+    """The phase every machine of a failed deploy got to.
+
+    :Returns: Dictionary
+
+    :param task_progress: The progress of the failed deploy.
+    :type task_progress: vlab_deployment_api.lib.worker.progress.TaskProgress
+    """
+    machines = task_progress.snapshot()['machines']
+    return {name: {'phase': info['phase']} for name, info in machines.items()}
+
+
 @app.task(name='deployment.delete', bind=True)
 def delete(self, username, user_token, template, client_ip, txn_id):
     """Destroy a deployment.
@@ -116,7 +151,7 @@ def delete(self, username, user_token, template, client_ip, txn_id):
 
 
 @app.task(name='deployment.images', bind=True)
-def images(self, verbose, txn_id):
+def images(self, verbose, txn_id, **query):
     """Obtain a list of available deployments that can be created/deployed.
 
     :Returns: Dictionary
@@ -126,12 +161,23 @@ def images(self, verbose, txn_id):
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param query: Filters, projection and paging; see ``catalog.list_images``
+    :type query: Dictionary
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DEPLOYMENT_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
-    resp['content'] = {'image': vmware.list_images(verbose=verbose)}
-    logger.info('Task complete')
+    try:
+        found = catalog.list_images(verbose=verbose, **query)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        resp['content'] = {'image': found}
+        if query.get('limit', None):
+            resp['content']['next'] = catalog.next_cursor(found, query['limit'])
+        logger.info('Task complete')
     return resp
 
 
@@ -185,7 +231,8 @@ def create_template(self, username, template, machines, portmaps, summary, txn_i
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        templates.create(username, template, machines, portmaps, summary, logger)
+        with TaskProgress(self) as task_progress:
+            templates.create(username, template, machines, portmaps, summary, logger, task_progress)
     except ValueError as doh:
         logger.error("Task failed")
         resp['error'] = '{}'.format(doh)
@@ -213,7 +260,7 @@ def delete_template(self, username, template, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        templates.delete(username, template)
+        templates.delete(username, template, logger)
     except ValueError as doh:
         logger.error("Task failed")
         resp['error'] = '{}'.format(doh)
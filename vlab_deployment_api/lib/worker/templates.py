@@ -2,13 +2,22 @@
 """A module for interacting with deployment templates"""
 import os
 import glob
-import shutil
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from pyVmomi import vmodl
+
 from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker import trash
 from vlab_deployment_api.lib.worker import vmware
+from vlab_deployment_api.lib.worker import export
+from vlab_deployment_api.lib.worker import progress
+from vlab_deployment_api.lib.worker import staging
+from vlab_deployment_api.lib.worker import integrity
+from vlab_deployment_api.lib.worker import admission
+from vlab_deployment_api.lib.worker import chunk_store
+from vlab_deployment_api.lib.worker.catalog import CATALOG
 from vlab_deployment_api.lib.utils import lookup_email_addr
-from vlab_deployment_api.lib.template_meta_data import get_meta, set_meta, update_meta, map_machine
+from vlab_deployment_api.lib.template_meta_data import get_meta, set_meta, update_meta, map_machine, publish_meta, delete_meta
 
 
 def show(username, logger):
@@ -22,15 +31,11 @@ def show(username, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    templates = {}
-    for template in os.listdir(const.VLAB_DEPLOYMENT_TEMPLATE_DIR):
-        meta = get_meta(template)
-        if meta['owner'] == username:
-            templates[template] = meta
-    return templates
+    # The catalog skips hidden directories; templates being created, and the chunk store
+    return CATALOG.owned_by(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, username)
 
 
-def create(username, template, machines, portmaps, summary, logger):
+def create(username, template, machines, portmaps, summary, logger, task_progress=None):
     """Make a new deployment template.
 
     :Returns: None
@@ -54,6 +59,9 @@ def create(username, template, machines, portmaps, summary, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param task_progress: Optionally, where to report the progress of every VM.
+    :type task_progress: vlab_deployment_api.lib.worker.progress.TaskProgress
     """
     hidden_template_dir = os.path.join(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, '.{}'.format(template))
     try:
@@ -64,34 +72,60 @@ def create(username, template, machines, portmaps, summary, logger):
     futures = set()
     failures = []
     vm_kind_map = {}
-    with ThreadPoolExecutor(max_workers=const.VLAB_DEPLOY_CONCURRENT_VMS) as executor:
+    manifests = {}
+    digests = {}
+    # One budget for every export, so a big template can't saturate the link
+    bandwidth = export.Bandwidth(const.VLAB_EXPORT_BANDWIDTH)
+    with ThreadPoolExecutor(max_workers=admission.task_workers()) as executor:
         for machine_name in machines:
-            future = executor.submit(vmware._make_ova, username, machine_name, hidden_template_dir, logger)
+            tracker = progress.machine(task_progress, machine_name)
+            tracker.phase(progress.QUEUED)
+            future = executor.submit(_save_machine, username, machine_name, hidden_template_dir, logger, bandwidth, tracker)
             futures.add(future)
         for future in as_completed(futures):
             try:
                 new_ova, kind, error = future.result()
+                # Computed while the disks streamed in; only the .mf is read here
+                files = integrity.ova_digests(new_ova) if new_ova else {}
             except Exception as doh:
                 logger.exception(doh)
                 failures.append(str(doh))
             else:
-                name = os.path.splitext(os.path.basename(new_ova))[0]
+                name, ext = os.path.splitext(os.path.basename(new_ova))
                 vm_kind_map[name] = kind
+                if ext == chunk_store.MANIFEST_SUFFIX:
+                    manifests[name] = os.path.basename(new_ova)
+                if files:
+                    digests[name] = files
     if failures:
-        shutil.rmtree(hidden_template_dir)
+        _release_chunks(hidden_template_dir)
+        trash.discard(hidden_template_dir)
         error_message = 'Failed to create template. Error(s): {}'.format(' '.join(failures))
         raise ValueError(error_message)
     else:
         machine_meta = create_machine_meta(template, portmaps, vm_kind_map)
+        for name, manifest in manifests.items():
+            machine_meta[name]['manifest'] = manifest
+        for name, files in digests.items():
+            machine_meta[name]['files'] = files
         email = lookup_email_addr(username)
         set_meta(template, username, email, summary, machine_meta)
         template_dir = os.path.join(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, template)
         # Hidden directories is how we avoid someone trying to deploy a template
         # while it's still being created.
         os.rename(hidden_template_dir, template_dir)
+        publish_meta(template)
+        CATALOG.invalidate(template)
+        if const.VLAB_DEPLOY_MODE in staging.CLONE_MODES:
+            try:
+                vmware.stage_template(template, username, logger)
+            except (ValueError, RuntimeError, vmodl.MethodFault) as doh:
+                # The template is already published; deployments of it just
+                # fall back to uploading the OVAs
+                logger.error('Unable to stage template %s: %s', template, doh)
 
 
-def delete(username, template):
+def delete(username, template, logger):
     """Destroy a deployment template. Raises a ValueError if the user does not own
     the template.
 
@@ -104,18 +138,74 @@ def delete(username, template):
 
     :param template: The name of the deployment template to destroy.
     :type template: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
     """
-    error = ''
-    for a_template in os.listdir(const.VLAB_DEPLOYMENT_TEMPLATE_DIR):
-        if template == a_template:
-            meta = get_meta(template)
-            if meta['owner'] == username:
-                template_path = os.path.join(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, template)
-                shutil.rmtree(template_path)
-            else:
-                error = 'Unable to delete templates you do not own. {} is owned by {}'.format(template, meta['owner'])
-    if error:
-        raise ValueError(error)
+    template_path = CATALOG.path(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, template)
+    if template_path is None:
+        return
+    # Ownership is checked against what's on disk, not what's cached
+    meta = get_meta(template)
+    if meta['owner'] != username:
+        raise ValueError('Unable to delete templates you do not own. {} is owned by {}'.format(template, meta['owner']))
+    _release_chunks(template_path)
+    # The OVAs are deleted in the background; see ``trash``
+    trash.discard(template_path)
+    delete_meta(template)
+    CATALOG.invalidate(template)
+    if const.VLAB_DEPLOY_MODE in staging.CLONE_MODES:
+        vmware.unstage_template(template, logger)
+
+
+def _save_machine(username, machine_name, template_dir, logger, bandwidth, tracker=None):
+    """Export a VM into the template. When ``const.VLAB_TEMPLATE_STORAGE`` is
+    ``chunks``, the OVA is moved into the chunk store, and the location of its
+    manifest is returned instead.
+
+    :Returns: Tuple - (location of the OVA/manifest, kind of VM, error)
+
+    :param username: The user creating the deployment template.
+    :type username: String
+
+    :param machine_name: The name of the VM to export.
+    :type machine_name: String
+
+    :param template_dir: The (hidden) directory of the new deployment template.
+    :type template_dir: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param bandwidth: Limits the download speed of the export.
+    :type bandwidth: vlab_deployment_api.lib.worker.export.Bandwidth
+
+    :param tracker: Optionally, where to report the progress of the export.
+    :type tracker: vlab_deployment_api.lib.worker.progress.MachineProgress
+    """
+    if tracker is None:
+        tracker = progress.machine(None, machine_name)
+    new_ova, kind, error = vmware._make_ova(username, machine_name, template_dir, logger, bandwidth, tracker)
+    # A reused OVA can already be a manifest
+    if new_ova and const.VLAB_TEMPLATE_STORAGE == 'chunks' and not new_ova.endswith(chunk_store.MANIFEST_SUFFIX):
+        tracker.phase(progress.STORING)
+        manifest = '{}{}'.format(os.path.splitext(new_ova)[0], chunk_store.MANIFEST_SUFFIX)
+        chunk_store.STORE.put(new_ova, manifest)
+        new_ova = manifest
+    tracker.phase(progress.DONE)
+    return new_ova, kind, error
+
+
+def _release_chunks(template_dir):
+    """Drop the chunk store references of every OVA in a deployment template.
+
+    :Returns: None
+
+    :param template_dir: The directory of the deployment template.
+    :type template_dir: String
+    """
+    for manifest in glob.glob(os.path.join(template_dir, '*{}'.format(chunk_store.MANIFEST_SUFFIX))):
+        chunk_store.STORE.release(manifest)
 
 
 def modify(username, template, summary, owner, email=None):
@@ -145,6 +235,8 @@ def modify(username, template, summary, owner, email=None):
                 owner=owner,
                 email=email,
                 summary=summary)
+    # Only meta.json changes, which the catalog otherwise takes a while to notice
+    CATALOG.invalidate(template)
 
 
 def check_for_template(template):
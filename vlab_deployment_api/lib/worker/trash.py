@@ -0,0 +1,184 @@
+# -*- coding: UTF-8 -*-
+"""
+Deletes deployment templates in the background, without hogging the disk.
+
+A template can hold many GB of OVAs, and ``shutil.rmtree`` on NFS used to
+block a task for minutes while spiking I/O for everyone deploying. Instead,
+``discard`` renames the directory into a ``.trash`` directory next to it (one
+atomic rename, on the same file system), and the ``Reclaimer`` removes it later.
+
+The reclaimer only ever unlinks files (a deploy may still be reading an OVA it
+opened before the template was deleted), and paces the unlinks by file size so
+no more than ``const.VLAB_RECLAIM_BANDWIDTH`` bytes per second are freed. Files
+with other hard links don't count against the rate; their bytes are still in use. Since the
+trash lives on disk, whatever a worker didn't finish is picked up after a restart.
+Workers share the trash; an ``fcntl`` lock picks the one that reclaims it.
+
+Run ``python -m vlab_deployment_api.lib.worker.trash status`` to see how many
+bytes are waiting to be reclaimed.
+"""
+import os
+import sys
+import time
+import fcntl
+import shutil
+import threading
+
+from vlab_api_common import get_logger
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker.export import Bandwidth
+
+logger = get_logger(__name__, loglevel=const.VLAB_DEPLOYMENT_LOG_LEVEL)
+
+TRASH_NAME = '.trash'
+LOCK_NAME = '.lock'
+# How often to look for new trash, in seconds
+INTERVAL = 30
+
+
+def discard(path):
+    """Move a directory into the trash, to be deleted in the background.
+
+    :Returns: String - where the directory went
+
+    :param path: The directory to delete.
+    :type path: String
+    """
+    path = path.rstrip(os.sep)
+    trash_dir = os.path.join(os.path.dirname(path), TRASH_NAME)
+    os.makedirs(trash_dir, exist_ok=True)
+    # The same template can be made, and deleted, many times
+    name = '{}.{}'.format(os.path.basename(path).lstrip('.'), '{:.0f}'.format(time.time() * 1e6))
+    new_path = os.path.join(trash_dir, name)
+    try:
+        os.rename(path, new_path)
+    except OSError as doh:
+        # i.e. the trash is on a different file system; delete it the slow way
+        logger.error('Unable to move %s into the trash: %s', path, doh)
+        shutil.rmtree(path)
+        return path
+    RECLAIMER.start()
+    return new_path
+
+
+def reclaimable(trash_dir):
+    """How many bytes deleting everything in the trash would free.
+
+    :Returns: Integer
+
+    :param trash_dir: The trash directory.
+    :type trash_dir: String
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(trash_dir):
+        for filename in filenames:
+            try:
+                info = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if info.st_nlink == 1:
+                total += info.st_size
+    return total
+
+
+class Reclaimer(object):
+    """Slowly deletes what's in the trash, in a background thread.
+
+    :param trash_dir: The trash directory.
+    :type trash_dir: String
+
+    :param rate: How many bytes per second may be freed. Zero means no limit.
+    :type rate: Integer
+
+    :param interval: How often to look for new trash, in seconds.
+    :type interval: Integer
+    """
+    def __init__(self, trash_dir, rate, interval=INTERVAL):
+        self.trash_dir = trash_dir
+        self.interval = interval
+        self.stats = {'reclaimed': 0, 'unlinked': 0, 'entries': 0}
+        self._bandwidth = Bandwidth(rate)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start reclaiming in the background, or reclaim new trash soon if already started.
+
+        :Returns: None
+        """
+        with self._lock:
+            # Threads do not survive a fork; start one in the process that needs it
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def reclaim(self):
+        """Delete everything in the trash, unless another worker already is.
+
+        :Returns: Boolean - True if this worker emptied the trash
+        """
+        if not os.path.isdir(self.trash_dir):
+            return True
+        lock_file = os.open(os.path.join(self.trash_dir, LOCK_NAME), os.O_CREAT | os.O_RDWR)
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            for entry in sorted(os.listdir(self.trash_dir)):
+                if entry == LOCK_NAME:
+                    continue
+                self._delete(os.path.join(self.trash_dir, entry))
+                self.stats['entries'] += 1
+            return True
+        finally:
+            os.close(lock_file)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                pending = reclaimable(self.trash_dir)
+                if pending:
+                    logger.info('Reclaiming %s bytes from %s', pending, self.trash_dir)
+                self.reclaim()
+            except Exception as doh:
+                # i.e. the template directory went away; try again later
+                logger.exception(doh)
+            self._wakeup.wait(self.interval)
+
+    def _delete(self, path):
+        """Remove a file, or a directory and everything in it, under the rate limit"""
+        if os.path.isdir(path) and not os.path.islink(path):
+            for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                for filename in filenames:
+                    self._delete_file(os.path.join(dirpath, filename))
+                for dirname in dirnames:
+                    os.rmdir(os.path.join(dirpath, dirname))
+            os.rmdir(path)
+        else:
+            self._delete_file(path)
+
+    def _delete_file(self, path):
+        """Wait until freeing a file fits within the rate limit, then unlink it"""
+        info = os.lstat(path)
+        # Other links (i.e. the same OVA in another template) still need these bytes
+        if info.st_nlink == 1 and os.path.isfile(path):
+            self._bandwidth.consume(info.st_size)
+            self.stats['reclaimed'] += info.st_size
+        # Never truncate; an open reader keeps the whole file until it closes it
+        os.unlink(path)
+        self.stats['unlinked'] += 1
+
+
+RECLAIMER = Reclaimer(os.path.join(const.VLAB_DEPLOYMENT_TEMPLATE_DIR, TRASH_NAME),
+                      rate=const.VLAB_RECLAIM_BANDWIDTH)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['status']:
+        sys.exit('Usage: python -m {} status'.format(__spec__.name))
+    print('{} bytes waiting to be reclaimed in {}'.format(reclaimable(RECLAIMER.trash_dir), RECLAIMER.trash_dir))
@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+"""
+A worker-wide pool of logged in vCenter sessions.
+
+Logging into (and out of) vCenter is slow, and vCenter limits how many sessions
+can exist at the same time. Instead of every function making its own session,
+borrow one from the pool:
+
+    with borrow() as vcenter:
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+"""
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+from vlab_inf_common.vmware import vim
+from vlab_api_common import get_logger
+
+from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker.morefs import CachedvCenter
+
+logger = get_logger(__name__, loglevel=const.VLAB_DEPLOYMENT_LOG_LEVEL)
+
+# Sessions idle for longer than this many seconds are verified before being
+# handed out again; anything newer was proven good by its last user.
+HEALTH_CHECK_AFTER = 60
+
+
+class SessionPool(object):
+    """Hands out logged in ``vCenter`` objects, and keeps idle ones alive.
+
+    Sessions are created lazily, so that a Celery worker that forks after importing
+    this module doesn't end up sharing a TCP connection between processes.
+
+    :param max_size: The most sessions the pool will ever have logged in at once.
+    :type max_size: Integer
+
+    :param keepalive: How often (in seconds) to ping idle sessions so vCenter doesn't expire them.
+    :type keepalive: Integer
+
+    :param borrow_timeout: How long (in seconds) to wait for a session when all are in use.
+    :type borrow_timeout: Integer
+    """
+    def __init__(self, max_size, keepalive, borrow_timeout=600):
+        self.max_size = max_size
+        self.keepalive = keepalive
+        self.borrow_timeout = borrow_timeout
+        self.stats = {'logins': 0, 'logouts': 0, 'borrows': 0, 'expired': 0}
+        self._idle = [] # LIFO; keeps the hottest sessions busy and lets the rest get reaped
+        self._size = 0
+        self._cond = threading.Condition()
+        self._keeper = None
+        self._closed = False
+
+    @contextmanager
+    def session(self):
+        """Borrow a session for the duration of a ``with`` statement.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        vcenter = self.borrow()
+        healthy = True
+        try:
+            yield vcenter
+        except vim.fault.NotAuthenticated:
+            healthy = False
+            raise
+        finally:
+            self.give_back(vcenter, healthy=healthy)
+
+    def borrow(self):
+        """Obtain a session, logging in a new one only when needed.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+
+        :Raises: RuntimeError
+        """
+        self._start_keeper()
+        deadline = time.time() + self.borrow_timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    vcenter, last_used = self._idle.pop()
+                    break
+                elif self._size < self.max_size:
+                    self._size += 1
+                    vcenter, last_used = None, None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('Timed out waiting for a vCenter session')
+                self._cond.wait(remaining)
+            self.stats['borrows'] += 1
+        if vcenter is not None and time.time() - last_used > HEALTH_CHECK_AFTER:
+            if not _is_alive(vcenter):
+                self.stats['expired'] += 1
+                self._logout(vcenter)
+                vcenter = None
+        if vcenter is None:
+            try:
+                vcenter = self._login()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return vcenter
+
+    def give_back(self, vcenter, healthy=True):
+        """Return a borrowed session to the pool.
+
+        :Returns: None
+
+        :param vcenter: The session that was borrowed.
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param healthy: Set to False to log out the session instead of reusing it.
+        :type healthy: Boolean
+        """
+        # The vCenter object never expires its network cache; a long lived
+        # session would otherwise never see new user networks.
+        vcenter._net_cache = None
+        if not healthy or self._closed:
+            self._logout(vcenter)
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+        else:
+            with self._cond:
+                self._idle.append((vcenter, time.time()))
+                self._cond.notify()
+
+    def close(self):
+        """Log out every idle session, and stop pinging vCenter.
+
+        :Returns: None
+        """
+        self._closed = True
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for vcenter, _ in idle:
+            self._logout(vcenter)
+
+    def _login(self):
+        """Create a new vCenter session"""
+        vcenter = CachedvCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                                password=const.INF_VCENTER_PASSWORD)
+        self.stats['logins'] += 1
+        return vcenter
+
+    def _logout(self, vcenter):
+        """Close a session; an expired session cannot logout, and that's OK"""
+        self.stats['logouts'] += 1
+        try:
+            vcenter.close()
+        except Exception as doh:
+            logger.debug('Ignoring error closing vCenter session: %s', doh)
+
+    def _start_keeper(self):
+        """Lazily start the keepalive thread; threads do not survive a fork"""
+        if self._keeper is None or not self._keeper.is_alive():
+            with self._cond:
+                if self._keeper is None or not self._keeper.is_alive():
+                    self._keeper = threading.Thread(target=self._keep_alive, daemon=True)
+                    self._keeper.start()
+
+    def _keep_alive(self):
+        """Ping idle sessions so vCenter doesn't expire them, and reap the dead ones"""
+        while not self._closed:
+            time.sleep(self.keepalive)
+            now = time.time()
+            with self._cond:
+                stale = [x for x in self._idle if now - x[1] >= self.keepalive]
+                self._idle = [x for x in self._idle if now - x[1] < self.keepalive]
+            for vcenter, last_used in stale:
+                if _is_alive(vcenter):
+                    with self._cond:
+                        self._idle.insert(0, (vcenter, time.time()))
+                        self._cond.notify()
+                else:
+                    self.stats['expired'] += 1
+                    self.give_back(vcenter, healthy=False)
+
+
+def _is_alive(vcenter):
+    """Check if vCenter still considers the session logged in.
+
+    :Returns: Boolean
+
+    :param vcenter: The session to check.
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        return vcenter.content.sessionManager.currentSession is not None
+    except Exception:
+        return False
+
+
+POOL = SessionPool(max_size=const.VLAB_VCENTER_POOL_SIZE, keepalive=const.VLAB_VCENTER_KEEPALIVE)
+atexit.register(POOL.close)
+
+
+def borrow():
+    """Borrow a vCenter session from the worker-wide pool. Use in a ``with`` statement.
+
+    :Returns: contextlib.GeneratorContextManager
+    """
+    return POOL.session()
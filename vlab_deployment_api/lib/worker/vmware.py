@@ -4,13 +4,27 @@ import time
 import glob
 import random
 import os.path
+import functools
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import ujson
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, virtual_machine
 
 from vlab_deployment_api.lib import const
+from vlab_deployment_api.lib.worker import export
+from vlab_deployment_api.lib.worker import progress
+from vlab_deployment_api.lib.worker import staging
+from vlab_deployment_api.lib.worker import lineage
+from vlab_deployment_api.lib.worker import inventory
+from vlab_deployment_api.lib.worker import admission
+from vlab_deployment_api.lib.worker import readiness
+from vlab_deployment_api.lib.worker.watch import TaskWatcher
+from vlab_deployment_api.lib.worker.ova_cache import open_ova
+from vlab_deployment_api.lib.worker.admission import SLOTS
+from vlab_deployment_api.lib.worker.deployment_index import INDEX
+from vlab_deployment_api.lib.worker.vcenter_pool import borrow
 from vlab_deployment_api.lib.template_meta_data import get_meta
 
 VM_NAME_APPEND = '-dply'
@@ -25,14 +39,12 @@ def show_deployment(username):
     :type username: String
     """
     info = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    with borrow() as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
         deployment_vms = {}
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta'].get('deployment', False) == True:
-                deployment_vms[vm.name] = info
+        for record in inventory.get_vms(vcenter, folder):
+            if record['meta'].get('deployment', False) == True:
+                deployment_vms[record['name']] = inventory.get_details(vcenter, record, username)
     return deployment_vms
 
 
@@ -50,27 +62,106 @@ def delete_deployment(username, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    with borrow() as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        tasks = []
-        for entity in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, entity, username)
-            if info['meta'].get('deployment', False) == True:
-                logger.debug('powering off VM %s', entity.name)
-                virtual_machine.power(entity, state='off')
-                delete_task = entity.Destroy_Task()
-                tasks.append(delete_task)
-        if tasks:
-            logger.debug('blocking while VMs are being destroyed')
-            for task in tasks:
-                consume_task(task)
+        records = [x for x in inventory.get_vms(vcenter, folder) if x['meta'].get('deployment', False) == True]
+        if not records:
+            INDEX.record(username, '')
+            raise ValueError('No {} named {} found'.format('deployment', machine_name))
+        try:
+            errors = _teardown(vcenter, records, logger)
+        except Exception:
+            # Some VMs might be gone, others not; only vCenter knows for sure
+            INDEX.invalidate(username)
+            raise
+    if errors:
+        INDEX.invalidate(username)
+        details = ', '.join('{}: {}'.format(x, errors[x]) for x in sorted(errors.keys()))
+        raise ValueError('Unable to destroy {} of {} VMs. {}'.format(len(errors), len(records), details))
+    # So the next create doesn't have to ask vCenter
+    INDEX.record(username, '')
+
+
+def _teardown(vcenter, records, logger, timeout=600):
+    """Power off and destroy many VMs at once.
+
+    Every power off is issued up front (VMs that are already off skip straight
+    to being destroyed), and each VM is destroyed as soon as *its* power off
+    finishes. One VM failing does not stop the others from being destroyed.
+
+    :Returns: Dictionary - The name of every VM not destroyed, mapped to the reason why
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
 
+    :param records: The VMs to destroy, as returned by ``inventory.get_vms``
+    :type records: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param timeout: How many seconds to wait for all the VMs to be destroyed
+    :type timeout: Integer
+    """
+    errors = {}
+    pending = set()
+
+    def destroyed(name, task, error):
+        pending.discard(name)
+        if error:
+            errors[name] = _fault_message(error)
+
+    def destroy(name, the_vm):
+        logger.debug('destroying VM %s', name)
+        try:
+            task = the_vm.Destroy_Task()
+        except vmodl.MethodFault as doh:
+            destroyed(name, None, doh)
         else:
-            raise ValueError('No {} named {} found'.format('deployment', machine_name))
+            watcher.watch(task, functools.partial(destroyed, name))
+
+    def powered_off(name, the_vm, task, error):
+        # InvalidPowerState -> the VM was powered off by someone else
+        if error and not isinstance(error, vim.fault.InvalidPowerState):
+            destroyed(name, task, error)
+        else:
+            destroy(name, the_vm)
+
+    with TaskWatcher(vcenter) as watcher:
+        for record in records:
+            name, the_vm = record['name'], record['vm']
+            pending.add(name)
+            if record['state'] == 'poweredOff':
+                destroy(name, the_vm)
+                continue
+            logger.debug('powering off VM %s', name)
+            try:
+                task = the_vm.PowerOffVM_Task()
+            except vmodl.MethodFault as doh:
+                powered_off(name, the_vm, None, doh)
+            else:
+                watcher.watch(task, functools.partial(powered_off, name, the_vm))
+        logger.debug('blocking while VMs are being destroyed')
+        try:
+            watcher.wait(timeout=timeout)
+        except RuntimeError:
+            for name in pending:
+                errors[name] = 'Timed out after {} seconds'.format(timeout)
+    return errors
+
+
+def _fault_message(fault):
+    """Make a human friendly message out of a vSphere fault
+
+    :Returns: String
+
+    :param fault: The error from a vCenter task
+    :type fault: vmodl.MethodFault
+    """
+    return fault.msg if fault.msg else type(fault).__name__
 
 
-def create_deployment(username, template, logger):
+def create_deployment(username, template, logger, task_progress=None, on_deployed=None):
     """Deploy a new instance of Deployment
 
     :Returns: Dictionary
@@ -83,106 +174,355 @@ def create_deployment(username, template, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param task_progress: Optionally, where to report the progress of every VM.
+    :type task_progress: vlab_deployment_api.lib.worker.progress.TaskProgress
+
+    :param on_deployed: Optionally, called with the name of every VM as soon as it's deployed (not yet ready).
+    :type on_deployed: Function
+    """
+    # Held for the whole create, so a create running in another worker process
+    # can't also find "no deployment" (the VMs aren't in vCenter yet) and deploy too.
+    with INDEX.claim(username):
+        current_deployment = _check_for_deployment(username)
+        if current_deployment:
+            error = "Multiple deployments per lab not allowed. Current have deployed: {}".format(current_deployment)
+            raise ValueError(error)
+        return _deploy(username, template, logger, task_progress, on_deployed)
+
+
+def _deploy(username, template, logger, task_progress=None, on_deployed=None):
+    """Create every VM of a template; see ``create_deployment``
+
+    :Returns: Dictionary
     """
-    current_deployment = _check_for_deployment(username)
-    if current_deployment:
-        error = "Multiple deployments per lab not allowed. Current have deployed: {}".format(current_deployment)
-        raise ValueError(error)
     logger.info("Deploying template: %s", template)
     try:
         meta = get_meta(template)
     except FileNotFoundError:
         raise ValueError("No deployment template named {} exists.".format(template))
-    deployments = {}
-    futures = set()
-    with ThreadPoolExecutor(max_workers=const.VLAB_DEPLOY_CONCURRENT_VMS) as executor:
-        for machine_name, details in meta['machines'].items():
-            # Avoids deploy failure due to the user have a VM by the same name
-            # as a VM in a deployment template.
-            deploy_name = '{}{}'.format(machine_name, VM_NAME_APPEND)
-            future = executor.submit(_create_vm, details['ova_path'], deploy_name, template, username, details['kind'], logger)
-            futures.add(future)
-        for future in as_completed(futures):
-            deployments.update(future.result())
+    futures = {}
+    names = {}
+    new_vms = []
+    # Recorded before any VM exists, and kept until the deploy ends, so a
+    # second create on this worker is rejected without asking vCenter
+    INDEX.record(username, template, pending=True)
+    try:
+        with ThreadPoolExecutor(max_workers=admission.task_workers()) as executor:
+            for machine_name, details in meta['machines'].items():
+                # Avoids deploy failure due to the user have a VM by the same name
+                # as a VM in a deployment template.
+                deploy_name = '{}{}'.format(machine_name, VM_NAME_APPEND)
+                tracker = progress.machine(task_progress, deploy_name)
+                tracker.phase(progress.QUEUED)
+                future = executor.submit(_create_vm, details['ova_path'], deploy_name, template, username, details['kind'], logger, tracker,
+                                         details.get('files', None))
+                futures[future] = details['kind']
+                names[future] = deploy_name
+            for future in as_completed(futures):
+                new_vms.append((future.result(), futures[future]))
+                if on_deployed is not None:
+                    # i.e. make its port maps, while the other VMs upload
+                    on_deployed(names[future])
+        deployments = _wait_until_ready(new_vms, username, logger, task_progress)
+    except BaseException:
+        # Some of the VMs might exist; the next create must ask vCenter
+        INDEX.invalidate(username)
+        raise
+    INDEX.record(username, template)
     return deployments
 
 
-def list_images(verbose=False):
-    """Obtain a list of available versions of Deployment that can be created
-
-    :Returns: List
-
-    :param verbose: Include details about each deployment template.
-    :type verbose: Boolean
-    """
-    answer = []
-    images = [x for x in os.listdir(const.VLAB_DEPLOYMENT_TEMPLATE_DIR) if not x.startswith('.')]
-    if verbose:
-        # This exists so the API can return handy info. The deployments service
-        # is unique, in that the templates are created and managed by users.
-        # The other services (like OneFS, InsightIQ, etc) are all managed by the
-        # sysadmin. So returning a simple list of what's available works for those
-        # services. The default of "False" is so we automatically mimic the behavior
-        # of those services when the RESTful API gets called; just give them a
-        # simple list of what's available. As an API client/consumer, I always get
-        # annoyed when two similar API end points return different data structures...
-        for template in images:
-            meta = get_meta(template)
-            detailed_info = {template: meta}
-            answer.append(detailed_info)
-    else:
-        answer = images
-    return answer
-
-
 def _check_for_deployment(username):
     """For many reasons, only 1 deployment per lab is allowed. This function
     checks if a deployment already exists.
 
+    What the deployment index knows (a deployment, or that there's none) is
+    trusted. Otherwise vCenter is asked, and the answer is recorded.
+
     :Returns: String
 
     :param username: The name of the user who wants to create a new Deployment
     :type username: String
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    current_deployment = INDEX.lookup(username)
+    if current_deployment is not None:
+        return current_deployment
+    with borrow() as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
         current_deployment = ''
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta'].get('deployment', False):
-                current_deployment = info['meta']['component']
+        for record in inventory.get_vms(vcenter, folder):
+            if record['meta'].get('deployment', False):
+                current_deployment = record['meta']['component']
                 break
+    INDEX.record(username, current_deployment)
     return current_deployment
 
 
-def _create_vm(ova_file, machine_name, template, username, vm_kind, logger):
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        ova = Ova(ova_file)
+def _create_vm(ova_file, machine_name, template, username, vm_kind, logger, tracker=None, files=None):
+    if tracker is None:
+        tracker = progress.machine(None, machine_name)
+    the_vm = None
+    baseline = {}
+    if const.VLAB_DEPLOY_MODE in staging.CLONE_MODES:
+        tracker.phase(progress.CLONING)
+        with borrow() as vcenter:
+            the_vm = _clone_vm(vcenter, machine_name, template, username, logger)
+    if the_vm is None:
+        # Queue for the slot before borrowing a session; an idle session held
+        # through a long wait could expire.
+        with SLOTS.slot('import', logger) as grant, borrow() as vcenter:
+            # Disks are checked against ``files`` while they upload
+            ova = open_ova(ova_file, files=files)
+            grant.nbytes = _ova_size(ova)
+            meter = _upload_meter(ova)
+            tracker.phase(progress.UPLOADING, total=grant.nbytes, meter=meter)
+            try:
+                net_map = _get_network_mapping(vcenter, ova, vm_kind, username)
+                the_vm = virtual_machine.deploy_from_ova(vcenter=vcenter,
+                                                         ova=ova,
+                                                         network_map=net_map,
+                                                         username=username,
+                                                         machine_name=machine_name,
+                                                         logger=logger,
+                                                         power_on=False)
+            finally:
+                # The meter is read after the upload (i.e. by the next phase),
+                # so it must not read the OVA once it's closed
+                if meter is not None:
+                    meter.stop()
+                ova.close()
+            # So a template made from this VM can reuse the OVA, if the VM doesn't change;
+            # the baseline must be taken before the VM is powered on
+            baseline = lineage.track_changes(the_vm)
+            # Powered on here, instead of by deploy_from_ova, so it's its own phase
+            tracker.phase(progress.POWERING_ON)
+            virtual_machine.power(the_vm, state='on')
+
+    meta_data = {'component' : template,
+                 'created' : time.time(),
+                 'deployment': True,
+                 'version' : 'n/a',
+                 'configured' : True,
+                 'generation' : 1}
+    meta_data['source'] = lineage.source_meta(template, ova_file, baseline)
+    virtual_machine.set_meta(the_vm, meta_data)
+    # Waiting for an IP is done for every VM at once, by ``_wait_until_ready``
+    return the_vm
+
+
+def _wait_until_ready(new_vms, username, logger, task_progress=None):
+    """Block until every new VM of a deployment is ready, then report on them.
+
+    :Returns: Dictionary
+
+    :Raises: RuntimeError if a VM is not ready within ``const.VLAB_DEPLOY_READY_TIMEOUT`` seconds
+
+    :param new_vms: The (VM, kind of VM) of every new VM.
+    :type new_vms: List
+
+    :param username: The name of the user who owns the VMs.
+    :type username: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param task_progress: Optionally, where to report the progress of every VM.
+    :type task_progress: vlab_deployment_api.lib.worker.progress.TaskProgress
+    """
+    deployments = {}
+    with borrow() as vcenter:
+        with readiness.ReadinessWatcher(vcenter) as watcher:
+            for the_vm, kind in new_vms:
+                tracker = progress.machine(task_progress, the_vm.name)
+                tracker.phase(progress.WAITING_FOR_IP)
+                ready = functools.partial(tracker.phase, progress.READY)
+                watcher.watch(the_vm, readiness.strategy_for(kind), callback=ready)
+            logger.info('Waiting on %s VMs to be ready', watcher.pending)
+            watcher.wait(timeout=const.VLAB_DEPLOY_READY_TIMEOUT)
+        for the_vm, _ in new_vms:
+            info = virtual_machine.get_info(vcenter, the_vm, username)
+            deployments[the_vm.name] = info
+    return deployments
+
+
+class _UploadMeter(object):
+    """Reports how many bytes of an OVA have been uploaded.
+
+    Once stopped, the meter keeps reporting the last count, without touching
+    the (soon to be closed) OVA again.
+
+    :param handle: The opened file of the OVA.
+    :type handle: vlab_inf_common.vmware.ova.FileHandle or chunk_store.ChunkedHandle
+    """
+    def __init__(self, handle):
+        self._handle = handle
+        self.nbytes = 0
+
+    def __call__(self):
+        handle = self._handle
+        if handle is not None:
+            try:
+                self.nbytes = handle.tell()
+            except ValueError:
+                # i.e. the progress publisher raced ``stop``, and the OVA is closed
+                pass
+        return self.nbytes
+
+    def stop(self):
+        """Take the final count, and stop reading the OVA.
+
+        :Returns: Integer
+        """
+        nbytes = self()
+        self._handle = None
+        return nbytes
+
+
+def _upload_meter(ova):
+    """Obtain a meter that reports how many bytes of an OVA have been uploaded.
+
+    :Returns: _UploadMeter, or None when the OVA can't tell
+
+    :param ova: The opened OVA.
+    :type ova: vlab_inf_common.vmware.ova.Ova
+    """
+    handle = getattr(ova, '_handle', None)
+    if getattr(handle, 'tell', None) is None:
+        return None
+    return _UploadMeter(handle)
+
+
+def _ova_size(ova):
+    """How many bytes deploying an OVA uploads; zero when unknown.
+
+    :Returns: Integer
+
+    :param ova: The opened OVA.
+    :type ova: vlab_inf_common.vmware.ova.Ova
+    """
+    handle = getattr(ova, '_handle', None)
+    return getattr(handle, 'st_size', 0)
+
+
+def _clone_vm(vcenter, machine_name, template, username, logger):
+    """Make a VM for a deployment by cloning the staged copy of the template's VM.
+
+    :Returns: vim.VirtualMachine, or None if the VM must be deployed from the OVA instead.
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param machine_name: The name to give the new VM.
+    :type machine_name: String
+
+    :param template: The name of template being deployed.
+    :type template: String
+
+    :param username: The name of the user deploying VMs.
+    :type username: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    source_name = machine_name[:-len(VM_NAME_APPEND)] if machine_name.endswith(VM_NAME_APPEND) else machine_name
+    try:
+        record = staging.get_staged(vcenter, template).get(source_name, None)
+        if record is None:
+            logger.info('Template %s has no staged copy of %s, deploying from OVA', template, source_name)
+            return None
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        linked = const.VLAB_DEPLOY_MODE == 'linked_clone'
+        logger.debug('Cloning staged VM %s (linked: %s)', record['name'], linked)
+        return staging.clone(vcenter, record, folder, machine_name, username, linked)
+    except (ValueError, RuntimeError, vmodl.MethodFault) as doh:
+        logger.warning('Unable to clone %s, deploying from OVA: %s', source_name, doh)
+        return None
+
+
+def stage_template(template, owner, logger):
+    """Deploy (powered off) copies of a template's VMs into the staging folder,
+    so deployments can be cloned instead of uploaded. Any copies staged before
+    for a template with the same name are destroyed first.
+
+    :Returns: None
+
+    :Raises: ValueError if not every VM could be staged
+
+    :param template: The name of the deployment template.
+    :type template: String
+
+    :param owner: The user who owns the template; staged VMs use their networks.
+    :type owner: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with borrow() as vcenter:
+        staging.make_folder(vcenter)
+    unstage_template(template, logger)
+    meta = get_meta(template)
+    failures = []
+    futures = set()
+    with ThreadPoolExecutor(max_workers=admission.task_workers()) as executor:
+        for machine_name, details in meta['machines'].items():
+            future = executor.submit(_stage_vm, details['ova_path'], machine_name, template, owner, details['kind'], logger,
+                                     details.get('files', None))
+            futures.add(future)
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as doh:
+                logger.exception(doh)
+                failures.append(str(doh))
+    if failures:
+        # A partly staged template deploys some VMs from OVA; just waste the space
+        unstage_template(template, logger)
+        raise ValueError('Unable to stage template {}. Error(s): {}'.format(template, ' '.join(failures)))
+
+
+def _stage_vm(ova_file, machine_name, template, owner, vm_kind, logger, files=None):
+    with SLOTS.slot('import', logger) as grant, borrow() as vcenter:
+        ova = open_ova(ova_file, files=files)
+        grant.nbytes = _ova_size(ova)
         try:
-            net_map = _get_network_mapping(vcenter, ova, vm_kind, username)
+            net_map = _get_network_mapping(vcenter, ova, vm_kind, owner)
             the_vm = virtual_machine.deploy_from_ova(vcenter=vcenter,
                                                      ova=ova,
                                                      network_map=net_map,
-                                                     username=username,
-                                                     machine_name=machine_name,
-                                                     logger=logger)
+                                                     username=const.VLAB_STAGING_FOLDER,
+                                                     machine_name=staging.staged_name(machine_name),
+                                                     logger=logger,
+                                                     power_on=False)
         finally:
             ova.close()
+        # Taken before the snapshot, so clones have change tracking on too
+        lineage.track_changes(the_vm)
+        virtual_machine.set_meta(the_vm, staging.stage_meta(template, machine_name, vm_kind))
+        staging.snapshot(the_vm)
 
-        meta_data = {'component' : template,
-                     'created' : time.time(),
-                     'deployment': True,
-                     'version' : 'n/a',
-                     'configured' : True,
-                     'generation' : 1}
-        virtual_machine.set_meta(the_vm, meta_data)
-        if vm_kind.lower() == 'onefs':
-            info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=False)
-        else:
-            info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
-        return {the_vm.name: info}
+
+def unstage_template(template, logger):
+    """Destroy the staged VMs of a deployment template.
+
+    :Returns: None
+
+    :Raises: ValueError if not every staged VM could be destroyed
+
+    :param template: The name of the deployment template.
+    :type template: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with borrow() as vcenter:
+        records = list(staging.get_staged(vcenter, template).values())
+        if not records:
+            return
+        errors = _teardown(vcenter, records, logger)
+    if errors:
+        details = ', '.join('{}: {}'.format(x, errors[x]) for x in sorted(errors.keys()))
+        raise ValueError('Unable to destroy staged VMs of {}. {}'.format(template, details))
 
 
 def _get_network_mapping(vcenter, ova, vm_kind, username):
@@ -257,8 +597,8 @@ def _make_onefs_network_map(ova_networks, vcenter_networks, front_end, back_end)
     return net_map
 
 
-def _make_ova(username, machine_name, template_dir, logger):
-    """Export a VM to an OVA.
+def _make_ova(username, machine_name, template_dir, logger, bandwidth=None, tracker=None):
+    """Export a VM to an OVA, or reuse the OVA it was deployed from when the VM is unchanged.
 
     :param username: The user creating a new deployment template.
     :type username: String
@@ -271,12 +611,20 @@ def _make_ova(username, machine_name, template_dir, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param bandwidth: Optionally limit the download speed; shared by every export of a template.
+    :type bandwidth: vlab_deployment_api.lib.worker.export.Bandwidth
+
+    :param tracker: Optionally, where to report the progress of the export.
+    :type tracker: vlab_deployment_api.lib.worker.progress.MachineProgress
     """
+    reused = _reuse_ova(username, machine_name, template_dir, logger)
+    if reused is not None:
+        return reused
     new_ova = ''
     kind = ''
     error = ''
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+    with SLOTS.slot('export', logger) as grant, borrow() as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
         for vm in folder.childEntity:
             if vm.name == machine_name:
@@ -285,8 +633,56 @@ def _make_ova(username, machine_name, template_dir, logger):
                 info = virtual_machine.get_info(vcenter, vm, username)
                 kind = info['meta']['component']
                 ova_name = vm.name.replace(VM_NAME_APPEND, '')
-                new_ova = virtual_machine.make_ova(vcenter, vm, template_dir, logger, ova_name=ova_name)
+                new_ova = export.make_ova(vcenter, vm, template_dir, logger, ova_name=ova_name,
+                                          bandwidth=bandwidth, tracker=tracker)
+                grant.nbytes = os.path.getsize(new_ova)
                 break
         else:
             error = 'No VM named {} found.'.format(machine_name)
     return new_ova, kind, error
+
+
+def _reuse_ova(username, machine_name, template_dir, logger):
+    """Link the OVA a VM was deployed from into a new template, if the VM hasn't changed since.
+
+    No export slot is needed; nothing is downloaded.
+
+    :Returns: Tuple (like ``_make_ova``), or None if the VM must be exported
+
+    :param username: The user creating a new deployment template.
+    :type username: String
+
+    :param machine_name: The name of the VM to include in the deployment template.
+    :type machine_name: String
+
+    :param template_dir: The folder to save the new VM OVA in.
+    :type template_dir: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with borrow() as vcenter:
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        for vm in folder.childEntity:
+            if vm.name == machine_name:
+                config = vm.config
+                break
+        else:
+            return None
+        source = lineage.reusable_ova(vm, config, const.VLAB_DEPLOYMENT_TEMPLATE_DIR)
+        if source is None:
+            return None
+        kind = ujson.loads(config.annotation)['component']
+        ova_name = machine_name.replace(VM_NAME_APPEND, '')
+        new_ova = os.path.join(template_dir, '{}{}'.format(ova_name, os.path.splitext(source)[1]))
+        try:
+            linked = lineage.link_ova(source, new_ova)
+        except OSError as doh:
+            # i.e. a chunk of the manifest was garbage collected
+            logger.warning('Unable to reuse %s for %s: %s', source, machine_name, doh)
+            return None
+        if not linked:
+            logger.info('Unable to link %s into %s, exporting %s', source, template_dir, machine_name)
+            return None
+        logger.info('VM %s is unchanged since it was deployed; reusing %s', machine_name, source)
+        return new_ova, kind, ''
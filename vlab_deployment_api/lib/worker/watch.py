@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+"""
+Wait on many vCenter tasks at once.
+
+``consume_task`` polls a single task once a second, so waiting on N tasks in a
+row costs (at least) N round trips a second, and a task that finishes early
+isn't noticed until every task before it is done. ``TaskWatcher`` registers
+every task with a private PropertyCollector and blocks in ``WaitForUpdatesEx``;
+vCenter answers as soon as *any* task changes state.
+"""
+import time
+
+from pyVmomi import vim, vmodl
+
+# How long a single WaitForUpdatesEx call blocks; keeps the timeout responsive
+MAX_WAIT_SECONDS = 30
+TASK_PROPERTIES = ['info.state', 'info.error']
+DONE_STATES = ('success', 'error')
+
+
+class TaskWatcher(object):
+    """Runs a callback for each task as it finishes.
+
+    A callback can watch more tasks (i.e. destroy a VM once it's powered off),
+    and ``wait`` will block on those too. Use as a context manager, so the
+    PropertyCollector is destroyed when you're done.
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    def __init__(self, vcenter):
+        self._collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+        self._watched = {}
+        self._version = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, the_traceback):
+        self.close()
+
+    def watch(self, task, callback):
+        """Call ``callback(task, error)`` once the task finishes. The error is
+        None when the task was successful, otherwise it's a ``vmodl.MethodFault``.
+
+        :Returns: None
+
+        :param task: The task to wait on
+        :type task: vim.Task
+
+        :param callback: What to do once the task is done
+        :type callback: Function
+        """
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        # A finished task never changes again, so its filter is left for
+        # ``close`` to clean up instead of costing another round trip.
+        self._collector.CreateFilter(filter_spec, partialUpdates=True)
+        self._watched[task._moId] = {'task': task, 'callback': callback, 'state': None, 'error': None}
+
+    @property
+    def pending(self):
+        """How many tasks have yet to finish"""
+        return len(self._watched)
+
+    def wait(self, timeout=600):
+        """Block until every watched task has finished, and every callback has ran.
+
+        :Returns: None
+
+        :Raises: RuntimeError if the tasks don't finish in time
+
+        :param timeout: How many seconds to wait for all tasks to complete
+        :type timeout: Integer
+        """
+        deadline = time.time() + timeout
+        while self._watched:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                msg = 'Timeout of {} seconds exceeded for tasks {}'.format(timeout, sorted(self._watched.keys()))
+                raise RuntimeError(msg)
+            max_wait = max(1, min(int(remaining), MAX_WAIT_SECONDS))
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait)
+            update = self._collector.WaitForUpdatesEx(self._version, options)
+            if update is None:
+                # maxWaitSeconds passed without any change
+                continue
+            self._version = update.version
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    self._handle(obj_update)
+
+    def close(self):
+        """Stop watching; destroys the PropertyCollector (and all its filters)
+
+        :Returns: None
+        """
+        self._watched = {}
+        try:
+            self._collector.DestroyPropertyCollector()
+        except vmodl.MethodFault:
+            # the session is already gone, and so is the collector
+            pass
+
+    def _handle(self, obj_update):
+        """Record the changes to a task, and run its callback if it's finished"""
+        watched = self._watched.get(obj_update.obj._moId)
+        if watched is None:
+            return
+        for change in obj_update.changeSet:
+            if change.name == 'info.state':
+                watched['state'] = change.val
+            elif change.name == 'info.error':
+                watched['error'] = change.val
+        if watched['state'] in DONE_STATES:
+            self._watched.pop(obj_update.obj._moId)
+            error = watched['error'] if watched['state'] == 'error' else None
+            watched['callback'](watched['task'], error)